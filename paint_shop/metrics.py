@@ -1,97 +1,176 @@
 """
 Система метрик Prometheus для приложения Жевжик
-Метрики сохраняются в БД для персистентности после перезапуска
+
+Используется, когда prometheus_client не установлен. Счётчики, gauge и гистограммы
+(по фиксированным корзинам) накапливаются в памяти процесса и раз в
+METRICS_FLUSH_INTERVAL секунд пакетно сбрасываются в агрегаты MetricRollup —
+по одной строке на метрику и набор меток. Экспорт читает только агрегаты,
+поэтому его стоимость не растёт вместе с историей запросов.
 """
-from django.db import models
-from django.utils import timezone
-from django.db.models import Sum, Count, Avg, Max
-from decimal import Decimal
-from django.utils import timezone
-from collections import defaultdict
+import hashlib
+import json
+import logging
 import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Sum, Count, Avg
+from django.utils import timezone
 
-# Глобальные счетчики метрик (в памяти)
-_metrics_storage = defaultdict(lambda: {
-    'counter': 0,
-    'histogram': [],
-    'gauge': 0
-})
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин гистограмм (секунды), последняя корзина — +Inf
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 15)
+
+# Накопленные с последнего сброса значения: (тип, имя, хеш меток) -> запись
+_metrics_storage = {}
 _metrics_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _labels_key(labels):
+    """Стабильный хеш набора меток"""
+    encoded = json.dumps(labels, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
 
-# Импортируем модель Metric из paint_shop_project
-try:
-    from paint_shop_project.models import Metric
-except ImportError:
-    # Fallback если модель еще не создана
-    class Metric(models.Model):
-        name = models.CharField(max_length=255, db_index=True)
-        value = models.FloatField()
-        labels = models.JSONField(default=dict, blank=True)
-        metric_type = models.CharField(max_length=20, choices=[
-            ('counter', 'Counter'),
-            ('gauge', 'Gauge'),
-            ('histogram', 'Histogram'),
-        ], default='counter')
-        timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
-        
-        class Meta:
-            db_table = 'metrics'
-            indexes = [
-                models.Index(fields=['name', 'timestamp']),
-            ]
-            ordering = ['-timestamp']
+
+def _entry(metric_type, name, labels):
+    """Запись накопителя для серии; вызывается под _metrics_lock"""
+    labels = {str(k): str(v) for k, v in (labels or {}).items()}
+    key = (metric_type, name, _labels_key(labels))
+    entry = _metrics_storage.get(key)
+    if entry is None:
+        entry = {'labels': labels, 'value': 0.0, 'count': 0, 'sum': 0.0}
+        if metric_type == 'histogram':
+            entry['buckets'] = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        _metrics_storage[key] = entry
+    return entry
 
 
 def increment_counter(name, value=1, labels=None):
     """Увеличить счетчик метрики"""
-    labels = labels or {}
     with _metrics_lock:
-        key = f"{name}:{hash(frozenset(labels.items()))}"
-        _metrics_storage[key]['counter'] += value
-    
-    # Сохраняем в БД
-    Metric.objects.create(
-        name=name,
-        value=value,
-        labels=labels,
-        metric_type='counter'
-    )
+        _entry('counter', name, labels)['value'] += value
+    _maybe_flush()
 
 
 def set_gauge(name, value, labels=None):
     """Установить значение gauge метрики"""
-    labels = labels or {}
     with _metrics_lock:
-        key = f"{name}:{hash(frozenset(labels.items()))}"
-        _metrics_storage[key]['gauge'] = value
-    
-    # Сохраняем в БД
-    Metric.objects.create(
-        name=name,
-        value=value,
-        labels=labels,
-        metric_type='gauge'
-    )
+        _entry('gauge', name, labels)['value'] = _format_metric_value(value)
+    _maybe_flush()
 
 
 def observe_histogram(name, value, labels=None):
     """Наблюдать значение для гистограммы"""
-    labels = labels or {}
+    value = _format_metric_value(value)
     with _metrics_lock:
-        key = f"{name}:{hash(frozenset(labels.items()))}"
-        if 'histogram' not in _metrics_storage[key]:
-            _metrics_storage[key]['histogram'] = []
-        _metrics_storage[key]['histogram'].append(value)
-    
-    # Сохраняем в БД
-    Metric.objects.create(
-        name=name,
-        value=value,
-        labels=labels,
-        metric_type='histogram'
-    )
+        entry = _entry('histogram', name, labels)
+        entry['buckets'][bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        entry['count'] += 1
+        entry['sum'] += value
+    _maybe_flush()
+
+
+# ==================== СБРОС В АГРЕГАТЫ ====================
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush_metrics()
+
+
+def _merge_back(pending):
+    """Возвращает несохранённые значения в накопитель (после ошибки БД)"""
+    with _metrics_lock:
+        for key, entry in pending.items():
+            current = _metrics_storage.get(key)
+            if current is None:
+                _metrics_storage[key] = entry
+            elif key[0] == 'counter':
+                current['value'] += entry['value']
+            elif key[0] == 'histogram':
+                current['count'] += entry['count']
+                current['sum'] += entry['sum']
+                current['buckets'] = [a + b for a, b in zip(current['buckets'], entry['buckets'])]
+            # для gauge новее значение, уже лежащее в накопителе
 
 
+def _write_rollups(pending):
+    from paint_shop_project.models import MetricRollup
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Недостающие строки создаём пустыми, затем блокируем и дополняем все серии пакетом
+        MetricRollup.objects.bulk_create(
+            [
+                MetricRollup(
+                    name=name,
+                    metric_type=metric_type,
+                    labels_key=labels_key,
+                    labels=entry['labels'],
+                    buckets=[0] * len(entry['buckets']) if metric_type == 'histogram' else [],
+                )
+                for (metric_type, name, labels_key), entry in pending.items()
+            ],
+            ignore_conflicts=True,
+        )
+        rows = (
+            MetricRollup.objects.select_for_update()
+            .filter(
+                name__in={name for _, name, _ in pending},
+                labels_key__in={labels_key for _, _, labels_key in pending},
+            )
+            .order_by('id')
+        )
+        changed = []
+        for row in rows:
+            entry = pending.get((row.metric_type, row.name, row.labels_key))
+            if entry is None:
+                continue
+            if row.metric_type == 'counter':
+                row.value += entry['value']
+            elif row.metric_type == 'gauge':
+                row.value = entry['value']
+            else:
+                if len(row.buckets or []) != len(entry['buckets']):
+                    # Набор корзин изменился — начинаем гистограмму заново
+                    row.buckets, row.count, row.sum = [0] * len(entry['buckets']), 0, 0.0
+                row.buckets = [a + b for a, b in zip(row.buckets, entry['buckets'])]
+                row.count += entry['count']
+                row.sum += entry['sum']
+            row.updated_at = now
+            changed.append(row)
+        MetricRollup.objects.bulk_update(changed, ['value', 'count', 'sum', 'buckets', 'updated_at'])
+
+
+def flush_metrics():
+    """
+    Сбрасывает накопленные в памяти значения в MetricRollup.
+    Возвращает число обновлённых серий.
+    """
+    global _metrics_storage, _last_flush
+    with _metrics_lock:
+        pending = _metrics_storage
+        _metrics_storage = {}
+        _last_flush = time.monotonic()
+    if not pending:
+        return 0
+
+    try:
+        _write_rollups(pending)
+    except DatabaseError:
+        logger.exception("Failed to flush %s metric series", len(pending))
+        _merge_back(pending)
+        return 0
+    return len(pending)
+
+
+# ==================== ЭКСПОРТ ====================
+
 def format_labels(labels):
     """Форматировать метки для Prometheus"""
     if not labels:
@@ -134,77 +213,32 @@ def _format_metric_value(value):
 
 
 def generate_prometheus_metrics():
-    """Генерировать метрики в формате Prometheus из БД"""
-    import json
+    """Генерировать метрики в формате Prometheus из агрегатов MetricRollup"""
+    from paint_shop_project.models import MetricRollup
+
+    # Значения текущего процесса должны попасть в выдачу сразу, не дожидаясь интервала
+    flush_metrics()
+
     output = []
-    
-    # Counter метрики (суммируем все значения)
-    # Группируем вручную, так как JSONField может некорректно группироваться
-    counter_groups = {}
-    for metric in Metric.objects.filter(metric_type='counter'):
-        name = metric.name
-        labels = metric.labels or {}
-        # Создаем ключ для группировки
-        labels_key = json.dumps(labels, sort_keys=True)
-        key = (name, labels_key)
-        
-        if key not in counter_groups:
-            counter_groups[key] = {'name': name, 'labels': labels, 'total': 0}
-        counter_groups[key]['total'] += _format_metric_value(metric.value)
-    
-    for group in counter_groups.values():
-        if _is_valid_number(group['total']):
-            output.append(f"{group['name']}{format_labels(group['labels'])} {group['total']}")
-    
-    # Gauge метрики (берем последнее значение)
-    gauge_groups = {}
-    for metric in Metric.objects.filter(metric_type='gauge').order_by('-timestamp'):
-        name = metric.name
-        labels = metric.labels or {}
-        labels_key = json.dumps(labels, sort_keys=True)
-        key = (name, labels_key)
-        
-        # Берем только самое последнее значение для каждой группы
-        if key not in gauge_groups or metric.timestamp > gauge_groups[key]['timestamp']:
-            gauge_groups[key] = {
-                'name': name,
-                'labels': labels,
-                'value': metric.value,
-                'timestamp': metric.timestamp
-            }
-    
-    for group in gauge_groups.values():
-        formatted_value = _format_metric_value(group['value'])
-        if _is_valid_number(formatted_value):
-            output.append(f"{group['name']}{format_labels(group['labels'])} {formatted_value}")
-    
-    # Histogram метрики (статистика)
-    histogram_groups = {}
-    for metric in Metric.objects.filter(metric_type='histogram'):
-        name = metric.name
-        labels = metric.labels or {}
-        labels_key = json.dumps(labels, sort_keys=True)
-        key = (name, labels_key)
-        
-        if key not in histogram_groups:
-            histogram_groups[key] = {
-                'name': name,
-                'labels': labels,
-                'values': []
-            }
-        histogram_groups[key]['values'].append(_format_metric_value(metric.value))
-    
-    for group in histogram_groups.values():
-        values = [v for v in group['values'] if _is_valid_number(v)]
-        if values:
-            count = len(values)
-            sum_val = sum(values)
-            avg_val = sum_val / count if count > 0 else 0
-            
-            output.append(f"{group['name']}_count{format_labels(group['labels'])} {count}")
-            output.append(f"{group['name']}_sum{format_labels(group['labels'])} {sum_val}")
-            output.append(f"{group['name']}_avg{format_labels(group['labels'])} {avg_val}")
-    
+    for rollup in MetricRollup.objects.order_by('metric_type', 'name', 'labels_key'):
+        name = rollup.name
+        labels = rollup.labels or {}
+        if rollup.metric_type in ('counter', 'gauge'):
+            output.append(f"{name}{format_labels(labels)} {_format_metric_value(rollup.value)}")
+            continue
+        if not rollup.count:
+            continue
+
+        cumulative = 0
+        bounds = [str(bound) for bound in HISTOGRAM_BUCKETS] + ['+Inf']
+        for bound, bucket_count in zip(bounds, rollup.buckets or []):
+            cumulative += bucket_count
+            output.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}")
+        sum_val = _format_metric_value(rollup.sum)
+        output.append(f"{name}_count{format_labels(labels)} {rollup.count}")
+        output.append(f"{name}_sum{format_labels(labels)} {sum_val}")
+        output.append(f"{name}_avg{format_labels(labels)} {sum_val / rollup.count}")
+
     return "\n".join(output) if output else ""
 
 
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "paint_shop_project",
     'django_prometheus',
     # REST API
@@ -50,10 +51,9 @@ INSTALLED_APPS = [
     'drf_yasg',
     'corsheaders',
     'django_filters',
-    # Celery (опционально, если установлены пакеты)
-    # Раскомментируйте, если установлены celery, django-celery-beat, django-celery-results
-    # 'django_celery_beat',
-    # 'django_celery_results',
+    # Celery: расписание beat (DatabaseScheduler) и результаты задач (django-db) хранятся в БД
+    'django_celery_beat',
+    'django_celery_results',
 ]
 
 MIDDLEWARE = [
@@ -64,6 +64,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "paint_shop_project.db_routing.ReplicaPinMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "paint_shop_project.middleware.SuppressSuccessMessagesMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
@@ -104,6 +105,54 @@ DATABASES = {
     )
 }
 
+# Реплика только для чтения: дашборды, RFM, отчеты и бизнес-метрики читают с нее,
+# если представление явно это разрешает (см. paint_shop_project/db_routing.py).
+# Без REPLICA_DATABASE_URL все запросы идут в default.
+REPLICA_DATABASE_URL = config('REPLICA_DATABASE_URL', default='')
+if REPLICA_DATABASE_URL:
+    DATABASES["replica"] = dj_database_url.parse(
+        REPLICA_DATABASE_URL,
+        conn_max_age=600,
+        conn_health_checks=True,
+    )
+    # В тестах реплика — то же соединение, что и default
+    DATABASES["replica"]["TEST"] = {"MIRROR": "default"}
+
+DATABASE_ROUTERS = ['paint_shop_project.db_routing.ReplicaRouter']
+# Отставание, после которого чтения возвращаются на primary, и период его проверки
+REPLICA_MAX_LAG_SECONDS = config('REPLICA_MAX_LAG_SECONDS', default=10, cast=int)
+REPLICA_LAG_CHECK_INTERVAL = config('REPLICA_LAG_CHECK_INTERVAL', default=5, cast=int)
+# Сколько секунд после своей записи клиент читает только с primary
+REPLICA_STICKY_SECONDS = config('REPLICA_STICKY_SECONDS', default=15, cast=int)
+
+# Кеш
+# При заданном REDIS_URL используется Redis, иначе — общая таблица кеша в БД
+# (создаётся командой `python manage.py createcachetable`)
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+            "KEY_PREFIX": "zhevzhik",
+            "TIMEOUT": 300,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "django_cache",
+            "KEY_PREFIX": "zhevzhik",
+            "TIMEOUT": 300,
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
+
+# Кеш акций и промокодов: локальный уровень процесса (сек) и максимальный срок снимка (сек)
+PROMO_CACHE_LOCAL_TTL = 5
+PROMO_CACHE_MAX_TTL = 3600
+
 # Настройки для резервного копирования PostgreSQL
 # Автоматический поиск бинарников PostgreSQL
 try:
@@ -224,7 +273,8 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    # Пагинация по курсору (keyset) без COUNT и OFFSET, см. paint_shop_project/pagination.py
+    'DEFAULT_PAGINATION_CLASS': 'paint_shop_project.pagination.KeysetPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
@@ -303,9 +353,13 @@ LOGGING = {
 }
 
 # Celery Configuration
-# Используем локальное хранилище для результатов (для разработки)
-# В продакшене используйте Redis или RabbitMQ
-CELERY_BROKER_URL = 'memory://'  # Для разработки на Windows
+# Брокер: CELERY_BROKER_URL, иначе REDIS_URL. Без них — memory://, который работает
+# только внутри одного процесса: тогда задачи, запускаемые со страниц (экспорт,
+# бэкап, метрики обслуживания БД), выполняются на месте (paint_shop_project.task_queue),
+# а периодические задачи не выполняются вовсе. Воркер и планировщик — процессы
+# worker и beat из Procfile (на Railway — отдельные сервисы, см. railway.worker.json
+# и railway.beat.json).
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default=REDIS_URL or 'memory://')
 CELERY_RESULT_BACKEND = 'django-db'  # Сохраняем результаты в БД
 CELERY_RESULT_EXTENDED = True
 CELERY_ACCEPT_CONTENT = ['json']
@@ -327,22 +381,109 @@ BACKUP_ENABLE_NOTIFICATIONS = True  # Включить уведомления п
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', None)  # Установите токен через переменную окружения
 TELEGRAM_ENABLE_NOTIFICATIONS = True  # Включить Telegram уведомления
 
-# Celery Configuration
-# Используем локальное хранилище для результатов (для разработки)
-# В продакшене используйте Redis или RabbitMQ
-CELERY_BROKER_URL = 'memory://'  # Для разработки на Windows
-CELERY_RESULT_BACKEND = 'django-db'  # Сохраняем результаты в БД
-CELERY_RESULT_EXTENDED = True
-CELERY_ACCEPT_CONTENT = ['json']
-CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TIMEZONE = TIME_ZONE
-CELERY_ENABLE_UTC = True
+# Формат резервных копий: "custom" — один файл pg_dump -Fc,
+# "directory" — параллельная выгрузка pg_dump -Fd в BACKUP_JOBS потоков, упакованная в .tar
+BACKUP_ENGINE = os.environ.get('BACKUP_ENGINE', 'custom')
+BACKUP_JOBS = int(os.environ.get('BACKUP_JOBS', 4))
+BACKUP_COMPRESSION_LEVEL = int(os.environ.get('BACKUP_COMPRESSION_LEVEL', 6))  # 0–9, pg_dump --compress
+RESTORE_JOBS = int(os.environ.get('RESTORE_JOBS', 4))  # pg_restore --jobs
+
+# Сроки хранения резервных копий по классам (дни); класс без срока (manual) хранится бессрочно
+BACKUP_RETENTION_DAYS = {
+    'daily': 7,
+    'weekly': 35,
+    'monthly': 365,
+    'pre_restore': 14,
+}
 
-# Планировщик задач
-CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+# Метрики без prometheus_client: как часто сбрасывать накопленные в памяти значения в БД (секунды)
+METRICS_FLUSH_INTERVAL = 15
 
-# Настройки для автоматических бэкапов
-BACKUP_SCHEDULE_HOUR = 2  # 2 часа ночи
-BACKUP_SCHEDULE_MINUTE = 0
-BACKUP_ENABLE_NOTIFICATIONS = True  # Включить уведомления по email
+# Максимум различных наборов меток HTTP-метрик в процессе; сверх него path="overflow"
+METRICS_MAX_LABEL_SETS = 1000
+
+# Интервал пересчёта бизнес-метрик Prometheus (секунды)
+BUSINESS_METRICS_INTERVAL = 60
+
+# Срок хранения файлов фонового экспорта отчетов (часы)
+EXPORT_JOB_TTL_HOURS = 24
+
+# Сколько минут готовый отчет отдается повторным одинаковым запросам вместо нового расчета
+EXPORT_JOB_REUSE_MINUTES = 5
+
+# Через сколько минут задание экспорта в очереди или в работе считается зависшим
+EXPORT_JOB_STALE_MINUTES = 15
+
+# Пороги RFM-баллов 5/4/3/2 (ниже последнего — 1), см. paint_shop_project/rfm_snapshot.py
+RFM_THRESHOLDS = {
+    'recency_days': (30, 60, 90, 180),  # дней с последнего заказа, не больше
+    'frequency': (10, 5, 3, 2),  # заказов, не меньше
+    'monetary': (50000, 20000, 10000, 5000),  # сумма доставленных заказов, не меньше
+}
+
+# Сколько секунд метрики дашборда склада берутся из общего кэша
+WAREHOUSE_DASHBOARD_CACHE_SECONDS = 60
+
+# Сколько секунд панель менеджера магазина отдается из снимка в кэше (свой на каждого менеджера)
+MANAGER_DASHBOARD_CACHE_SECONDS = 30
+
+# Сколько просроченных партий списывается одним UPDATE (одной транзакцией)
+SPOILAGE_CHUNK_SIZE = 500
+
+# Периоды (дни), для которых графики PDF-дашборда рисуются заранее
+DASHBOARD_PDF_PREWARM_PERIODS = [30]
+
+# Как часто пересчитывать снимок метрик страницы обслуживания БД (секунды)
+DB_MAINTENANCE_METRICS_INTERVAL = 300
+
+# Периодические задачи Celery
+from celery.schedules import crontab  # noqa: E402
+
+CELERY_BEAT_SCHEDULE = {
+    # Списание партий, срок годности которых истек накануне
+    'spoil-expired-batches': {
+        'task': 'spoil_expired_batches',
+        'schedule': crontab(hour=0, minute=1),
+    },
+    'refresh-sellable-stock': {
+        'task': 'refresh_sellable_stock',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    'rebuild-recent-sales-rollups': {
+        'task': 'rebuild_recent_sales_rollups',
+        'schedule': crontab(hour=0, minute=15),
+    },
+    'rebuild-rfm-snapshot': {
+        'task': 'rebuild_rfm_snapshot',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    'collect-business-metrics': {
+        'task': 'collect_business_metrics',
+        'schedule': float(BUSINESS_METRICS_INTERVAL),
+    },
+    'cleanup-expired-exports': {
+        'task': 'cleanup_expired_exports',
+        'schedule': crontab(minute=30),
+    },
+    'render-dashboard-charts': {
+        'task': 'render_dashboard_charts',
+        'schedule': crontab(minute=40),
+    },
+    # Задача сама решает, пора ли делать бэкап (BACKUP_AUTO_INTERVAL_HOURS)
+    'create-scheduled-backup': {
+        'task': 'create_scheduled_backup',
+        'schedule': crontab(minute=BACKUP_SCHEDULE_MINUTE),
+    },
+    'refresh-maintenance-metrics': {
+        'task': 'refresh_maintenance_metrics',
+        'schedule': float(DB_MAINTENANCE_METRICS_INTERVAL),
+    },
+    'reconcile-backup-catalog': {
+        'task': 'reconcile_backup_catalog',
+        'schedule': crontab(hour=3, minute=30),
+    },
+    'cleanup-old-backups': {
+        'task': 'cleanup_old_backups',
+        'schedule': crontab(hour=4, minute=0),
+    },
+}
@@ -11,6 +11,8 @@ try:
         NotificationsCenterView,
         notifications_api,
         ExportReportsView,
+        export_job_status,
+        export_job_download,
         SlowQueriesView,
         RFMAnalysisView,
         BulkOperationsView,
@@ -26,6 +28,8 @@ except ImportError:
     NotificationsCenterView = None
     notifications_api = None
     ExportReportsView = None
+    export_job_status = None
+    export_job_download = None
     SlowQueriesView = None
     RFMAnalysisView = None
     BulkOperationsView = None
@@ -448,6 +452,22 @@ class MetricAdmin(admin.ModelAdmin):
         return super().get_queryset(request)
 
 
+@admin.register(MetricRollup)
+class MetricRollupAdmin(admin.ModelAdmin):
+    list_display = ['name', 'metric_type', 'value', 'count', 'labels_display', 'updated_at']
+    list_filter = ['metric_type', 'name']
+    search_fields = ['name']
+    readonly_fields = ['name', 'metric_type', 'labels_key', 'labels', 'value', 'count', 'sum', 'buckets', 'updated_at']
+    list_per_page = 50
+
+    def labels_display(self, obj):
+        """Отображает метки в читаемом виде"""
+        if obj.labels:
+            return ", ".join([f"{k}={v}" for k, v in obj.labels.items()])
+        return "—"
+    labels_display.short_description = "Метки"
+
+
 @admin.register(ErrorLog)
 class ErrorLogAdmin(admin.ModelAdmin):
     list_display = ['error_type', 'message_short', 'user', 'product', 'is_resolved', 'created_at']
@@ -623,12 +643,32 @@ class FavoriteCategoryAdmin(admin.ModelAdmin):
 
 @admin.register(CashbackTransaction)
 class CashbackTransactionAdmin(admin.ModelAdmin):
-    list_display = ['user', 'order', 'amount', 'transaction_type', 'description', 'created_at']
+    """Журнал кешбэка пишет только cashback_ledger: правка записи разошлась бы с балансом"""
+    list_display = ['user', 'order', 'amount', 'transaction_type', 'balance_after', 'description', 'created_at']
     list_filter = ['transaction_type', 'created_at']
     search_fields = ['user__username', 'description']
-    readonly_fields = ['created_at']
+    readonly_fields = ['balance_after', 'created_at']
     ordering = ['-created_at']
 
+    def has_add_permission(self, request):
+        """Запрещаем ручное создание операций"""
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        """Запрещаем редактирование операций"""
+        return False
+
+@admin.register(CashbackBalance)
+class CashbackBalanceAdmin(admin.ModelAdmin):
+    """Балансы меняет только cashback_ledger; исправление — manage.py reconcile_cashback_balances --fix"""
+    list_display = ['user', 'balance', 'total_earned', 'total_spent', 'total_expired', 'updated_at']
+    search_fields = ['user__username']
+    readonly_fields = ['user', 'balance', 'total_earned', 'total_spent', 'total_expired', 'updated_at']
+    ordering = ['-balance']
+
+    def has_add_permission(self, request):
+        return False
+
 @admin.register(SupportTicket)
 class SupportTicketAdmin(admin.ModelAdmin):
     list_display = ['user', 'subject', 'status', 'priority', 'category', 'created_at']
@@ -663,10 +703,16 @@ class UserSpecialSectionAdmin(admin.ModelAdmin):
 
 @admin.register(DatabaseBackup)
 class DatabaseBackupAdmin(admin.ModelAdmin):
-    list_display = ['operation', 'status', 'file_size_display', 'started_at', 'completed_at', 'duration_display']
-    list_filter = ['operation', 'status', 'started_at']
-    search_fields = ['file_path', 'comment', 'error_message']
-    readonly_fields = ['started_at', 'completed_at', 'duration_display', 'file_size_display']
+    list_display = [
+        'operation', 'status', 'backup_format', 'file_size_display', 'started_at', 'completed_at',
+        'duration_display', 'throughput_mb_s',
+    ]
+    list_filter = ['operation', 'status', 'backup_format', 'started_at']
+    search_fields = ['file_path', 'comment', 'error_message', 'checksum']
+    readonly_fields = [
+        'started_at', 'completed_at', 'duration_display', 'file_size_display', 'backup_format', 'checksum',
+        'duration_seconds', 'throughput_mb_s',
+    ]
     ordering = ['-started_at']
     date_hierarchy = 'started_at'
     
@@ -675,13 +721,13 @@ class DatabaseBackupAdmin(admin.ModelAdmin):
             'fields': ('operation', 'status')
         }),
         ('Файл', {
-            'fields': ('file_path', 'file_size', 'file_size_display')
+            'fields': ('file_path', 'backup_format', 'file_size', 'file_size_display', 'checksum')
         }),
         ('Информация', {
             'fields': ('comment', 'error_message')
         }),
         ('Временные метки', {
-            'fields': ('started_at', 'completed_at', 'duration_display'),
+            'fields': ('started_at', 'completed_at', 'duration_display', 'duration_seconds', 'throughput_mb_s'),
             'classes': ('collapse',)
         }),
     )
@@ -712,6 +758,36 @@ class DatabaseBackupAdmin(admin.ModelAdmin):
     duration_display.short_description = "Длительность"
 
 
+@admin.register(BackupFile)
+class BackupFileAdmin(admin.ModelAdmin):
+    list_display = ['file_path', 'retention_class', 'label', 'file_size', 'created_at']
+    list_filter = ['retention_class', 'label', 'created_at']
+    search_fields = ['file_path', 'checksum']
+    readonly_fields = ['file_path', 'file_size', 'checksum', 'label', 'retention_class', 'backup', 'created_at']
+    ordering = ['-created_at']
+    date_hierarchy = 'created_at'
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'report_type', 'status', 'progress', 'filename', 'requested_by', 'created_at', 'expires_at']
+    list_filter = ['status', 'report_type', 'created_at']
+    search_fields = ['filename', 'requested_by__username', 'error_message']
+    readonly_fields = [
+        'report_type', 'params', 'params_hash', 'status', 'progress', 'requested_by', 'file_path',
+        'filename', 'content_type', 'file_size', 'error_message', 'created_at', 'started_at',
+        'finished_at', 'expires_at',
+    ]
+    ordering = ['-created_at']
+    date_hierarchy = 'created_at'
+
+    def has_add_permission(self, request):
+        return False
+
+
 # --- Дополнительные URL административной панели ---
 original_admin_get_urls = admin.site.get_urls
 
@@ -758,13 +834,23 @@ def get_custom_admin_urls():
         ])
     
     if ExportReportsView:
-        custom_urls.append(
+        custom_urls.extend([
             path(
                 "export-reports/",
                 admin.site.admin_view(ExportReportsView.as_view()),
                 name="export-reports",
             ),
-        )
+            path(
+                "export-reports/jobs/<int:pk>/",
+                admin.site.admin_view(export_job_status),
+                name="export-job-status",
+            ),
+            path(
+                "export-reports/jobs/<int:pk>/download/",
+                admin.site.admin_view(export_job_download),
+                name="export-job-download",
+            ),
+        ])
     
     if SlowQueriesView:
         custom_urls.append(
@@ -74,10 +74,10 @@ class DatabaseRestoreUploadForm(forms.Form):
 
     backup_file = forms.FileField(
         label="Файл резервной копии",
-        help_text="Поддерживаются файлы, созданные pg_dump (.dump, .sql).",
+        help_text="Поддерживаются файлы, созданные pg_dump (.dump, .sql), и архивы параллельных копий (.tar).",
         widget=forms.ClearableFileInput(attrs={
             "class": "vClearableFileInput",
-            "accept": ".dump,.sql,.backup",
+            "accept": ".dump,.sql,.backup,.tar",
         }),
     )
     confirm = forms.BooleanField(
@@ -19,9 +19,11 @@ except ImportError:
     notifications_api = None
 
 try:
-    from .exports import ExportReportsView
+    from .exports import ExportReportsView, export_job_download, export_job_status
 except ImportError:
     ExportReportsView = None
+    export_job_download = None
+    export_job_status = None
 
 try:
     from .performance import SlowQueriesView
@@ -59,6 +61,8 @@ __all__ = [
     'NotificationsCenterView',
     'notifications_api',
     'ExportReportsView',
+    'export_job_status',
+    'export_job_download',
     'SlowQueriesView',
     'RFMAnalysisView',
     'BulkOperationsView',
@@ -7,8 +7,7 @@ from decimal import Decimal
 from typing import Dict, List
 
 from django.contrib.auth.decorators import user_passes_test
-from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum
-from django.db.models.functions import TruncDay, TruncMonth
+from django.db.models import Count
 from django.http import JsonResponse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
@@ -17,7 +16,9 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.views.generic import TemplateView
 
-from ..models import Order, OrderItem, Product, User
+from ..db_routing import replica_reads
+from ..models import Order, User
+from ..sales_rollups import daily_sales, monthly_sales, period_start, product_sales, sales_totals
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,7 @@ def is_staff(user):
 
 
 @method_decorator(user_passes_test(is_staff), name='dispatch')
+@method_decorator(replica_reads, name='dispatch')
 class DashboardView(TemplateView):
     """Дашборд с графиками продаж и аналитикой"""
     template_name = 'admin/dashboard.html'
@@ -37,29 +39,21 @@ class DashboardView(TemplateView):
         
         now = timezone.now()
         last_30_days = now - timedelta(days=30)
-        last_7_days = now - timedelta(days=7)
         
-        # Общая статистика
-        all_orders = Order.objects.all()
-        delivered_orders = all_orders.filter(status='delivered')
+        # Продажи — из дневных агрегатов, а не из Order/OrderItem
+        totals = sales_totals()
+        totals_30 = sales_totals(period_start(30))
+        totals_7 = sales_totals(period_start(7))
         
         # Выручка
-        total_revenue = delivered_orders.aggregate(
-            total=Sum('total_amount')
-        )['total'] or Decimal('0')
-        
-        revenue_last_30 = delivered_orders.filter(
-            order_date__gte=last_30_days
-        ).aggregate(total=Sum('total_amount'))['total'] or Decimal('0')
-        
-        revenue_last_7 = delivered_orders.filter(
-            order_date__gte=last_7_days
-        ).aggregate(total=Sum('total_amount'))['total'] or Decimal('0')
+        total_revenue = totals['delivered_revenue']
+        revenue_last_30 = totals_30['delivered_revenue']
+        revenue_last_7 = totals_7['delivered_revenue']
         
         # Заказы
-        orders_total = all_orders.count()
-        orders_last_30 = all_orders.filter(order_date__gte=last_30_days).count()
-        orders_last_7 = all_orders.filter(order_date__gte=last_7_days).count()
+        orders_total = totals['orders_count']
+        orders_last_30 = totals_30['orders_count']
+        orders_last_7 = totals_7['orders_count']
         
         # Клиенты
         total_customers = User.objects.filter(is_staff=False).count()
@@ -70,46 +64,25 @@ class DashboardView(TemplateView):
         
         # Средний чек
         avg_order_value = (
-            total_revenue / delivered_orders.count()
-            if delivered_orders.count() > 0
+            total_revenue / totals['delivered_orders']
+            if totals['delivered_orders'] > 0
             else Decimal('0')
         )
         
         # Топ товары
-        revenue_expr = ExpressionWrapper(
-            F('quantity') * F('price_per_unit'),
-            output_field=DecimalField(max_digits=16, decimal_places=2)
-        )
-        
         top_products = list(
-            OrderItem.objects.filter(order__status='delivered')
-            .values('product__name', 'product__id')
-            .annotate(
-                revenue=Sum(revenue_expr),
-                quantity=Sum('quantity'),
-                orders=Count('order', distinct=True)
-            )
-            .order_by('-revenue')[:10]
+            product_sales().values('product__name', 'product__id', 'revenue', 'quantity', 'orders')[:10]
         )
         
         # Статистика по статусам
         orders_by_status = list(
-            all_orders.values('status')
+            Order.objects.values('status')
             .annotate(count=Count('id'))
             .order_by('-count')
         )
         
         # Данные для графиков (последние 30 дней)
-        daily_data = list(
-            delivered_orders.filter(order_date__gte=last_30_days)
-            .annotate(day=TruncDay('order_date'))
-            .values('day')
-            .annotate(
-                revenue=Sum('total_amount'),
-                orders=Count('id')
-            )
-            .order_by('day')
-        )
+        daily_data = list(daily_sales(period_start(30)))
         
         context.update({
             'title': _('Дашборд аналитики'),
@@ -133,6 +106,7 @@ class DashboardView(TemplateView):
 @csrf_exempt
 @require_http_methods(["GET"])
 @user_passes_test(is_staff)
+@replica_reads
 def dashboard_api(request):
     """API endpoint для получения данных для графиков"""
     logger.info("Dashboard API called by user=%s, period=%s", request.user.username, request.GET.get('period'))
@@ -152,20 +126,8 @@ def dashboard_api(request):
     
     # Данные по дням
     try:
-        daily_data = (
-            Order.objects.filter(
-                order_date__gte=start_date,
-                status='delivered'
-            )
-            .annotate(day=TruncDay('order_date'))
-            .values('day')
-            .annotate(
-                revenue=Sum('total_amount'),
-                orders=Count('id')
-            )
-            .order_by('day')
-        )
-        logger.info("Daily data query returned %d items", len(list(daily_data)))
+        daily_data = list(daily_sales(period_start(days)))
+        logger.info("Daily data query returned %d items", len(daily_data))
     except Exception as e:
         logger.error("Error querying daily data: %s", e, exc_info=True)
         daily_data = []
@@ -174,26 +136,13 @@ def dashboard_api(request):
     monthly_data = []
     if days > 90:
         try:
-            monthly_data = (
-                Order.objects.filter(
-                    order_date__gte=start_date,
-                    status='delivered'
-                )
-                .annotate(month=TruncMonth('order_date'))
-                .values('month')
-                .annotate(
-                    revenue=Sum('total_amount'),
-                    orders=Count('id')
-                )
-                .order_by('month')
-            )
             monthly_data = [
                 {
                     'month': item['month'].strftime('%Y-%m'),
                     'revenue': float(item['revenue'] or 0),
                     'orders': item['orders']
                 }
-                for item in monthly_data
+                for item in monthly_sales(period_start(days))
             ]
             logger.info("Monthly data processed: %d items", len(monthly_data))
         except Exception as e:
@@ -6,76 +6,101 @@ import shutil
 import subprocess
 import tempfile
 import time
-from datetime import datetime, timedelta, timezone as dt_timezone
+from contextlib import contextmanager
+from datetime import timedelta
 from decimal import Decimal
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.db import connection
-from django.db.models import Count, DecimalField, F, Sum, ExpressionWrapper
-from django.db.models.functions import TruncDay
-from django.http import FileResponse, Http404, HttpResponse
+from django.db.models import Count
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import TemplateView
 
+from .. import backup_catalog, pg_backup, sql_export
 from ..admin_forms import (
     DatabaseBackupForm,
     DatabaseRestoreExistingForm,
     DatabaseRestoreUploadForm,
 )
-from ..models import DatabaseBackup, Order, OrderItem, User
+from ..models import DatabaseBackup, Order, User
+from ..sales_rollups import category_sales, daily_sales, period_start, product_sales, sales_totals
+from ..task_queue import broker_configured, enqueue
 
 logger = logging.getLogger(__name__)
 
 
 BACKUP_DIR_NAME = "backups"
-ALLOWED_BACKUP_EXTENSIONS = {".dump", ".sql", ".backup"}
+ALLOWED_BACKUP_EXTENSIONS = {".dump", ".sql", ".backup", pg_backup.ARCHIVE_SUFFIX}
 AUTO_BACKUP_INTERVAL_HOURS = getattr(settings, "BACKUP_AUTO_INTERVAL_HOURS", 24)
 
 
-def ensure_daily_backup() -> bool:
+# Запас на неточность расписания: ежечасная проверка не должна сдвигать бэкап на час каждые сутки
+AUTO_BACKUP_SLACK = timedelta(minutes=10)
+
+# Один pg_dump на кластер: ключ pg_advisory_lock в PostgreSQL, ключ кэша на других СУБД
+BACKUP_LOCK_KEY = 7316001
+BACKUP_LOCK_CACHE_KEY = "db_maintenance:backup_lock"
+BACKUP_LOCK_TIMEOUT = 6 * 60 * 60
+
+# Через сколько после срока автоматического бэкапа страница предупреждает, что его нет:
+# beat проверяет раз в час, сам pg_dump может идти долго
+BACKUP_OVERDUE_SLACK = timedelta(hours=2)
+
+METRICS_SNAPSHOT_CACHE_KEY = "db_maintenance:metrics"
+METRICS_REFRESH_LOCK_KEY = "db_maintenance:metrics_refresh"
+
+
+def backup_is_due(now=None) -> bool:
     """
-    Проверяет, выполнялся ли автоматический бэкап за последние AUTO_BACKUP_INTERVAL_HOURS
-    и при необходимости запускает его.
+    Пора ли делать автоматический бэкап: последний успешный старше
+    AUTO_BACKUP_INTERVAL_HOURS (с запасом AUTO_BACKUP_SLACK) или его нет вовсе.
     """
     if not getattr(settings, "BACKUP_AUTO_ENABLED", True):
         return False
-    
-    last_backup = DatabaseBackup.objects.filter(
+
+    last_started = DatabaseBackup.objects.filter(
         operation="backup",
         status="success"
-    ).order_by("-started_at").first()
-    
-    now = timezone.now()
-    should_run = False
-    if not last_backup:
-        should_run = True
-    else:
-        delta = now - last_backup.started_at
-        if delta >= timedelta(hours=AUTO_BACKUP_INTERVAL_HOURS):
-            should_run = True
-    
-    if not should_run:
-        return False
-    
-    try:
-        folder_name = timezone.localtime(now).strftime("auto_%Y%m%d")
-        perform_backup(
-            label="auto",
-            folder_name=folder_name,
-            comment=f"Автоматический бэкап от {timezone.localtime(now).strftime('%d.%m.%Y %H:%M')}",
-        )
-        logger.info("Automatic backup created successfully")
+    ).order_by("-started_at").values_list("started_at", flat=True).first()
+    if last_started is None:
         return True
-    except Exception as exc:  # pragma: no cover
-        logger.error("Failed to create automatic backup: %s", exc)
-        return False
+    now = now or timezone.now()
+    return now - last_started >= timedelta(hours=AUTO_BACKUP_INTERVAL_HOURS) - AUTO_BACKUP_SLACK
+
+
+@contextmanager
+def backup_lock() -> Iterator[bool]:
+    """
+    Блокировка «один бэкап на кластер», не ждет освобождения: возвращает, удалось ли ее взять.
+    В PostgreSQL это сессионный pg_advisory_lock — он снимается и при обрыве соединения
+    упавшего воркера; на других СУБД — ключ в общем кэше с таймаутом BACKUP_LOCK_TIMEOUT.
+    """
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [BACKUP_LOCK_KEY])
+            acquired = cursor.fetchone()[0]
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", [BACKUP_LOCK_KEY])
+        return
+
+    acquired = cache.add(BACKUP_LOCK_CACHE_KEY, True, timeout=BACKUP_LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(BACKUP_LOCK_CACHE_KEY)
 
 
 def _get_db_settings() -> Dict[str, str]:
@@ -175,16 +200,11 @@ def _format_timedelta(delta) -> str:
 
 
 def list_backup_files() -> List[dict]:
+    """Копии в стандартном каталоге по данным BackupFile, без обхода диска"""
     backup_root = _get_backup_root()
     files: List[dict] = []
-    file_candidates = [
-        p
-        for p in backup_root.rglob("*")
-        if p.is_file() and p.suffix.lower() in ALLOWED_BACKUP_EXTENSIONS
-    ]
-    for path in sorted(file_candidates, key=lambda p: p.stat().st_mtime, reverse=True):
-        stat = path.stat()
-        created_at = datetime.fromtimestamp(stat.st_mtime, tz=dt_timezone.utc)
+    for entry in backup_catalog.catalog_entries(backup_root):
+        path = Path(entry.file_path)
         relative_path = path.relative_to(backup_root)
         parent = relative_path.parent
         files.append(
@@ -193,21 +213,45 @@ def list_backup_files() -> List[dict]:
                 "relative_path": relative_path.as_posix(),
                 "folder": "" if parent == Path(".") else parent.as_posix(),
                 "path": path,
-                "size_bytes": stat.st_size,
-                "size_display": _format_bytes(stat.st_size),
-                "created_at": timezone.localtime(created_at),
+                "size_bytes": entry.file_size,
+                "size_display": _format_bytes(entry.file_size),
+                "created_at": timezone.localtime(entry.created_at),
+                "retention": entry.get_retention_class_display(),
+                "checksum": entry.checksum,
             }
         )
     return files
 
 
+def _pg_connection_args(db_settings: Dict[str, str]) -> List[str]:
+    args: List[str] = []
+    host = db_settings.get("HOST") or None
+    port = db_settings.get("PORT") or None
+    user = db_settings.get("USER") or None
+    if host:
+        args.extend(["--host", str(host)])
+    if port:
+        args.extend(["--port", str(port)])
+    if user:
+        args.extend(["--username", str(user)])
+    return args
+
+
 def perform_backup(
     *,
     label: str | None = None,
     destination_dir: Path | None = None,
     folder_name: str | None = None,
     comment: str | None = None,
+    backup_format: str | None = None,
 ) -> Path:
+    """
+    Создает копию через pg_dump в формате BACKUP_ENGINE (или backup_format):
+    custom — один .dump, directory — параллельная выгрузка, упакованная в .tar
+    с манифестом (см. pg_backup). Рядом пишется <файл>.sha256, в DatabaseBackup
+    сохраняются формат, контрольная сумма, длительность и скорость выгрузки.
+    """
+    backup_format = backup_format or pg_backup.backup_format()
     db_settings = _get_db_settings()
     _ensure_postgres(db_settings)
 
@@ -223,28 +267,29 @@ def perform_backup(
     backup_folder = base_dir / folder_slug / timestamp
     backup_folder.mkdir(parents=True, exist_ok=True)
 
-    filename = f"{database_name}{suffix}.dump"
-    backup_path = backup_folder / filename
+    if backup_format == pg_backup.FORMAT_DIRECTORY:
+        backup_path = backup_folder / f"{database_name}{suffix}{pg_backup.ARCHIVE_SUFFIX}"
+        # Каталог pg_dump живет только до упаковки в архив
+        dump_target = backup_folder / f"{database_name}{suffix}"
+    else:
+        backup_path = backup_folder / f"{database_name}{suffix}.dump"
+        dump_target = backup_path
 
     try:
         pg_dump_binary = resolve_pg_command("pg_dump")
     except FileNotFoundError as exc:
         raise RuntimeError(str(exc)) from exc
 
-    command: List[str] = [pg_dump_binary, "--format=custom", "--blobs"]
-
-    host = db_settings.get("HOST") or None
-    port = db_settings.get("PORT") or None
-    user = db_settings.get("USER") or None
-
-    if host:
-        command.extend(["--host", str(host)])
-    if port:
-        command.extend(["--port", str(port)])
-    if user:
-        command.extend(["--username", str(user)])
-
-    command.extend(["--file", str(backup_path), str(database_name)])
+    command: List[str] = [
+        pg_dump_binary,
+        f"--format={backup_format}",
+        "--blobs",
+        f"--compress={pg_backup.compression_level()}",
+    ]
+    if backup_format == pg_backup.FORMAT_DIRECTORY:
+        command.append(f"--jobs={pg_backup.backup_jobs()}")
+    command.extend(_pg_connection_args(db_settings))
+    command.extend(["--file", str(dump_target), str(database_name)])
 
     env = os.environ.copy()
     password = db_settings.get("PASSWORD")
@@ -259,6 +304,7 @@ def perform_backup(
             operation='backup',
             status='in_progress',
             file_path=str(backup_path),
+            backup_format=backup_format,
             comment=comment or f"Резервная копия {label or 'автоматическая'}",
         )
         backup_record.save()
@@ -276,12 +322,14 @@ def perform_backup(
                 operation='backup',
                 status='in_progress',
                 file_path=str(backup_path),
+                backup_format=backup_format,
                 comment=comment or f"Резервная копия {label or 'автоматическая'}",
             )
             backup_record.save()
         else:
             raise
     
+    started = time.monotonic()
     try:
         result = subprocess.run(
             command,
@@ -294,8 +342,7 @@ def perform_backup(
         )
 
         if result.returncode != 0:
-            if backup_path.exists():
-                backup_path.unlink(missing_ok=True)  # type: ignore[arg-type]
+            _remove_backup_files(backup_path, dump_target)
             error_output = ""
             if result.stderr:
                 error_output = result.stderr.strip()
@@ -313,18 +360,31 @@ def perform_backup(
             
             raise RuntimeError(_("pg_dump завершился с ошибкой: %s") % error_output)
 
-        # Получаем размер файла
-        file_size = backup_path.stat().st_size if backup_path.exists() else None
+        if dump_target != backup_path:
+            pg_backup.pack_directory(dump_target, backup_path)
+            shutil.rmtree(dump_target, ignore_errors=True)
+
+        file_size = backup_path.stat().st_size
+        checksum = pg_backup.write_checksum_file(backup_path)
+        duration = time.monotonic() - started
         
         # Обновляем запись в истории
         backup_record.status = 'success'
         backup_record.file_size = file_size
+        backup_record.checksum = checksum
+        backup_record.duration_seconds = round(duration, 3)
+        backup_record.throughput_mb_s = round(file_size / (1024 * 1024) / duration, 2) if duration else None
         backup_record.completed_at = timezone.now()
         backup_record.save()
+        backup_catalog.register_backup(backup_path, record=backup_record, label=label, checksum=checksum)
         
-        logger.info("Backup completed: %s", backup_path)
+        logger.info(
+            "Backup completed: %s format=%s size=%s duration=%.1fs throughput=%s MB/s",
+            backup_path, backup_format, file_size, duration, backup_record.throughput_mb_s,
+        )
         return backup_path
     except Exception as exc:
+        _remove_backup_files(backup_path, dump_target)
         # Обновляем запись в истории при любой ошибке
         backup_record.status = 'failed'
         backup_record.error_message = str(exc)
@@ -333,6 +393,14 @@ def perform_backup(
         raise
 
 
+def _remove_backup_files(backup_path: Path, dump_target: Path) -> None:
+    """Удаляет недописанную копию: файл, его .sha256 и каталог pg_dump"""
+    for path in (backup_path, pg_backup.checksum_path(backup_path)):
+        path.unlink(missing_ok=True)
+    if dump_target.is_dir():
+        shutil.rmtree(dump_target, ignore_errors=True)
+
+
 def _clean_database_before_restore(db_settings: Dict[str, str]) -> None:
     """Очищает базу данных перед восстановлением, безопасно удаляя все объекты с учетом зависимостей."""
     try:
@@ -361,13 +429,17 @@ def _clean_database_before_restore(db_settings: Dict[str, str]) -> None:
 
 
 def _build_restore_command(file_path: Path, db_settings: Dict[str, str]) -> Tuple[List[str], dict]:
+    """
+    psql для .sql, иначе pg_restore; file_path может быть и распакованным каталогом
+    pg_dump. Для каталога и custom-файла восстановление идет в RESTORE_JOBS потоков.
+    """
     host = db_settings.get("HOST") or None
     port = db_settings.get("PORT") or None
     user = db_settings.get("USER") or None
     database_name = db_settings.get("NAME")
 
     suffix = file_path.suffix.lower()
-    if suffix == ".sql":
+    if suffix == ".sql" and file_path.is_file():
         try:
             psql_binary = resolve_pg_command("psql")
         except FileNotFoundError as exc:
@@ -398,6 +470,8 @@ def _build_restore_command(file_path: Path, db_settings: Dict[str, str]) -> Tupl
             "--exit-on-error",
             "--verbose",
         ]
+        if pg_backup.supports_parallel_restore(file_path):
+            command.append(f"--jobs={pg_backup.restore_jobs()}")
         if host:
             command.extend(["--host", str(host)])
         if port:
@@ -452,6 +526,26 @@ def perform_restore_from_file(
         else:
             raise
     
+    # Архив проверяется и распаковывается до бэкапа и очистки базы: испорченная
+    # копия не должна оставить базу пустой
+    unpacked_dir: Path | None = None
+    restore_source = file_path
+    try:
+        pg_backup.verify_checksum_file(file_path)
+        if pg_backup.is_directory_archive(file_path):
+            unpack_root = _get_backup_root() / "uploads"
+            unpack_root.mkdir(parents=True, exist_ok=True)
+            unpacked_dir = Path(tempfile.mkdtemp(prefix="restore_", dir=unpack_root))
+            restore_source = pg_backup.unpack_archive(file_path, unpacked_dir)
+    except Exception as exc:
+        if unpacked_dir:
+            shutil.rmtree(unpacked_dir, ignore_errors=True)
+        restore_record.status = 'failed'
+        restore_record.error_message = str(exc)
+        restore_record.completed_at = timezone.now()
+        restore_record.save()
+        raise RuntimeError(_("Резервная копия повреждена: %s") % exc) from exc
+
     if create_backup:
         try:
             perform_backup(label="pre_restore", comment="Автоматический бэкап перед восстановлением")
@@ -467,7 +561,7 @@ def perform_restore_from_file(
             # Продолжаем восстановление, так как pg_restore может справиться сам
 
     try:
-        command, env = _build_restore_command(file_path, db_settings)
+        command, env = _build_restore_command(restore_source, db_settings)
 
         logger.info("Starting database restore from %s", file_path)
         result = subprocess.run(
@@ -511,6 +605,9 @@ def perform_restore_from_file(
         restore_record.completed_at = timezone.now()
         restore_record.save()
         raise
+    finally:
+        if unpacked_dir:
+            shutil.rmtree(unpacked_dir, ignore_errors=True)
 
 
 def fetch_database_metrics() -> Tuple[Dict[str, object], List[str]]:
@@ -623,18 +720,18 @@ def gather_sales_metrics() -> Tuple[Dict[str, object], List[str]]:
     try:
         now = timezone.now()
         last_30_days = now - timedelta(days=30)
-        last_7_days = now - timedelta(days=7)
 
         all_orders = Order.objects.all()
-        delivered_orders = all_orders.filter(status="delivered")
+        totals = sales_totals()
+        totals_30 = sales_totals(period_start(30))
 
-        metrics["orders_total"] = all_orders.count()
-        metrics["orders_delivered"] = delivered_orders.count()
-        metrics["orders_last_30"] = all_orders.filter(order_date__gte=last_30_days).count()
+        metrics["orders_total"] = totals["orders_count"]
+        metrics["orders_delivered"] = totals["delivered_orders"]
+        metrics["orders_last_30"] = totals_30["orders_count"]
         metrics["orders_in_progress"] = all_orders.exclude(status__in=("delivered", "cancelled")).count()
 
-        revenue_total = delivered_orders.aggregate(total=Sum("total_amount"))["total"] or Decimal("0")
-        revenue_last_30 = delivered_orders.filter(order_date__gte=last_30_days).aggregate(total=Sum("total_amount"))["total"] or Decimal("0")
+        revenue_total = totals["delivered_revenue"]
+        revenue_last_30 = totals_30["delivered_revenue"]
 
         metrics["revenue_total"] = revenue_total
         metrics["revenue_last_30"] = revenue_last_30
@@ -666,22 +763,6 @@ def gather_sales_metrics() -> Tuple[Dict[str, object], List[str]]:
         metrics["active_customers_last_30"] = recent_customers
         metrics["new_customers_last_30"] = new_customers
 
-        revenue_expr = ExpressionWrapper(
-            F("quantity") * F("price_per_unit"),
-            output_field=DecimalField(max_digits=16, decimal_places=2)
-        )
-
-        top_products_qs = (
-            OrderItem.objects.filter(order__status="delivered")
-            .annotate(line_revenue=revenue_expr)
-            .values("product__name")
-            .annotate(
-                quantity=Sum("quantity"),
-                revenue=Sum("line_revenue"),
-                orders=Count("order", distinct=True),
-            )
-            .order_by("-revenue", "-quantity")[:5]
-        )
         metrics["top_products"] = [
             {
                 "name": row["product__name"] or "—",
@@ -689,42 +770,25 @@ def gather_sales_metrics() -> Tuple[Dict[str, object], List[str]]:
                 "revenue": row["revenue"] or Decimal("0"),
                 "orders": row["orders"] or 0,
             }
-            for row in top_products_qs
+            for row in product_sales()[:5]
         ]
 
-        top_categories_qs = (
-            OrderItem.objects.filter(order__status="delivered")
-            .annotate(line_revenue=revenue_expr)
-            .values("product__category__name")
-            .annotate(
-                quantity=Sum("quantity"),
-                revenue=Sum("line_revenue"),
-            )
-            .order_by("-revenue", "-quantity")[:5]
-        )
         metrics["top_categories"] = [
             {
-                "name": row["product__category__name"] or "Без категории",
+                "name": row["category__name"] or "Без категории",
                 "quantity": row["quantity"] or 0,
                 "revenue": row["revenue"] or Decimal("0"),
             }
-            for row in top_categories_qs
+            for row in category_sales()[:5]
         ]
 
-        daily_revenue_qs = (
-            delivered_orders.filter(order_date__gte=last_7_days)
-            .annotate(day=TruncDay("order_date"))
-            .values("day")
-            .annotate(revenue=Sum("total_amount"), orders=Count("id"))
-            .order_by("day")
-        )
         metrics["daily_revenue"] = [
             {
                 "day": row["day"],
                 "revenue": row["revenue"] or Decimal("0"),
                 "orders": row["orders"],
             }
-            for row in daily_revenue_qs
+            for row in daily_sales(period_start(7))
         ]
 
     except Exception as exc:  # pragma: no cover - защита на случай проблем БД
@@ -734,6 +798,92 @@ def gather_sales_metrics() -> Tuple[Dict[str, object], List[str]]:
     return metrics, errors
 
 
+def _metrics_interval() -> int:
+    return int(getattr(settings, "DB_MAINTENANCE_METRICS_INTERVAL", 300))
+
+
+def collect_maintenance_metrics() -> Dict[str, object]:
+    """Собирает метрики БД и продаж для страницы обслуживания и кладет снимок в общий кэш"""
+    metrics, metric_errors = fetch_database_metrics()
+    sales_metrics, sales_metric_errors = gather_sales_metrics()
+    snapshot = {
+        "collected_at": timezone.now(),
+        "metrics": metrics,
+        "metric_errors": metric_errors,
+        "sales_metrics": sales_metrics,
+        "sales_metric_errors": sales_metric_errors,
+    }
+    cache.set(METRICS_SNAPSHOT_CACHE_KEY, snapshot, timeout=None)
+    return snapshot
+
+
+def metrics_snapshot_is_stale(snapshot: Optional[Dict[str, object]]) -> bool:
+    """Снимка нет или он старше двух интервалов: beat не ставит пересчет или воркер его не выполняет"""
+    if snapshot is None:
+        return True
+    return (timezone.now() - snapshot["collected_at"]).total_seconds() > 2 * _metrics_interval()
+
+
+def get_maintenance_metrics() -> Optional[Dict[str, object]]:
+    """
+    Снимок метрик для страницы — чтение кэша. Если снимка нет или он устарел, пересчет
+    ставится в очередь один раз на интервал для всего кластера, а страница показывает
+    то, что есть. Без брокера Celery пересчет выполняется здесь же (task_queue.enqueue).
+    """
+    snapshot = cache.get(METRICS_SNAPSHOT_CACHE_KEY)
+    if metrics_snapshot_is_stale(snapshot) and cache.add(
+        METRICS_REFRESH_LOCK_KEY, True, timeout=_metrics_interval(),
+    ):
+        from ..tasks import refresh_maintenance_metrics
+
+        try:
+            enqueue(refresh_maintenance_metrics)
+        except Exception:  # pragma: no cover - брокер недоступен
+            logger.exception("Failed to queue maintenance metrics refresh")
+        if not broker_configured():
+            snapshot = cache.get(METRICS_SNAPSHOT_CACHE_KEY) or snapshot
+    return snapshot
+
+
+def run_due_backup_without_broker() -> bool:
+    """
+    Без брокера Celery beat не выполняет create_scheduled_backup, поэтому плановый бэкап
+    делает страница обслуживания, когда он просрочен (как раньше ensure_daily_backup).
+    С брокером ничего не делает. Возвращает, был ли создан бэкап.
+    """
+    if broker_configured() or not backup_is_due():
+        return False
+    from ..tasks import create_scheduled_backup
+
+    result = enqueue(create_scheduled_backup)
+    if result.failed():
+        logger.error("Automatic backup failed: %s", result.result)
+        return False
+    return result.result.get("status") == "success"
+
+
+def backup_is_overdue(last_success: Optional[DatabaseBackup], now=None) -> bool:
+    """
+    Последний успешный бэкап старше интервала с запасом на ежечасную проверку (или его
+    нет вовсе, хотя автоматические бэкапы включены): задачу никто не выполняет или она падает.
+    """
+    if not getattr(settings, "BACKUP_AUTO_ENABLED", True):
+        return False
+    if last_success is None:
+        return True
+    now = now or timezone.now()
+    return now - last_success.started_at > timedelta(hours=AUTO_BACKUP_INTERVAL_HOURS) + BACKUP_OVERDUE_SLACK
+
+
+def _backup_running(backup_history: Iterable[DatabaseBackup]) -> bool:
+    """Есть ли незавершенный бэкап; записи старше BACKUP_LOCK_TIMEOUT считаются оборванными"""
+    started_after = timezone.now() - timedelta(seconds=BACKUP_LOCK_TIMEOUT)
+    return any(
+        record.operation == "backup" and record.status == "in_progress" and record.started_at >= started_after
+        for record in backup_history
+    )
+
+
 def test_database_connection() -> Dict[str, object]:
     result: Dict[str, object] = {}
     start = time.perf_counter()
@@ -788,34 +938,37 @@ class DatabaseMaintenanceView(TemplateView):
 
                 destination_dir = Path(custom_directory) if destination_choice == "custom" else None
 
+                from ..tasks import create_scheduled_backup
+
                 try:
-                    backup_path = perform_backup(
-                        destination_dir=destination_dir,
-                        folder_name=folder_name,
+                    result = enqueue(
+                        create_scheduled_backup,
                         comment=backup_form.cleaned_data.get("folder_name") or None,
+                        manual=True,
+                        folder_name=folder_name,
+                        destination_dir=str(destination_dir) if destination_dir else None,
                     )
-
-                    if destination_choice == "custom":
-                        messages.success(
-                            request,
-                            _("Резервная копия создана: %s") % backup_path,
-                        )
-                    else:
-                        relative_path = backup_path.relative_to(_get_backup_root())
-                        download_url = f"{self._self_url()}?download={relative_path.as_posix()}"
-                        messages.success(
-                            request,
-                            format_html(
-                                _(
-                                    "Резервная копия создана в каталоге <code>{folder}</code>. "
-                                    '<a href="{url}">Скачать</a>'
-                                ),
-                                folder=(relative_path.parent.as_posix() or "."),
-                                url=download_url,
-                            ),
-                        )
                 except Exception as exc:
                     messages.error(request, str(exc))
+                    return redirect(self._self_url())
+
+                if broker_configured():
+                    messages.success(
+                        request,
+                        _(
+                            "Резервная копия поставлена в очередь. Ее статус появится в истории "
+                            "операций; если другой бэкап еще выполняется, новый запущен не будет."
+                        ),
+                    )
+                elif result.failed():
+                    messages.error(request, str(result.result))
+                elif result.result.get("status") == "skipped":
+                    messages.warning(request, _("Другой бэкап еще выполняется, новый не запущен."))
+                else:
+                    messages.success(
+                        request,
+                        _("Резервная копия создана: %s") % Path(result.result["file_path"]).name,
+                    )
                 return redirect(self._self_url())
 
             context = self.get_context_data(
@@ -910,22 +1063,38 @@ class DatabaseMaintenanceView(TemplateView):
         backup_files = kwargs.get("backup_files") or list_backup_files()
         backup_choices = self._backup_choices(backup_files)
 
-        auto_backup_triggered = ensure_daily_backup()
-        metrics, metric_errors = fetch_database_metrics()
-        sales_metrics, sales_metric_errors = gather_sales_metrics()
-        backup_history = DatabaseBackup.objects.order_by('-started_at')[:20]
+        # Бэкап запускает только задача create_scheduled_backup, метрики считает
+        # refresh_maintenance_metrics: страница читает историю и снимок из кэша.
+        # Без брокера обе задачи выполняются здесь же, иначе их никто бы не выполнил
+        run_due_backup_without_broker()
+        snapshot = get_maintenance_metrics()
+        metrics_stale = metrics_snapshot_is_stale(snapshot)
+        snapshot = snapshot or {}
+        backup_history = list(DatabaseBackup.objects.order_by('-started_at')[:20])
         last_backup = backup_history[0] if backup_history else None
+        last_success = next(
+            (
+                record for record in backup_history
+                if record.operation == "backup" and record.status == "success"
+            ),
+            None,
+        )
+        backup_running = _backup_running(backup_history)
         next_backup = None
-        if last_backup:
-            next_backup = last_backup.started_at + timedelta(hours=AUTO_BACKUP_INTERVAL_HOURS)
+        if last_success:
+            next_backup = last_success.started_at + timedelta(hours=AUTO_BACKUP_INTERVAL_HOURS)
 
         context.update(
             {
                 "title": _("Управление базой данных"),
-                "metrics": metrics,
-                "metric_errors": metric_errors,
-                "sales_metrics": sales_metrics,
-                "sales_metric_errors": sales_metric_errors,
+                "metrics": snapshot.get("metrics", {}),
+                "metric_errors": snapshot.get("metric_errors", []),
+                "sales_metrics": snapshot.get("sales_metrics", {}),
+                "sales_metric_errors": snapshot.get("sales_metric_errors", []),
+                "metrics_collected_at": snapshot.get("collected_at"),
+                "metrics_stale": metrics_stale,
+                "backup_overdue": not backup_running and backup_is_overdue(last_success),
+                "celery_broker_configured": broker_configured(),
                 "backup_files": backup_files,
                 "backup_choices": backup_choices,
                 "backup_root": str(_get_backup_root()),
@@ -937,8 +1106,12 @@ class DatabaseMaintenanceView(TemplateView):
                 or DatabaseRestoreExistingForm(backup_choices=backup_choices),
                 "backup_history": backup_history,
                 "last_backup": last_backup,
+                "last_success_backup": last_success,
                 "next_backup": next_backup,
-                "auto_backup_triggered": auto_backup_triggered,
+                "backup_running": backup_running,
+                "sql_export_presets": [
+                    (key, preset.get("label", key)) for key, preset in sql_export.export_presets().items()
+                ],
                 "auto_backup_enabled": getattr(settings, "BACKUP_AUTO_ENABLED", True),
                 "auto_backup_interval_hours": AUTO_BACKUP_INTERVAL_HOURS,
             }
@@ -957,7 +1130,10 @@ class DatabaseMaintenanceView(TemplateView):
         )
     
     def _export_sql_script(self) -> HttpResponse:
-        """Экспортирует базу данных в SQL скрипт"""
+        """
+        Отдает SQL-скрипт базы потоком прямо из pg_dump (см. sql_export): без
+        временных файлов, с фильтрами таблиц (preset, tables, exclude) и gzip=1.
+        """
         db_settings = _get_db_settings()
         _ensure_postgres(db_settings)
         
@@ -969,108 +1145,51 @@ class DatabaseMaintenanceView(TemplateView):
             pg_dump_binary = resolve_pg_command("pg_dump")
         except FileNotFoundError as exc:
             raise RuntimeError(str(exc)) from exc
-        
-        # Создаем временные файлы для SQL скрипта
-        import tempfile
-        schema_file = tempfile.NamedTemporaryFile(mode='w+', suffix='_schema.sql', delete=False)
-        schema_path = Path(schema_file.name)
-        schema_file.close()
-        
-        data_file = tempfile.NamedTemporaryFile(mode='w+', suffix='_data.sql', delete=False)
-        data_path = Path(data_file.name)
-        data_file.close()
-        
-        final_file = tempfile.NamedTemporaryFile(mode='w+', suffix='.sql', delete=False)
-        final_path = Path(final_file.name)
-        final_file.close()
-        
-        host = db_settings.get("HOST") or None
-        port = db_settings.get("PORT") or None
-        user = db_settings.get("USER") or None
-        
+
+        params = self.request.GET
+        preset = sql_export.export_presets().get(params.get("preset") or "", {})
+        try:
+            include = list(preset.get("include", [])) + sql_export.parse_table_patterns(params.get("tables"))
+            exclude = list(preset.get("exclude", [])) + sql_export.parse_table_patterns(params.get("exclude"))
+        except ValueError as exc:
+            messages.error(self.request, str(exc))
+            return redirect(self._self_url())
+        compress = params.get("gzip") == "1"
+
+        command = sql_export.build_dump_command(
+            pg_dump_binary,
+            _pg_connection_args(db_settings),
+            database_name,
+            include=include,
+            exclude=exclude,
+            exclude_data=preset.get("exclude_data", []),
+        )
         env = os.environ.copy()
         password = db_settings.get("PASSWORD")
         if password:
             env["PGPASSWORD"] = str(password)
-        
+
+        logger.info("Streaming SQL export include=%s exclude=%s gzip=%s", include, exclude, compress)
         try:
-            # Базовые параметры команды
-            base_params = []
-            if host:
-                base_params.extend(["--host", str(host)])
-            if port:
-                base_params.extend(["--port", str(port)])
-            if user:
-                base_params.extend(["--username", str(user)])
-            
-            # 1. Экспортируем структуру (схему) - сначала
-            logger.info("Exporting database schema to SQL script")
-            schema_command = [pg_dump_binary, "--format=plain", "--no-owner", "--no-privileges", "--schema-only"]
-            schema_command.extend(base_params)
-            schema_command.extend(["--file", str(schema_path), str(database_name)])
-            
-            result = subprocess.run(
-                schema_command,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=300
-            )
-            
-            if result.returncode != 0:
-                error_msg = result.stderr or "Unknown error"
-                logger.error("SQL schema export failed: %s", error_msg)
-                raise RuntimeError(f"Ошибка экспорта структуры SQL: {error_msg}")
-            
-            # 2. Экспортируем данные - потом
-            logger.info("Exporting database data to SQL script")
-            data_command = [pg_dump_binary, "--format=plain", "--no-owner", "--no-privileges", "--data-only", "--disable-triggers"]
-            data_command.extend(base_params)
-            data_command.extend(["--file", str(data_path), str(database_name)])
-            
-            result = subprocess.run(
-                data_command,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=300
+            chunks = sql_export.stream_dump(
+                command,
+                env,
+                gzip_level=pg_backup.compression_level() if compress else None,
             )
-            
-            if result.returncode != 0:
-                error_msg = result.stderr or "Unknown error"
-                logger.error("SQL data export failed: %s", error_msg)
-                raise RuntimeError(f"Ошибка экспорта данных SQL: {error_msg}")
-            
-            # 3. Объединяем: сначала структура, потом данные
-            with final_path.open("wb") as final:
-                # Записываем структуру
-                if schema_path.exists():
-                    with schema_path.open("rb") as schema:
-                        final.write(schema.read())
-                        final.write(b"\n\n-- ============================================\n")
-                        final.write(b"-- DATA\n")
-                        final.write(b"-- ============================================\n\n")
-                
-                # Записываем данные
-                if data_path.exists():
-                    with data_path.open("rb") as data:
-                        final.write(data.read())
-            
-            # Читаем объединенный SQL файл и возвращаем как ответ
-            with final_path.open("rb") as sql_file:
-                response = HttpResponse(sql_file.read(), content_type="text/plain; charset=utf-8")
-                timestamp = timezone.localtime().strftime("%Y%m%d_%H%M%S")
-                filename = f"{database_name}_export_{timestamp}.sql"
-                response["Content-Disposition"] = f'attachment; filename="{filename}"'
-                return response
-        finally:
-            # Удаляем временные файлы
-            for path in [schema_path, data_path, final_path]:
-                if path.exists():
-                    try:
-                        path.unlink()
-                    except Exception:
-                        pass
+        except sql_export.SqlExportError as exc:
+            logger.error("SQL export failed: %s", exc)
+            messages.error(self.request, _("Ошибка экспорта SQL: %s") % exc)
+            return redirect(self._self_url())
+
+        timestamp = timezone.localtime().strftime("%Y%m%d_%H%M%S")
+        filename = f"{database_name}_export_{timestamp}.sql"
+        if compress:
+            response = StreamingHttpResponse(chunks, content_type="application/gzip")
+            filename += ".gz"
+        else:
+            response = StreamingHttpResponse(chunks, content_type="text/plain; charset=utf-8")
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
 
     def _backup_choices(self, backup_files: Iterable[dict]) -> List[Tuple[str, str]]:
         return [
@@ -1,20 +1,25 @@
 """
 Экспорт отчетов в Excel
 """
+import csv
+import tempfile
 from datetime import timedelta
 from decimal import Decimal
 from io import BytesIO
 
 from django.contrib.auth.decorators import user_passes_test
 from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum
-from django.db.models.functions import TruncDay
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import TemplateView
 
-from ..models import Order, OrderItem, Product, User, ProductBatch, BatchAuditLog, Category
+from ..db_routing import replica_reads
+from ..export_jobs import fail_stale_jobs, job_file, normalize_params, submit_export_job
+from ..models import ExportJob, Order, Product, User, ProductBatch, BatchAuditLog, Category
+from ..sales_rollups import daily_sales, product_sales
 
 
 def is_staff(user):
@@ -82,7 +87,84 @@ def _apply_excel_row_style(ws, row, num_cols, styles, is_alt=False, is_total=Fal
                 cell.fill = styles['alt_fill']
 
 
+# ==================== ПОТОКОВЫЙ ЭКСПОРТ ====================
+# Большие отчёты не собираются в памяти: строки читаются из БД порциями (.iterator),
+# CSV отдаётся генератором, XLSX пишется xlsxwriter в режиме constant_memory во
+# временный файл и отдаётся из него блоками.
+
+EXPORT_CHUNK_SIZE = 2000
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class _Echo:
+    """Псевдобуфер для csv.writer: writerow возвращает готовую строку"""
+
+    def write(self, value):
+        return value
+
+
+def _stream_csv(filename, headers, rows):
+    """CSV через StreamingHttpResponse; rows — итератор списков значений"""
+    writer = csv.writer(_Echo(), delimiter=';')
+
+    def generate():
+        yield '\ufeff'  # BOM, чтобы Excel распознал UTF-8
+        yield writer.writerow(headers)
+        for row in rows:
+            yield writer.writerow(row)
+
+    response = StreamingHttpResponse(generate(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename={filename}.csv'
+    return response
+
+
+def _stream_xlsx(filename, sheet_title, columns, rows):
+    """
+    XLSX с постоянным расходом памяти.
+    columns — список (заголовок, ширина, тип), тип: 'text', 'int' или 'money'.
+    """
+    import xlsxwriter
+
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    ws = workbook.add_worksheet(sheet_title)
+
+    header_format = workbook.add_format({
+        'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#1a2a6c', 'font_size': 12,
+        'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1,
+    })
+    base = {'font_size': 10, 'border': 1}
+    kinds = {
+        'text': {'align': 'left'},
+        'int': {'align': 'center'},
+        'money': {'align': 'right', 'num_format': '#,##0.00 ₽'},
+    }
+    # Формат на каждый тип колонки и чётность строки — вместо стилизации каждой ячейки
+    formats = {
+        (kind, is_alt): workbook.add_format({**base, **options, **({'bg_color': '#f0f4ff'} if is_alt else {})})
+        for kind, options in kinds.items()
+        for is_alt in (False, True)
+    }
+
+    ws.set_row(0, 25)
+    for col, (header, width, _kind) in enumerate(columns):
+        ws.set_column(col, col, width)
+        ws.write(0, col, header, header_format)
+    ws.freeze_panes(1, 0)
+
+    column_kinds = [kind for _header, _width, kind in columns]
+    for row_index, row in enumerate(rows, 1):
+        is_alt = row_index % 2 == 1
+        for col, value in enumerate(row):
+            ws.write(row_index, col, value, formats[(column_kinds[col], is_alt)])
+
+    workbook.close()
+    output.seek(0)
+    return FileResponse(output, as_attachment=True, filename=f'{filename}.xlsx', content_type=XLSX_CONTENT_TYPE)
+
+
 @method_decorator(user_passes_test(is_staff), name='dispatch')
+@method_decorator(replica_reads, name='dispatch')
 class ExportReportsView(TemplateView):
     """Экспорт отчетов в Excel"""
     template_name = 'admin/export_reports.html'
@@ -90,38 +172,37 @@ class ExportReportsView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         today = timezone.now().date()
+        # Зависшие задания показываются ошибкой, а не «в очереди» до конца срока хранения
+        fail_stale_jobs()
         context.update({
             'title': _('Экспорт отчетов'),
             'today': today,
             'last_month': today - timedelta(days=30),
             'next_month': today + timedelta(days=30),
+            'export_jobs': ExportJob.objects.select_related('requested_by')[:20],
         })
         return context
 
+    # Отчеты, которые формируются в фоне через ExportJob (см. export_jobs.py)
+    EXPORT_HANDLERS = {
+        'sales': '_export_sales_report',
+        'orders': '_export_orders_report',
+        'products': '_export_products_report',
+        'customers': '_export_customers_report',
+        'batches_expiring': '_export_batches_expiring_report',
+        'batches_history': '_export_batches_history_report',
+        'batches_losses': '_export_batches_losses_report',
+        'batches_by_category': '_export_batches_by_category_report',
+        'dashboard_pdf': '_export_dashboard_pdf',
+        'all_metrics_export': '_export_all_metrics',
+    }
+
     def post(self, request, *args, **kwargs):
-        """Генерация и скачивание отчета"""
+        """Постановка отчета в очередь; импорт метрик и стили выполняются сразу"""
         report_type = request.POST.get('report_type')
         
-        if report_type == 'sales':
-            return self._export_sales_report(request)
-        elif report_type == 'orders':
-            return self._export_orders_report(request)
-        elif report_type == 'products':
-            return self._export_products_report(request)
-        elif report_type == 'customers':
-            return self._export_customers_report(request)
-        elif report_type == 'batches_expiring':
-            return self._export_batches_expiring_report(request)
-        elif report_type == 'batches_history':
-            return self._export_batches_history_report(request)
-        elif report_type == 'batches_losses':
-            return self._export_batches_losses_report(request)
-        elif report_type == 'batches_by_category':
-            return self._export_batches_by_category_report(request)
-        elif report_type == 'dashboard_pdf':
-            return self._export_dashboard_pdf(request)
-        elif report_type == 'all_metrics_export':
-            return self._export_all_metrics(request)
+        if report_type in self.EXPORT_HANDLERS:
+            return self._submit_export_job(request, report_type)
         elif report_type == 'all_metrics_import':
             return self._import_all_metrics(request)
         elif report_type == 'export_styles':
@@ -129,6 +210,23 @@ class ExportReportsView(TemplateView):
         else:
             return self.get(request)
 
+    def dispatch_export(self, request):
+        """Синхронное формирование отчета; вызывается из задачи run_export_job"""
+        handler = getattr(self, self.EXPORT_HANDLERS[request.POST.get('report_type')])
+        return handler(request)
+
+    def _submit_export_job(self, request, report_type):
+        from django.contrib import messages
+
+        job, created = submit_export_job(
+            report_type, normalize_params(request.POST), request.user, force=request.POST.get('force') == '1',
+        )
+        if created:
+            messages.info(request, _('Отчет поставлен в очередь. Ссылка на скачивание появится в списке заданий ниже.'))
+        else:
+            messages.info(request, _('Такой отчет уже формируется или готов — используется существующее задание.'))
+        return redirect('admin:export-reports')
+
     def _export_sales_report(self, request):
         """Экспорт отчета по продажам"""
         try:
@@ -172,19 +270,7 @@ class ExportReportsView(TemplateView):
             days = int(request.POST.get('days', 30))
             start_date = now - timedelta(days=days)
             
-            daily_data = (
-                Order.objects.filter(
-                    order_date__gte=start_date,
-                    status='delivered'
-                )
-                .annotate(day=TruncDay('order_date'))
-                .values('day')
-                .annotate(
-                    orders=Count('id'),
-                    revenue=Sum('total_amount')
-                )
-                .order_by('day')
-            )
+            daily_data = daily_sales(timezone.localdate(start_date))
             
             row = 2
             for idx, item in enumerate(daily_data):
@@ -262,62 +348,48 @@ class ExportReportsView(TemplateView):
             return self.get(request)
 
     def _export_orders_report(self, request):
-        """Экспорт отчета по заказам"""
+        """Экспорт отчета по заказам (потоково, XLSX или CSV)"""
+        days = int(request.POST.get('days', 30))
+        start_date = timezone.now() - timedelta(days=days)
+        filename = f'orders_report_{timezone.now().strftime("%Y%m%d")}'
+        columns = [
+            ('ID', 10, 'int'),
+            ('Дата', 18, 'text'),
+            ('Клиент', 20, 'text'),
+            ('Статус', 18, 'text'),
+            ('Сумма', 15, 'money'),
+            ('Товаров', 12, 'int'),
+        ]
+        rows = self._orders_report_rows(start_date)
+
+        if request.POST.get('format') == 'csv':
+            return _stream_csv(filename, [header for header, _width, _kind in columns], rows)
         try:
-            from openpyxl import Workbook
-            from openpyxl.styles import Alignment
-            
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Заказы"
-            
-            styles = _get_excel_styles()
-            headers = ['ID', 'Дата', 'Клиент', 'Статус', 'Сумма', 'Товаров']
-            _apply_excel_header_style(ws, headers, styles)
-            
-            days = int(request.POST.get('days', 30))
-            start_date = timezone.now() - timedelta(days=days)
-            
-            orders = Order.objects.filter(order_date__gte=start_date).select_related('user')
-            
-            row = 2
-            for idx, order in enumerate(orders):
-                items_count = order.orderitem_set.count()
-                ws.cell(row=row, column=1, value=order.id)
-                ws.cell(row=row, column=2, value=order.order_date.strftime('%d.%m.%Y %H:%M'))
-                ws.cell(row=row, column=3, value=order.user.username if order.user else '—')
-                ws.cell(row=row, column=4, value=order.get_status_display())
-                ws.cell(row=row, column=5, value=float(order.total_amount)).number_format = '#,##0.00 ₽'
-                ws.cell(row=row, column=6, value=items_count)
-                
-                _apply_excel_row_style(ws, row, len(headers), styles, is_alt=(idx % 2 == 0))
-                
-                # Выравнивание
-                ws.cell(row=row, column=1).alignment = Alignment(horizontal='center')
-                ws.cell(row=row, column=2).alignment = Alignment(horizontal='left')
-                ws.cell(row=row, column=3).alignment = Alignment(horizontal='left')
-                ws.cell(row=row, column=4).alignment = Alignment(horizontal='center')
-                ws.cell(row=row, column=5).alignment = Alignment(horizontal='right')
-                ws.cell(row=row, column=6).alignment = Alignment(horizontal='center')
-                
-                row += 1
-            
-            output = BytesIO()
-            wb.save(output)
-            output.seek(0)
-            
-            response = HttpResponse(
-                output.read(),
-                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            )
-            response['Content-Disposition'] = f'attachment; filename=orders_report_{timezone.now().strftime("%Y%m%d")}.xlsx'
-            return response
-            
+            return _stream_xlsx(filename, 'Заказы', columns, rows)
         except ImportError:
             from django.contrib import messages
-            messages.error(request, _('Библиотека openpyxl не установлена.'))
+            messages.error(request, _('Библиотека xlsxwriter не установлена. Установите: pip install xlsxwriter'))
             return self.get(request)
 
+    def _orders_report_rows(self, start_date):
+        """Строки отчета по заказам; количество позиций считается в том же запросе"""
+        statuses = dict(Order.STATUS_CHOICES)
+        orders = (
+            Order.objects.filter(order_date__gte=start_date)
+            .annotate(items_count=Count('items'))
+            .order_by('id')
+            .values_list('id', 'order_date', 'user__username', 'status', 'total_amount', 'items_count')
+        )
+        for order_id, order_date, username, status, total_amount, items_count in orders.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield [
+                order_id,
+                timezone.localtime(order_date).strftime('%d.%m.%Y %H:%M'),
+                username or '—',
+                statuses.get(status, status),
+                float(total_amount or 0),
+                items_count,
+            ]
+
     def _export_products_report(self, request):
         """Экспорт отчета по товарам"""
         try:
@@ -336,19 +408,7 @@ class ExportReportsView(TemplateView):
             start_date = timezone.now() - timedelta(days=days)
             
             # Агрегируем данные по товарам
-            products_data = list((
-                OrderItem.objects.filter(
-                    order__order_date__gte=start_date,
-                    order__status='delivered'
-                )
-                .values('product__id', 'product__name', 'product__category__name', 'product__price')
-                .annotate(
-                    total_quantity=Sum('quantity'),
-                    total_revenue=Sum(ExpressionWrapper(F('quantity') * F('price_per_unit'), output_field=DecimalField())),
-                    orders_count=Count('order', distinct=True)
-                )
-                .order_by('-total_revenue')
-            ))
+            products_data = list(product_sales(timezone.localdate(start_date)))
             
             row = 2
             for idx, item in enumerate(products_data):
@@ -356,9 +416,9 @@ class ExportReportsView(TemplateView):
                 ws.cell(row=row, column=2, value=item['product__name'] or '—')
                 ws.cell(row=row, column=3, value=item['product__category__name'] or 'Без категории')
                 ws.cell(row=row, column=4, value=float(item['product__price'] or 0)).number_format = '#,##0.00 ₽'
-                ws.cell(row=row, column=5, value=item['total_quantity'] or 0)
-                ws.cell(row=row, column=6, value=float(item['total_revenue'] or 0)).number_format = '#,##0.00 ₽'
-                ws.cell(row=row, column=7, value=item['orders_count'] or 0)
+                ws.cell(row=row, column=5, value=item['quantity'] or 0)
+                ws.cell(row=row, column=6, value=float(item['revenue'] or 0)).number_format = '#,##0.00 ₽'
+                ws.cell(row=row, column=7, value=item['orders'] or 0)
                 
                 _apply_excel_row_style(ws, row, len(headers), styles, is_alt=(idx % 2 == 0))
                 
@@ -377,9 +437,9 @@ class ExportReportsView(TemplateView):
             if row > 2:
                 total_row = row
                 ws.cell(row=total_row, column=1, value='ИТОГО')
-                ws.cell(row=total_row, column=5, value=sum(item['total_quantity'] or 0 for item in products_data))
-                ws.cell(row=total_row, column=6, value=sum(float(item['total_revenue'] or 0) for item in products_data))
-                ws.cell(row=total_row, column=7, value=sum(item['orders_count'] or 0 for item in products_data))
+                ws.cell(row=total_row, column=5, value=sum(item['quantity'] or 0 for item in products_data))
+                ws.cell(row=total_row, column=6, value=sum(float(item['revenue'] or 0) for item in products_data))
+                ws.cell(row=total_row, column=7, value=sum(item['orders'] or 0 for item in products_data))
                 
                 _apply_excel_row_style(ws, total_row, len(headers), styles, is_total=True)
                 ws.cell(row=total_row, column=1).alignment = Alignment(horizontal='left')
@@ -497,419 +557,21 @@ class ExportReportsView(TemplateView):
             return self.get(request)
 
     def _export_dashboard_pdf(self, request):
-        """Экспорт дашборда в PDF с графиками"""
+        """Экспорт дашборда в PDF с графиками (см. dashboard_pdf.py)"""
         try:
-            from reportlab.lib import colors
-            from reportlab.lib.pagesizes import A4, landscape
-            from reportlab.lib.units import inch
-            from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak, Image
-            from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-            from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_JUSTIFY
-            from reportlab.pdfbase import pdfmetrics
-            from reportlab.pdfbase.ttfonts import TTFont
-            import matplotlib
-            matplotlib.use('Agg')
-            import matplotlib.pyplot as plt
-            import matplotlib.font_manager as fm
-            from datetime import datetime
-            import os
-            
-            # Настройка шрифтов для кириллицы
-            try:
-                # Пытаемся использовать системные шрифты Windows
-                font_paths = [
-                    'C:/Windows/Fonts/arial.ttf',
-                    'C:/Windows/Fonts/arialbd.ttf',
-                    'C:/Windows/Fonts/times.ttf',
-                    'C:/Windows/Fonts/timesbd.ttf',
-                ]
-                
-                # Регистрируем шрифты если они доступны
-                for font_path in font_paths:
-                    if os.path.exists(font_path):
-                        font_name = os.path.basename(font_path).replace('.ttf', '').replace('arial', 'Arial').replace('times', 'Times')
-                        if 'bd' in font_path:
-                            font_name += '-Bold'
-                        try:
-                            pdfmetrics.registerFont(TTFont(font_name, font_path))
-                        except:
-                            pass
-            except:
-                pass
-            
-            # Настройка matplotlib для кириллицы
-            # Пытаемся найти шрифт с поддержкой кириллицы
-            import matplotlib.font_manager as fm
-            font_list = fm.findSystemFonts(fontpaths=None, fontext='ttf')
-            cyrillic_fonts = ['DejaVu', 'Arial', 'Liberation', 'Calibri', 'Tahoma', 'Verdana']
-            found_font = None
-            
-            for font_path in font_list:
-                try:
-                    font_name = fm.get_font(font_path).family_name
-                    if any(cyr in font_name for cyr in cyrillic_fonts):
-                        found_font = font_name
-                        break
-                except:
-                    continue
-            
-            if found_font:
-                plt.rcParams['font.family'] = found_font
-            else:
-                # Fallback на DejaVu Sans, который обычно есть
-                plt.rcParams['font.family'] = ['DejaVu Sans', 'Arial', 'Liberation Sans', 'sans-serif']
-            
-            plt.rcParams['axes.unicode_minus'] = False
-            plt.rcParams['font.size'] = 10
-            
-            buffer = BytesIO()
-            doc = SimpleDocTemplate(buffer, pagesize=landscape(A4))
-            elements = []
-            styles = getSampleStyleSheet()
-            
-            # Создаем стили с поддержкой кириллицы
-            try:
-                title_font = 'Arial-Bold' if 'Arial-Bold' in pdfmetrics.getRegisteredFontNames() else 'Helvetica-Bold'
-                normal_font = 'Arial' if 'Arial' in pdfmetrics.getRegisteredFontNames() else 'Helvetica'
-            except:
-                title_font = 'Helvetica-Bold'
-                normal_font = 'Helvetica'
-            
-            # Заголовок
-            title_style = ParagraphStyle(
-                'CustomTitle',
-                parent=styles['Heading1'],
-                fontSize=24,
-                textColor=colors.HexColor('#1a2a6c'),
-                spaceAfter=30,
-                alignment=TA_CENTER,
-                fontName=title_font
-            )
-            
-            # Стиль для описаний
-            desc_style = ParagraphStyle(
-                'Description',
-                parent=styles['Normal'],
-                fontSize=10,
-                textColor=colors.HexColor('#666666'),
-                spaceAfter=12,
-                alignment=TA_JUSTIFY,
-                fontName=normal_font
-            )
-            
-            # Стиль для подзаголовков
-            subtitle_style = ParagraphStyle(
-                'Subtitle',
-                parent=styles['Heading2'],
-                fontSize=16,
-                textColor=colors.HexColor('#1a2a6c'),
-                spaceAfter=12,
-                spaceBefore=12,
-                alignment=TA_LEFT,
-                fontName=title_font
-            )
-            
-            # Заголовок документа
-            elements.append(Paragraph('Дашборд аналитики продаж', title_style))
-            elements.append(Spacer(1, 0.1*inch))
-            
-            # Информация о периоде
-            period = int(request.POST.get('period', 30))
-            period_text = f'<b>Период анализа:</b> {period} дней'
-            elements.append(Paragraph(period_text, desc_style))
-            elements.append(Paragraph(f'<b>Дата формирования отчета:</b> {timezone.now().strftime("%d.%m.%Y %H:%M")}', desc_style))
-            elements.append(Spacer(1, 0.2*inch))
-            
-            # Получаем данные
+            from ..dashboard_pdf import build_dashboard_pdf
+
             period = int(request.POST.get('period', 30))
-            now = timezone.now()
-            start_date = now - timedelta(days=period)
-            
-            # Данные для графиков
-            daily_data = (
-                Order.objects.filter(
-                    order_date__gte=start_date,
-                    status='delivered'
-                )
-                .annotate(day=TruncDay('order_date'))
-                .values('day')
-                .annotate(
-                    revenue=Sum('total_amount'),
-                    orders=Count('id')
-                )
-                .order_by('day')
-            )
-            
-            # Статистика по статусам
-            orders_by_status = (
-                Order.objects.filter(order_date__gte=start_date)
-                .values('status')
-                .annotate(count=Count('id'))
-            )
-            
-            # Топ товары
-            revenue_expr = ExpressionWrapper(
-                F('quantity') * F('price_per_unit'),
-                output_field=DecimalField(max_digits=16, decimal_places=2)
-            )
-            top_products = (
-                OrderItem.objects.filter(
-                    order__order_date__gte=start_date,
-                    order__status='delivered'
-                )
-                .values('product__name')
-                .annotate(
-                    revenue=Sum(revenue_expr),
-                    quantity=Sum('quantity'),
-                    orders=Count('order', distinct=True)
-                )
-                .order_by('-revenue')[:10]
+            output = tempfile.TemporaryFile()
+            build_dashboard_pdf(period, output)
+            output.seek(0)
+            return FileResponse(
+                output,
+                as_attachment=True,
+                filename=f'dashboard_report_{timezone.now().strftime("%Y%m%d")}.pdf',
+                content_type='application/pdf',
             )
             
-            # График 1: Выручка по дням
-            dates = [item['day'] for item in daily_data]
-            revenues = [float(item['revenue'] or 0) for item in daily_data]
-            
-            if dates:
-                elements.append(Paragraph('1. Выручка по дням', subtitle_style))
-                elements.append(Paragraph(
-                    'График показывает динамику ежедневной выручки за выбранный период. '
-                    'Позволяет выявить тренды роста или падения продаж, а также определить наиболее прибыльные дни.',
-                    desc_style
-                ))
-                
-                fig, ax = plt.subplots(figsize=(10, 4.5))
-                ax.plot(dates, revenues, marker='o', linewidth=2.5, color='#1a2a6c', markersize=6)
-                ax.fill_between(dates, revenues, alpha=0.3, color='#1a2a6c')
-                ax.set_title('Выручка по дням', fontsize=16, fontweight='bold', pad=15)
-                ax.set_xlabel('Дата', fontsize=12, fontweight='bold')
-                ax.set_ylabel('Выручка (₽)', fontsize=12, fontweight='bold')
-                ax.grid(True, alpha=0.3, linestyle='--')
-                plt.xticks(rotation=45, ha='right')
-                
-                # Добавляем аннотацию с максимальным значением
-                if revenues:
-                    max_idx = revenues.index(max(revenues))
-                    max_revenue = max(revenues)
-                    ax.annotate(f'Макс: {max_revenue:.2f} ₽', 
-                              xy=(dates[max_idx], max_revenue),
-                              xytext=(10, 10), textcoords='offset points',
-                              bbox=dict(boxstyle='round,pad=0.5', facecolor='yellow', alpha=0.7),
-                              arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0'))
-                
-                plt.tight_layout()
-                
-                chart1 = BytesIO()
-                plt.savefig(chart1, format='png', dpi=110, bbox_inches='tight')
-                plt.close()
-                chart1.seek(0)
-                
-                from reportlab.platypus import Image as RLImage
-                elements.append(RLImage(chart1, width=9*inch, height=4.3*inch))
-                elements.append(Spacer(1, 0.3*inch))
-            
-            # График 2: Количество заказов
-            orders_count = [item['orders'] for item in daily_data]
-            if dates:
-                elements.append(PageBreak())
-                elements.append(Paragraph('2. Количество заказов по дням', subtitle_style))
-                elements.append(Paragraph(
-                    'Столбчатая диаграмма отображает количество заказов, оформленных каждый день. '
-                    'Помогает анализировать активность покупателей и планировать загрузку службы доставки.',
-                    desc_style
-                ))
-                
-                fig, ax = plt.subplots(figsize=(10, 4.5))
-                bars = ax.bar(dates, orders_count, color='#4f63d8', alpha=0.8, edgecolor='#1a2a6c', linewidth=1.5)
-                ax.set_title('Количество заказов по дням', fontsize=16, fontweight='bold', pad=15)
-                ax.set_xlabel('Дата', fontsize=12, fontweight='bold')
-                ax.set_ylabel('Количество заказов', fontsize=12, fontweight='bold')
-                ax.grid(True, alpha=0.3, axis='y', linestyle='--')
-                plt.xticks(rotation=45, ha='right')
-                
-                # Добавляем значения на столбцы
-                for bar in bars:
-                    height = bar.get_height()
-                    ax.text(bar.get_x() + bar.get_width()/2., height,
-                           f'{int(height)}',
-                           ha='center', va='bottom', fontweight='bold')
-                
-                plt.tight_layout()
-                
-                chart2 = BytesIO()
-                plt.savefig(chart2, format='png', dpi=110, bbox_inches='tight')
-                plt.close()
-                chart2.seek(0)
-                
-                elements.append(RLImage(chart2, width=9*inch, height=4.3*inch))
-                elements.append(Spacer(1, 0.3*inch))
-            
-            # График 3: Статусы заказов
-            status_labels = []
-            status_counts = []
-            status_translation = {
-                'created': 'Создан',
-                'confirmed': 'Подтверждён',
-                'ready': 'Готов',
-                'in_transit': 'В пути',
-                'delivered': 'Доставлен',
-                'cancelled': 'Отменён'
-            }
-            
-            for item in orders_by_status:
-                status_labels.append(status_translation.get(item['status'], item['status']))
-                status_counts.append(item['count'])
-            
-            if status_labels:
-                elements.append(PageBreak())
-                elements.append(Paragraph('3. Распределение заказов по статусам', subtitle_style))
-                elements.append(Paragraph(
-                    'Круговая диаграмма показывает распределение всех заказов по статусам выполнения. '
-                    'Позволяет оценить эффективность обработки заказов и выявить узкие места в процессе доставки.',
-                    desc_style
-                ))
-                
-                fig, ax = plt.subplots(figsize=(8, 6))
-                colors_list = ['#10b981', '#3b82f6', '#f59e0b', '#ef4444', '#8b5cf6', '#ec4899']
-                wedges, texts, autotexts = ax.pie(
-                    status_counts, 
-                    labels=status_labels, 
-                    autopct='%1.1f%%',
-                    colors=colors_list[:len(status_labels)],
-                    startangle=90,
-                    textprops={'fontsize': 11, 'fontweight': 'bold'}
-                )
-                ax.set_title('Распределение заказов по статусам', fontsize=16, fontweight='bold', pad=20)
-                
-                # Улучшаем отображение процентов
-                for autotext in autotexts:
-                    autotext.set_color('white')
-                    autotext.set_fontweight('bold')
-                    autotext.set_fontsize(10)
-                
-                plt.tight_layout()
-                
-                chart3 = BytesIO()
-                plt.savefig(chart3, format='png', dpi=110, bbox_inches='tight')
-                plt.close()
-                chart3.seek(0)
-                
-                elements.append(RLImage(chart3, width=7*inch, height=5*inch))
-                elements.append(Spacer(1, 0.3*inch))
-            
-            # График 4: Топ-10 товаров
-            if top_products:
-                elements.append(PageBreak())
-                elements.append(Paragraph('4. Топ-10 товаров по выручке', subtitle_style))
-                elements.append(Paragraph(
-                    'Горизонтальная столбчатая диаграмма отображает товары, приносящие наибольшую выручку. '
-                    'Помогает определить наиболее прибыльные позиции и оптимизировать ассортимент.',
-                    desc_style
-                ))
-                
-                product_names = [item['product__name'] or '—' for item in top_products]
-                # Обрезаем длинные названия для лучшей читаемости
-                product_names_short = [name[:40] + '...' if len(name) > 40 else name for name in product_names]
-                product_revenues = [float(item['revenue'] or 0) for item in top_products]
-                
-                fig, ax = plt.subplots(figsize=(10, 5.5))
-                bars = ax.barh(product_names_short, product_revenues, color='#4f63d8', alpha=0.8, edgecolor='#1a2a6c', linewidth=1.5)
-                ax.set_title('Топ-10 товаров по выручке', fontsize=16, fontweight='bold', pad=15)
-                ax.set_xlabel('Выручка (₽)', fontsize=12, fontweight='bold')
-                ax.set_ylabel('Товар', fontsize=12, fontweight='bold')
-                ax.grid(True, alpha=0.3, axis='x', linestyle='--')
-                
-                # Добавляем значения на столбцы
-                for i, (bar, revenue) in enumerate(zip(bars, product_revenues)):
-                    width = bar.get_width()
-                    ax.text(width, bar.get_y() + bar.get_height()/2.,
-                           f'{revenue:.2f} ₽',
-                           ha='left', va='center', fontweight='bold', fontsize=9)
-                
-                plt.tight_layout()
-                
-                chart4 = BytesIO()
-                plt.savefig(chart4, format='png', dpi=110, bbox_inches='tight')
-                plt.close()
-                chart4.seek(0)
-                
-                elements.append(RLImage(chart4, width=9*inch, height=4.8*inch))
-            
-            # Таблица топ товаров
-            if top_products:
-                elements.append(PageBreak())
-                elements.append(Paragraph('Детализация топ-товаров', subtitle_style))
-                elements.append(Paragraph(
-                    'Подробная таблица с данными о наиболее прибыльных товарах за выбранный период.',
-                    desc_style
-                ))
-                elements.append(Spacer(1, 0.2*inch))
-                
-                table_data = [['Товар', 'Выручка', 'Количество', 'Заказов']]
-                for item in top_products:
-                    table_data.append([
-                        item['product__name'] or '—',
-                        f"{float(item['revenue'] or 0):.2f} ₽",
-                        str(item['quantity'] or 0),
-                        str(item['orders'] or 0)
-                    ])
-                
-                # Улучшенная таблица с красивым форматированием
-                table = Table(table_data, colWidths=[4*inch, 1.5*inch, 1.5*inch, 1.5*inch])
-                table.setStyle(TableStyle([
-                    # Заголовок
-                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1a2a6c')),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                    ('FONTNAME', (0, 0), (-1, 0), title_font),
-                    ('FONTSIZE', (0, 0), (-1, 0), 12),
-                    ('FONTWEIGHT', (0, 0), (-1, 0), 'BOLD'),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                    ('TOPPADDING', (0, 0), (-1, 0), 12),
-                    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-                    ('VALIGN', (0, 0), (-1, 0), 'MIDDLE'),
-                    # Данные
-                    ('ALIGN', (0, 1), (0, -1), 'LEFT'),
-                    ('ALIGN', (1, 1), (-1, -1), 'RIGHT'),
-                    ('FONTNAME', (0, 1), (-1, -1), normal_font),
-                    ('FONTSIZE', (0, 1), (-1, -1), 10),
-                    ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
-                    ('TOPPADDING', (0, 1), (-1, -1), 8),
-                    ('VALIGN', (0, 1), (-1, -1), 'MIDDLE'),
-                    # Чередующиеся цвета строк
-                    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8f9fa')]),
-                    # Границы
-                    ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#dee2e6')),
-                    ('LINEBELOW', (0, 0), (-1, 0), 2, colors.HexColor('#1a2a6c')),
-                ]))
-                elements.append(table)
-                
-                # Итоговая статистика
-                total_revenue = sum(float(item['revenue'] or 0) for item in top_products)
-                total_quantity = sum(item['quantity'] or 0 for item in top_products)
-                total_orders = sum(item['orders'] or 0 for item in top_products)
-                
-                elements.append(Spacer(1, 0.3*inch))
-                summary_style = ParagraphStyle(
-                    'Summary',
-                    parent=styles['Normal'],
-                    fontSize=11,
-                    textColor=colors.HexColor('#1a2a6c'),
-                    spaceAfter=6,
-                    fontName=title_font
-                )
-                elements.append(Paragraph(f'<b>Итого по топ-10 товарам:</b>', summary_style))
-                elements.append(Paragraph(f'Общая выручка: {total_revenue:.2f} ₽', desc_style))
-                elements.append(Paragraph(f'Общее количество проданных единиц: {total_quantity}', desc_style))
-                elements.append(Paragraph(f'Количество уникальных заказов: {total_orders}', desc_style))
-            
-            # Собираем PDF
-            doc.build(elements)
-            buffer.seek(0)
-            
-            response = HttpResponse(buffer.read(), content_type='application/pdf')
-            response['Content-Disposition'] = f'attachment; filename=dashboard_report_{timezone.now().strftime("%Y%m%d")}.pdf'
-            return response
-            
         except ImportError as e:
             from django.contrib import messages
             messages.error(request, _('Библиотеки для PDF не установлены. Установите: pip install reportlab matplotlib'))
@@ -937,19 +599,7 @@ class ExportReportsView(TemplateView):
             headers = ['Дата', 'Заказов', 'Выручка', 'Средний чек']
             _apply_excel_header_style(ws_sales, headers, styles)
             
-            daily_data = (
-                Order.objects.filter(
-                    order_date__gte=start_date,
-                    status='delivered'
-                )
-                .annotate(day=TruncDay('order_date'))
-                .values('day')
-                .annotate(
-                    orders=Count('id'),
-                    revenue=Sum('total_amount')
-                )
-                .order_by('day')
-            )
+            daily_data = daily_sales(timezone.localdate(start_date))
             
             daily_data_list = list(daily_data)
             row = 2
@@ -993,23 +643,7 @@ class ExportReportsView(TemplateView):
             headers = ['ID', 'Название', 'Категория', 'Цена', 'Продано шт.', 'Выручка', 'Заказов']
             _apply_excel_header_style(ws_products, headers, styles)
             
-            revenue_expr = ExpressionWrapper(
-                F('quantity') * F('price_per_unit'),
-                output_field=DecimalField(max_digits=16, decimal_places=2)
-            )
-            products_data = list((
-                OrderItem.objects.filter(
-                    order__order_date__gte=start_date,
-                    order__status='delivered'
-                )
-                .values('product__id', 'product__name', 'product__category__name', 'product__price')
-                .annotate(
-                    total_quantity=Sum('quantity'),
-                    total_revenue=Sum(revenue_expr),
-                    orders_count=Count('order', distinct=True)
-                )
-                .order_by('-total_revenue')
-            ))
+            products_data = list(product_sales(timezone.localdate(start_date)))
             
             row = 2
             for idx, item in enumerate(products_data):
@@ -1017,9 +651,9 @@ class ExportReportsView(TemplateView):
                 ws_products.cell(row=row, column=2, value=item['product__name'] or '—')
                 ws_products.cell(row=row, column=3, value=item['product__category__name'] or 'Без категории')
                 ws_products.cell(row=row, column=4, value=float(item['product__price'] or 0)).number_format = '#,##0.00 ₽'
-                ws_products.cell(row=row, column=5, value=item['total_quantity'] or 0)
-                ws_products.cell(row=row, column=6, value=float(item['total_revenue'] or 0)).number_format = '#,##0.00 ₽'
-                ws_products.cell(row=row, column=7, value=item['orders_count'] or 0)
+                ws_products.cell(row=row, column=5, value=item['quantity'] or 0)
+                ws_products.cell(row=row, column=6, value=float(item['revenue'] or 0)).number_format = '#,##0.00 ₽'
+                ws_products.cell(row=row, column=7, value=item['orders'] or 0)
                 
                 _apply_excel_row_style(ws_products, row, len(headers), styles, is_alt=(idx % 2 == 0))
                 ws_products.cell(row=row, column=1).alignment = Alignment(horizontal='center')
@@ -1036,9 +670,9 @@ class ExportReportsView(TemplateView):
             if row > 2:
                 total_row = row
                 ws_products.cell(row=total_row, column=1, value='ИТОГО')
-                ws_products.cell(row=total_row, column=5, value=sum(item['total_quantity'] or 0 for item in products_data))
-                ws_products.cell(row=total_row, column=6, value=sum(float(item['total_revenue'] or 0) for item in products_data)).number_format = '#,##0.00 ₽'
-                ws_products.cell(row=total_row, column=7, value=sum(item['orders_count'] or 0 for item in products_data))
+                ws_products.cell(row=total_row, column=5, value=sum(item['quantity'] or 0 for item in products_data))
+                ws_products.cell(row=total_row, column=6, value=sum(float(item['revenue'] or 0) for item in products_data)).number_format = '#,##0.00 ₽'
+                ws_products.cell(row=total_row, column=7, value=sum(item['orders'] or 0 for item in products_data))
                 
                 _apply_excel_row_style(ws_products, total_row, len(headers), styles, is_total=True)
                 ws_products.cell(row=total_row, column=1).alignment = Alignment(horizontal='left')
@@ -1543,7 +1177,7 @@ class ExportReportsView(TemplateView):
                 ws.cell(row=row, column=1, value=item['product__category__name'] or 'Без категории')
                 ws.cell(row=row, column=2, value=item['products_count'] or 0)
                 ws.cell(row=row, column=3, value=item['batches_count'] or 0)
-                ws.cell(row=row, column=4, value=item['total_quantity'] or 0)
+                ws.cell(row=row, column=4, value=item['quantity'] or 0)
                 ws.cell(row=row, column=5, value=float(item['avg_price'] or 0))
                 ws.cell(row=row, column=6, value=float(item['total_value'] or 0))
                 row += 1
@@ -1564,3 +1198,33 @@ class ExportReportsView(TemplateView):
             messages.error(request, _('Ошибка при экспорте: {}').format(str(e)))
             return self.get(request)
 
+
+@user_passes_test(is_staff)
+def export_job_status(request, pk):
+    """Состояние задания экспорта для опроса со страницы"""
+    fail_stale_jobs(ExportJob.objects.filter(pk=pk))
+    job = get_object_or_404(ExportJob, pk=pk)
+    return JsonResponse({
+        'id': job.pk,
+        'report_type': job.report_type,
+        'status': job.status,
+        'progress': job.progress,
+        'filename': job.filename,
+        'error': job.error_message,
+        'ready': job.is_ready,
+    })
+
+
+@user_passes_test(is_staff)
+def export_job_download(request, pk):
+    """Скачивание результата готового задания экспорта"""
+    job = get_object_or_404(ExportJob, pk=pk)
+    path = job_file(job)
+    if path is None:
+        raise Http404(_('Файл отчета не готов или срок его хранения истек'))
+    return FileResponse(
+        path.open('rb'),
+        as_attachment=True,
+        filename=job.filename,
+        content_type=job.content_type or None,
+    )
@@ -4,11 +4,13 @@
 import logging
 from datetime import timedelta
 from decimal import Decimal
-from typing import Dict, List
+from typing import Dict
 
+from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
-from django.db.models import Count, Q, Sum, Avg, Min
-from django.db.models.functions import TruncDay
+from django.core.cache import cache
+from django.db.models import Avg, Count, DecimalField, F, FloatField, Q, Sum
+from django.db.models.functions import Coalesce, TruncDay
 from django.http import JsonResponse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
@@ -17,7 +19,9 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.views.generic import TemplateView
 
-from ..models import ProductBatch, Product, Category, BatchAuditLog, OrderItem
+from ..batch_allocation import expiry_percent_expression
+from ..db_routing import replica_reads
+from ..models import ProductBatch, BatchAuditLog, OrderItem
 
 logger = logging.getLogger(__name__)
 
@@ -27,149 +31,127 @@ def is_staff_or_manager(user):
     return user.is_staff or (user.role and user.role.can_manage_store)
 
 
+WAREHOUSE_METRICS_CACHE_KEY = 'warehouse_dashboard:metrics'
+
+# Пороги карточек дашборда
+EXPIRING_WINDOWS = (3, 7, 14)
+LOW_STOCK_THRESHOLD = 10
+SPOILAGE_PERIOD_DAYS = 30
+
+
+def _metrics_cache_timeout():
+    return getattr(settings, 'WAREHOUSE_DASHBOARD_CACHE_SECONDS', 60)
+
+
+def collect_warehouse_metrics(today=None) -> Dict:
+    """
+    Метрики дашборда склада: счетчики по партиям — одна условная агрегация по
+    ProductBatch (включая средний процент срока годности по всем партиям в остатке),
+    списания — одна агрегация по BatchAuditLog с JOIN партии и товара, плюс
+    группировки для графиков.
+    """
+    today = today or timezone.now().date()
+    now = timezone.now()
+    in_stock = Q(remaining_quantity__gt=0)
+    expired = in_stock & Q(expiry_date__lt=today)
+    low_stock = in_stock & Q(remaining_quantity__lte=LOW_STOCK_THRESHOLD)
+
+    batch_totals = ProductBatch.objects.aggregate(
+        **{
+            f'expiring_{days}_days': Count('id', filter=in_stock & Q(
+                expiry_date__gte=today, expiry_date__lte=today + timedelta(days=days),
+            ))
+            for days in EXPIRING_WINDOWS
+        },
+        expired_count=Count('id', filter=expired),
+        expired_quantity=Coalesce(Sum('remaining_quantity', filter=expired), 0),
+        low_stock_count=Count('id', filter=low_stock),
+        low_stock_quantity=Coalesce(Sum('remaining_quantity', filter=low_stock), 0),
+        total_batches=Count('id', filter=in_stock),
+        total_quantity=Coalesce(Sum('remaining_quantity', filter=in_stock), 0),
+        avg_percent=Avg(expiry_percent_expression(today), filter=in_stock, output_field=FloatField()),
+    )
+
+    # Стоимость списанного — по остатку до списания (old_value) и текущей цене товара
+    spoilage = BatchAuditLog.objects.filter(
+        action='spoiled',
+        created_at__gte=now - timedelta(days=SPOILAGE_PERIOD_DAYS),
+    ).aggregate(
+        spoiled_count=Count('id'),
+        spoiled_value=Coalesce(
+            Sum(
+                F('old_value') * F('batch__product__price'),
+                output_field=DecimalField(max_digits=14, decimal_places=2),
+            ),
+            Decimal('0'),
+        ),
+    )
+
+    # Топ товаров по скорости продаж (за последние 7 дней)
+    top_products = (
+        OrderItem.objects.filter(
+            order__order_date__gte=now - timedelta(days=7),
+            order__status__in=['delivered', 'ready'],
+        )
+        .values('product__name', 'product__id')
+        .annotate(
+            total_sold=Sum('quantity'),
+            total_revenue=Sum('price_per_unit'),
+        )
+        .order_by('-total_sold')[:10]
+    )
+
+    # Партии по категориям (для карты тепла)
+    batches_by_category = (
+        ProductBatch.objects.filter(in_stock)
+        .values('product__category__name')
+        .annotate(
+            total_batches=Count('id'),
+            expiring_soon=Count('id', filter=Q(
+                expiry_date__gte=today,
+                expiry_date__lte=today + timedelta(days=7),
+            )),
+            total_quantity=Sum('remaining_quantity'),
+        )
+        .order_by('-expiring_soon')[:10]
+    )
+
+    return {
+        **batch_totals,
+        'avg_percent': round(batch_totals['avg_percent'] or 0, 1),
+        'spoiled_count': spoilage['spoiled_count'],
+        'spoiled_value': spoilage['spoiled_value'],
+        'top_products': list(top_products),
+        'batches_by_category': list(batches_by_category),
+    }
+
+
+def get_warehouse_metrics() -> Dict:
+    """Метрики из общего кэша: все менеджеры в пределах окна видят один расчет"""
+    metrics = cache.get(WAREHOUSE_METRICS_CACHE_KEY)
+    if metrics is None:
+        metrics = collect_warehouse_metrics()
+        cache.set(WAREHOUSE_METRICS_CACHE_KEY, metrics, timeout=_metrics_cache_timeout())
+    return metrics
+
+
 @method_decorator(user_passes_test(is_staff_or_manager), name='dispatch')
+@method_decorator(replica_reads, name='dispatch')
 class WarehouseDashboardView(TemplateView):
     """Дашборд для менеджеров склада с метриками по партиям"""
     template_name = 'admin/warehouse_dashboard.html'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        
-        today = timezone.now().date()
-        
-        # Партии, истекающие через разные периоды
-        expiring_3_days = ProductBatch.objects.filter(
-            expiry_date__gte=today,
-            expiry_date__lte=today + timedelta(days=3),
-            remaining_quantity__gt=0
-        ).count()
-        
-        expiring_7_days = ProductBatch.objects.filter(
-            expiry_date__gte=today,
-            expiry_date__lte=today + timedelta(days=7),
-            remaining_quantity__gt=0
-        ).count()
-        
-        expiring_14_days = ProductBatch.objects.filter(
-            expiry_date__gte=today,
-            expiry_date__lte=today + timedelta(days=14),
-            remaining_quantity__gt=0
-        ).count()
-        
-        # Просроченные партии
-        expired_batches = ProductBatch.objects.filter(
-            expiry_date__lt=today,
-            remaining_quantity__gt=0
-        )
-        expired_count = expired_batches.count()
-        expired_quantity = expired_batches.aggregate(
-            total=Sum('remaining_quantity')
-        )['total'] or 0
-        
-        # Партии с низким остатком
-        low_stock_batches = ProductBatch.objects.filter(
-            remaining_quantity__lte=10,
-            remaining_quantity__gt=0
-        )
-        low_stock_count = low_stock_batches.count()
-        low_stock_quantity = low_stock_batches.aggregate(
-            total=Sum('remaining_quantity')
-        )['total'] or 0
-        
-        # Статистика списаний за последние 30 дней
-        last_30_days = timezone.now() - timedelta(days=30)
-        spoiled_logs = BatchAuditLog.objects.filter(
-            action='spoiled',
-            created_at__gte=last_30_days
-        )
-        spoiled_count = spoiled_logs.count()
-        spoiled_batches = ProductBatch.objects.filter(
-            audit_logs__action='spoiled',
-            audit_logs__created_at__gte=last_30_days
-        ).distinct()
-        
-        # Общая стоимость списанного (примерная)
-        spoiled_value = 0
-        for batch in spoiled_batches:
-            spoiled_value += float(batch.product.price) * (batch.audit_logs.filter(
-                action='spoiled',
-                created_at__gte=last_30_days
-            ).first().old_value or 0)
-        
-        # Топ товаров по скорости продаж (за последние 7 дней)
-        last_7_days = timezone.now() - timedelta(days=7)
-        top_products = (
-            OrderItem.objects.filter(
-                order__order_date__gte=last_7_days,
-                order__status__in=['delivered', 'ready']
-            )
-            .values('product__name', 'product__id')
-            .annotate(
-                total_sold=Sum('quantity'),
-                total_revenue=Sum('price_per_unit')
-            )
-            .order_by('-total_sold')[:10]
-        )
-        
-        # Партии по категориям (для карты тепла)
-        batches_by_category = (
-            ProductBatch.objects.filter(remaining_quantity__gt=0)
-            .values('product__category__name')
-            .annotate(
-                total_batches=Count('id'),
-                expiring_soon=Count('id', filter=Q(
-                    expiry_date__gte=today,
-                    expiry_date__lte=today + timedelta(days=7)
-                )),
-                total_quantity=Sum('remaining_quantity')
-            )
-            .order_by('-expiring_soon')[:10]
-        )
-        
-        # Общая статистика
-        total_batches = ProductBatch.objects.filter(remaining_quantity__gt=0).count()
-        total_quantity = ProductBatch.objects.filter(remaining_quantity__gt=0).aggregate(
-            total=Sum('remaining_quantity')
-        )['total'] or 0
-        
-        # Средний процент срока годности
-        batches_with_percent = ProductBatch.objects.filter(
-            remaining_quantity__gt=0,
-            production_date__isnull=False
-        )
-        avg_percent = 0
-        count = 0
-        for batch in batches_with_percent[:100]:  # Ограничиваем для производительности
-            percent = batch.expiry_percent_remaining
-            if percent is not None:
-                avg_percent += percent
-                count += 1
-        avg_percent = avg_percent / count if count > 0 else 0
-        
-        context.update({
-            'title': _('Дашборд склада'),
-            'expiring_3_days': expiring_3_days,
-            'expiring_7_days': expiring_7_days,
-            'expiring_14_days': expiring_14_days,
-            'expired_count': expired_count,
-            'expired_quantity': expired_quantity,
-            'low_stock_count': low_stock_count,
-            'low_stock_quantity': low_stock_quantity,
-            'spoiled_count': spoiled_count,
-            'spoiled_value': round(spoiled_value, 2),
-            'top_products': list(top_products),
-            'batches_by_category': list(batches_by_category),
-            'total_batches': total_batches,
-            'total_quantity': total_quantity,
-            'avg_percent': round(avg_percent, 1),
-        })
-        
+        context.update(get_warehouse_metrics())
+        context['title'] = _('Дашборд склада')
         return context
 
 
 @csrf_exempt
 @require_http_methods(["GET"])
 @user_passes_test(is_staff_or_manager)
+@replica_reads
 def warehouse_dashboard_api(request):
     """API endpoint для динамического обновления данных дашборда"""
     try:
@@ -21,6 +21,8 @@ from .serializers import (
     CartCreateSerializer
 )
 # UserAddressSerializer, DeliverySlotSerializer, StoreInventorySerializer - не используются
+from . import product_suggest
+from .product_search import search_products
 
 
 class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
@@ -32,15 +34,52 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
     search_fields = ['name', 'description']
 
 
+class ProductSearchFilter(SearchFilter):
+    """
+    ?search= через полнотекстовый и триграммный поиск (product_search.py).
+    Без явного ?ordering= результаты идут по релевантности.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '')
+        if not query.strip():
+            return queryset
+        return search_products(queryset, query, order_by_rank=True)
+
+
 class ProductViewSet(viewsets.ReadOnlyModelViewSet):
     """ViewSet для товаров (только чтение)"""
     queryset = Product.objects.filter(is_active=True).select_related('category', 'manufacturer')
     serializer_class = ProductSerializer
     permission_classes = [AllowAny]
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     filterset_fields = ['category', 'manufacturer', 'is_featured']
     search_fields = ['name', 'description']
-    ordering_fields = ['price', 'rating', 'created_at']
+    ordering_fields = ['price', 'rating', 'created_at', 'sellable_quantity']
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # ?in_stock=1 — только товары с доступным к продаже остатком
+        if self.request.query_params.get('in_stock') in ('1', 'true', 'True'):
+            queryset = queryset.filter(sellable_quantity__gt=0)
+        return queryset
+    
+    @action(detail=False, methods=['get'], authentication_classes=[], permission_classes=[AllowAny])
+    def suggest(self, request):
+        """Подсказки поиска по префиксу: из индекса в памяти, без запросов к БД"""
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 20)
+        except ValueError:
+            limit = 10
+        suggestions = product_suggest.suggest(query, limit)
+        return Response({
+            'query': query,
+            'suggestions': [
+                {'text': item.text, 'type': item.kind, 'product_id': item.product_id}
+                for item in suggestions
+            ],
+        })
     
     @action(detail=True, methods=['get'])
     def reviews(self, request, pk=None):
@@ -9,4 +9,7 @@ class PaintShopProjectConfig(AppConfig):
         """Подключаем сигналы при запуске приложения"""
         import paint_shop_project.batch_signals  # noqa
         import paint_shop_project.product_signals  # noqa
-        import paint_shop_project.loyalty_signals  # noqa
\ No newline at end of file
+        import paint_shop_project.loyalty_signals  # noqa
+        import paint_shop_project.promo_signals  # noqa
+        import paint_shop_project.sales_signals  # noqa
+        import paint_shop_project.suggest_signals  # noqa
@@ -0,0 +1,207 @@
+"""
+Каталог резервных копий и сроки хранения
+
+Каждая записанная копия регистрируется в BackupFile (register_backup): размер,
+SHA-256, метка и класс хранения. Страница обслуживания читает каталог вместо обхода
+каталога на диске, а очистка выбирает истекшие копии одним запросом по
+(retention_class, created_at).
+
+Классы хранения (дед-отец-сын): первая плановая копия месяца — monthly, первая
+плановая копия недели — weekly, остальные плановые — daily. Копии перед
+восстановлением — pre_restore, созданные вручную — manual. Срок хранения в днях для
+каждого класса задает BACKUP_RETENTION_DAYS; класс без срока хранится бессрочно.
+
+Файлы, появившиеся или пропавшие мимо perform_backup (скопированы вручную, удалены
+с диска), подхватывает reconcile_catalog — периодическая задача
+reconcile_backup_catalog и одноименная команда manage.py.
+"""
+from __future__ import annotations
+
+import logging
+import os
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+
+from . import pg_backup
+from .models import BackupFile, DatabaseBackup
+
+logger = logging.getLogger(__name__)
+
+DAILY = 'daily'
+WEEKLY = 'weekly'
+MONTHLY = 'monthly'
+PRE_RESTORE = 'pre_restore'
+MANUAL = 'manual'
+
+# Метки perform_backup, которыми помечены плановые копии
+SCHEDULED_LABELS = {'scheduled', 'auto'}
+
+DEFAULT_RETENTION_DAYS = {
+    DAILY: 7,
+    WEEKLY: 35,
+    MONTHLY: 365,
+    PRE_RESTORE: 14,
+}
+
+
+def retention_days() -> Dict[str, Optional[int]]:
+    return getattr(settings, 'BACKUP_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+
+
+def classify(label: Optional[str], created_at: datetime) -> str:
+    """Класс хранения новой копии; плановые делятся на monthly/weekly/daily"""
+    if label == 'pre_restore':
+        return PRE_RESTORE
+    if label not in SCHEDULED_LABELS:
+        return MANUAL
+
+    local = timezone.localtime(created_at)
+    month_start = local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if not BackupFile.objects.filter(retention_class=MONTHLY, created_at__gte=month_start, created_at__lte=created_at).exists():
+        return MONTHLY
+    week_start = (local - timedelta(days=local.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    if not BackupFile.objects.filter(
+        retention_class__in=(WEEKLY, MONTHLY), created_at__gte=week_start, created_at__lte=created_at,
+    ).exists():
+        return WEEKLY
+    return DAILY
+
+
+def register_backup(
+    path: Path,
+    *,
+    record: Optional[DatabaseBackup] = None,
+    label: Optional[str] = None,
+    checksum: str = '',
+    created_at: Optional[datetime] = None,
+) -> BackupFile:
+    """Добавляет (или обновляет) файл копии в каталоге"""
+    created_at = created_at or timezone.now()
+    entry, _created = BackupFile.objects.update_or_create(
+        file_path=str(path),
+        defaults={
+            'file_size': path.stat().st_size,
+            'checksum': checksum,
+            'label': label or '',
+            'retention_class': classify(label, created_at),
+            'backup': record,
+            'created_at': created_at,
+        },
+    )
+    return entry
+
+
+def catalog_entries(root: Path) -> QuerySet:
+    """Копии в стандартном каталоге, новые первыми"""
+    return BackupFile.objects.filter(file_path__startswith=f'{root}{os.sep}').order_by('-created_at')
+
+
+def expired_entries(now: Optional[datetime] = None, daily_days: Optional[int] = None) -> QuerySet:
+    now = now or timezone.now()
+    days_by_class = dict(retention_days())
+    if daily_days is not None:
+        days_by_class[DAILY] = daily_days
+    condition = Q(pk__in=[])
+    for retention_class, days in days_by_class.items():
+        if days is not None:
+            condition |= Q(retention_class=retention_class, created_at__lt=now - timedelta(days=days))
+    return BackupFile.objects.filter(condition)
+
+
+def _remove_files(path: Path) -> int:
+    """Удаляет файл копии и его .sha256, возвращает освобожденные байты"""
+    freed = 0
+    for target in (path, pg_backup.checksum_path(path)):
+        try:
+            freed += target.stat().st_size
+            target.unlink()
+        except FileNotFoundError:
+            continue
+    return freed
+
+
+def apply_retention(now: Optional[datetime] = None, daily_days: Optional[int] = None) -> dict:
+    """
+    Удаляет копии с истекшим сроком хранения: один запрос на выборку, файлы
+    удаляются по списку, строки каталога — одним DELETE. Файл, который не удалось
+    удалить, остается в каталоге до следующего запуска.
+    """
+    deleted_ids: List[int] = []
+    freed = 0
+    errors: List[str] = []
+    for entry_id, file_path in expired_entries(now, daily_days).values_list('id', 'file_path'):
+        try:
+            freed += _remove_files(Path(file_path))
+        except OSError as exc:
+            errors.append(f'Failed to delete {file_path}: {exc}')
+            logger.error("Failed to delete expired backup %s: %s", file_path, exc)
+            continue
+        deleted_ids.append(entry_id)
+    BackupFile.objects.filter(id__in=deleted_ids).delete()
+    logger.info("Backup retention: deleted %d files, freed %d bytes", len(deleted_ids), freed)
+    return {'deleted': len(deleted_ids), 'freed_bytes': freed, 'errors': errors}
+
+
+def _read_checksum(path: Path) -> str:
+    sidecar = pg_backup.checksum_path(path)
+    if sidecar.exists():
+        return sidecar.read_text(encoding='utf-8').split()[0]
+    return pg_backup.write_checksum_file(path)
+
+
+def reconcile_catalog(root: Optional[Path] = None, verify: bool = False) -> dict:
+    """
+    Сверяет каталог с диском одним обходом root: добавляет неизвестные файлы копий,
+    удаляет строки пропавших файлов, при verify пересчитывает SHA-256 и возвращает
+    id строк с расхождением.
+    """
+    from .admin_views.database import ALLOWED_BACKUP_EXTENSIONS, _get_backup_root
+
+    root = root or _get_backup_root()
+
+    known = dict(BackupFile.objects.values_list('file_path', 'checksum'))
+    on_disk = sorted(
+        (
+            path for path in root.rglob('*')
+            if path.is_file() and path.suffix.lower() in ALLOWED_BACKUP_EXTENSIONS
+        ),
+        key=lambda path: path.stat().st_mtime,
+    )
+
+    added = 0
+    for path in on_disk:
+        if str(path) in known:
+            continue
+        # Плановые копии лежат в папках auto_<дата>/<время>/ (см. create_scheduled_backup)
+        if path.stem.endswith('_pre_restore'):
+            label = 'pre_restore'
+        elif path.parent.parent.name.startswith('auto_'):
+            label = 'scheduled'
+        else:
+            label = ''
+        created_at = datetime.fromtimestamp(path.stat().st_mtime, tz=dt_timezone.utc)
+        register_backup(path, label=label, checksum=_read_checksum(path), created_at=created_at)
+        added += 1
+
+    disk_paths = {str(path) for path in on_disk}
+    missing = [
+        file_path for file_path in known
+        if file_path not in disk_paths and (file_path.startswith(f'{root}{os.sep}') or not Path(file_path).exists())
+    ]
+    BackupFile.objects.filter(file_path__in=missing).delete()
+
+    mismatched: List[int] = []
+    if verify:
+        for entry in BackupFile.objects.exclude(checksum='').only('id', 'file_path', 'checksum'):
+            path = Path(entry.file_path)
+            if path.exists() and pg_backup.file_sha256(path) != entry.checksum:
+                mismatched.append(entry.id)
+
+    logger.info("Backup catalog reconciled: added=%d removed=%d mismatched=%d", added, len(missing), len(mismatched))
+    return {'added': added, 'removed': len(missing), 'mismatched': mismatched}
@@ -0,0 +1,362 @@
+"""
+Подбор партий по FEFO с правилом 70% срока годности
+
+Правило «партию можно продать, если осталось не меньше min_percent срока годности»
+выражено в SQL (см. sellable_condition), поэтому доступный остаток по всей корзине
+считается одним запросом, а план подбора партий для заказа — по одному списку партий,
+отсортированному по сроку годности (First Expired, First Out).
+
+Product.sellable_quantity хранит тот же остаток в денормализованном виде для каталога
+и API; его пересчитывает refresh_sellable_quantity.
+"""
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import (
+    Case,
+    Count,
+    DateField,
+    DurationField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    FloatField,
+    Func,
+    IntegerField,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Least
+from django.db.models.lookups import GreaterThan, GreaterThanOrEqual, LessThan, LessThanOrEqual
+from django.utils import timezone
+
+from .models import BatchAuditLog, OrderItem, Product, ProductBatch
+
+logger = logging.getLogger(__name__)
+
+MIN_SELLABLE_PERCENT = 70
+
+
+class BatchAllocationError(Exception):
+    """Остаток партии изменился между построением плана и его применением"""
+
+
+def sellable_condition(
+    today: Optional[date] = None,
+    min_percent: int = MIN_SELLABLE_PERCENT,
+    prefix: str = '',
+) -> Q:
+    """
+    SQL-аналог ProductBatch.is_sellable: не просрочена, есть остаток и
+    (expiry - today) * 100 >= (expiry - production) * min_percent.
+
+    prefix позволяет применить условие через связь, например 'batches__' для Product.
+    """
+    today = today or timezone.now().date()
+    expiry = F(f'{prefix}expiry_date')
+    shelf_total = ExpressionWrapper(expiry - F(f'{prefix}production_date'), output_field=DurationField())
+    shelf_left = ExpressionWrapper(expiry - Value(today, output_field=DateField()), output_field=DurationField())
+
+    condition = Q(**{f'{prefix}expiry_date__gte': today, f'{prefix}remaining_quantity__gt': 0})
+    if min_percent > 0:
+        condition &= Q(GreaterThan(shelf_total, timedelta(0)))
+        condition &= Q(GreaterThanOrEqual(
+            ExpressionWrapper(shelf_left * 100, output_field=DurationField()),
+            ExpressionWrapper(shelf_total * min_percent, output_field=DurationField()),
+        ))
+    return condition
+
+
+class DaysBetween(Func):
+    """Число дней end - start для двух дат (целое)"""
+    arity = 2
+    arg_joiner = ' - '
+    template = '(%(expressions)s)'  # PostgreSQL: date - date = integer
+    output_field = IntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        end, start = (compiler.compile(expression) for expression in self.get_source_expressions())
+        return f'CAST(julianday({end[0]}) - julianday({start[0]}) AS INTEGER)', [*end[1], *start[1]]
+
+
+def expiry_percent_expression(today: Optional[date] = None, prefix: str = ''):
+    """
+    SQL-аналог ProductBatch.expiry_percent_remaining: доля оставшегося срока
+    годности 0–100, для просроченных партий и партий без срока — 0.
+    """
+    today = today or timezone.now().date()
+    expiry = F(f'{prefix}expiry_date')
+    shelf_total = DaysBetween(expiry, F(f'{prefix}production_date'))
+    shelf_left = DaysBetween(expiry, Value(today, output_field=DateField()))
+    return Case(
+        When(LessThanOrEqual(shelf_total, 0), then=Value(0.0)),
+        When(LessThan(shelf_left, 0), then=Value(0.0)),
+        When(GreaterThanOrEqual(shelf_left, shelf_total), then=Value(100.0)),
+        default=ExpressionWrapper(shelf_left * Value(100.0) / shelf_total, output_field=FloatField()),
+        output_field=FloatField(),
+    )
+
+
+def sellable_batches(product_ids: Iterable[int], *, today=None, min_percent: int = MIN_SELLABLE_PERCENT):
+    """Продаваемые партии товаров в порядке FEFO"""
+    return (
+        ProductBatch.objects
+        .filter(sellable_condition(today, min_percent), product_id__in=list(product_ids))
+        .order_by('expiry_date', 'production_date', 'id')
+    )
+
+
+# ==================== ДОСТУПНОСТЬ ====================
+
+@dataclass(frozen=True)
+class ProductAvailability:
+    """Остаток товара с учётом продаваемых партий"""
+    product_id: int
+    name: str
+    stock_quantity: int
+    has_expiry_date: bool
+    has_batches: bool
+    sellable_quantity: int
+
+    @property
+    def uses_batches(self) -> bool:
+        # Для товаров со сроком годности, у которых партии ещё не заведены, достаточно общего остатка
+        return self.has_expiry_date and self.has_batches
+
+    @property
+    def available_quantity(self) -> int:
+        if self.uses_batches:
+            return min(self.stock_quantity, self.sellable_quantity)
+        return self.stock_quantity
+
+    def shortage_message(self, quantity: int) -> Optional[str]:
+        """Описание нехватки для пользователя или None, если товара достаточно"""
+        if self.stock_quantity < quantity:
+            return f"{self.name} (доступно {self.stock_quantity}, требуется {quantity})"
+        if self.uses_batches and self.sellable_quantity < quantity:
+            return (
+                f"{self.name} (доступно {self.sellable_quantity} в партиях с минимум "
+                f"{MIN_SELLABLE_PERCENT}% срока годности, требуется {quantity})"
+            )
+        return None
+
+
+def load_availability(
+    product_ids: Iterable[int],
+    *,
+    today=None,
+    min_percent: int = MIN_SELLABLE_PERCENT,
+) -> Dict[int, ProductAvailability]:
+    """Остатки и продаваемые количества по всем товарам одним запросом"""
+    rows = (
+        Product.objects
+        .filter(id__in=list(product_ids))
+        .annotate(
+            sellable=Coalesce(
+                Sum('batches__remaining_quantity', filter=sellable_condition(today, min_percent, 'batches__')),
+                0,
+            ),
+            batch_count=Count('batches'),
+        )
+        .values_list('id', 'name', 'stock_quantity', 'has_expiry_date', 'batch_count', 'sellable')
+    )
+    return {
+        product_id: ProductAvailability(
+            product_id=product_id,
+            name=name,
+            stock_quantity=stock_quantity or 0,
+            has_expiry_date=has_expiry_date,
+            has_batches=batch_count > 0,
+            sellable_quantity=sellable or 0,
+        )
+        for product_id, name, stock_quantity, has_expiry_date, batch_count, sellable in rows
+    }
+
+
+def find_shortages(quantities: Dict[int, int], **kwargs) -> List[str]:
+    """Список нехваток по корзине {product_id: количество}"""
+    availability = load_availability(quantities.keys(), **kwargs)
+    shortages: List[str] = []
+    for product_id, quantity in quantities.items():
+        info = availability.get(product_id)
+        if info is None:
+            shortages.append(f"Товар #{product_id} (недоступен)")
+            continue
+        message = info.shortage_message(quantity)
+        if message:
+            shortages.append(message)
+    return shortages
+
+
+# ==================== ДЕНОРМАЛИЗОВАННЫЙ ОСТАТОК ====================
+
+def sellable_quantity_expression(today=None, min_percent: int = MIN_SELLABLE_PERCENT):
+    """
+    Выражение для Product.sellable_quantity: для товаров со сроком годности и партиями —
+    меньшее из stock_quantity и суммы продаваемых партий, для остальных — stock_quantity.
+    """
+    batches = ProductBatch.objects.filter(product=OuterRef('pk')).order_by()
+    in_batches = Subquery(
+        batches.filter(sellable_condition(today, min_percent))
+        .values('product')
+        .annotate(total=Sum('remaining_quantity'))
+        .values('total')[:1],
+        output_field=IntegerField(),
+    )
+    return Case(
+        When(
+            Exists(batches),
+            has_expiry_date=True,
+            then=Least(F('stock_quantity'), Coalesce(in_batches, 0)),
+        ),
+        default=F('stock_quantity'),
+        output_field=IntegerField(),
+    )
+
+
+def refresh_sellable_quantity(product_ids: Optional[Iterable[int]] = None, *, today=None) -> int:
+    """
+    Пересчитывает Product.sellable_quantity одним UPDATE для указанных товаров
+    (или для всех, если product_ids не передан). Возвращает число обновлённых строк.
+    """
+    products = Product.objects.all()
+    if product_ids is not None:
+        product_ids = {pid for pid in product_ids if pid is not None}
+        if not product_ids:
+            return 0
+        products = products.filter(id__in=product_ids)
+    return products.update(sellable_quantity=sellable_quantity_expression(today))
+
+
+# ==================== ПЛАН FEFO ====================
+
+@dataclass(frozen=True)
+class BatchTake:
+    batch: ProductBatch
+    quantity: int
+
+
+@dataclass(frozen=True)
+class LineAllocation:
+    """Подбор партий для одной позиции заказа"""
+    item: OrderItem
+    takes: Tuple[BatchTake, ...]
+
+    @property
+    def allocated(self) -> int:
+        return sum(take.quantity for take in self.takes)
+
+    @property
+    def is_complete(self) -> bool:
+        return self.allocated >= self.item.quantity
+
+
+@dataclass(frozen=True)
+class AllocationPlan:
+    lines: Tuple[LineAllocation, ...]
+
+    @property
+    def complete_lines(self) -> List[LineAllocation]:
+        return [line for line in self.lines if line.is_complete]
+
+    @property
+    def incomplete_lines(self) -> List[LineAllocation]:
+        return [line for line in self.lines if not line.is_complete]
+
+
+def plan_fefo(items: Iterable[OrderItem], *, today=None, min_percent: int = MIN_SELLABLE_PERCENT) -> AllocationPlan:
+    """
+    Строит план подбора: каждой позиции достаются партии с ближайшим сроком годности.
+    Несколько позиций одного товара не делят один и тот же остаток дважды.
+    """
+    items = list(items)
+    batches_by_product: Dict[int, List[ProductBatch]] = {}
+    for batch in sellable_batches({item.product_id for item in items}, today=today, min_percent=min_percent):
+        batches_by_product.setdefault(batch.product_id, []).append(batch)
+
+    left: Dict[int, int] = {}
+    lines: List[LineAllocation] = []
+    for item in items:
+        needed = item.quantity
+        takes: List[BatchTake] = []
+        for batch in batches_by_product.get(item.product_id, []):
+            if needed <= 0:
+                break
+            available = left.setdefault(batch.id, batch.remaining_quantity)
+            take = min(needed, available)
+            if take > 0:
+                takes.append(BatchTake(batch=batch, quantity=take))
+                left[batch.id] = available - take
+                needed -= take
+        lines.append(LineAllocation(item=item, takes=tuple(takes)))
+    return AllocationPlan(lines=tuple(lines))
+
+
+def apply_allocation(plan: AllocationPlan, *, user=None, ip_address=None) -> int:
+    """
+    Применяет полностью обеспеченные позиции плана: списывает остатки партий и
+    назначает позициям первую партию. Обновления и записи аудита выполняются пакетно.
+    Возвращает число использованных партий.
+    """
+    lines = plan.complete_lines
+    if not lines:
+        return 0
+
+    taken: Dict[int, int] = {}
+    for line in lines:
+        for take in line.takes:
+            taken[take.batch.id] = taken.get(take.batch.id, 0) + take.quantity
+
+    now = timezone.now()
+    with transaction.atomic():
+        locked = {
+            batch.id: batch
+            for batch in ProductBatch.objects.select_for_update().filter(id__in=taken).order_by('id')
+        }
+        for batch_id, quantity in taken.items():
+            batch = locked.get(batch_id)
+            if batch is None or batch.remaining_quantity < quantity:
+                raise BatchAllocationError(batch_id)
+
+        audit_logs: List[BatchAuditLog] = []
+        for line in lines:
+            item = line.item
+            for take in line.takes:
+                batch = locked[take.batch.id]
+                old_value = batch.remaining_quantity
+                batch.remaining_quantity -= take.quantity
+                audit_logs.append(BatchAuditLog(
+                    batch=batch,
+                    action='assigned',
+                    user=user,
+                    old_value=old_value,
+                    new_value=batch.remaining_quantity,
+                    comment=(
+                        f'Автоподбор для заказа #{item.order_id}, позиция: {item.product.name} '
+                        f'(взято: {take.quantity} из {item.quantity})'
+                    ),
+                    ip_address=ip_address,
+                ))
+            item.batch = locked[line.takes[0].batch.id]
+
+        for batch in locked.values():
+            batch.updated_at = now
+        ProductBatch.objects.bulk_update(list(locked.values()), ['remaining_quantity', 'updated_at'])
+        OrderItem.objects.bulk_update([line.item for line in lines], ['batch'])
+        BatchAuditLog.objects.bulk_create(audit_logs)
+        # bulk_update не вызывает сигналы партий — пересчитываем остаток явно
+        refresh_sellable_quantity({batch.product_id for batch in locked.values()})
+
+    logger.info(
+        "batches allocated lines=%s batches=%s", len(lines), len(taken),
+    )
+    return sum(len(line.takes) for line in lines)
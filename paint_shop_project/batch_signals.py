@@ -5,6 +5,7 @@ from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from .models import ProductBatch, BatchAuditLog
+from .batch_allocation import refresh_sellable_quantity
 
 
 @receiver(pre_save, sender=ProductBatch)
@@ -51,3 +52,10 @@ def log_batch_deletion(sender, instance, **kwargs):
     )
 
 
+
+
+@receiver(post_save, sender=ProductBatch)
+@receiver(post_delete, sender=ProductBatch)
+def refresh_product_sellable_quantity(sender, instance, **kwargs):
+    """Пересчитывает доступный к продаже остаток товара при любом изменении партии"""
+    refresh_sellable_quantity([instance.product_id])
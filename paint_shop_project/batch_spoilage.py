@@ -0,0 +1,314 @@
+"""
+Списание просроченных партий
+
+Партии списываются пачками по chunk_size (SPOILAGE_CHUNK_SIZE): каждая пачка — одна
+транзакция с одним UPDATE, который обнуляет остаток и возвращает (RETURNING) прежний
+остаток, срок годности, название и цену товара. Из возвращённых строк пишутся записи
+BatchAuditLog (bulk_create) и собирается отчёт — queryset повторно не перебирается.
+Сигналы pre_save/post_save партии при этом не срабатывают, поэтому доступный к продаже
+остаток затронутых товаров пересчитывается явно (refresh_sellable_quantity).
+
+Одновременно работает не больше одного списания на кластер (spoilage_lock): запуски
+из cron и из Celery не спишут одну партию дважды — второй просто пропускается.
+Строки, заблокированные параллельной транзакцией (например, подбором партий заказа),
+пропускаются (SKIP LOCKED) и будут списаны следующим запуском.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.utils import timezone
+
+from .batch_allocation import refresh_sellable_quantity
+from .models import BatchAuditLog, Product, ProductBatch
+
+try:
+    from .prometheus_metrics import (
+        batch_spoilage_batches_total,
+        batch_spoilage_duration_seconds,
+        batch_spoilage_runs_total,
+        batch_spoilage_units_total,
+    )
+    USE_NATIVE_METRICS = True
+except ImportError:
+    USE_NATIVE_METRICS = False
+    from paint_shop.metrics import increment_counter, observe_histogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Одно списание на кластер: ключ pg_advisory_lock в PostgreSQL, ключ кэша на других СУБД
+SPOILAGE_LOCK_KEY = 7316003
+SPOILAGE_LOCK_CACHE_KEY = 'batch_spoilage:lock'
+SPOILAGE_LOCK_TIMEOUT = 60 * 60
+
+# (id партии, id товара, прежний остаток, срок годности, название товара, цена товара)
+SpoiledRow = Tuple[int, int, int, date, str, Decimal]
+
+LINE_VALUE = ExpressionWrapper(
+    F('remaining_quantity') * F('product__price'),
+    output_field=DecimalField(max_digits=16, decimal_places=2),
+)
+
+
+@dataclass
+class SpoilageReport:
+    """Итоги списания (или предпросмотра) по всем партиям и по товарам"""
+    threshold: date
+    batches: int = 0
+    quantity: int = 0
+    value: Decimal = Decimal('0')
+    # {название товара: {'batches', 'total_quantity', 'total_value'}}
+    by_product: Dict[str, Dict] = field(default_factory=dict)
+    chunks: int = 0
+    duration_seconds: float = 0.0
+    locked: bool = False
+
+    def add(self, name: str, batches: int, quantity: int, value: Decimal) -> None:
+        totals = self.by_product.setdefault(
+            name, {'batches': 0, 'total_quantity': 0, 'total_value': Decimal('0')},
+        )
+        totals['batches'] += batches
+        totals['total_quantity'] += quantity
+        totals['total_value'] += value
+        self.batches += batches
+        self.quantity += quantity
+        self.value += value
+
+
+def chunk_size() -> int:
+    return getattr(settings, 'SPOILAGE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def expiry_threshold(days_overdue: int = 0, today: Optional[date] = None) -> date:
+    """Списываются партии со сроком годности раньше этой даты"""
+    return (today or timezone.localdate()) - timedelta(days=days_overdue)
+
+
+@contextmanager
+def spoilage_lock() -> Iterator[bool]:
+    """
+    Блокировка «одно списание на кластер», не ждет освобождения: возвращает, удалось ли
+    ее взять. В PostgreSQL — сессионный pg_advisory_lock (снимается и при обрыве
+    соединения упавшего воркера), на других СУБД — ключ в общем кэше с таймаутом.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [SPOILAGE_LOCK_KEY])
+            acquired = cursor.fetchone()[0]
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", [SPOILAGE_LOCK_KEY])
+        return
+
+    acquired = cache.add(SPOILAGE_LOCK_CACHE_KEY, True, timeout=SPOILAGE_LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(SPOILAGE_LOCK_CACHE_KEY)
+
+
+def _spoil_chunk_postgresql(threshold: date, now, limit: int) -> List[SpoiledRow]:
+    quote = connection.ops.quote_name
+    batch_table = quote(ProductBatch._meta.db_table)
+    product_table = quote(Product._meta.db_table)
+    sql = f"""
+        UPDATE {batch_table} AS b
+        SET remaining_quantity = 0, updated_at = %s
+        FROM (
+            SELECT id, remaining_quantity FROM {batch_table}
+            WHERE expiry_date < %s AND remaining_quantity > 0
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ) AS expired, {product_table} AS p
+        WHERE b.id = expired.id AND p.id = b.product_id
+        RETURNING b.id, b.product_id, expired.remaining_quantity, b.expiry_date, p.name, p.price
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [now, threshold, limit])
+        return cursor.fetchall()
+
+
+def _spoil_chunk_generic(threshold: date, now, limit: int) -> List[SpoiledRow]:
+    # Без UPDATE ... RETURNING: значения пачки читаются тем же фильтром перед обнулением
+    rows = list(
+        ProductBatch.objects.select_for_update()
+        .filter(expiry_date__lt=threshold, remaining_quantity__gt=0)
+        .order_by('id')
+        .values_list('id', 'product_id', 'remaining_quantity', 'expiry_date', 'product__name', 'product__price')
+        [:limit]
+    )
+    if rows:
+        ProductBatch.objects.filter(id__in=[row[0] for row in rows]).update(remaining_quantity=0, updated_at=now)
+    return rows
+
+
+def _spoil_chunk(threshold: date, now, limit: int) -> List[SpoiledRow]:
+    """Списывает одну пачку в своей транзакции, возвращает списанные строки"""
+    spoil = _spoil_chunk_postgresql if connection.vendor == 'postgresql' else _spoil_chunk_generic
+    with transaction.atomic():
+        rows = spoil(threshold, now, limit)
+        if rows:
+            BatchAuditLog.objects.bulk_create([
+                BatchAuditLog(
+                    batch_id=batch_id,
+                    action='spoiled',
+                    old_value=quantity,
+                    new_value=0,
+                    comment=f'Автоматическое списание просроченной партии (просрочена с {expiry_date})',
+                )
+                for batch_id, _product_id, quantity, expiry_date, _name, _price in rows
+            ])
+            refresh_sellable_quantity({row[1] for row in rows})
+    return rows
+
+
+def preview_expired(days_overdue: int = 0) -> SpoilageReport:
+    """Что будет списано (для --dry-run) — один GROUP BY по товарам, без изменений"""
+    report = SpoilageReport(threshold=expiry_threshold(days_overdue))
+    rows = (
+        ProductBatch.objects.filter(expiry_date__lt=report.threshold, remaining_quantity__gt=0)
+        .values('product__name')
+        .annotate(batches=Count('id'), total_value=Sum(LINE_VALUE), total_quantity=Sum('remaining_quantity'))
+        .order_by()
+    )
+    for row in rows:
+        report.add(row['product__name'], row['batches'], row['total_quantity'], row['total_value'] or Decimal('0'))
+    return report
+
+
+def spoil_expired_batches(days_overdue: int = 0, limit: Optional[int] = None) -> SpoilageReport:
+    """
+    Списывает просроченные партии пачками по limit (по умолчанию SPOILAGE_CHUNK_SIZE).
+    Если списание уже идет в другом процессе, возвращает отчет с locked=True.
+    """
+    limit = limit or chunk_size()
+    report = SpoilageReport(threshold=expiry_threshold(days_overdue))
+    started = time.monotonic()
+
+    with spoilage_lock() as acquired:
+        if not acquired:
+            report.locked = True
+            logger.info("Batch spoilage skipped: another run holds the lock")
+            _record_metrics(report, 'locked')
+            return report
+
+        now = timezone.now()
+        while True:
+            rows = _spoil_chunk(report.threshold, now, limit)
+            if not rows:
+                break
+            report.chunks += 1
+            for _batch_id, _product_id, quantity, _expiry_date, name, price in rows:
+                report.add(name, 1, quantity, Decimal(price) * quantity)
+            if len(rows) < limit:
+                break
+
+    report.duration_seconds = time.monotonic() - started
+    _record_metrics(report, 'success')
+    logger.info(
+        "Batch spoilage: %d batches, %d units in %d chunks (%.2fs)",
+        report.batches, report.quantity, report.chunks, report.duration_seconds,
+    )
+    return report
+
+
+def _record_metrics(report: SpoilageReport, status: str) -> None:
+    if USE_NATIVE_METRICS:
+        batch_spoilage_runs_total.labels(status=status).inc()
+        if status == 'success':
+            batch_spoilage_duration_seconds.observe(report.duration_seconds)
+            batch_spoilage_batches_total.inc(report.batches)
+            batch_spoilage_units_total.inc(report.quantity)
+        return
+
+    increment_counter('zhevzhik_batch_spoilage_runs_total', labels={'status': status})
+    if status == 'success':
+        observe_histogram('zhevzhik_batch_spoilage_duration_seconds', report.duration_seconds)
+        increment_counter('zhevzhik_batch_spoilage_batches_total', report.batches)
+        increment_counter('zhevzhik_batch_spoilage_units_total', report.quantity)
+
+
+# ==================== УВЕДОМЛЕНИЯ ====================
+
+def notification_message(report: SpoilageReport, max_products: int = 10) -> str:
+    """Текст уведомления менеджерам (HTML-разметка Telegram)"""
+    lines: List[str] = [
+        '📦 <b>Автоматическое списание просроченных партий</b>',
+        '',
+        f'Списано партий: <b>{report.batches}</b>',
+        f'Списано единиц: <b>{report.quantity}</b>',
+        f'Примерная стоимость: <b>~{report.value:.2f} ₽</b>',
+        '',
+        '<b>Детали по товарам:</b>',
+    ]
+    products: Sequence = sorted(report.by_product.items())
+    for product_name, data in products[:max_products]:
+        lines.append(f'  • {product_name}: {data["total_quantity"]} ед.')
+    if len(products) > max_products:
+        lines.append(f'  ... и еще {len(products) - max_products} товаров')
+    return '\n'.join(lines)
+
+
+def notify_managers(report: SpoilageReport) -> Dict[str, Optional[int]]:
+    """
+    Внутренние уведомления и сообщения в Telegram менеджерам магазинов о списании.
+    Возвращает {'notifications': N, 'telegram': N или None, если Telegram не настроен}.
+    """
+    from .models import Notification, User
+
+    managers = list(User.objects.filter(role__can_manage_store=True, is_active=True).distinct())
+    if not managers:
+        return {'notifications': 0, 'telegram': None}
+
+    message = notification_message(report)
+    message_plain = message.replace('<b>', '').replace('</b>', '')
+    Notification.objects.bulk_create([
+        Notification(
+            user=manager,
+            title='Списание просроченных партий',
+            message=message_plain,
+            notification_type='system',
+            is_read=False,
+        )
+        for manager in managers
+    ])
+
+    try:
+        from .telegram_bot import TelegramNotifier
+        telegram_notifier = TelegramNotifier()
+        telegram_enabled = telegram_notifier.is_configured()
+    except ImportError:
+        telegram_enabled = False
+
+    if not telegram_enabled:
+        return {'notifications': len(managers), 'telegram': None}
+
+    telegram_sent = 0
+    for manager in managers:
+        if not (manager.telegram_chat_id and manager.telegram_notifications_enabled):
+            continue
+        try:
+            chat_id = int(manager.telegram_chat_id)
+        except (ValueError, TypeError):
+            logger.warning("Invalid Telegram chat_id for user %s", manager.username)
+            continue
+        if telegram_notifier.send_message(chat_id, message):
+            telegram_sent += 1
+    return {'notifications': len(managers), 'telegram': telegram_sent}
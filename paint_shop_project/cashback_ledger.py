@@ -0,0 +1,227 @@
+"""
+Журнал и баланс кешбэка
+
+CashbackTransaction — журнал операций, CashbackBalance — текущий баланс пользователя.
+Каждая операция выполняется в одной транзакции:
+
+    SELECT ... FROM cashbackbalance WHERE user_id = %s FOR UPDATE
+    INSERT INTO cashbacktransaction (..., balance_after)
+    UPDATE cashbackbalance SET balance = ...
+
+Поэтому баланс читается одной строкой (get_balance), а два параллельных списания
+одного и того же кешбэка выполняются по очереди: второе видит уже уменьшенный баланс
+и получает InsufficientCashbackError. User.total_cashback_earned/total_cashback_spent
+обновляются здесь же, из той же заблокированной строки.
+
+Начисление увеличивает баланс, списание и сгорание уменьшают. Сверка баланса с
+журналом и исправление расхождений — reconcile_balances (manage.py
+reconcile_cashback_balances).
+"""
+from __future__ import annotations
+
+import logging
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+from django.db import transaction
+from django.db.models import Q, Sum
+
+from .models import CashbackBalance, CashbackTransaction, User
+
+logger = logging.getLogger(__name__)
+
+EARNED = 'earned'
+SPENT = 'spent'
+EXPIRED = 'expired'
+
+ZERO = Decimal('0.00')
+
+# Поле итогов CashbackBalance для каждого типа операции
+_TOTAL_FIELDS = {
+    EARNED: 'total_earned',
+    SPENT: 'total_spent',
+    EXPIRED: 'total_expired',
+}
+
+
+class InsufficientCashbackError(Exception):
+    """Списание больше текущего баланса"""
+
+    def __init__(self, balance: Decimal, amount: Decimal):
+        super().__init__(f'Недостаточно кешбэка: баланс {balance}, требуется {amount}')
+        self.balance = balance
+        self.amount = amount
+
+
+def get_balance(user) -> Decimal:
+    """Текущий баланс: одна строка по первичному ключу"""
+    balance = CashbackBalance.objects.filter(user_id=user.pk).values_list('balance', flat=True).first()
+    return balance if balance is not None else ZERO
+
+
+def get_summary(user) -> CashbackBalance:
+    """Баланс и итоги пользователя; без операций — несохраненная нулевая строка"""
+    return CashbackBalance.objects.filter(user_id=user.pk).first() or CashbackBalance(user_id=user.pk)
+
+
+def _lock_balance(user_id) -> CashbackBalance:
+    balance, _created = CashbackBalance.objects.select_for_update().get_or_create(user_id=user_id)
+    return balance
+
+
+def _record(user, order, amount, transaction_type: str, description: str) -> CashbackTransaction:
+    amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+    if amount <= 0:
+        raise ValueError(f'Сумма операции кешбэка должна быть положительной: {amount}')
+
+    with transaction.atomic():
+        balance = _lock_balance(user.pk)
+        if transaction_type == EARNED:
+            balance.balance += amount
+        else:
+            if amount > balance.balance:
+                raise InsufficientCashbackError(balance.balance, amount)
+            balance.balance -= amount
+        total_field = _TOTAL_FIELDS[transaction_type]
+        setattr(balance, total_field, getattr(balance, total_field) + amount)
+        balance.save(update_fields=['balance', total_field, 'updated_at'])
+
+        entry = CashbackTransaction.objects.create(
+            user_id=user.pk,
+            order=order,
+            amount=amount,
+            transaction_type=transaction_type,
+            description=description,
+            balance_after=balance.balance,
+        )
+        _sync_user_totals(user, balance)
+
+    logger.info(
+        "cashback %s user=%s order=%s amount=%s balance=%s",
+        transaction_type, user.pk, getattr(order, 'pk', None), amount, balance.balance,
+    )
+    return entry
+
+
+def _sync_user_totals(user, balance: CashbackBalance) -> None:
+    User.objects.filter(pk=user.pk).update(
+        total_cashback_earned=balance.total_earned,
+        total_cashback_spent=balance.total_spent,
+    )
+    user.total_cashback_earned = balance.total_earned
+    user.total_cashback_spent = balance.total_spent
+
+
+def earn_cashback(user, order, amount, description: str) -> CashbackTransaction:
+    return _record(user, order, amount, EARNED, description)
+
+
+def spend_cashback(user, order, amount, description: str) -> CashbackTransaction:
+    """Списывает кешбэк; при нехватке бросает InsufficientCashbackError и ничего не меняет"""
+    return _record(user, order, amount, SPENT, description)
+
+
+def expire_cashback(user, order, amount, description: str) -> CashbackTransaction:
+    return _record(user, order, amount, EXPIRED, description)
+
+
+# ==================== СВЕРКА ====================
+
+def ledger_totals(user_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict[str, Decimal]]:
+    """Итоги журнала по пользователям одним GROUP BY"""
+    queryset = CashbackTransaction.objects.all()
+    if user_ids is not None:
+        queryset = queryset.filter(user_id__in=list(user_ids))
+    rows = queryset.order_by().values('user_id').annotate(
+        total_earned=Sum('amount', filter=Q(transaction_type=EARNED)),
+        total_spent=Sum('amount', filter=Q(transaction_type=SPENT)),
+        total_expired=Sum('amount', filter=Q(transaction_type=EXPIRED)),
+    )
+    totals = {}
+    for row in rows:
+        earned = row['total_earned'] or ZERO
+        spent = row['total_spent'] or ZERO
+        expired = row['total_expired'] or ZERO
+        totals[row['user_id']] = {
+            'balance': earned - spent - expired,
+            'total_earned': earned,
+            'total_spent': spent,
+            'total_expired': expired,
+        }
+    return totals
+
+
+_EMPTY_TOTALS = {'balance': ZERO, 'total_earned': ZERO, 'total_spent': ZERO, 'total_expired': ZERO}
+
+
+def _mismatched(balances, totals, user_totals) -> List[int]:
+    mismatched = []
+    for user_id in sorted(set(balances) | set(totals) | set(user_totals)):
+        expected = totals.get(user_id, _EMPTY_TOTALS)
+        balance = balances.get(user_id)
+        if balance is None:
+            if expected != _EMPTY_TOTALS or user_id in user_totals:
+                mismatched.append(user_id)
+            continue
+        if any(getattr(balance, field) != value for field, value in expected.items()):
+            mismatched.append(user_id)
+        elif user_totals.get(user_id, (ZERO, ZERO)) != (expected['total_earned'], expected['total_spent']):
+            mismatched.append(user_id)
+    return mismatched
+
+
+def find_discrepancies() -> List[int]:
+    """
+    Пользователи, у которых баланс или User.total_cashback_* не совпадают с журналом
+    (в том числе нет строки баланса при непустом журнале)
+    """
+    balances = {balance.user_id: balance for balance in CashbackBalance.objects.all()}
+    user_totals = {
+        user_id: (earned, spent)
+        for user_id, earned, spent in User.objects.exclude(total_cashback_earned=0, total_cashback_spent=0)
+        .values_list('id', 'total_cashback_earned', 'total_cashback_spent')
+    }
+    return _mismatched(balances, ledger_totals(), user_totals)
+
+
+def reconcile_balances(fix: bool = False, batch_size: int = 500) -> List[int]:
+    """
+    Сверяет балансы с журналом и возвращает id пользователей с расхождениями.
+    При fix=True исправляет их пачками: строки баланса блокируются, итоги журнала
+    пересчитываются уже под блокировкой, затем bulk_update/bulk_create.
+    """
+    discrepancies = find_discrepancies()
+    if not fix:
+        return discrepancies
+
+    for start in range(0, len(discrepancies), batch_size):
+        user_ids = discrepancies[start:start + batch_size]
+        with transaction.atomic():
+            balances = {
+                balance.user_id: balance
+                for balance in CashbackBalance.objects.select_for_update().filter(user_id__in=user_ids).order_by('user_id')
+            }
+            totals = ledger_totals(user_ids)
+            to_update, to_create = [], []
+            for user_id in user_ids:
+                values = totals.get(user_id, _EMPTY_TOTALS)
+                if user_id in balances:
+                    balance = balances[user_id]
+                    for field, value in values.items():
+                        setattr(balance, field, value)
+                    to_update.append(balance)
+                else:
+                    to_create.append(CashbackBalance(user_id=user_id, **values))
+            CashbackBalance.objects.bulk_update(to_update, list(_EMPTY_TOTALS))
+            CashbackBalance.objects.bulk_create(to_create, ignore_conflicts=True)
+            users = []
+            for user_id in user_ids:
+                values = totals.get(user_id, _EMPTY_TOTALS)
+                users.append(User(
+                    pk=user_id,
+                    total_cashback_earned=values['total_earned'],
+                    total_cashback_spent=values['total_spent'],
+                ))
+            User.objects.bulk_update(users, ['total_cashback_earned', 'total_cashback_spent'])
+        logger.warning("cashback balances repaired users=%s", user_ids)
+    return discrepancies
@@ -0,0 +1,457 @@
+"""
+PDF-отчет дашборда
+
+Шрифты ищутся и регистрируются один раз на процесс (lru_cache), а не при каждом
+экспорте. Графики рисуются matplotlib в PNG-файлы MEDIA_ROOT/exports/charts, имя
+файла содержит период и версию данных (хеш рядов графика): повторный экспорт за
+тот же период при неизменных продажах берет готовые картинки. Картинки можно
+подготовить заранее задачей render_dashboard_charts.
+
+Документ верстается по мере генерации: flowable (и PNG графиков) создаются
+генераторами разделов только тогда, когда reportlab доходит до них (LazyStory), а не
+все сразу до начала сборки. Изображения ссылаются на файлы и читаются reportlab при
+отрисовке страницы, результат пишется в файл, а не в память.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+from django.db.models import Count
+from django.utils import timezone
+
+from .export_jobs import get_export_root, job_ttl
+from .models import Order
+from .sales_rollups import daily_sales, period_start, product_sales
+
+logger = logging.getLogger(__name__)
+
+CHARTS_DIR_NAME = 'charts'
+CHART_DPI = 110
+
+# Шрифты Windows с кириллицей; при их отсутствии остаются встроенные Helvetica
+PDF_FONT_FILES = {
+    'Arial': 'C:/Windows/Fonts/arial.ttf',
+    'Arial-Bold': 'C:/Windows/Fonts/arialbd.ttf',
+    'Times': 'C:/Windows/Fonts/times.ttf',
+    'Times-Bold': 'C:/Windows/Fonts/timesbd.ttf',
+}
+CYRILLIC_FONT_FAMILIES = ('DejaVu', 'Arial', 'Liberation', 'Calibri', 'Tahoma', 'Verdana')
+
+STATUS_LABELS = dict(Order.STATUS_CHOICES)
+STATUS_COLORS = ['#10b981', '#3b82f6', '#f59e0b', '#ef4444', '#8b5cf6', '#ec4899']
+
+
+# ==================== ШРИФТЫ ====================
+
+@lru_cache(maxsize=None)
+def pdf_fonts() -> Dict[str, str]:
+    """Регистрирует TTF-шрифты в reportlab (один раз) и возвращает имена для заголовков и текста"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    for font_name, font_path in PDF_FONT_FILES.items():
+        if not os.path.exists(font_path):
+            continue
+        try:
+            pdfmetrics.registerFont(TTFont(font_name, font_path))
+        except Exception as exc:
+            logger.warning("PDF font %s not registered: %s", font_path, exc)
+
+    registered = pdfmetrics.getRegisteredFontNames()
+    return {
+        'title': 'Arial-Bold' if 'Arial-Bold' in registered else 'Helvetica-Bold',
+        'normal': 'Arial' if 'Arial' in registered else 'Helvetica',
+    }
+
+
+@lru_cache(maxsize=None)
+def _pyplot():
+    """matplotlib с бэкендом Agg и шрифтом с кириллицей; поиск шрифта — один раз на процесс"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.font_manager as fm
+    import matplotlib.pyplot as plt
+
+    found_font = None
+    for font_path in fm.findSystemFonts(fontpaths=None, fontext='ttf'):
+        try:
+            font_name = fm.get_font(font_path).family_name
+        except Exception:
+            continue
+        if any(family in font_name for family in CYRILLIC_FONT_FAMILIES):
+            found_font = font_name
+            break
+
+    plt.rcParams['font.family'] = found_font or ['DejaVu Sans', 'Arial', 'Liberation Sans', 'sans-serif']
+    plt.rcParams['axes.unicode_minus'] = False
+    plt.rcParams['font.size'] = 10
+    return plt
+
+
+# ==================== ДАННЫЕ ====================
+
+def dashboard_data(period: int) -> Dict:
+    """Ряды для графиков и таблицы за последние period дней"""
+    start = period_start(period)
+    daily = list(daily_sales(start))
+    statuses = (
+        Order.objects.filter(order_date__gte=timezone.now() - timedelta(days=period))
+        .values('status')
+        .annotate(count=Count('id'))
+        .order_by('status')
+    )
+    top_products = list(product_sales(start)[:10])
+    return {
+        'days': [row['day'].isoformat() for row in daily],
+        'revenues': [float(row['revenue'] or 0) for row in daily],
+        'orders': [row['orders'] or 0 for row in daily],
+        'statuses': [(STATUS_LABELS.get(row['status'], row['status']), row['count']) for row in statuses],
+        'top_products': [
+            {
+                'name': row['product__name'] or '—',
+                'revenue': float(row['revenue'] or 0),
+                'quantity': row['quantity'] or 0,
+                'orders': row['orders'] or 0,
+            }
+            for row in top_products
+        ],
+    }
+
+
+# ==================== ГРАФИКИ ====================
+
+def _plot_daily_revenue(plt, data):
+    from datetime import date
+
+    dates = [date.fromisoformat(day) for day in data['days']]
+    revenues = data['revenues']
+    fig, ax = plt.subplots(figsize=(10, 4.5))
+    ax.plot(dates, revenues, marker='o', linewidth=2.5, color='#1a2a6c', markersize=6)
+    ax.fill_between(dates, revenues, alpha=0.3, color='#1a2a6c')
+    ax.set_title('Выручка по дням', fontsize=16, fontweight='bold', pad=15)
+    ax.set_xlabel('Дата', fontsize=12, fontweight='bold')
+    ax.set_ylabel('Выручка (₽)', fontsize=12, fontweight='bold')
+    ax.grid(True, alpha=0.3, linestyle='--')
+    plt.xticks(rotation=45, ha='right')
+
+    max_revenue = max(revenues)
+    max_idx = revenues.index(max_revenue)
+    ax.annotate(
+        f'Макс: {max_revenue:.2f} ₽',
+        xy=(dates[max_idx], max_revenue),
+        xytext=(10, 10), textcoords='offset points',
+        bbox=dict(boxstyle='round,pad=0.5', facecolor='yellow', alpha=0.7),
+        arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0'),
+    )
+    return fig
+
+
+def _plot_daily_orders(plt, data):
+    from datetime import date
+
+    dates = [date.fromisoformat(day) for day in data['days']]
+    fig, ax = plt.subplots(figsize=(10, 4.5))
+    bars = ax.bar(dates, data['orders'], color='#4f63d8', alpha=0.8, edgecolor='#1a2a6c', linewidth=1.5)
+    ax.set_title('Количество заказов по дням', fontsize=16, fontweight='bold', pad=15)
+    ax.set_xlabel('Дата', fontsize=12, fontweight='bold')
+    ax.set_ylabel('Количество заказов', fontsize=12, fontweight='bold')
+    ax.grid(True, alpha=0.3, axis='y', linestyle='--')
+    plt.xticks(rotation=45, ha='right')
+    for bar in bars:
+        height = bar.get_height()
+        ax.text(bar.get_x() + bar.get_width() / 2., height, f'{int(height)}', ha='center', va='bottom', fontweight='bold')
+    return fig
+
+
+def _plot_statuses(plt, data):
+    labels = [label for label, _count in data['statuses']]
+    counts = [count for _label, count in data['statuses']]
+    fig, ax = plt.subplots(figsize=(8, 6))
+    _wedges, _texts, autotexts = ax.pie(
+        counts,
+        labels=labels,
+        autopct='%1.1f%%',
+        colors=STATUS_COLORS[:len(labels)],
+        startangle=90,
+        textprops={'fontsize': 11, 'fontweight': 'bold'},
+    )
+    ax.set_title('Распределение заказов по статусам', fontsize=16, fontweight='bold', pad=20)
+    for autotext in autotexts:
+        autotext.set_color('white')
+        autotext.set_fontweight('bold')
+        autotext.set_fontsize(10)
+    return fig
+
+
+def _plot_top_products(plt, data):
+    names = [item['name'] for item in data['top_products']]
+    names = [name[:40] + '...' if len(name) > 40 else name for name in names]
+    revenues = [item['revenue'] for item in data['top_products']]
+    fig, ax = plt.subplots(figsize=(10, 5.5))
+    bars = ax.barh(names, revenues, color='#4f63d8', alpha=0.8, edgecolor='#1a2a6c', linewidth=1.5)
+    ax.set_title('Топ-10 товаров по выручке', fontsize=16, fontweight='bold', pad=15)
+    ax.set_xlabel('Выручка (₽)', fontsize=12, fontweight='bold')
+    ax.set_ylabel('Товар', fontsize=12, fontweight='bold')
+    ax.grid(True, alpha=0.3, axis='x', linestyle='--')
+    for bar, revenue in zip(bars, revenues):
+        ax.text(bar.get_width(), bar.get_y() + bar.get_height() / 2., f'{revenue:.2f} ₽',
+                ha='left', va='center', fontweight='bold', fontsize=9)
+    return fig
+
+
+# Имя графика -> (функция отрисовки, ключи данных, от которых он зависит)
+CHARTS = {
+    'daily_revenue': (_plot_daily_revenue, ('days', 'revenues')),
+    'daily_orders': (_plot_daily_orders, ('days', 'orders')),
+    'statuses': (_plot_statuses, ('statuses',)),
+    'top_products': (_plot_top_products, ('top_products',)),
+}
+
+
+def get_charts_root() -> Path:
+    charts_dir = get_export_root() / CHARTS_DIR_NAME
+    charts_dir.mkdir(parents=True, exist_ok=True)
+    return charts_dir
+
+
+def data_version(data: Dict, keys) -> str:
+    payload = json.dumps({key: data[key] for key in keys}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def chart_path(name: str, period: int, data: Dict) -> Path:
+    """PNG графика; рисуется только если для этого периода и версии данных его еще нет"""
+    plot, keys = CHARTS[name]
+    path = get_charts_root() / f'{name}_{period}_{data_version(data, keys)}.png'
+    if path.exists():
+        os.utime(path)  # продлеваем жизнь используемого графика
+        return path
+
+    plt = _pyplot()
+    fig = plot(plt, data)
+    try:
+        fig.tight_layout()
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        fig.savefig(tmp_path, format='png', dpi=CHART_DPI, bbox_inches='tight')
+        os.replace(tmp_path, path)
+    finally:
+        plt.close(fig)
+    return path
+
+
+def render_dashboard_charts(period: int) -> Dict[str, Path]:
+    """Готовит все графики периода (для прогрева вне запроса)"""
+    data = dashboard_data(period)
+    return {name: chart_path(name, period, data) for name in available_charts(data)}
+
+
+def available_charts(data: Dict) -> List[str]:
+    charts = []
+    if data['days']:
+        charts += ['daily_revenue', 'daily_orders']
+    if data['statuses']:
+        charts.append('statuses')
+    if data['top_products']:
+        charts.append('top_products')
+    return charts
+
+
+def cleanup_chart_cache(max_age: timedelta = None) -> int:
+    """Удаляет графики, не использовавшиеся дольше max_age (по умолчанию — срок хранения экспорта)"""
+    cutoff = time.time() - (max_age or job_ttl()).total_seconds()
+    removed = 0
+    for path in get_charts_root().iterdir():
+        if path.is_file() and path.stat().st_mtime < cutoff:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+# ==================== ДОКУМЕНТ ====================
+
+def _styles(fonts):
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_LEFT
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+
+    styles = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle(
+            'CustomTitle', parent=styles['Heading1'], fontSize=24, textColor=colors.HexColor('#1a2a6c'),
+            spaceAfter=30, alignment=TA_CENTER, fontName=fonts['title'],
+        ),
+        'desc': ParagraphStyle(
+            'Description', parent=styles['Normal'], fontSize=10, textColor=colors.HexColor('#666666'),
+            spaceAfter=12, alignment=TA_JUSTIFY, fontName=fonts['normal'],
+        ),
+        'subtitle': ParagraphStyle(
+            'Subtitle', parent=styles['Heading2'], fontSize=16, textColor=colors.HexColor('#1a2a6c'),
+            spaceAfter=12, spaceBefore=12, alignment=TA_LEFT, fontName=fonts['title'],
+        ),
+        'summary': ParagraphStyle(
+            'Summary', parent=styles['Normal'], fontSize=11, textColor=colors.HexColor('#1a2a6c'),
+            spaceAfter=6, fontName=fonts['title'],
+        ),
+    }
+
+
+# Подписи разделов с графиками: заголовок, описание, размер картинки в дюймах
+CHART_SECTIONS = {
+    'daily_revenue': (
+        '1. Выручка по дням',
+        'График показывает динамику ежедневной выручки за выбранный период. '
+        'Позволяет выявить тренды роста или падения продаж, а также определить наиболее прибыльные дни.',
+        (9, 4.3),
+    ),
+    'daily_orders': (
+        '2. Количество заказов по дням',
+        'Столбчатая диаграмма отображает количество заказов, оформленных каждый день. '
+        'Помогает анализировать активность покупателей и планировать загрузку службы доставки.',
+        (9, 4.3),
+    ),
+    'statuses': (
+        '3. Распределение заказов по статусам',
+        'Круговая диаграмма показывает распределение всех заказов по статусам выполнения. '
+        'Позволяет оценить эффективность обработки заказов и выявить узкие места в процессе доставки.',
+        (7, 5),
+    ),
+    'top_products': (
+        '4. Топ-10 товаров по выручке',
+        'Горизонтальная столбчатая диаграмма отображает товары, приносящие наибольшую выручку. '
+        'Помогает определить наиболее прибыльные позиции и оптимизировать ассортимент.',
+        (9, 4.8),
+    ),
+}
+
+
+def _header(period, styles) -> Iterator:
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Paragraph, Spacer
+
+    yield Paragraph('Дашборд аналитики продаж', styles['title'])
+    yield Spacer(1, 0.1 * inch)
+    yield Paragraph(f'<b>Период анализа:</b> {period} дней', styles['desc'])
+    yield Paragraph(
+        f'<b>Дата формирования отчета:</b> {timezone.localtime().strftime("%d.%m.%Y %H:%M")}', styles['desc'],
+    )
+    yield Spacer(1, 0.2 * inch)
+
+
+def _chart_sections(period, data, styles) -> Iterator:
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Image, PageBreak, Paragraph, Spacer
+
+    for index, name in enumerate(available_charts(data)):
+        title, description, (width, height) = CHART_SECTIONS[name]
+        if index:
+            yield PageBreak()
+        yield Paragraph(title, styles['subtitle'])
+        yield Paragraph(description, styles['desc'])
+        # Image с путем к файлу: reportlab читает PNG только при отрисовке страницы
+        yield Image(str(chart_path(name, period, data)), width=width * inch, height=height * inch)
+        yield Spacer(1, 0.3 * inch)
+
+
+def _top_products_table(data, styles, fonts) -> Iterator:
+    from reportlab.lib import colors
+    from reportlab.lib.units import inch
+    from reportlab.platypus import PageBreak, Paragraph, Spacer, Table, TableStyle
+
+    top_products = data['top_products']
+    if not top_products:
+        return
+    yield PageBreak()
+    yield Paragraph('Детализация топ-товаров', styles['subtitle'])
+    yield Paragraph('Подробная таблица с данными о наиболее прибыльных товарах за выбранный период.', styles['desc'])
+    yield Spacer(1, 0.2 * inch)
+
+    table_data = [['Товар', 'Выручка', 'Количество', 'Заказов']]
+    table_data += [
+        [item['name'], f"{item['revenue']:.2f} ₽", str(item['quantity']), str(item['orders'])]
+        for item in top_products
+    ]
+    table = Table(table_data, colWidths=[4 * inch, 1.5 * inch, 1.5 * inch, 1.5 * inch])
+    table.setStyle(TableStyle([
+        # Заголовок
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1a2a6c')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('FONTNAME', (0, 0), (-1, 0), fonts['title']),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('TOPPADDING', (0, 0), (-1, 0), 12),
+        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, 0), 'MIDDLE'),
+        # Данные
+        ('ALIGN', (0, 1), (0, -1), 'LEFT'),
+        ('ALIGN', (1, 1), (-1, -1), 'RIGHT'),
+        ('FONTNAME', (0, 1), (-1, -1), fonts['normal']),
+        ('FONTSIZE', (0, 1), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+        ('TOPPADDING', (0, 1), (-1, -1), 8),
+        ('VALIGN', (0, 1), (-1, -1), 'MIDDLE'),
+        # Чередующиеся цвета строк
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f8f9fa')]),
+        # Границы
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#dee2e6')),
+        ('LINEBELOW', (0, 0), (-1, 0), 2, colors.HexColor('#1a2a6c')),
+    ]))
+    yield table
+
+    yield Spacer(1, 0.3 * inch)
+    yield Paragraph('<b>Итого по топ-10 товарам:</b>', styles['summary'])
+    yield Paragraph(f"Общая выручка: {sum(item['revenue'] for item in top_products):.2f} ₽", styles['desc'])
+    yield Paragraph(
+        f"Общее количество проданных единиц: {sum(item['quantity'] for item in top_products)}", styles['desc'],
+    )
+    yield Paragraph(f"Количество уникальных заказов: {sum(item['orders'] for item in top_products)}", styles['desc'])
+
+
+class LazyStory(list):
+    """
+    Очередь flowable для BaseDocTemplate.build, которая подтягивает элементы из итератора
+    по мере верстки. reportlab снимает flowable с начала списка и перед каждым шагом
+    проверяет len(): в этот момент буфер дополняется до LOOKAHEAD элементов (запас для
+    keepWithNext), поэтому следующий раздел и его график готовятся только тогда, когда
+    предыдущие страницы уже сверстаны.
+    """
+
+    LOOKAHEAD = 8
+
+    def __init__(self, flowables: Iterable):
+        super().__init__()
+        self._source = iter(flowables)
+
+    def __len__(self):
+        while self._source is not None and super().__len__() < self.LOOKAHEAD:
+            try:
+                self.append(next(self._source))
+            except StopIteration:
+                self._source = None
+        return super().__len__()
+
+
+def build_dashboard_pdf(period: int, output) -> None:
+    """Пишет PDF дашборда за последние period дней в файловый объект output"""
+    from itertools import chain
+
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.platypus import SimpleDocTemplate
+
+    fonts = pdf_fonts()
+    styles = _styles(fonts)
+    data = dashboard_data(period)
+    story = chain(
+        _header(period, styles),
+        _chart_sections(period, data, styles),
+        _top_products_table(data, styles, fonts),
+    )
+    doc = SimpleDocTemplate(output, pagesize=landscape(A4))
+    doc.build(LazyStory(story))
@@ -0,0 +1,203 @@
+"""
+Чтение тяжелых отчетов с реплики
+
+Если в настройках есть база REPLICA_ALIAS (REPLICA_DATABASE_URL), ReplicaRouter
+отправляет на нее чтения только там, где это явно разрешено:
+
+    @replica_reads                                   # функция-представление
+    @method_decorator(replica_reads, name='dispatch')  # класс-представление
+    with use_replica(): ...                          # задачи Celery, сбор метрик
+
+Все записи и все остальные чтения идут в default. Реплика не используется, если:
+    - в этом запросе уже была запись (свои изменения читаются с primary);
+    - у клиента стоит cookie REPLICA_PIN_COOKIE — ReplicaPinMiddleware ставит ее на
+      REPLICA_STICKY_SECONDS после запроса с записью или небезопасного метода, чтобы
+      следующая страница после сохранения не показала старые данные;
+    - отставание реплики больше REPLICA_MAX_LAG_SECONDS или реплика недоступна
+      (проверяется не чаще раза в REPLICA_LAG_CHECK_INTERVAL секунд на процесс).
+
+Без реплики в настройках роутер ничего не меняет.
+"""
+from __future__ import annotations
+
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_ALIAS = 'default'
+REPLICA_ALIAS = 'replica'
+
+REPLICA_PIN_COOKIE = 'pin_primary'
+
+# Кэш и сессии всегда читаются с primary: устаревшая запись здесь хуже лишней нагрузки
+PRIMARY_ONLY_APPS = {'django_cache', 'sessions'}
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class _RoutingState:
+    """Состояние маршрутизации текущего запроса или блока use_replica"""
+
+    __slots__ = ('replica', 'pinned', 'wrote')
+
+    def __init__(self, pinned: bool = False):
+        self.replica = False
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state: ContextVar[Optional[_RoutingState]] = ContextVar('replica_routing_state', default=None)
+
+_lag_lock = threading.Lock()
+_lag_checked_at = 0.0
+_lag_value: Optional[float] = None
+
+
+def replica_configured() -> bool:
+    return REPLICA_ALIAS in settings.DATABASES
+
+
+def replica_lag_seconds() -> Optional[float]:
+    """Отставание реплики в секундах (None — реплика недоступна); кэшируется на процесс"""
+    global _lag_checked_at, _lag_value
+    interval = getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5)
+    with _lag_lock:
+        if time.monotonic() - _lag_checked_at < interval:
+            return _lag_value
+        try:
+            connection = connections[REPLICA_ALIAS]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(_LAG_SQL)
+                    _lag_value = float(cursor.fetchone()[0])
+            else:
+                connection.ensure_connection()
+                _lag_value = 0.0
+        except DatabaseError as exc:
+            logger.warning("Replica unavailable, reading from primary: %s", exc)
+            _lag_value = None
+        _lag_checked_at = time.monotonic()
+        return _lag_value
+
+
+def reset_lag_cache() -> None:
+    global _lag_checked_at, _lag_value
+    with _lag_lock:
+        _lag_checked_at = 0.0
+        _lag_value = None
+
+
+def replica_available() -> bool:
+    if not replica_configured():
+        return False
+    lag = replica_lag_seconds()
+    max_lag = getattr(settings, 'REPLICA_MAX_LAG_SECONDS', 10)
+    if lag is None or lag > max_lag:
+        return False
+    return True
+
+
+@contextmanager
+def use_replica():
+    """Разрешает чтение с реплики внутри блока (в запросе или вне его — в задаче Celery)"""
+    state = _state.get()
+    token = None
+    if state is None:
+        state = _RoutingState()
+        token = _state.set(state)
+    previous = state.replica
+    state.replica = True
+    try:
+        yield
+    finally:
+        state.replica = previous
+        if token is not None:
+            _state.reset(token)
+
+
+def replica_reads(view_func):
+    """Декоратор представления: его чтения могут идти на реплику"""
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return view_func(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (
+            state is None
+            or not state.replica
+            or state.pinned
+            or state.wrote
+            or model._meta.app_label in PRIMARY_ONLY_APPS
+        ):
+            return None
+        return REPLICA_ALIAS if replica_available() else PRIMARY_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            state.wrote = True
+        # Явно primary: иначе объект, прочитанный с реплики, сохранялся бы туда же
+        return PRIMARY_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {PRIMARY_ALIAS, REPLICA_ALIAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Реплика получает схему репликацией с primary
+        if db == REPLICA_ALIAS:
+            return False
+        return None
+
+
+class ReplicaPinMiddleware:
+    """
+    Read-your-writes между запросами: после записи или небезопасного запроса клиент
+    на REPLICA_STICKY_SECONDS получает cookie, и его чтения идут только на primary.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = _RoutingState(
+            pinned=REPLICA_PIN_COOKIE in request.COOKIES or request.method not in SAFE_METHODS,
+        )
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if replica_configured() and (state.wrote or request.method not in SAFE_METHODS):
+            response.set_cookie(
+                REPLICA_PIN_COOKIE,
+                '1',
+                max_age=getattr(settings, 'REPLICA_STICKY_SECONDS', 15),
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
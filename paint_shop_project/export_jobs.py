@@ -0,0 +1,272 @@
+"""
+Фоновый экспорт отчетов
+
+Страница экспорта не формирует отчет в запросе администратора, а ставит ExportJob
+в очередь Celery (задача run_export_job); если брокер не настроен, задание
+выполняется сразу после фиксации транзакции (task_queue.enqueue). Задача вызывает
+тот же обработчик ExportReportsView, что и раньше, записывает ответ в файл в
+MEDIA_ROOT/exports и отмечает прогресс в задании. Готовый файл хранится EXPORT_JOB_TTL_HOURS часов,
+затем удаляется задачей cleanup_expired_exports.
+
+Одинаковые запросы (тип отчета + параметры) дедуплицируются по params_hash: пока
+задание в очереди или формируется, новый запрос получает то же задание; задание,
+зависшее дольше EXPORT_JOB_STALE_MINUTES (потерянное сообщение, упавший воркер),
+помечается failed и не мешает поставить новое. Готовый
+отчет переиспользуется только EXPORT_JOB_REUSE_MINUTES минут после завершения,
+а с force=True («Сформировать заново») — не переиспользуется вовсе.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import re
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.contrib.messages.storage.base import BaseStorage
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+
+from .db_routing import use_replica
+from .models import ExportJob
+from .task_queue import enqueue
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR_NAME = 'exports'
+
+# Поля формы, которые не влияют на содержимое отчета
+IGNORED_PARAMS = {'csrfmiddlewaretoken', 'report_type', 'force'}
+
+_FILENAME_RE = re.compile(r"filename\*=UTF-8''([^;]+)|filename=\"?([^\";]+)\"?")
+
+
+def get_export_root() -> Path:
+    export_dir = Path(settings.MEDIA_ROOT) / EXPORT_DIR_NAME
+    export_dir.mkdir(parents=True, exist_ok=True)
+    return export_dir
+
+
+def job_ttl() -> timedelta:
+    return timedelta(hours=getattr(settings, 'EXPORT_JOB_TTL_HOURS', 24))
+
+
+def reuse_window() -> timedelta:
+    """Сколько готовый отчет отдается повторным запросам вместо нового расчета"""
+    return timedelta(minutes=getattr(settings, 'EXPORT_JOB_REUSE_MINUTES', 5))
+
+
+def stale_after() -> timedelta:
+    """Сколько задание может быть в очереди или формироваться, прежде чем считается зависшим"""
+    return timedelta(minutes=getattr(settings, 'EXPORT_JOB_STALE_MINUTES', 15))
+
+
+def params_hash(report_type: str, params: Dict[str, str]) -> str:
+    payload = json.dumps({'report_type': report_type, 'params': params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def normalize_params(data: QueryDict) -> Dict[str, str]:
+    """Параметры формы без служебных полей, с обрезанными пробелами"""
+    return {
+        key: value.strip()
+        for key, value in data.items()
+        if key not in IGNORED_PARAMS
+    }
+
+
+# ==================== ПОСТАНОВКА В ОЧЕРЕДЬ ====================
+
+def fail_stale_jobs(jobs=None) -> int:
+    """
+    Помечает failed задания, которые дольше stale_after() ждут в очереди (created_at)
+    или формируются (started_at): сообщение потеряно или воркер упал. Иначе такое
+    задание держало бы уникальный слот params_hash до конца срока хранения.
+    """
+    jobs = ExportJob.objects.all() if jobs is None else jobs
+    now = timezone.now()
+    stale_before = now - stale_after()
+    return jobs.filter(
+        Q(status='pending', created_at__lt=stale_before) | Q(status='running', started_at__lt=stale_before),
+    ).update(status='failed', error_message='Задание зависло и не завершилось', finished_at=now)
+
+
+def _reusable_job(digest: str, include_done: bool = True) -> Optional[ExportJob]:
+    """Задание в очереди или в работе, иначе (include_done) — готовое в пределах reuse_window"""
+    jobs = ExportJob.objects.filter(params_hash=digest)
+    if fail_stale_jobs(jobs):
+        logger.warning("stale export jobs failed params_hash=%s", digest)
+    job = jobs.filter(status__in=ExportJob.ACTIVE_STATUSES).first()
+    if job is None and include_done:
+        now = timezone.now()
+        job = (
+            jobs.filter(status='done', finished_at__gte=now - reuse_window(), expires_at__gt=now)
+            .order_by('-finished_at')
+            .first()
+        )
+    return job
+
+
+def submit_export_job(
+    report_type: str, params: Dict[str, str], user=None, force: bool = False,
+) -> Tuple[ExportJob, bool]:
+    """
+    Возвращает (задание, создано ли новое). Если такой же отчет уже формируется или
+    только что готов, возвращается существующее задание без повторного расчета.
+    force=True игнорирует готовые задания (формируемое все равно переиспользуется).
+    """
+    digest = params_hash(report_type, params)
+    job = _reusable_job(digest, include_done=not force)
+    if job:
+        return job, False
+
+    try:
+        with transaction.atomic():
+            job = ExportJob.objects.create(
+                report_type=report_type,
+                params=params,
+                params_hash=digest,
+                requested_by=user if user and user.is_authenticated else None,
+            )
+    except IntegrityError:
+        # Параллельный запрос успел создать задание с теми же параметрами; к этому
+        # моменту оно может быть уже готово — тогда свежий результат тоже подходит
+        job = _reusable_job(digest)
+        if job is None:
+            return submit_export_job(report_type, params, user, force=force)
+        return job, False
+
+    from .tasks import run_export_job
+
+    # Без брокера (memory://) задание выполняется сразу после фиксации, в этом же процессе
+    transaction.on_commit(lambda: enqueue(run_export_job, job.pk))
+    logger.info("export job queued id=%s type=%s", job.pk, report_type)
+    return job, True
+
+
+# ==================== ВЫПОЛНЕНИЕ ====================
+
+class _CollectedMessages(BaseStorage):
+    """Хранилище messages для запроса без сессии: сообщения остаются в памяти"""
+
+    def _get(self, *args, **kwargs):
+        return [], True
+
+    def _store(self, messages, response, *args, **kwargs):
+        return []
+
+
+def _build_request(job: ExportJob) -> HttpRequest:
+    request = HttpRequest()
+    request.method = 'POST'
+    request.user = job.requested_by
+    request.POST = QueryDict(mutable=True)
+    request.POST.update({'report_type': job.report_type, **job.params})
+    request._messages = _CollectedMessages(request)
+    return request
+
+
+def _response_filename(response, job: ExportJob) -> str:
+    match = _FILENAME_RE.search(response.get('Content-Disposition', ''))
+    if match:
+        return unquote(match.group(1)) if match.group(1) else match.group(2)
+    return f'{job.report_type}_{job.pk}'
+
+
+def _set_progress(job: ExportJob, progress: int, **fields) -> None:
+    job.progress = progress
+    for name, value in fields.items():
+        setattr(job, name, value)
+    ExportJob.objects.filter(pk=job.pk).update(progress=progress, **fields)
+
+
+def _write_response(response, path: Path) -> int:
+    with path.open('wb') as output:
+        if response.streaming:
+            for chunk in response.streaming_content:
+                output.write(chunk)
+        else:
+            output.write(response.content)
+    # response.close() не вызываем: он шлет request_finished, а тот закрывает соединение с БД
+    file_to_stream = getattr(response, 'file_to_stream', None)
+    if file_to_stream is not None:
+        file_to_stream.close()
+    return path.stat().st_size
+
+
+def run_export_job(job_id: int) -> ExportJob:
+    """Формирует отчет задания и сохраняет результат в каталог экспорта"""
+    from .admin_views.exports import ExportReportsView
+
+    # Захват задания условным UPDATE: повторная доставка сообщения не запустит расчет дважды
+    claimed = ExportJob.objects.filter(pk=job_id, status='pending').update(
+        status='running', progress=5, started_at=timezone.now(),
+    )
+    job = ExportJob.objects.select_related('requested_by').get(pk=job_id)
+    if not claimed:
+        return job
+
+    path = None
+    try:
+        view = ExportReportsView()
+        request = _build_request(job)
+        view.setup(request)
+        # Запросы отчета (в том числе ленивые, при записи файла) читают с реплики
+        with use_replica():
+            response = view.dispatch_export(request)
+        if 'attachment' not in response.get('Content-Disposition', ''):
+            errors = [str(message) for message in request._messages._queued_messages]
+            raise RuntimeError('; '.join(errors) or 'Отчет не сформирован')
+        _set_progress(job, 60)
+
+        filename = _response_filename(response, job)
+        path = get_export_root() / f'{uuid.uuid4().hex}{Path(filename).suffix}'
+        with use_replica():
+            file_size = _write_response(response, path)
+
+        finished_at = timezone.now()
+        _set_progress(
+            job, 100,
+            status='done',
+            file_path=path.name,
+            filename=filename,
+            content_type=response.get('Content-Type', ''),
+            file_size=file_size,
+            finished_at=finished_at,
+            expires_at=finished_at + job_ttl(),
+        )
+        logger.info("export job done id=%s size=%s", job.pk, file_size)
+    except Exception as exc:
+        logger.exception("export job failed id=%s", job.pk)
+        if path is not None:
+            path.unlink(missing_ok=True)
+        _set_progress(job, job.progress, status='failed', error_message=str(exc), finished_at=timezone.now())
+    return job
+
+
+def job_file(job: ExportJob) -> Optional[Path]:
+    """Путь к файлу готового задания или None, если файла нет или он истек"""
+    if not job.is_ready or not job.file_path:
+        return None
+    path = get_export_root() / job.file_path
+    return path if path.is_file() else None
+
+
+def cleanup_expired_exports() -> int:
+    """Удаляет истекшие файлы экспорта и их задания; возвращает число удаленных заданий"""
+    root = get_export_root()
+    expired = ExportJob.objects.filter(expires_at__lte=timezone.now())
+    for file_path in expired.exclude(file_path='').values_list('file_path', flat=True):
+        (root / file_path).unlink(missing_ok=True)
+    deleted, _ = expired.delete()
+
+    fail_stale_jobs()
+    ExportJob.objects.filter(status='failed', created_at__lte=timezone.now() - job_ttl()).delete()
+    return deleted
@@ -0,0 +1,109 @@
+"""
+Django management command для сравнения скорости поиска товаров.
+
+Создает синтетический каталог (по умолчанию 100 000 товаров) внутри транзакции,
+замеряет прежний поиск icontains и полнотекстовый/триграммный поиск
+(product_search.search_products) на наборе запросов и откатывает транзакцию.
+Работает только в PostgreSQL.
+
+Использование:
+    python manage.py benchmark_product_search
+    python manage.py benchmark_product_search --products 20000 --repeat 50
+    python manage.py benchmark_product_search --query "ржаной хлеб" --query "малоко"
+"""
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from paint_shop_project.models import Category, Product
+from paint_shop_project.product_search import full_text_enabled, search_products
+
+ADJECTIVES = ['свежий', 'ржаной', 'пшеничный', 'домашний', 'фермерский', 'нежирный', 'сладкий', 'соленый', 'копченый', 'отборный']
+NOUNS = ['хлеб', 'батон', 'молоко', 'кефир', 'творог', 'сыр', 'колбаса', 'печенье', 'йогурт', 'масло', 'краска', 'сок']
+DETAILS = ['в упаковке', 'без добавок', 'по ГОСТ', 'высший сорт', 'для детей', 'на закваске', 'с отрубями']
+
+DEFAULT_QUERIES = [
+    'молоко',      # точное слово
+    'сыры',        # другая словоформа
+    'ржаной хлеб',  # несколько слов
+    'малоко',      # опечатка
+    'кол',         # начало слова
+]
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает задержку поиска товаров: icontains против полнотекстового и триграммного поиска'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000, help='Сколько товаров сгенерировать')
+        parser.add_argument('--repeat', type=int, default=20, help='Сколько раз выполнить каждый запрос')
+        parser.add_argument('--query', action='append', dest='queries', help='Поисковый запрос (можно несколько)')
+
+    def handle(self, *args, **options):
+        if not full_text_enabled():
+            raise CommandError('Бенчмарк работает только с PostgreSQL')
+
+        queries = options['queries'] or DEFAULT_QUERIES
+        try:
+            with transaction.atomic():
+                self._create_catalog(options['products'])
+                for query in queries:
+                    self._compare(query, options['repeat'])
+                raise _Rollback
+        except _Rollback:
+            self.stdout.write('Синтетические товары удалены (транзакция откачена)')
+
+    def _create_catalog(self, count):
+        started = time.perf_counter()
+        category = Category.objects.create(name='Бенчмарк поиска', slug='search-benchmark')
+        rng = random.Random(42)
+        batch = []
+        for i in range(count):
+            name = f'{rng.choice(ADJECTIVES).capitalize()} {rng.choice(NOUNS)} {rng.choice(DETAILS)}'
+            batch.append(Product(
+                name=name,
+                slug=f'search-benchmark-{i}',
+                description=f'{name}. {rng.choice(DETAILS).capitalize()}, {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}.',
+                category=category,
+                price=rng.randint(30, 900),
+            ))
+            if len(batch) == 5000:
+                Product.objects.bulk_create(batch)
+                batch = []
+        Product.objects.bulk_create(batch)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE paint_shop_project_product')
+        self.stdout.write(f'Создано товаров: {count} за {time.perf_counter() - started:.1f} с')
+
+    def _measure(self, build_queryset, repeat):
+        timings = []
+        found = 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            queryset = build_queryset()
+            list(queryset[:20])  # первая страница выдачи
+            found = queryset.count()  # и счетчик для пагинатора
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        return statistics.median(timings), p95, found
+
+    def _compare(self, query, repeat):
+        base = Product.objects.filter(is_active=True)
+        legacy = self._measure(
+            lambda: base.filter(Q(name__icontains=query) | Q(description__icontains=query)).order_by('name'),
+            repeat,
+        )
+        ranked = self._measure(lambda: search_products(base, query, order_by_rank=True), repeat)
+        self.stdout.write(
+            f'«{query}»: icontains median {legacy[0]:.1f} мс, p95 {legacy[1]:.1f} мс, найдено {legacy[2]} | '
+            f'FTS+trgm median {ranked[0]:.1f} мс, p95 {ranked[1]:.1f} мс, найдено {ranked[2]}'
+        )
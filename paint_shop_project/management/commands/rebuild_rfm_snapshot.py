@@ -0,0 +1,20 @@
+"""
+Django management command для пересчета RFM-сегментов клиентов.
+
+Снимок CustomerRFMSnapshot пересобирается ночью задачей rebuild_rfm_snapshot;
+команда нужна для первичного заполнения и после изменения RFM_THRESHOLDS.
+
+Использование:
+    python manage.py rebuild_rfm_snapshot
+"""
+from django.core.management.base import BaseCommand
+
+from paint_shop_project.rfm_snapshot import rebuild_rfm_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает RFM-оценки и сегменты клиентов (CustomerRFMSnapshot)'
+
+    def handle(self, *args, **options):
+        customers = rebuild_rfm_snapshot()
+        self.stdout.write(self.style.SUCCESS(f'✅ RFM-снимок пересчитан, клиентов: {customers}'))
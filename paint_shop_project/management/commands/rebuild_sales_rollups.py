@@ -0,0 +1,30 @@
+"""
+Django management command для пересборки дневных агрегатов продаж.
+
+Агрегаты поддерживаются сигналами при оформлении и доставке заказов; команда нужна
+для первичного заполнения и после ручных правок заказов в обход ORM.
+
+Использование:
+    python manage.py rebuild_sales_rollups              # вся история
+    python manage.py rebuild_sales_rollups --days 30    # последние 30 дней
+"""
+from django.core.management.base import BaseCommand
+
+from paint_shop_project.sales_rollups import period_start, rebuild_sales_rollups
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает дневные агрегаты продаж (по дням, магазинам, товарам и категориям)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=None,
+            help='Пересобрать только последние N дней (по умолчанию — всю историю)',
+        )
+
+    def handle(self, *args, **options):
+        start = period_start(options['days']) if options['days'] else None
+        days = rebuild_sales_rollups(start=start)
+        self.stdout.write(self.style.SUCCESS(f'✅ Агрегаты продаж пересобраны, дней с заказами: {days}'))
@@ -0,0 +1,47 @@
+"""
+Django management command для сверки каталога резервных копий с диском.
+
+Добавляет в BackupFile файлы копий, которые лежат в MEDIA_ROOT/backups, но не
+записаны в каталог (скопированы вручную, созданы до появления каталога), и
+удаляет строки файлов, которых на диске больше нет. С --verify пересчитывает
+SHA-256 всех копий и сообщает о расхождениях. С --cleanup затем удаляет копии
+с истекшим сроком хранения (BACKUP_RETENTION_DAYS).
+
+Запустите один раз после обновления, чтобы заполнить каталог существующими копиями.
+
+Использование:
+    python manage.py reconcile_backup_catalog
+    python manage.py reconcile_backup_catalog --verify --cleanup
+
+Для автоматического запуска добавьте в crontab:
+    30 3 * * * cd /path/to/project && python manage.py reconcile_backup_catalog --cleanup
+"""
+from django.core.management.base import BaseCommand
+
+from paint_shop_project.backup_catalog import apply_retention, reconcile_catalog
+
+
+class Command(BaseCommand):
+    help = 'Сверяет каталог резервных копий BackupFile с файлами на диске'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='Пересчитать SHA-256 всех копий')
+        parser.add_argument('--cleanup', action='store_true', help='Удалить копии с истекшим сроком хранения')
+
+    def handle(self, *args, **options):
+        stats = reconcile_catalog(verify=options['verify'])
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Каталог сверен: добавлено {stats['added']}, удалено записей {stats['removed']}"
+        ))
+        if stats['mismatched']:
+            listed = ', '.join(str(entry_id) for entry_id in stats['mismatched'])
+            self.stdout.write(self.style.WARNING(f'⚠️ Контрольная сумма не совпадает у копий: {listed}'))
+
+        if options['cleanup']:
+            result = apply_retention()
+            self.stdout.write(self.style.SUCCESS(
+                f"✅ Удалено копий с истекшим сроком: {result['deleted']} "
+                f"({result['freed_bytes'] / (1024 * 1024):.2f} МБ)"
+            ))
+            for error in result['errors']:
+                self.stdout.write(self.style.WARNING(f'⚠️ {error}'))
@@ -0,0 +1,43 @@
+"""
+Django management command для сверки балансов кешбэка с журналом операций.
+
+Сравнивает CashbackBalance и User.total_cashback_earned/total_cashback_spent с
+итогами CashbackTransaction (один GROUP BY по журналу) и выводит пользователей с
+расхождениями. С --fix исправляет их пачками под блокировкой строк баланса.
+
+Использование:
+    python manage.py reconcile_cashback_balances
+    python manage.py reconcile_cashback_balances --fix
+
+Для автоматического запуска добавьте в crontab:
+    15 3 * * * cd /path/to/project && python manage.py reconcile_cashback_balances --fix
+"""
+from django.core.management.base import BaseCommand
+
+from paint_shop_project.cashback_ledger import reconcile_balances
+
+MAX_LISTED = 50
+
+
+class Command(BaseCommand):
+    help = 'Сверяет балансы кешбэка с журналом CashbackTransaction и при --fix исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Исправить найденные расхождения')
+        parser.add_argument('--batch-size', type=int, default=500, help='Сколько пользователей исправлять в одной транзакции')
+
+    def handle(self, *args, **options):
+        discrepancies = reconcile_balances(fix=options['fix'], batch_size=options['batch_size'])
+        if not discrepancies:
+            self.stdout.write(self.style.SUCCESS('✅ Балансы кешбэка совпадают с журналом'))
+            return
+
+        listed = ', '.join(str(user_id) for user_id in discrepancies[:MAX_LISTED])
+        if len(discrepancies) > MAX_LISTED:
+            listed += ', ...'
+        if options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'✅ Исправлены балансы пользователей: {len(discrepancies)} ({listed})'))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️ Расхождения у пользователей: {len(discrepancies)} ({listed}). Запустите с --fix для исправления'
+            ))
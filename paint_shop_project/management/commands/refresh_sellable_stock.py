@@ -0,0 +1,23 @@
+"""
+Django management command для пересчёта доступного к продаже остатка товаров.
+
+Партии со временем перестают проходить правило 70% срока годности без каких-либо
+изменений в БД, поэтому Product.sellable_quantity нужно раз в сутки «прокручивать» вперёд.
+
+Использование:
+    python manage.py refresh_sellable_stock
+
+Для автоматического запуска добавьте в crontab (или используйте задачу Celery refresh_sellable_stock):
+    5 0 * * * cd /path/to/project && python manage.py refresh_sellable_stock
+"""
+from django.core.management.base import BaseCommand
+
+from paint_shop_project.batch_allocation import refresh_sellable_quantity
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает доступный к продаже остаток (Product.sellable_quantity) по всем товарам'
+
+    def handle(self, *args, **options):
+        updated = refresh_sellable_quantity()
+        self.stdout.write(self.style.SUCCESS(f'✅ Пересчитан остаток для товаров: {updated}'))
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.16 on 2026-10-17 07:42
+
+import datetime
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0032_alter_favoritecategory_discount_percent'),
+    ]
+
+    def _backfill_sellable_quantity(apps, schema_editor):
+        Product = apps.get_model('paint_shop_project', 'Product')
+        today = datetime.date.today()
+        for product in Product.objects.prefetch_related('batches').iterator(chunk_size=500):
+            sellable = product.stock_quantity
+            batches = list(product.batches.all())
+            if product.has_expiry_date and batches:
+                in_batches = 0
+                for batch in batches:
+                    total_days = (batch.expiry_date - batch.production_date).days
+                    left_days = (batch.expiry_date - today).days
+                    if batch.remaining_quantity > 0 and left_days >= 0 and total_days > 0 and left_days * 100 >= total_days * 70:
+                        in_batches += batch.remaining_quantity
+                sellable = min(sellable, in_batches)
+            Product.objects.filter(pk=product.pk).update(sellable_quantity=sellable)
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='sellable_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Доступно к продаже'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_active', '-sellable_quantity'], name='product_active_sellable_idx'),
+        ),
+        migrations.RunPython(_backfill_sellable_quantity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.16 on 2026-10-17 07:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0033_product_sellable_quantity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='Название метрики')),
+                ('metric_type', models.CharField(choices=[('counter', 'Counter'), ('gauge', 'Gauge'), ('histogram', 'Histogram')], max_length=20, verbose_name='Тип метрики')),
+                ('labels_key', models.CharField(max_length=64, verbose_name='Хеш меток')),
+                ('labels', models.JSONField(blank=True, default=dict, verbose_name='Метки')),
+                ('value', models.FloatField(default=0, verbose_name='Значение')),
+                ('count', models.BigIntegerField(default=0, verbose_name='Количество наблюдений')),
+                ('sum', models.FloatField(default=0, verbose_name='Сумма наблюдений')),
+                ('buckets', models.JSONField(blank=True, default=list, verbose_name='Корзины гистограммы')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Агрегат метрики',
+                'verbose_name_plural': 'Агрегаты метрик',
+                'db_table': 'metric_rollups',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='metricrollup',
+            constraint=models.UniqueConstraint(fields=('name', 'metric_type', 'labels_key'), name='metric_rollup_unique_series'),
+        ),
+    ]
@@ -0,0 +1,158 @@
+# Generated by Django 4.2.16 on 2026-10-17 07:52
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0034_metric_rollup'),
+    ]
+
+    def _backfill_sales_rollups(apps, schema_editor):
+        Order = apps.get_model('paint_shop_project', 'Order')
+        OrderItem = apps.get_model('paint_shop_project', 'OrderItem')
+        DailySalesRollup = apps.get_model('paint_shop_project', 'DailySalesRollup')
+        DailyStoreSalesRollup = apps.get_model('paint_shop_project', 'DailyStoreSalesRollup')
+        DailyProductSalesRollup = apps.get_model('paint_shop_project', 'DailyProductSalesRollup')
+        DailyCategorySalesRollup = apps.get_model('paint_shop_project', 'DailyCategorySalesRollup')
+
+        delivered = Q(status='delivered')
+        order_totals = dict(
+            orders_count=Count('id'),
+            orders_revenue=Coalesce(Sum('total_amount'), Value(Decimal('0'))),
+            delivered_orders=Count('id', filter=delivered),
+            delivered_revenue=Coalesce(Sum('total_amount', filter=delivered), Value(Decimal('0'))),
+        )
+        orders = Order.objects.annotate(day=TruncDate('order_date')).order_by()
+        DailySalesRollup.objects.bulk_create(
+            [DailySalesRollup(date=row.pop('day'), **row) for row in orders.values('day').annotate(**order_totals)],
+            batch_size=1000,
+        )
+        DailyStoreSalesRollup.objects.bulk_create(
+            [
+                DailyStoreSalesRollup(date=row.pop('day'), store_id=row.pop('store'), **row)
+                for row in (
+                    orders.annotate(store=Coalesce('fulfillment_store', 'pickup_point'))
+                    .filter(store__isnull=False)
+                    .values('day', 'store')
+                    .annotate(**order_totals)
+                )
+            ],
+            batch_size=1000,
+        )
+
+        items = (
+            OrderItem.objects.filter(order__status='delivered')
+            .annotate(day=TruncDate('order__order_date'))
+            .order_by()
+        )
+        item_totals = dict(
+            revenue=Sum(ExpressionWrapper(F('quantity') * F('price_per_unit'), output_field=DecimalField(max_digits=16, decimal_places=2))),
+            quantity=Sum('quantity'),
+            orders_count=Count('order', distinct=True),
+        )
+        DailyProductSalesRollup.objects.bulk_create(
+            [
+                DailyProductSalesRollup(date=row.pop('day'), product_id=row.pop('product'), **row)
+                for row in items.values('day', 'product').annotate(**item_totals)
+            ],
+            batch_size=1000,
+        )
+        DailyCategorySalesRollup.objects.bulk_create(
+            [
+                DailyCategorySalesRollup(date=row.pop('day'), category_id=row.pop('product__category'), **row)
+                for row in items.values('day', 'product__category').annotate(**item_totals)
+            ],
+            batch_size=1000,
+        )
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True, verbose_name='Дата')),
+                ('orders_count', models.IntegerField(default=0, verbose_name='Заказов оформлено')),
+                ('orders_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Сумма оформленных заказов')),
+                ('delivered_orders', models.IntegerField(default=0, verbose_name='Заказов доставлено')),
+                ('delivered_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Выручка')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Продажи за день',
+                'verbose_name_plural': 'Продажи по дням',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyStoreSalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('orders_count', models.IntegerField(default=0, verbose_name='Заказов оформлено')),
+                ('orders_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Сумма оформленных заказов')),
+                ('delivered_orders', models.IntegerField(default=0, verbose_name='Заказов доставлено')),
+                ('delivered_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Выручка')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='paint_shop_project.store', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Продажи магазина за день',
+                'verbose_name_plural': 'Продажи магазинов по дням',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyProductSalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Продано шт.')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Выручка')),
+                ('orders_count', models.IntegerField(default=0, verbose_name='Заказов')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='paint_shop_project.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Продажи товара за день',
+                'verbose_name_plural': 'Продажи товаров по дням',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyCategorySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Продано шт.')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Выручка')),
+                ('orders_count', models.IntegerField(default=0, verbose_name='Заказов')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='paint_shop_project.category', verbose_name='Категория')),
+            ],
+            options={
+                'verbose_name': 'Продажи категории за день',
+                'verbose_name_plural': 'Продажи категорий по дням',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailystoresalesrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'store'), name='daily_store_sales_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyproductsalesrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'product'), name='daily_product_sales_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailycategorysalesrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'category'), name='daily_category_sales_unique'),
+        ),
+        migrations.RunPython(_backfill_sales_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 4.2.16 on 2026-10-17 12:10
+
+import django.contrib.postgres.search
+from django.db import DatabaseError, migrations, transaction
+
+# Триггер, GIN-индексы и pg_trgm есть только в PostgreSQL; на других СУБД поиск
+# работает через icontains (см. product_search.py), а search_vector остается пустым.
+FORWARD_SQL = [
+    """
+    CREATE OR REPLACE FUNCTION product_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('russian', coalesce(NEW.name, '')), 'A') ||
+            setweight(to_tsvector('russian', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER product_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, description ON paint_shop_project_product
+    FOR EACH ROW EXECUTE PROCEDURE product_search_vector_update()
+    """,
+    # Заполнение для существующих товаров: UPDATE OF name запускает триггер
+    "UPDATE paint_shop_project_product SET name = name",
+    """
+    CREATE INDEX IF NOT EXISTS product_search_vector_gin
+    ON paint_shop_project_product USING gin (search_vector)
+    """,
+]
+
+TRIGRAM_SQL = """
+    CREATE INDEX IF NOT EXISTS product_name_trgm_gin
+    ON paint_shop_project_product USING gin (name gin_trgm_ops)
+"""
+
+REVERSE_SQL = [
+    "DROP INDEX IF EXISTS product_name_trgm_gin",
+    "DROP INDEX IF EXISTS product_search_vector_gin",
+    "DROP TRIGGER IF EXISTS product_search_vector_trigger ON paint_shop_project_product",
+    "DROP FUNCTION IF EXISTS product_search_vector_update()",
+]
+
+
+def forwards(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for statement in FORWARD_SQL:
+        schema_editor.execute(statement)
+    # pg_trgm входит в contrib и может быть не установлен на сервере: тогда поиск
+    # обходится без устойчивости к опечаткам (product_search.trigram_enabled)
+    try:
+        with transaction.atomic():
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError:
+        return
+    schema_editor.execute(TRIGRAM_SQL)
+
+
+def backwards(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for statement in REVERSE_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0036_export_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый вектор'),
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
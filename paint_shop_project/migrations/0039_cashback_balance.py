@@ -0,0 +1,85 @@
+# Generated by Django 4.2.16 on 2026-10-17 08:23
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from decimal import Decimal
+
+BATCH_SIZE = 1000
+
+# Знак операции в балансе: сгорание уменьшает баланс так же, как списание
+SIGNS = {'earned': 1, 'spent': -1, 'expired': -1}
+TOTAL_FIELDS = {'earned': 'total_earned', 'spent': 'total_spent', 'expired': 'total_expired'}
+
+
+def build_balances(apps, schema_editor):
+    """Балансы и balance_after по журналу; итоги пользователя приводятся к журналу"""
+    CashbackTransaction = apps.get_model('paint_shop_project', 'CashbackTransaction')
+    CashbackBalance = apps.get_model('paint_shop_project', 'CashbackBalance')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+
+    balances = {}
+    pending = []
+    rows = CashbackTransaction.objects.order_by('user_id', 'created_at', 'id').only(
+        'id', 'user_id', 'amount', 'transaction_type',
+    )
+    for entry in rows.iterator(chunk_size=BATCH_SIZE):
+        balance = balances.get(entry.user_id)
+        if balance is None:
+            balance = balances[entry.user_id] = CashbackBalance(user_id=entry.user_id)
+        sign = SIGNS.get(entry.transaction_type)
+        if sign is None:
+            continue
+        balance.balance += sign * entry.amount
+        field = TOTAL_FIELDS[entry.transaction_type]
+        setattr(balance, field, getattr(balance, field) + entry.amount)
+        entry.balance_after = balance.balance
+        pending.append(entry)
+        if len(pending) >= BATCH_SIZE:
+            CashbackTransaction.objects.bulk_update(pending, ['balance_after'])
+            pending = []
+    CashbackTransaction.objects.bulk_update(pending, ['balance_after'])
+
+    CashbackBalance.objects.bulk_create(balances.values(), batch_size=BATCH_SIZE)
+    User.objects.exclude(pk__in=list(balances)).exclude(
+        total_cashback_earned=0, total_cashback_spent=0,
+    ).update(total_cashback_earned=Decimal('0'), total_cashback_spent=Decimal('0'))
+    User.objects.bulk_update(
+        [
+            User(pk=user_id, total_cashback_earned=balance.total_earned, total_cashback_spent=balance.total_spent)
+            for user_id, balance in balances.items()
+        ],
+        ['total_cashback_earned', 'total_cashback_spent'],
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0038_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CashbackBalance',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='cashback_balance', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Баланс')),
+                ('total_earned', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Всего начислено')),
+                ('total_spent', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Всего потрачено')),
+                ('total_expired', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Всего сгорело')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Баланс кешбэка',
+                'verbose_name_plural': 'Балансы кешбэка',
+            },
+        ),
+        migrations.AddField(
+            model_name='cashbacktransaction',
+            name='balance_after',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True, verbose_name='Баланс после операции'),
+        ),
+        migrations.RunPython(build_balances, migrations.RunPython.noop),
+    ]
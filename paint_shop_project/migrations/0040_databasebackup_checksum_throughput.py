@@ -0,0 +1,33 @@
+# Generated by Django 4.2.16 on 2026-10-17 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0039_cashback_balance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='databasebackup',
+            name='backup_format',
+            field=models.CharField(blank=True, choices=[('custom', 'pg_dump --format=custom'), ('directory', 'pg_dump --format=directory --jobs N (.tar)')], max_length=20, verbose_name='Формат копии'),
+        ),
+        migrations.AddField(
+            model_name='databasebackup',
+            name='checksum',
+            field=models.CharField(blank=True, help_text='Контрольная сумма файла копии; она же записана рядом в <файл>.sha256', max_length=64, verbose_name='SHA-256'),
+        ),
+        migrations.AddField(
+            model_name='databasebackup',
+            name='duration_seconds',
+            field=models.FloatField(blank=True, null=True, verbose_name='Время выгрузки (с)'),
+        ),
+        migrations.AddField(
+            model_name='databasebackup',
+            name='throughput_mb_s',
+            field=models.FloatField(blank=True, null=True, verbose_name='Скорость (МБ/с)'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.16 on 2026-10-17 08:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0040_databasebackup_checksum_throughput'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_path', models.CharField(max_length=1024, unique=True, verbose_name='Путь к файлу')),
+                ('file_size', models.BigIntegerField(verbose_name='Размер файла (байты)')),
+                ('checksum', models.CharField(blank=True, max_length=64, verbose_name='SHA-256')),
+                ('label', models.CharField(blank=True, max_length=50, verbose_name='Метка')),
+                ('retention_class', models.CharField(choices=[('daily', 'Ежедневная'), ('weekly', 'Еженедельная'), ('monthly', 'Ежемесячная'), ('pre_restore', 'Перед восстановлением'), ('manual', 'Ручная')], default='manual', max_length=20, verbose_name='Класс хранения')),
+                ('created_at', models.DateTimeField(verbose_name='Создан')),
+                ('backup', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='catalog_files', to='paint_shop_project.databasebackup', verbose_name='Операция')),
+            ],
+            options={
+                'verbose_name': 'Файл резервной копии',
+                'verbose_name_plural': 'Каталог резервных копий',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['retention_class', 'created_at'], name='backupfile_retention_idx'), models.Index(fields=['-created_at'], name='backupfile_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.16 on 2026-10-17 08:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('paint_shop_project', '0041_backup_catalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerRFMSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_order_date', models.DateTimeField(verbose_name='Первый заказ')),
+                ('last_order_date', models.DateTimeField(verbose_name='Последний заказ')),
+                ('recency_days', models.IntegerField(verbose_name='Дней с последнего заказа')),
+                ('frequency', models.IntegerField(verbose_name='Заказов')),
+                ('monetary', models.DecimalField(decimal_places=2, max_digits=14, verbose_name='Сумма доставленных заказов')),
+                ('r_score', models.PositiveSmallIntegerField(verbose_name='R')),
+                ('f_score', models.PositiveSmallIntegerField(verbose_name='F')),
+                ('m_score', models.PositiveSmallIntegerField(verbose_name='M')),
+                ('segment', models.CharField(choices=[('champions', 'Чемпионы (VIP)'), ('loyal_customers', 'Постоянные клиенты'), ('potential_loyalists', 'Потенциальные постоянные'), ('new_customers', 'Новые клиенты'), ('promising', 'Перспективные'), ('needs_attention', 'Требуют внимания'), ('about_to_sleep', 'Уходящие'), ('at_risk', 'В зоне риска'), ('lost', 'Потерянные')], max_length=32, verbose_name='Сегмент')),
+                ('computed_at', models.DateTimeField(verbose_name='Рассчитано')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rfm_snapshot', to=settings.AUTH_USER_MODEL, verbose_name='Клиент')),
+            ],
+            options={
+                'verbose_name': 'RFM-оценка клиента',
+                'verbose_name_plural': 'RFM-оценки клиентов',
+                'ordering': ['segment', '-monetary', '-id'],
+                'indexes': [models.Index(fields=['segment', '-monetary', '-id'], name='rfm_segment_monetary_idx')],
+            },
+        ),
+    ]
@@ -4,6 +4,7 @@
 """
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
@@ -96,10 +97,9 @@ class User(AbstractUser):
             return "novice"
 
     def get_cashback_balance(self):
-        """Текущий баланс кешбэка пользователя."""
-        earned = Decimal(str(self.total_cashback_earned or 0))
-        spent = Decimal(str(self.total_cashback_spent or 0))
-        return earned - spent
+        """Текущий баланс кешбэка пользователя (строка CashbackBalance, без суммирования журнала)."""
+        from .cashback_ledger import get_balance
+        return get_balance(self)
 
     def get_favorite_categories_discount(self, category):
         """Возвращает скидку для любимой категории пользователя."""
@@ -176,6 +176,9 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)], verbose_name="Цена")
     old_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, validators=[MinValueValidator(0)], verbose_name="Старая цена")
     stock_quantity = models.PositiveIntegerField(default=0, verbose_name="Количество на складе")
+    # Денормализованный остаток, доступный к продаже (с учётом партий и правила 70%),
+    # поддерживается batch_allocation.refresh_sellable_quantity
+    sellable_quantity = models.PositiveIntegerField(default=0, editable=False, verbose_name="Доступно к продаже")
     unit = models.CharField(max_length=10, choices=UNIT_CHOICES, default='шт', verbose_name="Единица измерения")
     weight = models.CharField(max_length=50, blank=True, verbose_name="Вес/объем")
     image = models.ImageField(upload_to='products/', blank=True, null=True, verbose_name="Изображение")
@@ -192,10 +195,24 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
     
+    # Полнотекстовый индекс (russian, название весомее описания). В PostgreSQL
+    # заполняется триггером product_search_vector_trigger, см. product_search.py
+    search_vector = SearchVectorField(null=True, editable=False, verbose_name="Поисковый вектор")
+    
     class Meta:
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
         ordering = ['-created_at']
+        # GIN-индексы по search_vector и триграммам name создаются миграцией 0037 только в PostgreSQL
+        indexes = [
+            models.Index(fields=['is_active', '-sellable_quantity'], name='product_active_sellable_idx'),
+            # Сортировки каталога с id последним полем (пагинация по курсору, views.PRODUCT_SORT_ORDERINGS);
+            # по убыванию цены индекс по цене читается в обратном порядке
+            models.Index(fields=['is_active', 'price', 'id'], name='product_active_price_idx'),
+            models.Index(fields=['is_active', 'name', 'id'], name='product_active_name_idx'),
+            models.Index(fields=['is_active', '-rating', '-id'], name='product_active_rating_idx'),
+            models.Index(fields=['is_active', '-created_at', '-id'], name='product_active_created_idx'),
+        ]
     
     def __str__(self):
         return self.name
@@ -224,8 +241,12 @@ class Product(models.Model):
     
     @property
     def is_available(self):
-        """Проверяет, доступен ли товар для покупки (есть ли на складе)"""
-        return self.stock_quantity > 0
+        """Проверяет, доступен ли товар для покупки (есть ли продаваемый остаток)"""
+        return self.sellable_quantity > 0
+
+    @property
+    def is_in_stock(self):
+        return self.is_available
 
 
 # ==================== ПАРТИИ ТОВАРОВ ====================
@@ -574,6 +595,10 @@ class Order(models.Model):
         verbose_name = "Заказ"
         verbose_name_plural = "Заказы"
         ordering = ['-order_date']
+        indexes = [
+            # История заказов покупателя, пагинация по курсору (order_date, id)
+            models.Index(fields=['user', '-order_date', '-id'], name='order_user_date_idx'),
+        ]
     
     def __str__(self):
         return f"Заказ #{self.id} от {self.user.username}"
@@ -698,6 +723,134 @@ class OrderStatusHistory(models.Model):
         return f"{self.order} - {self.get_status_display()} ({self.timestamp})"
 
 
+# ==================== АГРЕГАТЫ ПРОДАЖ ====================
+# Поддерживаются инкрементально из sales_signals, пересобираются командой rebuild_sales_rollups
+
+class DailySalesRollup(models.Model):
+    """Продажи за день: все оформленные заказы и доставленные"""
+    date = models.DateField(unique=True, verbose_name="Дата")
+    orders_count = models.IntegerField(default=0, verbose_name="Заказов оформлено")
+    orders_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="Сумма оформленных заказов")
+    delivered_orders = models.IntegerField(default=0, verbose_name="Заказов доставлено")
+    delivered_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="Выручка")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    class Meta:
+        verbose_name = "Продажи за день"
+        verbose_name_plural = "Продажи по дням"
+        ordering = ['-date']
+
+    def __str__(self):
+        return f"{self.date}: {self.delivered_revenue}"
+
+
+class DailyStoreSalesRollup(models.Model):
+    """Продажи магазина за день (магазин комплектации, иначе точка самовывоза)"""
+    date = models.DateField(verbose_name="Дата")
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name='daily_sales', verbose_name="Магазин")
+    orders_count = models.IntegerField(default=0, verbose_name="Заказов оформлено")
+    orders_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="Сумма оформленных заказов")
+    delivered_orders = models.IntegerField(default=0, verbose_name="Заказов доставлено")
+    delivered_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="Выручка")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    class Meta:
+        verbose_name = "Продажи магазина за день"
+        verbose_name_plural = "Продажи магазинов по дням"
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'store'], name='daily_store_sales_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.store} {self.date}: {self.delivered_revenue}"
+
+
+class DailyProductSalesRollup(models.Model):
+    """Продажи товара за день (только доставленные заказы)"""
+    date = models.DateField(verbose_name="Дата")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales', verbose_name="Товар")
+    quantity = models.IntegerField(default=0, verbose_name="Продано шт.")
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="Выручка")
+    orders_count = models.IntegerField(default=0, verbose_name="Заказов")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    class Meta:
+        verbose_name = "Продажи товара за день"
+        verbose_name_plural = "Продажи товаров по дням"
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'product'], name='daily_product_sales_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.product} {self.date}: {self.quantity}"
+
+
+class DailyCategorySalesRollup(models.Model):
+    """Продажи категории за день (только доставленные заказы)"""
+    date = models.DateField(verbose_name="Дата")
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='daily_sales', verbose_name="Категория")
+    quantity = models.IntegerField(default=0, verbose_name="Продано шт.")
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="Выручка")
+    orders_count = models.IntegerField(default=0, verbose_name="Заказов")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    class Meta:
+        verbose_name = "Продажи категории за день"
+        verbose_name_plural = "Продажи категорий по дням"
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'category'], name='daily_category_sales_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.category} {self.date}: {self.quantity}"
+
+
+class CustomerRFMSnapshot(models.Model):
+    """RFM-оценка клиента на момент ночного пересчета (см. rfm_snapshot.py)"""
+    SEGMENT_CHOICES = [
+        ('champions', 'Чемпионы (VIP)'),
+        ('loyal_customers', 'Постоянные клиенты'),
+        ('potential_loyalists', 'Потенциальные постоянные'),
+        ('new_customers', 'Новые клиенты'),
+        ('promising', 'Перспективные'),
+        ('needs_attention', 'Требуют внимания'),
+        ('about_to_sleep', 'Уходящие'),
+        ('at_risk', 'В зоне риска'),
+        ('lost', 'Потерянные'),
+    ]
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='rfm_snapshot', verbose_name="Клиент")
+    first_order_date = models.DateTimeField(verbose_name="Первый заказ")
+    last_order_date = models.DateTimeField(verbose_name="Последний заказ")
+    recency_days = models.IntegerField(verbose_name="Дней с последнего заказа")
+    frequency = models.IntegerField(verbose_name="Заказов")
+    monetary = models.DecimalField(max_digits=14, decimal_places=2, verbose_name="Сумма доставленных заказов")
+    r_score = models.PositiveSmallIntegerField(verbose_name="R")
+    f_score = models.PositiveSmallIntegerField(verbose_name="F")
+    m_score = models.PositiveSmallIntegerField(verbose_name="M")
+    segment = models.CharField(max_length=32, choices=SEGMENT_CHOICES, verbose_name="Сегмент")
+    computed_at = models.DateTimeField(verbose_name="Рассчитано")
+
+    class Meta:
+        verbose_name = "RFM-оценка клиента"
+        verbose_name_plural = "RFM-оценки клиентов"
+        ordering = ['segment', '-monetary', '-id']
+        indexes = [
+            # Страница сегмента: WHERE segment = %s ORDER BY monetary DESC, id DESC (keyset)
+            models.Index(fields=['segment', '-monetary', '-id'], name='rfm_segment_monetary_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.rfm_score} ({self.segment})"
+
+    @property
+    def rfm_score(self):
+        return f"{self.r_score}{self.f_score}{self.m_score}"
+
+
 # ==================== ПЛАТЕЖИ ====================
 
 class Payment(models.Model):
@@ -1050,15 +1203,8 @@ class LoyaltyCard(models.Model):
         self.save(update_fields=['points', 'level', 'total_spent', 'last_activity'])
 
         if cashback_amount > 0 and order is not None:
-            CashbackTransaction.objects.create(
-                user=self.user,
-                order=order,
-                amount=cashback_amount,
-                transaction_type='earned',
-                description=description or f'Кешбэк за заказ #{order.id}',
-            )
-            self.user.total_cashback_earned = Decimal(str(self.user.total_cashback_earned or 0)) + cashback_amount
-            self.user.save(update_fields=['total_cashback_earned'])
+            from .cashback_ledger import earn_cashback
+            earn_cashback(self.user, order, cashback_amount, description or f'Кешбэк за заказ #{order.id}')
 
         LoyaltyTransaction.objects.create(
             card=self,
@@ -1111,17 +1257,45 @@ class CashbackTransaction(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Сумма кешбэка")
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPE_CHOICES, verbose_name="Тип транзакции")
     description = models.CharField(max_length=200, verbose_name="Описание")
+    # Баланс пользователя после этой операции; пишется cashback_ledger под блокировкой CashbackBalance
+    balance_after = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name="Баланс после операции")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата транзакции")
     
     class Meta:
         verbose_name = "Транзакция кешбэка"
         verbose_name_plural = "Транзакции кешбэка"
         ordering = ['-created_at']
+        indexes = [
+            # История кешбэка пользователя, пагинация по курсору (created_at, id)
+            models.Index(fields=['user', '-created_at', '-id'], name='cashback_user_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.get_transaction_type_display()} - {self.amount} ₽"
 
 
+class CashbackBalance(models.Model):
+    """
+    Текущий баланс кешбэка пользователя (одна строка на пользователя).
+    Меняется только в cashback_ledger, в одной транзакции с вставкой CashbackTransaction
+    и под SELECT ... FOR UPDATE этой строки; сверка с журналом —
+    manage.py reconcile_cashback_balances.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='cashback_balance', verbose_name="Пользователь")
+    balance = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Баланс")
+    total_earned = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Всего начислено")
+    total_spent = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Всего потрачено")
+    total_expired = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Всего сгорело")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+    
+    class Meta:
+        verbose_name = "Баланс кешбэка"
+        verbose_name_plural = "Балансы кешбэка"
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.balance} ₽"
+
+
 # ==================== ИЗБРАННОЕ ====================
 
 class Favorite(models.Model):
@@ -1465,6 +1639,36 @@ class Metric(models.Model):
         return f"{self.name} = {self.value}"
 
 
+class MetricRollup(models.Model):
+    """
+    Агрегированное значение метрики для одного набора меток.
+    Заполняется пакетно из памяти процессов (paint_shop.metrics.flush_metrics).
+    """
+    METRIC_TYPE_CHOICES = Metric.METRIC_TYPE_CHOICES
+
+    name = models.CharField(max_length=255, verbose_name="Название метрики")
+    metric_type = models.CharField(max_length=20, choices=METRIC_TYPE_CHOICES, verbose_name="Тип метрики")
+    labels_key = models.CharField(max_length=64, verbose_name="Хеш меток")
+    labels = models.JSONField(default=dict, blank=True, verbose_name="Метки")
+    value = models.FloatField(default=0, verbose_name="Значение")
+    count = models.BigIntegerField(default=0, verbose_name="Количество наблюдений")
+    sum = models.FloatField(default=0, verbose_name="Сумма наблюдений")
+    buckets = models.JSONField(default=list, blank=True, verbose_name="Корзины гистограммы")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    class Meta:
+        verbose_name = "Агрегат метрики"
+        verbose_name_plural = "Агрегаты метрик"
+        db_table = "metric_rollups"
+        ordering = ['name']
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'metric_type', 'labels_key'], name='metric_rollup_unique_series'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.metric_type})"
+
+
 # ==================== ИСТОРИЯ ДЕЙСТВИЙ СБОРЩИКА ====================
 
 class PickerActionLog(models.Model):
@@ -1536,6 +1740,11 @@ class DatabaseBackup(models.Model):
         ('in_progress', 'В процессе'),
     ]
     
+    FORMAT_CHOICES = [
+        ('custom', 'pg_dump --format=custom'),
+        ('directory', 'pg_dump --format=directory --jobs N (.tar)'),
+    ]
+    
     operation = models.CharField(
         max_length=20,
         choices=OPERATION_CHOICES,
@@ -1556,6 +1765,28 @@ class DatabaseBackup(models.Model):
         blank=True,
         verbose_name="Размер файла (байты)"
     )
+    backup_format = models.CharField(
+        max_length=20,
+        choices=FORMAT_CHOICES,
+        blank=True,
+        verbose_name="Формат копии"
+    )
+    checksum = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name="SHA-256",
+        help_text="Контрольная сумма файла копии; она же записана рядом в <файл>.sha256"
+    )
+    duration_seconds = models.FloatField(
+        null=True,
+        blank=True,
+        verbose_name="Время выгрузки (с)"
+    )
+    throughput_mb_s = models.FloatField(
+        null=True,
+        blank=True,
+        verbose_name="Скорость (МБ/с)"
+    )
     comment = models.TextField(
         blank=True,
         verbose_name="Комментарий"
@@ -1592,3 +1823,127 @@ class DatabaseBackup(models.Model):
         if self.completed_at and self.started_at:
             return (self.completed_at - self.started_at).total_seconds()
         return None
+
+
+class BackupFile(models.Model):
+    """
+    Каталог файлов резервных копий: строка появляется при записи копии
+    (perform_backup) или при сверке с диском (reconcile_backup_catalog), так что
+    страница обслуживания и очистка по срокам хранения не обходят каталог на диске.
+    """
+    RETENTION_CHOICES = [
+        ('daily', 'Ежедневная'),
+        ('weekly', 'Еженедельная'),
+        ('monthly', 'Ежемесячная'),
+        ('pre_restore', 'Перед восстановлением'),
+        ('manual', 'Ручная'),
+    ]
+    
+    file_path = models.CharField(
+        max_length=1024,
+        unique=True,
+        verbose_name="Путь к файлу"
+    )
+    file_size = models.BigIntegerField(
+        verbose_name="Размер файла (байты)"
+    )
+    checksum = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name="SHA-256"
+    )
+    label = models.CharField(
+        max_length=50,
+        blank=True,
+        verbose_name="Метка"
+    )
+    retention_class = models.CharField(
+        max_length=20,
+        choices=RETENTION_CHOICES,
+        default='manual',
+        verbose_name="Класс хранения"
+    )
+    backup = models.ForeignKey(
+        DatabaseBackup,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='catalog_files',
+        verbose_name="Операция"
+    )
+    created_at = models.DateTimeField(
+        verbose_name="Создан"
+    )
+    
+    class Meta:
+        verbose_name = "Файл резервной копии"
+        verbose_name_plural = "Каталог резервных копий"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['retention_class', 'created_at'], name='backupfile_retention_idx'),
+            models.Index(fields=['-created_at'], name='backupfile_created_idx'),
+        ]
+    
+    def __str__(self):
+        return self.file_path
+
+
+# ==================== ФОНОВЫЙ ЭКСПОРТ ОТЧЕТОВ ====================
+
+class ExportJob(models.Model):
+    """Задание на формирование отчета в фоне (Celery) с хранением результата"""
+    STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('running', 'Формируется'),
+        ('done', 'Готов'),
+        ('failed', 'Ошибка'),
+    ]
+    ACTIVE_STATUSES = ('pending', 'running')
+
+    report_type = models.CharField(max_length=50, verbose_name="Тип отчета")
+    params = models.JSONField(default=dict, blank=True, verbose_name="Параметры")
+    params_hash = models.CharField(
+        max_length=64,
+        db_index=True,
+        verbose_name="Хеш параметров",
+        help_text="SHA-256 от типа отчета и параметров; одинаковые запросы используют одно задание",
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
+    progress = models.PositiveSmallIntegerField(default=0, verbose_name="Прогресс, %")
+    requested_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='export_jobs',
+        verbose_name="Запросил",
+    )
+    file_path = models.CharField(max_length=255, blank=True, verbose_name="Файл (относительно каталога экспорта)")
+    filename = models.CharField(max_length=255, blank=True, verbose_name="Имя файла")
+    content_type = models.CharField(max_length=100, blank=True, verbose_name="MIME-тип")
+    file_size = models.BigIntegerField(null=True, blank=True, verbose_name="Размер файла (байты)")
+    error_message = models.TextField(blank=True, verbose_name="Сообщение об ошибке")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Начало формирования")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Окончание формирования")
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True, verbose_name="Хранить до")
+
+    class Meta:
+        verbose_name = "Задание экспорта"
+        verbose_name_plural = "Задания экспорта"
+        ordering = ['-created_at']
+        constraints = [
+            # Не больше одного активного задания на набор параметров
+            models.UniqueConstraint(
+                fields=['params_hash'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='export_job_active_params_unique',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.report_type} #{self.pk} - {self.get_status_display()}"
+
+    @property
+    def is_ready(self):
+        return self.status == 'done' and (self.expires_at is None or self.expires_at > timezone.now())
@@ -0,0 +1,221 @@
+"""
+Атомарное оформление заказа
+
+Все изменения, которые делает оформление заказа, выполняются в одной транзакции:
+списание остатков, бронь слота доставки, позиции заказа, акции и кешбэк, очистка корзины.
+Строки Product и DeliverySlot блокируются (SELECT ... FOR UPDATE) в детерминированном
+порядке: сначала товары по возрастанию id, затем слот, последней — строка баланса
+кешбэка (cashback_ledger). Поэтому параллельные оформления
+не продают один и тот же остаток дважды и не блокируют друг друга взаимно.
+"""
+from __future__ import annotations
+
+import logging
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import (
+    Cart,
+    DeliverySlot,
+    Order,
+    OrderDelivery,
+    OrderItem,
+    OrderPicking,
+    Product,
+    UserPromotion,
+)
+from .batch_allocation import find_shortages, refresh_sellable_quantity
+from .cashback_ledger import InsufficientCashbackError, spend_cashback
+from .pricing import CartPricing
+from .promo_cache import register_promo_code_use
+
+logger = logging.getLogger(__name__)
+
+class OrderPlacementError(Exception):
+    """Заказ не может быть оформлен; транзакция откатывается целиком"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+class InsufficientStockError(OrderPlacementError):
+    """Недостаточно остатка по одной или нескольким позициям"""
+
+    def __init__(self, unavailable: List[str]):
+        super().__init__('Невозможно оформить заказ: недостаточно товара')
+        self.unavailable = unavailable
+
+
+class DeliverySlotUnavailableError(OrderPlacementError):
+    """Слот доставки не найден или заполнен"""
+
+
+class PromoCodeUnavailableError(OrderPlacementError):
+    """Лимит использований промокода исчерпан (например, последнее использование забрал параллельный заказ)"""
+
+
+class CashbackUnavailableError(OrderPlacementError):
+    """Баланс кешбэка меньше суммы списания (например, его уже потратил параллельный заказ)"""
+
+
+def _quantities(pricing: CartPricing) -> Dict[int, int]:
+    quantities: Dict[int, int] = defaultdict(int)
+    for item in pricing.items:
+        quantities[item.product_id] += int(item.quantity)
+    return dict(quantities)
+
+
+def _lock_products(product_ids) -> None:
+    """Блокирует строки товаров по возрастанию id"""
+    list(
+        Product.objects.select_for_update().filter(id__in=list(product_ids)).order_by('id').values_list('id', flat=True)
+    )
+
+
+def _lock_slot(slot_id) -> DeliverySlot:
+    try:
+        slot = DeliverySlot.objects.select_for_update().get(id=int(slot_id))
+    except (DeliverySlot.DoesNotExist, TypeError, ValueError):
+        raise DeliverySlotUnavailableError('Слот доставки не найден')
+    if not slot.available:
+        raise DeliverySlotUnavailableError('Выбранный слот доставки недоступен')
+    return slot
+
+
+def _decrement_stock(quantities: Dict[int, int]) -> None:
+    """
+    Списывает остатки условными UPDATE ... SET stock_quantity = stock_quantity - n
+    WHERE stock_quantity >= n. Товары с одинаковым количеством списываются одним запросом.
+    """
+    by_quantity: Dict[int, List[int]] = defaultdict(list)
+    for product_id, quantity in quantities.items():
+        by_quantity[quantity].append(product_id)
+    for quantity, product_ids in by_quantity.items():
+        updated = Product.objects.filter(
+            id__in=product_ids,
+            stock_quantity__gte=quantity,
+        ).update(stock_quantity=F('stock_quantity') - quantity)
+        if updated != len(product_ids):
+            raise InsufficientStockError(['Остаток изменился во время оформления заказа'])
+
+
+def _reserve_slot(slot: DeliverySlot) -> None:
+    updated = DeliverySlot.objects.filter(
+        pk=slot.pk,
+        is_active=True,
+        reserved_count__lt=F('capacity'),
+    ).update(reserved_count=F('reserved_count') + 1)
+    if not updated:
+        raise DeliverySlotUnavailableError('Выбранный слот доставки недоступен')
+
+
+def _spend_cashback(user, order: Order, amount: Decimal) -> None:
+    """Списание под блокировкой строки баланса: один кешбэк не тратится дважды"""
+    try:
+        spend_cashback(user, order, amount, f'Использование кешбэка для заказа #{order.id}')
+    except InsufficientCashbackError:
+        raise CashbackUnavailableError('Недостаточно средств на балансе кешбэка')
+
+
+def place_order(
+    user,
+    pricing: CartPricing,
+    *,
+    delivery_type: str,
+    payment_method: str,
+    delivery_address: str = '',
+    fulfillment_store=None,
+    delivery_slot_id=None,
+    comment: str = '',
+    cashback_used: Decimal = Decimal('0'),
+    status: Optional[str] = None,
+) -> Order:
+    """
+    Оформляет заказ по рассчитанной корзине.
+
+    Бросает InsufficientStockError / DeliverySlotUnavailableError /
+    CashbackUnavailableError; в этом случае ни остатки, ни слот, ни кешбэк,
+    ни корзина не изменяются.
+    """
+    if pricing.is_empty:
+        raise OrderPlacementError('Ваша корзина пуста!')
+
+    quantities = _quantities(pricing)
+    prices = {item.product_id: item.product.price for item in pricing.items}
+    cashback_used = Decimal(str(cashback_used or 0))
+
+    with transaction.atomic():
+        _lock_products(quantities.keys())
+        slot = None
+        if delivery_type == 'delivery' and delivery_slot_id:
+            slot = _lock_slot(delivery_slot_id)
+
+        # Остатки проверяются уже под блокировкой; партии — одним запросом с правилом 70% в SQL
+        unavailable = find_shortages(quantities)
+        if unavailable:
+            raise InsufficientStockError(unavailable)
+
+        _decrement_stock(quantities)
+        refresh_sellable_quantity(quantities.keys())
+        if slot is not None:
+            _reserve_slot(slot)
+
+        order_fields = {}
+        if status:
+            order_fields['status'] = status
+        order = Order.objects.create(
+            user=user,
+            delivery_type=delivery_type,
+            delivery_address=delivery_address,
+            total_amount=pricing.total,
+            payment_method=payment_method,
+            favorite_discount_amount=pricing.favorite_discount_amount,
+            promotion_discount=pricing.total_promotion_discount,
+            delivery_cost=pricing.delivery_cost,
+            fulfillment_store=fulfillment_store,
+            delivery_slot=slot,
+            comment=comment,
+            cashback_used=cashback_used,
+            amount_due=pricing.total - cashback_used,
+            **order_fields,
+        )
+
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product_id=product_id,
+                quantity=quantity,
+                price_per_unit=prices[product_id],
+            )
+            for product_id, quantity in quantities.items()
+        ])
+
+        OrderPicking.objects.create(order=order, status='pending')
+        if delivery_type == 'delivery':
+            OrderDelivery.objects.create(order=order, status='pending')
+
+        if pricing.applied_promotion and pricing.promotion_discount > 0:
+            UserPromotion.objects.create(
+                user=user,
+                promotion=pricing.applied_promotion,
+                order=order,
+                discount_amount=pricing.promotion_discount,
+            )
+        if pricing.applied_promo_code and not register_promo_code_use(pricing.applied_promo_code):
+            raise PromoCodeUnavailableError('Промокод больше недействителен: лимит использований исчерпан')
+
+        if cashback_used > 0:
+            _spend_cashback(user, order, cashback_used)
+
+        Cart.objects.filter(user=user).delete()
+
+    logger.info(
+        "order placed order=%s user=%s lines=%s total=%s cashback_used=%s",
+        order.id, user.pk, len(quantities), pricing.total, cashback_used,
+    )
+    return order
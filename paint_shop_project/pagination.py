@@ -0,0 +1,224 @@
+"""
+Keyset-пагинация (по курсору)
+
+Вместо OFFSET N и COUNT(*) следующая страница выбирается условием «строки после
+последней показанной» по ключу сортировки, например для (-order_date, -id):
+
+    WHERE order_date <= %s AND (order_date < %s OR (order_date = %s AND id < %s))
+    ORDER BY order_date DESC, id DESC LIMIT 11
+
+С составным индексом по тем же полям (Order(user, -order_date, -id) и т.п.) стоимость
+страницы не зависит от ее номера, а количество строк не считается вовсе.
+
+Курсор — непрозрачная строка (base64 от JSON со значениями ключа крайней строки и
+направлением), клиент возвращает ее как есть. Поля ключа не должны быть NULL;
+последним полем ключа всегда идет первичный ключ, чтобы порядок был однозначным.
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import List, Optional, Sequence, Tuple
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvalidCursor(ValueError):
+    """Курсор поврежден или не подходит к сортировке страницы"""
+
+
+# ==================== КУРСОР ====================
+
+def _encode_value(value):
+    # DjangoJSONEncoder обрезает микросекунды, а ключ должен совпадать с БД точно
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def encode_cursor(values: Sequence, backwards: bool = False) -> str:
+    payload = {'k': [_encode_value(value) for value in values]}
+    if backwards:
+        payload['r'] = 1
+    raw = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str) -> Tuple[list, bool]:
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw.decode('utf-8'))
+        values = payload['k']
+    except (binascii.Error, ValueError, TypeError, KeyError, UnicodeDecodeError):
+        raise InvalidCursor(token)
+    if not isinstance(values, list):
+        raise InvalidCursor(token)
+    return values, bool(payload.get('r'))
+
+
+# ==================== ПАГИНАТОР ====================
+
+class KeysetPage:
+    """Страница: объекты в порядке сортировки и курсоры соседних страниц"""
+
+    def __init__(self, object_list: list, next_cursor: Optional[str], previous_cursor: Optional[str]):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Пагинатор по ключу сортировки. ordering — поля в формате order_by
+    ('-order_date', '-id'); допускаются и аннотации queryset (например, search_rank).
+    Если первичного ключа в ordering нет, он добавляется последним с направлением
+    первого поля.
+    """
+
+    def __init__(self, queryset: QuerySet, ordering: Sequence[str], per_page: int):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys: List[Tuple[str, bool]] = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+        pk_name = queryset.model._meta.pk.name
+        if not self.keys or not any(name in ('pk', pk_name) for name, _desc in self.keys):
+            self.keys.append(('pk', self.keys[0][1] if self.keys else True))
+
+    def _order_by(self, backwards: bool) -> List[str]:
+        return [('-' if descending != backwards else '') + name for name, descending in self.keys]
+
+    def _to_python(self, name: str, value):
+        if name == 'pk':
+            return self.queryset.model._meta.pk.to_python(value)
+        try:
+            field = self.queryset.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return value  # аннотация: значение из JSON как есть
+        try:
+            return field.to_python(value)
+        except ValidationError:
+            raise InvalidCursor(name)
+
+    def _key(self, obj) -> list:
+        return [getattr(obj, name) for name, _descending in self.keys]
+
+    def _after(self, values: list, backwards: bool) -> Q:
+        """Строки строго после ключа values в порядке выборки"""
+        condition = Q()
+        for position, (name, descending) in enumerate(self.keys):
+            lookup = 'lt' if descending != backwards else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[position]})
+            for prev_position in range(position):
+                step &= Q(**{self.keys[prev_position][0]: values[prev_position]})
+            condition |= step
+        # Избыточное условие по первому полю позволяет планировщику взять диапазон индекса
+        first_name, first_descending = self.keys[0]
+        bound = 'lte' if first_descending != backwards else 'gte'
+        return Q(**{f'{first_name}__{bound}': values[0]}) & condition
+
+    def page(self, cursor: Optional[str] = None) -> KeysetPage:
+        backwards = False
+        queryset = self.queryset
+        if cursor:
+            values, backwards = decode_cursor(cursor)
+            if len(values) != len(self.keys):
+                raise InvalidCursor(cursor)
+            values = [self._to_python(name, value) for (name, _desc), value in zip(self.keys, values)]
+            queryset = queryset.filter(self._after(values, backwards))
+
+        rows = list(queryset.order_by(*self._order_by(backwards))[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            has_next, has_previous = bool(cursor), has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor)
+
+        next_cursor = encode_cursor(self._key(rows[-1])) if rows and has_next else None
+        previous_cursor = encode_cursor(self._key(rows[0]), backwards=True) if rows and has_previous else None
+        return KeysetPage(rows, next_cursor, previous_cursor)
+
+
+# ==================== DRF ====================
+
+class KeysetPagination(BasePagination):
+    """
+    Пагинация viewset'ов по курсору: ?cursor=<токен из next/previous>.
+    Порядок берется из queryset (OrderingFilter, поиск по релевантности,
+    Meta.ordering); поля связанных моделей и NULL-поля в ключ не входят.
+    """
+    page_size = api_settings.PAGE_SIZE or 20
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Некорректный курсор'
+
+    def get_ordering(self, queryset: QuerySet) -> List[str]:
+        ordering = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+        keys = []
+        for name in ordering:
+            if not isinstance(name, str) or name == '?' or '__' in name:
+                break
+            try:
+                if queryset.model._meta.get_field(name.lstrip('-')).null:
+                    break
+            except FieldDoesNotExist:
+                if name.lstrip('-') not in queryset.query.annotations and name.lstrip('-') != 'pk':
+                    break
+            keys.append(name)
+        return keys
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        paginator = KeysetPaginator(queryset, self.get_ordering(queryset), self.page_size)
+        try:
+            self.page = paginator.page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound(self.invalid_cursor_message)
+        return list(self.page)
+
+    def _link(self, cursor: Optional[str]) -> Optional[str]:
+        if cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self._link(self.page.next_cursor),
+            'previous': self._link(self.page.previous_cursor),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
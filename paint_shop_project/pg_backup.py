@@ -0,0 +1,179 @@
+"""
+Форматы резервных копий PostgreSQL
+
+custom (по умолчанию) — один файл pg_dump --format=custom.
+
+directory — pg_dump --format=directory --jobs BACKUP_JOBS: таблицы выгружаются
+параллельно, каждая в свой файл, поэтому большие таблицы заказов и аудита не
+выстраиваются в одну очередь. Каталог упаковывается в один .tar вместе с
+MANIFEST.sha256 (контрольные суммы всех файлов в формате sha256sum). Повторно архив
+не сжимается: файлы уже сжаты pg_dump с уровнем BACKUP_COMPRESSION_LEVEL.
+
+Рядом с каждой копией пишется <файл>.sha256 с суммой всего файла; та же сумма
+хранится в DatabaseBackup.checksum. Перед восстановлением сумма и манифест
+сверяются, затем pg_restore запускается с --jobs RESTORE_JOBS (параллельное
+восстановление возможно для custom-файла и каталога, но не для .sql и формата tar).
+
+Настройки: BACKUP_ENGINE ("custom" или "directory"), BACKUP_JOBS,
+BACKUP_COMPRESSION_LEVEL (0–9), RESTORE_JOBS.
+"""
+from __future__ import annotations
+
+import hashlib
+import tarfile
+from pathlib import Path, PurePosixPath
+from typing import Dict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+FORMAT_CUSTOM = 'custom'
+FORMAT_DIRECTORY = 'directory'
+BACKUP_FORMATS = (FORMAT_CUSTOM, FORMAT_DIRECTORY)
+
+ARCHIVE_SUFFIX = '.tar'
+CHECKSUM_SUFFIX = '.sha256'
+MANIFEST_NAME = 'MANIFEST.sha256'
+
+# Сигнатура файла pg_dump --format=custom
+CUSTOM_DUMP_MAGIC = b'PGDMP'
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class BackupIntegrityError(RuntimeError):
+    """Контрольная сумма или состав архива не совпадают с манифестом"""
+
+
+# ==================== НАСТРОЙКИ ====================
+
+def backup_format() -> str:
+    engine = getattr(settings, 'BACKUP_ENGINE', FORMAT_CUSTOM)
+    if engine not in BACKUP_FORMATS:
+        raise ImproperlyConfigured(f'BACKUP_ENGINE должен быть одним из {BACKUP_FORMATS}, получено {engine!r}')
+    return engine
+
+
+def backup_jobs() -> int:
+    return max(1, int(getattr(settings, 'BACKUP_JOBS', 4)))
+
+
+def restore_jobs() -> int:
+    return max(1, int(getattr(settings, 'RESTORE_JOBS', 4)))
+
+
+def compression_level() -> int:
+    return min(9, max(0, int(getattr(settings, 'BACKUP_COMPRESSION_LEVEL', 6))))
+
+
+# ==================== КОНТРОЛЬНЫЕ СУММЫ ====================
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def checksum_path(path: Path) -> Path:
+    return path.with_name(path.name + CHECKSUM_SUFFIX)
+
+
+def write_checksum_file(path: Path) -> str:
+    """Считает SHA-256 файла копии и пишет его рядом в <файл>.sha256"""
+    checksum = file_sha256(path)
+    checksum_path(path).write_text(f'{checksum}  {path.name}\n', encoding='utf-8')
+    return checksum
+
+
+def verify_checksum_file(path: Path) -> bool:
+    """
+    Сверяет файл с <файл>.sha256. Возвращает False, если суммы рядом нет
+    (копия загружена вручную или создана до появления сумм), при расхождении
+    бросает BackupIntegrityError.
+    """
+    sidecar = checksum_path(path)
+    if not sidecar.exists():
+        return False
+    expected = sidecar.read_text(encoding='utf-8').split()[0]
+    if file_sha256(path) != expected:
+        raise BackupIntegrityError(f'Контрольная сумма {path.name} не совпадает с {sidecar.name}')
+    return True
+
+
+def _read_manifest(directory: Path) -> Dict[str, str]:
+    entries = {}
+    for line in (directory / MANIFEST_NAME).read_text(encoding='utf-8').splitlines():
+        if line.strip():
+            checksum, name = line.split(None, 1)
+            entries[name.strip()] = checksum
+    return entries
+
+
+def write_manifest(directory: Path) -> Path:
+    """MANIFEST.sha256 со всеми файлами каталога pg_dump (пути относительно каталога)"""
+    lines = [
+        f'{file_sha256(path)}  {path.relative_to(directory).as_posix()}'
+        for path in sorted(directory.rglob('*'))
+        if path.is_file() and path.name != MANIFEST_NAME
+    ]
+    manifest = directory / MANIFEST_NAME
+    manifest.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return manifest
+
+
+def verify_manifest(directory: Path) -> None:
+    expected = _read_manifest(directory)
+    actual = {
+        path.relative_to(directory).as_posix()
+        for path in directory.rglob('*')
+        if path.is_file() and path.name != MANIFEST_NAME
+    }
+    if actual != set(expected):
+        raise BackupIntegrityError('Состав архива не совпадает с манифестом')
+    for name, checksum in expected.items():
+        if file_sha256(directory / name) != checksum:
+            raise BackupIntegrityError(f'Контрольная сумма {name} не совпадает с манифестом')
+
+
+# ==================== АРХИВ КАТАЛОГА ====================
+
+def pack_directory(directory: Path, archive_path: Path) -> None:
+    """Упаковывает каталог pg_dump в один .tar; манифест идет первым членом архива"""
+    manifest = write_manifest(directory)
+    with tarfile.open(archive_path, 'w') as archive:
+        archive.add(manifest, arcname=MANIFEST_NAME)
+        for path in sorted(directory.rglob('*')):
+            if path.is_file() and path != manifest:
+                archive.add(path, arcname=path.relative_to(directory).as_posix())
+
+
+def is_directory_archive(path: Path) -> bool:
+    """Архив каталога pg_dump (а не формат tar самого pg_dump): первый член — манифест"""
+    if not tarfile.is_tarfile(path):
+        return False
+    with tarfile.open(path, 'r') as archive:
+        first = archive.next()
+    return first is not None and first.name == MANIFEST_NAME
+
+
+def unpack_archive(archive_path: Path, destination: Path) -> Path:
+    """Распаковывает архив каталога и сверяет файлы с манифестом"""
+    with tarfile.open(archive_path, 'r') as archive:
+        members = archive.getmembers()
+        for member in members:
+            name = PurePosixPath(member.name)
+            if not member.isfile() or name.is_absolute() or '..' in name.parts:
+                raise BackupIntegrityError(f'Недопустимый элемент архива: {member.name}')
+        archive.extractall(destination, members=members)
+    verify_manifest(destination)
+    return destination
+
+
+def supports_parallel_restore(path: Path) -> bool:
+    """pg_restore --jobs работает с каталогом и custom-файлом, но не с форматом tar"""
+    if path.is_dir():
+        return True
+    with open(path, 'rb') as source:
+        return source.read(len(CUSTOM_DUMP_MAGIC)) == CUSTOM_DUMP_MAGIC
@@ -0,0 +1,293 @@
+"""
+Единый расчёт стоимости корзины
+
+Корзина, сводка корзины, оформление и создание заказа используют один конвейер скидок:
+любимые категории → любимые товары (10%) → промокод / акция → промо-правила → доставка
+→ ожидаемый кешбэк. Все данные загружаются фиксированным числом запросов, не зависящим
+от количества позиций в корзине.
+"""
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+
+from .models import (
+    Cart,
+    Favorite,
+    FavoriteCategory,
+    PromoCode,
+    PromoRule,
+    Promotion,
+    UserPromotion,
+)
+from .promo_cache import active_promo_rules, active_promotions, get_promo_code
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal('0.01')
+FAVORITE_PRODUCT_DISCOUNT_PERCENT = Decimal('10')
+FREE_DELIVERY_THRESHOLD = Decimal(str(getattr(settings, 'FREE_DELIVERY_THRESHOLD', 5000)))
+DEFAULT_DELIVERY_COST = Decimal(str(getattr(settings, 'DEFAULT_DELIVERY_COST', 200)))
+
+
+def _money(value) -> Decimal:
+    return Decimal(str(value or 0)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+@dataclass(frozen=True)
+class PricedLine:
+    """Позиция корзины с рассчитанными персональными скидками"""
+    item: Cart
+    line_total: Decimal
+    favorite_category_discount: Decimal
+    favorite_product_discount: Decimal
+
+
+@dataclass(frozen=True)
+class CartPricing:
+    """Неизменяемый расчёт стоимости корзины"""
+    lines: Tuple[PricedLine, ...]
+    subtotal: Decimal
+    favorite_discount_amount: Decimal
+    favorite_products_discount: Decimal
+    promotion_discount: Decimal
+    rule_discount: Decimal
+    total_without_delivery: Decimal
+    delivery_type: str
+    delivery_cost: Decimal
+    total: Decimal
+    expected_cashback: Decimal
+    applied_promotion: Optional[Promotion] = None
+    applied_promo_code: Optional[PromoCode] = None
+    promo_message: Optional[str] = None
+    available_promotions: Tuple[Tuple[Promotion, Decimal], ...] = ()
+
+    @property
+    def items(self) -> List[Cart]:
+        return [line.item for line in self.lines]
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.lines
+
+    @property
+    def base_for_promo(self) -> Decimal:
+        """Сумма после персональных скидок, к которой применяются акции"""
+        return max(self.subtotal - self.favorite_discount_amount - self.favorite_products_discount, Decimal('0'))
+
+    @property
+    def total_promotion_discount(self) -> Decimal:
+        """Скидка по акции/промокоду вместе с промо-правилами корзины"""
+        return self.promotion_discount + self.rule_discount
+
+    def as_summary(self) -> Dict[str, float]:
+        """Данные для JSON-ответа сводки корзины"""
+        return {
+            'subtotal': float(self.subtotal),
+            'favorite_discount_amount': float(self.favorite_discount_amount),
+            'favorite_products_discount': float(self.favorite_products_discount),
+            'promotion_discount': float(self.total_promotion_discount),
+            'total_after_discounts': float(self.total_without_delivery),
+            'expected_cashback': float(self.expected_cashback),
+        }
+
+
+# ==================== ЗАГРУЗКА ДАННЫХ ====================
+
+def load_cart_items(user) -> List[Cart]:
+    return list(Cart.objects.filter(user=user).select_related('product__category'))
+
+
+def load_favorite_category_discounts(user) -> Dict[int, int]:
+    return dict(
+        FavoriteCategory.objects.filter(user=user, is_active=True).values_list('category_id', 'discount_percent')
+    )
+
+
+def load_favorite_product_ids(user) -> Set[int]:
+    return set(Favorite.objects.filter(user=user).values_list('product_id', flat=True))
+
+
+def load_used_promotion_ids(user) -> Set[int]:
+    return set(UserPromotion.objects.filter(user=user).values_list('promotion_id', flat=True))
+
+
+def _get_loyalty_card(user):
+    try:
+        return user.loyalty_card
+    except (ObjectDoesNotExist, AttributeError):
+        return None
+
+
+# ==================== РАСЧЁТ ====================
+
+def calculate_rule_discount(items: Iterable[Cart], rules: Iterable[PromoRule]) -> Decimal:
+    """Промо корзины: 1+1 (сладости), mix&match (напитки) и правила PromoRule."""
+    items = list(items)
+    extra_discount = Decimal('0')
+
+    # 1+1 для категории 'Сладости'
+    for ci in items:
+        if getattr(ci.product.category, 'slug', '') == 'sweets':
+            free_units = ci.quantity // 2
+            if free_units > 0:
+                extra_discount += Decimal(str(ci.product.price)) * free_units
+
+    # mix&match: напитки — при суммарно >=3 единиц скидка 10% на напитки
+    beverages = [ci for ci in items if getattr(ci.product.category, 'slug', '') == 'beverages']
+    if sum(ci.quantity for ci in beverages) >= 3:
+        beverages_subtotal = sum((Decimal(str(ci.total_price)) for ci in beverages), Decimal('0'))
+        extra_discount += beverages_subtotal * Decimal('0.10')
+
+    for rule in rules:
+        if not rule.category_id:
+            continue
+        cat_items = [ci for ci in items if ci.product.category_id == rule.category_id]
+        qty_sum = sum(ci.quantity for ci in cat_items)
+        if rule.rule_type == 'n_for_m':
+            if qty_sum >= max(rule.n, rule.m, 1):
+                # Скидка = бесплатные единицы по самой дешёвой цене категории
+                free_units = (qty_sum // max(rule.n, 1)) * max(rule.n - rule.m, 0)
+                if free_units > 0:
+                    unit_prices: List[Decimal] = []
+                    for ci in cat_items:
+                        unit_prices += [Decimal(str(ci.product.price))] * ci.quantity
+                    unit_prices.sort()
+                    extra_discount += sum(unit_prices[:free_units], Decimal('0'))
+        elif rule.rule_type == 'percent_category' and rule.percent > 0:
+            if qty_sum >= max(rule.min_qty, 1):
+                cat_subtotal = sum((Decimal(str(ci.total_price)) for ci in cat_items), Decimal('0'))
+                extra_discount += cat_subtotal * Decimal(rule.percent) / Decimal('100')
+
+    return _money(extra_discount)
+
+
+def _promo_code_discount(promo_code: PromoCode, base: Decimal) -> Decimal:
+    if promo_code.discount_type == 'percent':
+        return base * Decimal(str(promo_code.discount_value)) / Decimal('100')
+    return min(Decimal(str(promo_code.discount_value)), base)
+
+
+def delivery_cost_for(delivery_type: str, total_without_delivery: Decimal) -> Decimal:
+    """Стоимость доставки: самовывоз бесплатно, доставка бесплатна от порога"""
+    if delivery_type != 'delivery' or total_without_delivery >= FREE_DELIVERY_THRESHOLD:
+        return Decimal('0.00')
+    return _money(DEFAULT_DELIVERY_COST)
+
+
+def price_cart(
+    user,
+    *,
+    promo_code: Optional[str] = None,
+    promotion_id=None,
+    delivery_type: str = 'pickup',
+) -> CartPricing:
+    """
+    Рассчитывает стоимость корзины пользователя.
+
+    Промокод имеет приоритет; без него применяется выбранная акция (promotion_id),
+    а если акция не выбрана — самая выгодная из действующих и ещё не использованных.
+    """
+    delivery_type = delivery_type or 'pickup'
+    if not getattr(user, 'is_authenticated', False):
+        zero = Decimal('0.00')
+        return CartPricing(
+            lines=(), subtotal=zero, favorite_discount_amount=zero, favorite_products_discount=zero,
+            promotion_discount=zero, rule_discount=zero, total_without_delivery=zero,
+            delivery_type=delivery_type, delivery_cost=zero, total=zero, expected_cashback=zero,
+        )
+
+    now = timezone.now()
+    items = load_cart_items(user)
+    category_discounts = load_favorite_category_discounts(user) if items else {}
+    favorite_product_ids = load_favorite_product_ids(user) if items else set()
+
+    lines: List[PricedLine] = []
+    for item in items:
+        line_total = Decimal(str(item.total_price))
+        category_percent = category_discounts.get(item.product.category_id) or 0
+        product_percent = FAVORITE_PRODUCT_DISCOUNT_PERCENT if item.product_id in favorite_product_ids else 0
+        lines.append(PricedLine(
+            item=item,
+            line_total=line_total,
+            favorite_category_discount=line_total * Decimal(category_percent) / Decimal('100'),
+            favorite_product_discount=line_total * Decimal(product_percent) / Decimal('100'),
+        ))
+
+    subtotal = _money(sum((line.line_total for line in lines), Decimal('0')))
+    favorite_discount_amount = _money(sum((line.favorite_category_discount for line in lines), Decimal('0')))
+    favorite_products_discount = _money(sum((line.favorite_product_discount for line in lines), Decimal('0')))
+    base_for_promo = max(subtotal - favorite_discount_amount - favorite_products_discount, Decimal('0'))
+
+    # Акции: одноразовые, уже использованные пользователем, не предлагаем
+    available: List[Tuple[Promotion, Decimal]] = []
+    if items:
+        used_ids = load_used_promotion_ids(user)
+        for promo in active_promotions(now):
+            if promo.id in used_ids:
+                continue
+            try:
+                saving = _money(promo.calculate_discount(base_for_promo))
+            except Exception:
+                saving = Decimal('0.00')
+            available.append((promo, saving))
+
+    promotion_discount = Decimal('0.00')
+    applied_promotion = None
+    applied_promo_code = None
+    promo_message = None
+
+    if promo_code:
+        code_obj = get_promo_code(promo_code)
+        if code_obj is None:
+            promo_message = 'Промокод не найден'
+        elif code_obj.is_valid() and base_for_promo >= Decimal(str(code_obj.min_order_amount)):
+            promotion_discount = _money(_promo_code_discount(code_obj, base_for_promo))
+            applied_promo_code = code_obj
+        else:
+            promo_message = 'Промокод недействителен или не подходит по сумме заказа'
+
+    if applied_promo_code is None and available:
+        if promotion_id:
+            selected = next((pair for pair in available if str(pair[0].id) == str(promotion_id)), None)
+        else:
+            selected = max(available, key=lambda pair: pair[1])
+        if selected and selected[1] > 0:
+            applied_promotion, promotion_discount = selected
+
+    rule_discount = calculate_rule_discount(items, active_promo_rules(now)) if items else Decimal('0.00')
+
+    total_without_delivery = max(base_for_promo - promotion_discount - rule_discount, Decimal('0.00'))
+    delivery_cost = delivery_cost_for(delivery_type, total_without_delivery)
+
+    expected_cashback = Decimal('0.00')
+    loyalty_card = _get_loyalty_card(user) if items else None
+    if loyalty_card is not None:
+        try:
+            expected_cashback = loyalty_card.calculate_cashback(total_without_delivery)
+        except Exception:
+            logger.exception("expected cashback calculation failed user=%s", user.pk)
+
+    return CartPricing(
+        lines=tuple(lines),
+        subtotal=subtotal,
+        favorite_discount_amount=favorite_discount_amount,
+        favorite_products_discount=favorite_products_discount,
+        promotion_discount=promotion_discount,
+        rule_discount=rule_discount,
+        total_without_delivery=_money(total_without_delivery),
+        delivery_type=delivery_type,
+        delivery_cost=delivery_cost,
+        total=_money(total_without_delivery + delivery_cost),
+        expected_cashback=expected_cashback,
+        applied_promotion=applied_promotion,
+        applied_promo_code=applied_promo_code,
+        promo_message=promo_message,
+        available_promotions=tuple(available),
+    )
@@ -0,0 +1,91 @@
+"""
+Поиск товаров
+
+В PostgreSQL поиск идет по Product.search_vector (конфигурация russian: «краски»
+находит «краска», слова ищутся как префиксы, совпадение в названии весомее, чем в
+описании) и по триграммам названия (pg_trgm, находит товары при опечатках). Оба условия
+обслуживаются GIN-индексами из миграции 0037, результаты можно сортировать по
+релевантности (аннотация search_rank).
+
+Если pg_trgm на сервере не установлен, работает только полнотекстовая часть.
+На других СУБД (SQLite в тестах и разработке) остается прежний поиск через icontains.
+"""
+from __future__ import annotations
+
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import F, FloatField, Q, QuerySet, Value
+from django.db.models.functions import Cast
+
+SEARCH_CONFIG = 'russian'
+
+# Вклад похожести названия (0..1) в итоговую релевантность рядом с ts_rank
+TRIGRAM_WEIGHT = 0.5
+
+RELEVANCE_SORT = 'relevance'
+
+_WORD_RE = re.compile(r'\w+')
+
+_trigram_enabled = {}
+
+
+def full_text_enabled() -> bool:
+    return connection.vendor == 'postgresql'
+
+
+def trigram_enabled() -> bool:
+    """Установлено ли расширение pg_trgm (проверяется один раз на процесс и базу)"""
+    if not full_text_enabled():
+        return False
+    alias = connection.alias
+    if alias not in _trigram_enabled:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigram_enabled[alias] = cursor.fetchone() is not None
+    return _trigram_enabled[alias]
+
+
+def prefix_query(query: str):
+    """
+    tsquery «все слова, каждое как префикс»: «кол» находит «колбаса», «ржан хлеб» —
+    «ржаной хлеб». Слова берутся только из букв и цифр, поэтому операторы tsquery
+    из пользовательского ввода не проходят.
+    """
+    words = _WORD_RE.findall(query)
+    if not words:
+        return None
+    return SearchQuery(' & '.join(f'{word}:*' for word in words), config=SEARCH_CONFIG, search_type='raw')
+
+
+def search_products(queryset: QuerySet, query: str, order_by_rank: bool = False) -> QuerySet:
+    """
+    Фильтрует queryset товаров по поисковой строке и добавляет аннотацию
+    search_rank (вне PostgreSQL — 0); при order_by_rank сортирует по ней.
+    """
+    query = (query or '').strip()
+    if not query:
+        return queryset
+
+    if not full_text_enabled():
+        queryset = queryset.filter(Q(name__icontains=query) | Q(description__icontains=query))
+        queryset = queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+        if order_by_rank:
+            queryset = queryset.order_by('name')
+        return queryset
+
+    search_query = prefix_query(query)
+    if search_query is None:
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField())).none()
+    condition = Q(search_vector=search_query)
+    # ts_rank возвращает real; в double precision значение переживает круг
+    # через курсор пагинации без потери точности (pagination.py)
+    rank = Cast(SearchRank(F('search_vector'), search_query), FloatField())
+    if trigram_enabled():
+        condition |= Q(name__trigram_word_similar=query)
+        rank = rank + TrigramWordSimilarity(query, 'name') * TRIGRAM_WEIGHT
+    queryset = queryset.filter(condition).annotate(search_rank=rank)
+    if order_by_rank:
+        queryset = queryset.order_by('-search_rank', 'name')
+    return queryset
@@ -6,6 +6,7 @@ from django.dispatch import receiver
 from django.utils import timezone
 from datetime import timedelta
 from .models import Product, ProductBatch
+from .batch_allocation import refresh_sellable_quantity
 
 
 @receiver(pre_save, sender=Product)
@@ -81,3 +82,15 @@ def create_batch_on_stock_increase(sender, instance, created, **kwargs):
         )
 
 
+
+
+@receiver(post_save, sender=Product)
+def refresh_sellable_quantity_on_save(sender, instance, **kwargs):
+    """Пересчитывает доступный к продаже остаток после изменения товара"""
+    refresh_sellable_quantity([instance.pk])
+    if instance.has_expiry_date:
+        instance.sellable_quantity = (
+            Product.objects.filter(pk=instance.pk).values_list('sellable_quantity', flat=True).first() or 0
+        )
+    else:
+        instance.sellable_quantity = instance.stock_quantity or 0
@@ -0,0 +1,370 @@
+"""
+Подсказки поиска (search-as-you-type)
+
+Подсказки отдаются из индекса в памяти процесса: отсортированный список
+нормализованных ключей и bisect по префиксу, без обращений к БД и кешу на каждое
+нажатие клавиши. В индекс входят названия активных товаров (с каждого слова
+названия: «ржан» находит «Хлеб ржаной») и популярные запросы из SearchHistory.
+
+Индекс обновляется инкрементально:
+- в процессе, где сохранили или удалили товар, — сразу (suggest_signals): записи
+  товара вставляются и удаляются через bisect, без пересортировки индекса;
+- в остальных процессах — по версии в общем кеше, которая проверяется не чаще
+  раза в SUGGEST_CHECK_INTERVAL секунд: догружаются только товары с updated_at
+  позже последней загрузки и удаляются id из журнала удаленных товаров.
+Полная пересборка (в том числе популярных запросов) — раз в SUGGEST_REBUILD_INTERVAL.
+"""
+from __future__ import annotations
+
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Product, SearchHistory
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'product_suggest:version'
+# Журнал удаленных товаров: кольцо из MAX_DELETED_IDS ключей, номер записи выдает
+# атомарный cache.incr, поэтому параллельные удаления не затирают друг друга
+DELETED_SEQ_KEY = 'product_suggest:deleted:seq'
+DELETED_KEY = 'product_suggest:deleted:{slot}'
+MAX_DELETED_IDS = 1000
+
+# Запас при догрузке по updated_at: транзакция могла зафиксироваться позже, чем
+# было записано updated_at
+CATCH_UP_SLACK = timedelta(minutes=1)
+
+CHECK_INTERVAL = getattr(settings, 'SUGGEST_CHECK_INTERVAL', 30)
+REBUILD_INTERVAL = getattr(settings, 'SUGGEST_REBUILD_INTERVAL', 3600)
+
+# Популярные запросы: за последние N дней, не реже MIN_COUNT раз, не больше MAX_QUERIES
+QUERY_HISTORY_DAYS = 90
+QUERY_MIN_COUNT = 2
+MAX_QUERIES = 500
+
+MIN_PREFIX_LENGTH = 2
+MAX_SCAN = 50  # сколько ключей с нужным префиксом просматривать, не больше
+
+KIND_PRODUCT = 'product'
+KIND_QUERY = 'query'
+
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize(text: str) -> str:
+    return _SPACES_RE.sub(' ', (text or '').lower().replace('ё', 'е')).strip()
+
+
+@dataclass(frozen=True)
+class Suggestion:
+    text: str
+    kind: str
+    product_id: Optional[int]
+    weight: int
+    normalized: str
+
+
+IndexItem = Tuple[str, int, Tuple[str, int, str], Suggestion]
+
+
+# ==================== ИНДЕКС ====================
+
+class PrefixIndex:
+    """
+    Отсортированный список записей (ключ, -вес, различитель, подсказка).
+    Сборка из пар сортирует все один раз; дальше записи товаров вставляются и
+    удаляются по одной через bisect (update_products/remove_products). Вставка и
+    удаление элемента списка атомарны, поэтому читатели (suggest) работают без
+    блокировок, а изменения упорядочены собственной блокировкой индекса.
+    """
+
+    def __init__(self, pairs: Iterable[Tuple[str, Suggestion]] = ()):
+        self.items: List[IndexItem] = sorted(self._item(key, suggestion) for key, suggestion in pairs)
+        # id товара -> его записи в items (для удаления и проверки, изменилось ли название)
+        self.products: Dict[int, List[IndexItem]] = {}
+        for item in self.items:
+            if item[3].kind == KIND_PRODUCT:
+                self.products.setdefault(item[3].product_id, []).append(item)
+        self._write_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    @staticmethod
+    def _item(key: str, suggestion: Suggestion) -> IndexItem:
+        # Различитель уникален для ключа, поэтому сами Suggestion никогда не сравниваются
+        return key, -suggestion.weight, (suggestion.kind, suggestion.product_id or 0, suggestion.text), suggestion
+
+    @staticmethod
+    def product_pairs(product_id: int, name: str, weight: int = 0) -> List[Tuple[str, Suggestion]]:
+        """Ключи товара: название целиком и его хвосты с начала каждого слова"""
+        normalized = normalize(name)
+        if not normalized:
+            return []
+        suggestion = Suggestion(
+            text=name.strip(), kind=KIND_PRODUCT, product_id=product_id, weight=weight, normalized=normalized,
+        )
+        words = normalized.split(' ')
+        return [(' '.join(words[i:]), suggestion) for i in range(len(words))]
+
+    @staticmethod
+    def query_pair(query: str, count: int) -> Tuple[str, Suggestion]:
+        normalized = normalize(query)
+        return normalized, Suggestion(
+            text=normalized, kind=KIND_QUERY, product_id=None, weight=count, normalized=normalized,
+        )
+
+    def indexed_text(self, product_id: int) -> Optional[str]:
+        """Название товара в индексе или None, если товара в индексе нет"""
+        items = self.products.get(product_id)
+        return items[0][3].text if items else None
+
+    def _remove(self, product_id: int) -> None:
+        for item in self.products.pop(product_id, ()):
+            position = bisect_left(self.items, item)
+            if position < len(self.items) and self.items[position] == item:
+                del self.items[position]
+
+    def remove_products(self, product_ids: Iterable[int]) -> None:
+        with self._write_lock:
+            for product_id in product_ids:
+                self._remove(product_id)
+
+    def update_products(self, products: Iterable[Tuple[int, str, bool]]) -> None:
+        """Заменяет записи товаров (id, название, активен); неактивные удаляются"""
+        with self._write_lock:
+            for product_id, name, is_active in products:
+                self._remove(product_id)
+                if not is_active:
+                    continue
+                items = [self._item(key, suggestion) for key, suggestion in self.product_pairs(product_id, name)]
+                for item in items:
+                    insort(self.items, item)
+                if items:
+                    self.products[product_id] = items
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[Suggestion]:
+        prefix = normalize(prefix)
+        if len(prefix) < MIN_PREFIX_LENGTH:
+            return []
+        # Срез копируется одной операцией: параллельная вставка может сдвинуть окно
+        # на запись, но не разорвет ее
+        start = bisect_left(self.items, (prefix,))
+        candidates = []
+        for key, _weight, _tiebreak, entry in self.items[start:start + MAX_SCAN]:
+            if not key.startswith(prefix):
+                break
+            candidates.append((key, entry))
+
+        # Точное начало названия выше совпадения с середины, затем популярность и длина
+        candidates.sort(key=lambda item: (
+            not item[1].normalized.startswith(prefix),
+            item[1].kind != KIND_QUERY,
+            -item[1].weight,
+            len(item[1].text),
+        ))
+        seen = set()
+        result = []
+        for _key, entry in candidates:
+            if entry.normalized in seen:
+                continue
+            seen.add(entry.normalized)
+            result.append(entry)
+            if len(result) == limit:
+                break
+        return result
+
+
+# ==================== ЗАГРУЗКА ИЗ БД ====================
+
+def _popular_queries() -> Dict[str, int]:
+    since = timezone.now() - timedelta(days=QUERY_HISTORY_DAYS)
+    rows = (
+        SearchHistory.objects.filter(created_at__gte=since)
+        .values('query')
+        .annotate(count=Count('id'))
+        .order_by('-count')[:MAX_QUERIES * 4]
+    )
+    # Нормализация в Python: lower() в SQLite не работает с кириллицей
+    counts = Counter()
+    for row in rows:
+        key = normalize(row['query'])
+        if len(key) >= MIN_PREFIX_LENGTH:
+            counts[key] += row['count']
+    return {query: count for query, count in counts.most_common(MAX_QUERIES) if count >= QUERY_MIN_COUNT}
+
+
+def build_index() -> Tuple[PrefixIndex, Optional[object]]:
+    """Полная сборка индекса; возвращает индекс и максимальный updated_at товаров"""
+    pairs = []
+    watermark = None
+    for product_id, name, updated_at in Product.objects.filter(is_active=True).values_list('id', 'name', 'updated_at'):
+        pairs.extend(PrefixIndex.product_pairs(product_id, name))
+        if watermark is None or updated_at > watermark:
+            watermark = updated_at
+    for query, count in _popular_queries().items():
+        pairs.append(PrefixIndex.query_pair(query, count))
+    return PrefixIndex(pairs), watermark
+
+
+# ==================== СОСТОЯНИЕ ПРОЦЕССА ====================
+
+_lock = threading.Lock()
+_state = {
+    'index': None,
+    'version': None,
+    'watermark': None,
+    'deleted_seq': 0,
+    'checked_at': 0.0,
+    'built_at': 0.0,
+}
+
+
+def _shared_version():
+    return cache.get(VERSION_KEY)
+
+
+def _deleted_seq() -> int:
+    return cache.get(DELETED_SEQ_KEY) or 0
+
+
+def _record_deleted(product_id: int) -> None:
+    cache.add(DELETED_SEQ_KEY, 0, None)
+    seq = cache.incr(DELETED_SEQ_KEY)
+    cache.set(DELETED_KEY.format(slot=seq % MAX_DELETED_IDS), (seq, product_id), None)
+
+
+def _read_deleted(since: int) -> Optional[Tuple[List[int], int]]:
+    """
+    Id товаров, удаленных после записи since, и номер последней прочитанной записи.
+    None — журнал уже перезаписан по кругу, нужна полная пересборка.
+    """
+    last = _deleted_seq()
+    if last - since >= MAX_DELETED_IDS:
+        return None
+    seqs = range(since + 1, last + 1)
+    slots = cache.get_many([DELETED_KEY.format(slot=seq % MAX_DELETED_IDS) for seq in seqs])
+    product_ids = []
+    for seq in seqs:
+        entry = slots.get(DELETED_KEY.format(slot=seq % MAX_DELETED_IDS))
+        if not entry or entry[0] != seq:
+            # Номер уже выдан, а запись еще не сделана — дочитаем при следующей проверке
+            return product_ids, seq - 1
+        product_ids.append(entry[1])
+    return product_ids, last
+
+
+def _rebuild(version) -> PrefixIndex:
+    deleted_seq = _deleted_seq()
+    index, watermark = build_index()
+    now = time.monotonic()
+    with _lock:
+        _state.update(
+            index=index, version=version, watermark=watermark, deleted_seq=deleted_seq,
+            checked_at=now, built_at=now,
+        )
+    logger.info("product suggest index built entries=%d", len(index))
+    return index
+
+
+def _catch_up(index: PrefixIndex, version) -> PrefixIndex:
+    """Догружает изменения других процессов: товары после watermark и удаленные id"""
+    deleted = _read_deleted(_state['deleted_seq'])
+    if deleted is None:
+        return _rebuild(version)
+    deleted_ids, deleted_seq = deleted
+
+    watermark = _state['watermark']
+    changed = Product.objects.all()
+    if watermark is not None:
+        changed = changed.filter(updated_at__gte=watermark - CATCH_UP_SLACK)
+    rows = list(changed.values_list('id', 'name', 'is_active', 'updated_at'))
+
+    index.update_products((pk, name, is_active) for pk, name, is_active, _updated in rows)
+    index.remove_products(deleted_ids)
+    if rows:
+        watermark = max(watermark or rows[0][3], max(row[3] for row in rows))
+    with _lock:
+        _state.update(version=version, watermark=watermark, deleted_seq=deleted_seq, checked_at=time.monotonic())
+    return index
+
+
+def get_index() -> PrefixIndex:
+    """
+    Индекс процесса. В пределах CHECK_INTERVAL отдается без каких-либо обращений
+    к кешу и БД.
+    """
+    now = time.monotonic()
+    with _lock:
+        index = _state['index']
+        if index is not None and now - _state['checked_at'] < CHECK_INTERVAL:
+            return index
+
+    version = _shared_version()
+    if index is None or now - _state['built_at'] >= REBUILD_INTERVAL:
+        return _rebuild(version)
+    if version != _state['version']:
+        return _catch_up(index, version)
+    with _lock:
+        _state['checked_at'] = now
+    return index
+
+
+def suggest(prefix: str, limit: int = 10) -> List[Suggestion]:
+    return get_index().suggest(prefix, limit)
+
+
+# ==================== ИЗМЕНЕНИЯ ТОВАРОВ ====================
+
+def _bump_version() -> str:
+    version = str(time.time_ns())
+    cache.set(VERSION_KEY, version, None)
+    return version
+
+
+# Версию процесса здесь не меняем: изменения других процессов, сделанные до этого
+# момента, еще не загружены, и следующая проверка версии их догрузит.
+
+def product_changed(product: Product) -> None:
+    """
+    Обновляет индекс процесса и сообщает остальным процессам о новой версии.
+    Сохранения, не меняющие название и активность (например, пересчет рейтинга
+    после отзыва), индекс и версию не трогают.
+    """
+    with _lock:
+        index = _state['index']
+    text = product.name.strip() if product.is_active and normalize(product.name) else None
+    if index is not None and index.indexed_text(product.pk) == text:
+        return
+    _bump_version()
+    if index is not None:
+        index.update_products([(product.pk, product.name, product.is_active)])
+
+
+def product_deleted(product_id: int) -> None:
+    _record_deleted(product_id)
+    _bump_version()
+    with _lock:
+        index = _state['index']
+    if index is not None:
+        index.remove_products([product_id])
+
+
+def reset() -> None:
+    """Сбрасывает индекс процесса (тесты, ручная пересборка)"""
+    with _lock:
+        _state.update(
+            index=None, version=None, watermark=None, deleted_seq=0, checked_at=0.0, built_at=0.0,
+        )
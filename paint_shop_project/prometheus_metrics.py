@@ -3,6 +3,11 @@
 Использует prometheus_client для создания метрик
 Все метрики регистрируются в глобальном REGISTRY, который используется django_prometheus
 """
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
 try:
     from prometheus_client import Gauge, Counter, Histogram
     PROMETHEUS_CLIENT_AVAILABLE = True
@@ -62,110 +67,253 @@ if PROMETHEUS_CLIENT_AVAILABLE:
                                ['method', 'status_code', 'path'])
     http_exceptions_total = Counter('zhevzhik_http_exceptions_total', 'Total number of HTTP exceptions',
                                     ['method', 'path', 'exception_type'])
+    http_label_overflow_total = Counter('zhevzhik_http_label_overflow_total',
+                                        'HTTP requests recorded under path="overflow" after the label set cap')
+
+    # Самонаблюдение сборщика бизнес-метрик
+    business_metrics_age_seconds = Gauge('zhevzhik_business_metrics_age_seconds',
+                                         'Seconds since business metrics were collected')
+    business_metrics_query_duration_seconds = Histogram('zhevzhik_business_metrics_query_duration_seconds',
+                                                        'Duration of business metrics collector queries',
+                                                        ['query'])
+
+    # Gauge по ключу снимка бизнес-метрик; ключи вне карты пропускаются (apply_business_metrics)
+    _BUSINESS_GAUGES = {
+        'users_total': users_total,
+        'users_active': users_active,
+        'users_today': users_today,
+        'orders_total': orders_total,
+        'orders_today': orders_today,
+        'revenue_total': revenue_total,
+        'revenue_today': revenue_today,
+        'avg_order_value': avg_order_value,
+        'cart_items_total': cart_items_total,
+        'carts_active': carts_active,
+        'products_total': products_total,
+        'products_with_discount': products_with_discount,
+        'reviews_total': reviews_total,
+        'reviews_approved': reviews_approved,
+        'avg_rating': avg_rating,
+        'payments_total': payments_total,
+        'payments_success': payments_success,
+        'payments_amount': payments_amount,
+        'promotions_active': promotions_active,
+        'batches_expired_total': batches_expired_total,
+        'batches_low_stock_total': batches_low_stock_total,
+    }
+    # Gauge с меткой и имя метки, по которой разложены серии
+    _LABELED_BUSINESS_GAUGES = {
+        'orders_by_status': (orders_by_status, 'status'),
+        'products_by_category': (products_by_category, 'category'),
+        'batches_expiring_days': (batches_expiring_days, 'days'),
+    }
+
+    # Списание просроченных партий (batch_spoilage)
+    batch_spoilage_runs_total = Counter('zhevzhik_batch_spoilage_runs_total',
+                                        'Batch spoilage runs by outcome (success, locked)', ['status'])
+    batch_spoilage_duration_seconds = Histogram('zhevzhik_batch_spoilage_duration_seconds',
+                                                'Duration of batch spoilage runs')
+    batch_spoilage_batches_total = Counter('zhevzhik_batch_spoilage_batches_total',
+                                           'Expired batches written off')
+    batch_spoilage_units_total = Counter('zhevzhik_batch_spoilage_units_total',
+                                         'Units written off with expired batches')
+
+
+# ==================== СБОРЩИК БИЗНЕС-МЕТРИК ====================
+#
+# Бизнес-метрики считает периодическая задача Celery collect_business_metrics (или первый
+# освободившийся процесс, если снимок устарел) и кладёт снимок в общий кэш Django.
+# /metrics/ только переносит снимок в gauge и не обращается к БД.
+
+BUSINESS_METRICS_CACHE_KEY = 'prometheus:business_metrics'
+BUSINESS_METRICS_LOCK_KEY = 'prometheus:business_metrics:lock'
+
+# Время последнего снимка, уже применённого в этом процессе
+_applied_collected_at = None
+
+
+def _business_metrics_interval():
+    from django.conf import settings
+    return getattr(settings, 'BUSINESS_METRICS_INTERVAL', 60)
+
+
+def collect_business_metrics():
+    """
+    Считает бизнес-метрики (по одному агрегирующему запросу на группу) и сохраняет
+    снимок в общий кэш. Возвращает снимок.
+    """
+    from django.core.cache import cache
+    from django.db.models import Avg, Count, Q, Sum
+    from django.utils import timezone
+    from paint_shop_project.db_routing import use_replica
+    from paint_shop_project.models import Cart, Order, Payment, Product, ProductBatch, Promotion, Review, User
+
+    today = timezone.now().date()
+    values = {}
+    labeled = {}
+    timings = {}
+
+    def timed(query_name, func):
+        started = time.perf_counter()
+        with use_replica():
+            result = func()
+        timings[query_name] = time.perf_counter() - started
+        return result
+
+    users = timed('users', lambda: User.objects.aggregate(
+        total=Count('id'),
+        active=Count('id', filter=Q(is_active=True)),
+        today=Count('id', filter=Q(date_joined__date=today)),
+    ))
+    values.update(users_total=users['total'], users_active=users['active'], users_today=users['today'])
+
+    orders = timed('orders', lambda: Order.objects.aggregate(
+        total=Count('id'),
+        today=Count('id', filter=Q(order_date__date=today)),
+        revenue=Sum('total_amount'),
+        revenue_today=Sum('total_amount', filter=Q(order_date__date=today)),
+        avg=Avg('total_amount'),
+    ))
+    values.update(
+        orders_total=orders['total'],
+        orders_today=orders['today'],
+        revenue_total=float(orders['revenue'] or 0),
+        revenue_today=float(orders['revenue_today'] or 0),
+        avg_order_value=float(orders['avg'] or 0),
+    )
+    labeled['orders_by_status'] = timed('orders_by_status', lambda: {
+        row['status']: row['count']
+        for row in Order.objects.order_by().values('status').annotate(count=Count('id'))
+    })
+
+    carts = timed('carts', lambda: Cart.objects.aggregate(
+        items=Count('id'),
+        users=Count('user', distinct=True),
+    ))
+    values.update(cart_items_total=carts['items'], carts_active=carts['users'])
+
+    products = timed('products', lambda: Product.objects.filter(is_active=True).aggregate(
+        total=Count('id'),
+        with_discount=Count('id', filter=Q(old_price__isnull=False)),
+    ))
+    values.update(products_total=products['total'], products_with_discount=products['with_discount'])
+    labeled['products_by_category'] = timed('products_by_category', lambda: {
+        row['category__name']: row['count']
+        for row in (
+            Product.objects.filter(is_active=True, category__isnull=False)
+            .order_by().values('category__name').annotate(count=Count('id'))
+        )
+        if row['category__name']
+    })
+
+    reviews = timed('reviews', lambda: Review.objects.aggregate(
+        total=Count('id'),
+        approved=Count('id', filter=Q(is_approved=True)),
+        rating=Avg('rating', filter=Q(is_approved=True)),
+    ))
+    values.update(
+        reviews_total=reviews['total'],
+        reviews_approved=reviews['approved'],
+        avg_rating=float(reviews['rating'] or 0),
+    )
+
+    payments = timed('payments', lambda: Payment.objects.aggregate(
+        total=Count('id'),
+        success=Count('id', filter=Q(status='success')),
+        amount=Sum('amount', filter=Q(status='success')),
+    ))
+    values.update(
+        payments_total=payments['total'],
+        payments_success=payments['success'],
+        payments_amount=float(payments['amount'] or 0),
+    )
+
+    values['promotions_active'] = timed('promotions', lambda: Promotion.objects.filter(is_active=True).count())
+
+    # Партии: просроченные, истекающие в окнах 3 и 7 дней, низкий остаток (<=10 единиц)
+    windows = (3, 7)
+    batches = timed('batches', lambda: ProductBatch.objects.aggregate(
+        expired=Count('id', filter=Q(expiry_date__lt=today)),
+        low_stock=Count('id', filter=Q(remaining_quantity__lte=10)),
+        **{
+            f'expiring_{days}': Count('id', filter=Q(
+                expiry_date__gte=today, expiry_date__lte=today + timezone.timedelta(days=days),
+            ))
+            for days in windows
+        },
+    ))
+    values.update(batches_expired_total=batches['expired'], batches_low_stock_total=batches['low_stock'])
+    labeled['batches_expiring_days'] = {str(days): batches[f'expiring_{days}'] for days in windows}
+
+    snapshot = {
+        'collected_at': time.time(),
+        'values': values,
+        'labeled': labeled,
+        'timings': timings,
+    }
+    cache.set(BUSINESS_METRICS_CACHE_KEY, snapshot, timeout=None)
+    return snapshot
+
+
+# Неизвестные ключи снимка, о которых уже предупредили в этом процессе
+_unknown_metric_names = set()
+
+
+def _skip_unknown_metric(metric_name):
+    # Снимок мог собрать процесс другой версии (например, во время выкладки)
+    if metric_name not in _unknown_metric_names:
+        _unknown_metric_names.add(metric_name)
+        logger.warning("Unknown business metric %r in snapshot skipped", metric_name)
+
+
+def apply_business_metrics(snapshot):
+    """Переносит снимок в gauge текущего процесса"""
+    global _applied_collected_at
+    if not PROMETHEUS_CLIENT_AVAILABLE or not snapshot:
+        return
+
+    for metric_name, value in snapshot['values'].items():
+        metric = _BUSINESS_GAUGES.get(metric_name)
+        if metric is None:
+            _skip_unknown_metric(metric_name)
+            continue
+        metric.set(value)
+    for metric_name, series in snapshot['labeled'].items():
+        if metric_name not in _LABELED_BUSINESS_GAUGES:
+            _skip_unknown_metric(metric_name)
+            continue
+        metric, label = _LABELED_BUSINESS_GAUGES[metric_name]
+        metric.clear()
+        for label_value, value in series.items():
+            metric.labels(**{label: label_value}).set(value)
+
+    # Длительности запросов наблюдаем один раз на снимок, а не на каждый scrape
+    if snapshot['collected_at'] != _applied_collected_at:
+        for query_name, duration in snapshot.get('timings', {}).items():
+            business_metrics_query_duration_seconds.labels(query=query_name).observe(duration)
+        _applied_collected_at = snapshot['collected_at']
+
+    business_metrics_age_seconds.set(max(0.0, time.time() - snapshot['collected_at']))
 
 
 def update_business_metrics():
-    """Обновить все бизнес-метрики из БД (с кэшированием)"""
+    """
+    Обновить бизнес-метрики из общего кэша.
+
+    Если снимка нет или он старше двух интервалов (не запущен Celery beat), один процесс
+    кластера пересчитывает его сам — остальные в это время отдают то, что есть в кэше.
+    """
     if not PROMETHEUS_CLIENT_AVAILABLE:
         return
-    
-    # Простое кэширование в памяти (обновление раз в минуту)
-    import time
-    cache_key = 'prometheus_metrics_cache'
-    cache_timeout = 60  # секунд
-    
-    if not hasattr(update_business_metrics, '_cache'):
-        update_business_metrics._cache = {}
-    
-    cache = update_business_metrics._cache
-    now = time.time()
-    
-    # Проверяем кэш
-    if cache_key in cache:
-        cached_time, cached_data = cache[cache_key]
-        if now - cached_time < cache_timeout:
-            # Используем кэшированные значения
-            for metric_name, value in cached_data.items():
-                if hasattr(update_business_metrics, metric_name):
-                    metric = getattr(update_business_metrics, metric_name)
-                    if hasattr(metric, 'set'):
-                        metric.set(value)
-            return
-    
-    from paint_shop_project.models import User, Order, Cart, Product, Review, Payment, ProductBatch
-    from django.db.models import Sum, Count, Avg
-    from django.utils import timezone
-    
-    metrics_data = {}
-    
-    try:
-        # Пользователи
-        users_total.set(User.objects.count())
-        users_active.set(User.objects.filter(is_active=True).count())
-        users_today.set(User.objects.filter(date_joined__date=timezone.now().date()).count())
-        
-        # Заказы
-        orders_total.set(Order.objects.count())
-        orders_today.set(Order.objects.filter(order_date__date=timezone.now().date()).count())
-        
-        # Заказы по статусам
-        orders_by_status.clear()
-        for order_stat in Order.objects.values('status').annotate(count=Count('id')):
-            orders_by_status.labels(status=order_stat['status']).set(order_stat['count'])
-        
-        # Выручка
-        revenue_total.set(float(Order.objects.aggregate(total=Sum('total_amount'))['total'] or 0))
-        revenue_today.set(float(Order.objects.filter(order_date__date=timezone.now().date()).aggregate(total=Sum('total_amount'))['total'] or 0))
-        avg_order_value.set(float(Order.objects.aggregate(avg=Avg('total_amount'))['avg'] or 0))
-        
-        # Корзины
-        cart_items_total.set(Cart.objects.count())
-        carts_active.set(Cart.objects.values('user').distinct().count())
-        
-        # Товары
-        products_total.set(Product.objects.filter(is_active=True).count())
-        products_with_discount.set(Product.objects.filter(is_active=True, old_price__isnull=False).count())
-        
-        # Товары по категориям
-        products_by_category.clear()
-        for cat_stat in Product.objects.filter(is_active=True).values('category__name').annotate(count=Count('id')):
-            if cat_stat['category__name']:
-                products_by_category.labels(category=cat_stat['category__name']).set(cat_stat['count'])
-        
-        # Отзывы
-        reviews_total.set(Review.objects.count())
-        reviews_approved.set(Review.objects.filter(is_approved=True).count())
-        avg_rating.set(float(Review.objects.filter(is_approved=True).aggregate(avg=Avg('rating'))['avg'] or 0))
-        
-        # Платежи
-        payments_total.set(Payment.objects.count())
-        payments_success.set(Payment.objects.filter(status='success').count())
-        payments_amount.set(float(Payment.objects.filter(status='success').aggregate(total=Sum('amount'))['total'] or 0))
-        
-        # Промоакции
-        from paint_shop_project.models import Promotion
-        promotions_active.set(Promotion.objects.filter(is_active=True).count())
-        
-        # Партии товаров: просроченные / истекающие / низкий остаток
-        today = timezone.now().date()
-        expired = ProductBatch.objects.filter(expiry_date__lt=today).count()
-        batches_expired_total.set(expired)
-        
-        # Настраиваемые окна: 3 и 7 дней
-        for days in (3, 7):
-            until = today + timezone.timedelta(days=days)
-            count = ProductBatch.objects.filter(expiry_date__gte=today, expiry_date__lte=until).count()
-            batches_expiring_days.labels(days=str(days)).set(count)
-        
-        # Низкий остаток (порог: <=10 единиц)
-        low_stock = ProductBatch.objects.filter(remaining_quantity__lte=10).count()
-        batches_low_stock_total.set(low_stock)
-        metrics_data['batches_low_stock_total'] = low_stock
-        
-        # Сохраняем в кэш
-        cache[cache_key] = (now, metrics_data)
-        
-    except Exception:
-        # Игнорируем ошибки если БД не готова
-        pass
+    from django.core.cache import cache
 
+    interval = _business_metrics_interval()
+    snapshot = cache.get(BUSINESS_METRICS_CACHE_KEY)
+    is_stale = snapshot is None or time.time() - snapshot['collected_at'] > 2 * interval
+    if is_stale and cache.add(BUSINESS_METRICS_LOCK_KEY, True, timeout=interval):
+        try:
+            snapshot = collect_business_metrics()
+        except Exception:
+            # БД может быть ещё не готова — отдаём последний снимок
+            logger.exception("Business metrics collection failed")
+    apply_business_metrics(snapshot)
@@ -1,24 +1,44 @@
 """
 Middleware для сбора метрик Prometheus
 Использует нативные Prometheus метрики если доступны
+
+Метка path — шаблон маршрута Django (request.resolver_match.route), а не сам URL,
+поэтому slug'и, токены и id не порождают новые серии. Запросы без маршрута
+попадают в общую корзину "unmatched", а число различных наборов меток ограничено
+METRICS_MAX_LABEL_SETS: сверх лимита запросы учитываются с path="overflow".
 """
+import re
+import threading
 import time
+
+from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
 
 # Пробуем использовать нативные Prometheus метрики
 try:
     from paint_shop_project.prometheus_metrics import (
         http_requests_total, http_request_duration_seconds, 
-        http_errors_total, http_exceptions_total
+        http_errors_total, http_exceptions_total, http_label_overflow_total
     )
     USE_NATIVE_METRICS = True
 except ImportError:
     USE_NATIVE_METRICS = False
     from paint_shop.metrics import increment_counter, observe_histogram
 
+IGNORED_PREFIXES = ('/metrics', '/static', '/media')
+KNOWN_METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+UNMATCHED_ROUTE = 'unmatched'
+OVERFLOW_ROUTE = 'overflow'
+
+_NUMERIC_SEGMENT_RE = re.compile(r'/\d+(?=/|$)')
+
 
 class PrometheusMetricsMiddleware(MiddlewareMixin):
     """Middleware для сбора метрик HTTP запросов"""
+
+    # Наборы меток, уже выданные в этом процессе (общие для всех экземпляров middleware)
+    _seen_label_sets = set()
+    _seen_lock = threading.Lock()
     
     def process_request(self, request):
         """Засекаем время начала обработки запроса"""
@@ -28,7 +48,7 @@ class PrometheusMetricsMiddleware(MiddlewareMixin):
     def process_response(self, request, response):
         """Собираем метрики после обработки запроса"""
         # Игнорируем запросы к метрикам и статике
-        if request.path.startswith('/metrics') or request.path.startswith('/static') or request.path.startswith('/media'):
+        if request.path.startswith(IGNORED_PREFIXES):
             return response
         
         # Время обработки запроса
@@ -37,9 +57,9 @@ class PrometheusMetricsMiddleware(MiddlewareMixin):
             duration = time.time() - request._prometheus_start_time
         
         # Метки для метрик (все значения должны быть строками для Prometheus)
-        method = str(request.method)
+        method = self._method_label(request)
         status_code = str(response.status_code)
-        path = self._sanitize_path(request.path)
+        path = self._bounded_route((method, status_code), self._route_label(request))
         
         if USE_NATIVE_METRICS:
             # Используем нативные Prometheus метрики
@@ -65,9 +85,9 @@ class PrometheusMetricsMiddleware(MiddlewareMixin):
     
     def process_exception(self, request, exception):
         """Обработка исключений"""
-        method = str(request.method)
-        path = self._sanitize_path(request.path)
+        method = self._method_label(request)
         exception_type = type(exception).__name__
+        path = self._bounded_route((method, exception_type), self._route_label(request))
         
         if USE_NATIVE_METRICS:
             http_exceptions_total.labels(method=method, path=path, exception_type=exception_type).inc()
@@ -80,15 +100,40 @@ class PrometheusMetricsMiddleware(MiddlewareMixin):
             increment_counter('zhevzhik_http_exceptions_total', labels=labels)
         return None
     
-    def _sanitize_path(self, path):
-        """Очистка пути от параметров для группировки"""
-        # Убираем ID из URL для группировки
-        import re
-        # Заменяем числа на placeholder
-        path = re.sub(r'/\d+/', '/{id}/', path)
-        # Убираем query параметры
-        path = path.split('?')[0]
-        return path[:100]  # Ограничиваем длину
+    def _method_label(self, request):
+        method = str(request.method).upper()
+        return method if method in KNOWN_METHODS else 'OTHER'
 
+    def _route_label(self, request):
+        """Шаблон маршрута, по которому разрешился запрос, или "unmatched" """
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return UNMATCHED_ROUTE
+        if match.route:
+            return '/' + match.route
+        # Маршрут без шаблона (корень или нестандартный резолвер)
+        return self._sanitize_path(request.path)
 
+    def _bounded_route(self, labels, route):
+        """Заменяет маршрут на "overflow", если лимит различных наборов меток исчерпан"""
+        label_set = labels + (route,)
+        if label_set in self._seen_label_sets:
+            return route
+        limit = getattr(settings, 'METRICS_MAX_LABEL_SETS', 1000)
+        with self._seen_lock:
+            if label_set in self._seen_label_sets:
+                return route
+            if len(self._seen_label_sets) < limit:
+                self._seen_label_sets.add(label_set)
+                return route
+        if USE_NATIVE_METRICS:
+            http_label_overflow_total.inc()
+        else:
+            increment_counter('zhevzhik_http_label_overflow_total')
+        return OVERFLOW_ROUTE
 
+    def _sanitize_path(self, path):
+        """Очистка пути от параметров для группировки"""
+        # Заменяем числа на placeholder и убираем query параметры
+        path = _NUMERIC_SEGMENT_RE.sub('/{id}', path.split('?')[0])
+        return path[:100]  # Ограничиваем длину
@@ -0,0 +1,171 @@
+"""
+Кеш действующих акций, промо-правил и промокодов
+
+Два уровня: локальный кеш процесса с коротким TTL перед общим кешем Django.
+Набор хранится под версией, которая меняется сигналами post_save/post_delete
+(см. promo_signals.py); снимок истекает на ближайшей границе start_date/end_date.
+"""
+from __future__ import annotations
+
+import copy
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from .models import PromoCode, PromoRule, Promotion
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'promo_cache:version'
+SNAPSHOT_KEY = 'promo_cache:snapshot:{version}'
+LOCAL_TTL_SECONDS = getattr(settings, 'PROMO_CACHE_LOCAL_TTL', 5)
+MAX_TTL_SECONDS = getattr(settings, 'PROMO_CACHE_MAX_TTL', 3600)
+
+_local_lock = threading.Lock()
+_local = {'version': None, 'snapshot': None, 'checked_at': 0.0}
+
+
+@dataclass(frozen=True)
+class PromoSnapshot:
+    """Снимок акций, правил и промокодов, не завершившихся на момент построения"""
+    promotions: Tuple[Promotion, ...]
+    rules: Tuple[PromoRule, ...]
+    promo_codes: Dict[str, PromoCode]
+    built_at: datetime
+    expires_at: Optional[datetime]
+
+    def is_fresh(self, now: datetime) -> bool:
+        return self.expires_at is None or now < self.expires_at
+
+    def active_promotions(self, now: datetime):
+        return [p for p in self.promotions if p.start_date <= now <= p.end_date]
+
+    def active_rules(self, now: datetime):
+        return [r for r in self.rules if r.start_date <= now <= r.end_date]
+
+
+def _next_boundary(rows, now: datetime) -> Optional[datetime]:
+    boundaries = []
+    for row in rows:
+        if row.start_date > now:
+            boundaries.append(row.start_date)
+        if row.end_date >= now:
+            boundaries.append(row.end_date)
+    return min(boundaries) if boundaries else None
+
+
+def _build_snapshot(now: datetime) -> PromoSnapshot:
+    promotions = tuple(Promotion.objects.filter(is_active=True, end_date__gte=now).order_by('-created_at'))
+    rules = tuple(PromoRule.objects.filter(is_active=True, end_date__gte=now).order_by('-created_at'))
+    promo_codes = {
+        code.code: code
+        for code in PromoCode.objects.filter(is_active=True, end_date__gte=now)
+    }
+    return PromoSnapshot(
+        promotions=promotions,
+        rules=rules,
+        promo_codes=promo_codes,
+        built_at=now,
+        expires_at=_next_boundary(list(promotions) + list(rules) + list(promo_codes.values()), now),
+    )
+
+
+def _new_version() -> str:
+    return str(time.time_ns())
+
+
+def _current_version() -> str:
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), None)
+        version = cache.get(VERSION_KEY) or _new_version()
+    return version
+
+
+def get_snapshot() -> PromoSnapshot:
+    """Возвращает актуальный снимок, перестраивая его при необходимости"""
+    now = timezone.now()
+    with _local_lock:
+        snapshot = _local['snapshot']
+        if (
+            snapshot is not None
+            and time.monotonic() - _local['checked_at'] < LOCAL_TTL_SECONDS
+            and snapshot.is_fresh(now)
+        ):
+            return snapshot
+
+    version = _current_version()
+    if snapshot is None or _local['version'] != version or not snapshot.is_fresh(now):
+        key = SNAPSHOT_KEY.format(version=version)
+        snapshot = cache.get(key)
+        if snapshot is None or not snapshot.is_fresh(now):
+            snapshot = _build_snapshot(now)
+            timeout = MAX_TTL_SECONDS
+            if snapshot.expires_at is not None:
+                timeout = max(1, min(MAX_TTL_SECONDS, int((snapshot.expires_at - now).total_seconds()) + 1))
+            cache.set(key, snapshot, timeout)
+            logger.debug("promo cache rebuilt version=%s expires_at=%s", version, snapshot.expires_at)
+
+    with _local_lock:
+        _local.update(version=version, snapshot=snapshot, checked_at=time.monotonic())
+    return snapshot
+
+
+def clear_local_cache() -> None:
+    with _local_lock:
+        _local.update(version=None, snapshot=None, checked_at=0.0)
+
+
+def invalidate() -> None:
+    """Сбрасывает кеш во всех процессах: новая версия + очистка локального уровня"""
+    cache.set(VERSION_KEY, _new_version(), None)
+    clear_local_cache()
+
+
+def active_promotions(now=None):
+    now = now or timezone.now()
+    return get_snapshot().active_promotions(now)
+
+
+def active_promo_rules(now=None):
+    now = now or timezone.now()
+    return get_snapshot().active_rules(now)
+
+
+def get_promo_code(code: str) -> Optional[PromoCode]:
+    """
+    Промокод из кеша; завершённые и выключенные промокоды берутся из БД.
+    used_count меняется с каждым заказом и в снимке не хранится: он читается
+    из БД, а из кеша возвращается копия промокода со свежим счётчиком.
+    """
+    promo_code = get_snapshot().promo_codes.get(code)
+    if promo_code is None:
+        return PromoCode.objects.filter(code=code).first()
+    used_count = PromoCode.objects.filter(pk=promo_code.pk).values_list('used_count', flat=True).first()
+    if used_count is None:
+        return None
+    promo_code = copy.copy(promo_code)
+    promo_code.used_count = used_count
+    return promo_code
+
+
+def register_promo_code_use(promo_code: PromoCode) -> bool:
+    """
+    Увеличивает счётчик использований промокода, не превышая max_uses.
+    Кеш не сбрасывается: счётчик не входит в снимок (см. get_promo_code).
+    """
+    updated = PromoCode.objects.filter(
+        pk=promo_code.pk,
+        used_count__lt=F('max_uses'),
+    ).update(used_count=F('used_count') + 1)
+    if not updated:
+        logger.warning("promo code %s exceeded max_uses", promo_code.code)
+    return bool(updated)
@@ -0,0 +1,21 @@
+"""
+Сигналы для сброса кеша акций, промо-правил и промокодов
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import promo_cache
+from .models import PromoCode, PromoRule, Promotion
+
+
+@receiver(post_save, sender=Promotion)
+@receiver(post_delete, sender=Promotion)
+@receiver(post_save, sender=PromoRule)
+@receiver(post_delete, sender=PromoRule)
+@receiver(post_save, sender=PromoCode)
+@receiver(post_delete, sender=PromoCode)
+def invalidate_promo_cache(sender, **kwargs):
+    """Сбрасывает кеш сразу и повторно после фиксации транзакции"""
+    promo_cache.invalidate()
+    transaction.on_commit(promo_cache.invalidate)
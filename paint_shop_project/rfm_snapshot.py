@@ -0,0 +1,169 @@
+"""
+RFM-сегментация клиентов
+
+Оценки считаются одним агрегирующим запросом: Recency, Frequency и Monetary
+агрегируются по заказам клиента, баллы 1–5 и сегмент вычисляются в том же SELECT
+выражениями CASE. Python только перекладывает готовые строки в CustomerRFMSnapshot
+пачками по BATCH_SIZE. Снимок пересобирается целиком в одной транзакции (задача
+rebuild_rfm_snapshot ночью, команда rebuild_rfm_snapshot вручную), поэтому страница
+RFM-анализа все время видит согласованный предыдущий или новый снимок.
+
+Пороги баллов — RFM_THRESHOLDS в настройках (по умолчанию DEFAULT_THRESHOLDS):
+четыре границы по убыванию балла (5, 4, 3, 2), всё за последней границей — 1.
+    recency_days — дней с последнего заказа, не больше;
+    frequency    — заказов, не меньше;
+    monetary     — сумма доставленных заказов, не меньше.
+"""
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Case, CharField, Count, IntegerField, Max, Min, Q, Sum, Value, When
+from django.utils import timezone
+
+from .models import CustomerRFMSnapshot, User
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 2000
+
+DEFAULT_THRESHOLDS: Dict[str, Sequence] = {
+    'recency_days': (30, 60, 90, 180),
+    'frequency': (10, 5, 3, 2),
+    'monetary': (50000, 20000, 10000, 5000),
+}
+
+SEGMENTS = [code for code, _label in CustomerRFMSnapshot.SEGMENT_CHOICES]
+
+# Правила сегментов по баллам, проверяются по порядку; не подошедшие — 'lost'
+SEGMENT_RULES = [
+    ('champions', Q(r_score__gte=4, f_score__gte=4, m_score__gte=4)),
+    ('loyal_customers', Q(r_score__gte=3, f_score__gte=4, m_score__gte=3)),
+    ('potential_loyalists', Q(r_score__gte=3, f_score__lte=2, m_score__gte=3)),
+    ('new_customers', Q(r_score__gte=4, f_score__lte=2)),
+    ('promising', Q(r_score__gte=3, f_score__lte=2, m_score__lte=2)),
+    ('needs_attention', Q(r_score__lte=3, f_score__gte=3)),
+    ('about_to_sleep', Q(r_score__lte=3, f_score__lte=2, m_score__gte=3)),
+    ('at_risk', Q(r_score__lte=2, f_score__gte=3)),
+]
+
+
+def rfm_thresholds() -> Dict[str, Sequence]:
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(getattr(settings, 'RFM_THRESHOLDS', {}))
+    return thresholds
+
+
+def _score(lookup: str, bounds: Sequence) -> Case:
+    """CASE с баллом 5..2 по границам bounds, иначе 1"""
+    return Case(
+        *[When(**{lookup: bound}, then=Value(5 - index)) for index, bound in enumerate(bounds)],
+        default=Value(1),
+        output_field=IntegerField(),
+    )
+
+
+def scored_customers(now: Optional[datetime] = None):
+    """
+    Клиенты с доставленными заказами и их R, F, M, баллами и сегментом — один
+    GROUP BY по заказам, значения (values) без экземпляров моделей.
+    """
+    now = now or timezone.now()
+    thresholds = rfm_thresholds()
+    # «Не больше N дней назад» = последний заказ не раньше полуночи дня today - N
+    midnight = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    recency_bounds = [midnight - timedelta(days=days) for days in thresholds['recency_days']]
+
+    return (
+        User.objects.filter(is_staff=False)
+        .values('id')
+        .annotate(
+            first_order_date=Min('orders__order_date'),
+            last_order_date=Max('orders__order_date'),
+            frequency=Count('orders'),
+            monetary=Sum('orders__total_amount', filter=Q(orders__status='delivered')),
+        )
+        .filter(frequency__gt=0, monetary__gt=0)
+        .annotate(
+            r_score=_score('last_order_date__gte', recency_bounds),
+            f_score=_score('frequency__gte', thresholds['frequency']),
+            m_score=_score('monetary__gte', [Decimal(str(bound)) for bound in thresholds['monetary']]),
+        )
+        .annotate(
+            segment=Case(
+                *[When(condition, then=Value(segment)) for segment, condition in SEGMENT_RULES],
+                default=Value('lost'),
+                output_field=CharField(),
+            ),
+        )
+        .order_by()
+    )
+
+
+def rebuild_rfm_snapshot(now: Optional[datetime] = None) -> int:
+    """Пересобирает CustomerRFMSnapshot целиком, возвращает число клиентов"""
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    total = 0
+
+    with transaction.atomic():
+        CustomerRFMSnapshot.objects.all().delete()
+        batch: List[CustomerRFMSnapshot] = []
+        for row in scored_customers(now).iterator(chunk_size=BATCH_SIZE):
+            batch.append(CustomerRFMSnapshot(
+                user_id=row['id'],
+                first_order_date=row['first_order_date'],
+                last_order_date=row['last_order_date'],
+                recency_days=(today - timezone.localdate(row['last_order_date'])).days,
+                frequency=row['frequency'],
+                monetary=row['monetary'],
+                r_score=row['r_score'],
+                f_score=row['f_score'],
+                m_score=row['m_score'],
+                segment=row['segment'],
+                computed_at=now,
+            ))
+            if len(batch) >= BATCH_SIZE:
+                CustomerRFMSnapshot.objects.bulk_create(batch)
+                total += len(batch)
+                batch = []
+        CustomerRFMSnapshot.objects.bulk_create(batch)
+        total += len(batch)
+
+    logger.info("RFM snapshot rebuilt: %d customers", total)
+    return total
+
+
+def segment_stats() -> Dict[str, dict]:
+    """Число клиентов, выручка и средний чек по сегментам — один GROUP BY по снимку"""
+    stats = {
+        segment: {'count': 0, 'total_revenue': Decimal('0'), 'avg_order_value': Decimal('0')}
+        for segment in SEGMENTS
+    }
+    rows = (
+        CustomerRFMSnapshot.objects.order_by()
+        .values('segment')
+        .annotate(count=Count('id'), total_revenue=Sum('monetary'), avg_order_value=Avg('monetary'))
+    )
+    for row in rows:
+        stats[row.pop('segment')] = row
+    return stats
+
+
+def segment_members(segment: str):
+    """Клиенты сегмента по убыванию суммы покупок (для KeysetPaginator по -monetary, -id)"""
+    return (
+        CustomerRFMSnapshot.objects.filter(segment=segment)
+        .select_related('user')
+        .only('id', 'monetary', 'recency_days', 'frequency', 'r_score', 'f_score', 'm_score', 'user__id', 'user__username')
+    )
+
+
+def last_computed_at() -> Optional[datetime]:
+    # Все строки снимка пишутся с одним computed_at — достаточно любой
+    return CustomerRFMSnapshot.objects.values_list('computed_at', flat=True).first()
@@ -0,0 +1,306 @@
+"""
+Дневные агрегаты продаж
+
+Дашборды, аналитика и отчёты читают продажи из таблиц Daily*SalesRollup (одна строка
+на день / день и магазин / день и товар / день и категорию), а не агрегируют Order и
+OrderItem при каждом открытии страницы.
+
+Агрегаты обновляются инкрементально из sales_signals, после фиксации транзакции заказа:
+- оформление заказа увеличивает счётчики оформленных заказов дня и магазина;
+- переход в статус «Доставлен» (и обратно) добавляет (вычитает) выручку дня, магазина,
+  товаров и категорий заказа.
+
+Полный пересчёт за период — rebuild_sales_rollups (команда rebuild_sales_rollups).
+День заказа берётся в текущем часовом поясе, как в TruncDay.
+"""
+from __future__ import annotations
+
+import logging
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, Optional
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate, TruncMonth
+from django.utils import timezone
+
+from .models import (
+    DailyCategorySalesRollup,
+    DailyProductSalesRollup,
+    DailySalesRollup,
+    DailyStoreSalesRollup,
+    Order,
+    OrderItem,
+)
+
+logger = logging.getLogger(__name__)
+
+DELIVERED = 'delivered'
+
+LINE_REVENUE = ExpressionWrapper(
+    F('quantity') * F('price_per_unit'),
+    output_field=DecimalField(max_digits=16, decimal_places=2),
+)
+
+
+def order_day(order: Order) -> date:
+    return timezone.localdate(order.order_date)
+
+
+def order_store_id(order: Order) -> Optional[int]:
+    """Магазин, к продажам которого относится заказ"""
+    return order.fulfillment_store_id or order.pickup_point_id
+
+
+def _bump(model, lookup: Dict, deltas: Dict) -> None:
+    """Атомарно прибавляет deltas к строке агрегата, создавая её при необходимости"""
+    deltas = {field: value for field, value in deltas.items() if value}
+    if not deltas:
+        return
+    model.objects.bulk_create([model(**lookup)], ignore_conflicts=True)
+    model.objects.filter(**lookup).update(
+        updated_at=timezone.now(),
+        **{field: F(field) + value for field, value in deltas.items()},
+    )
+
+
+# ==================== ИНКРЕМЕНТАЛЬНЫЕ ОБНОВЛЕНИЯ ====================
+
+def record_order_placed(order: Order, sign: int = 1) -> None:
+    """Учитывает (sign=1) или снимает (sign=-1) оформленный заказ"""
+    day = order_day(order)
+    deltas = {'orders_count': sign, 'orders_revenue': sign * (order.total_amount or Decimal('0'))}
+    with transaction.atomic():
+        _bump(DailySalesRollup, {'date': day}, deltas)
+        store_id = order_store_id(order)
+        if store_id:
+            _bump(DailyStoreSalesRollup, {'date': day, 'store_id': store_id}, deltas)
+
+
+def record_delivery(order: Order, sign: int = 1) -> None:
+    """Учитывает (sign=1) или снимает (sign=-1) доставленный заказ и его позиции"""
+    day = order_day(order)
+    deltas = {'delivered_orders': sign, 'delivered_revenue': sign * (order.total_amount or Decimal('0'))}
+    lines = (
+        OrderItem.objects.filter(order=order)
+        .values('product_id', 'product__category_id')
+        .annotate(revenue=Sum(LINE_REVENUE), quantity=Sum('quantity'))
+        .order_by('product_id')
+    )
+    with transaction.atomic():
+        _bump(DailySalesRollup, {'date': day}, deltas)
+        store_id = order_store_id(order)
+        if store_id:
+            _bump(DailyStoreSalesRollup, {'date': day, 'store_id': store_id}, deltas)
+
+        categories: Dict[int, Dict] = {}
+        for line in lines:
+            quantity = line['quantity'] or 0
+            revenue = line['revenue'] or Decimal('0')
+            _bump(
+                DailyProductSalesRollup,
+                {'date': day, 'product_id': line['product_id']},
+                {'quantity': sign * quantity, 'revenue': sign * revenue, 'orders_count': sign},
+            )
+            totals = categories.setdefault(line['product__category_id'], {'quantity': 0, 'revenue': Decimal('0')})
+            totals['quantity'] += quantity
+            totals['revenue'] += revenue
+        for category_id, totals in categories.items():
+            _bump(
+                DailyCategorySalesRollup,
+                {'date': day, 'category_id': category_id},
+                {'quantity': sign * totals['quantity'], 'revenue': sign * totals['revenue'], 'orders_count': sign},
+            )
+
+
+# ==================== ПОЛНЫЙ ПЕРЕСЧЁТ ====================
+
+def rebuild_sales_rollups(start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """
+    Пересобирает агрегаты за период [start, end] (по умолчанию — за всю историю)
+    из Order и OrderItem. Возвращает число дней с продажами.
+    """
+    def in_range(queryset, field):
+        if start:
+            queryset = queryset.filter(**{f'{field}__gte': start})
+        if end:
+            queryset = queryset.filter(**{f'{field}__lte': end})
+        return queryset
+
+    orders = in_range(Order.objects.annotate(day=TruncDate('order_date')), 'day').order_by()
+    delivered = Q(status=DELIVERED)
+    order_totals = dict(
+        orders_count=Count('id'),
+        orders_revenue=Coalesce(Sum('total_amount'), Value(Decimal('0'))),
+        delivered_orders=Count('id', filter=delivered),
+        delivered_revenue=Coalesce(Sum('total_amount', filter=delivered), Value(Decimal('0'))),
+    )
+    items = (
+        in_range(OrderItem.objects.annotate(day=TruncDate('order__order_date')), 'day')
+        .filter(order__status=DELIVERED)
+        .order_by()
+    )
+    # revenue раньше quantity: иначе F('quantity') в LINE_REVENUE сошлётся на аннотацию
+    item_totals = dict(
+        revenue=Sum(LINE_REVENUE),
+        quantity=Sum('quantity'),
+        orders_count=Count('order', distinct=True),
+    )
+
+    with transaction.atomic():
+        for model in (DailySalesRollup, DailyStoreSalesRollup, DailyProductSalesRollup, DailyCategorySalesRollup):
+            in_range(model.objects.all(), 'date').delete()
+
+        days = [
+            DailySalesRollup(date=row.pop('day'), **row)
+            for row in orders.values('day').annotate(**order_totals)
+        ]
+        DailySalesRollup.objects.bulk_create(days, batch_size=1000)
+        DailyStoreSalesRollup.objects.bulk_create(
+            [
+                DailyStoreSalesRollup(date=row.pop('day'), store_id=row.pop('store'), **row)
+                for row in (
+                    orders.annotate(store=Coalesce('fulfillment_store', 'pickup_point'))
+                    .filter(store__isnull=False)
+                    .values('day', 'store')
+                    .annotate(**order_totals)
+                )
+            ],
+            batch_size=1000,
+        )
+        DailyProductSalesRollup.objects.bulk_create(
+            [
+                DailyProductSalesRollup(date=row.pop('day'), product_id=row.pop('product'), **row)
+                for row in items.values('day', 'product').annotate(**item_totals)
+            ],
+            batch_size=1000,
+        )
+        DailyCategorySalesRollup.objects.bulk_create(
+            [
+                DailyCategorySalesRollup(date=row.pop('day'), category_id=row.pop('product__category'), **row)
+                for row in items.values('day', 'product__category').annotate(**item_totals)
+            ],
+            batch_size=1000,
+        )
+
+    logger.info("sales rollups rebuilt start=%s end=%s days=%s", start, end, len(days))
+    return len(days)
+
+
+# ==================== ЧТЕНИЕ ДЛЯ ДАШБОРДОВ ====================
+
+def period_start(days: int) -> date:
+    """Первый день периода «последние N дней» (тот же день, что и now - N дней)"""
+    return timezone.localdate(timezone.now() - timedelta(days=days))
+
+
+def _day_rows(start: Optional[date], store_ids: Optional[Iterable[int]]):
+    if store_ids is None:
+        rows = DailySalesRollup.objects.all()
+    else:
+        rows = DailyStoreSalesRollup.objects.filter(store_id__in=list(store_ids))
+    if start:
+        rows = rows.filter(date__gte=start)
+    return rows.order_by()
+
+
+def sales_totals(start: Optional[date] = None, store_ids: Optional[Iterable[int]] = None) -> Dict:
+    """Итоги периода: orders_count, orders_revenue, delivered_orders, delivered_revenue"""
+    totals = _day_rows(start, store_ids).aggregate(
+        orders_count=Sum('orders_count'),
+        orders_revenue=Sum('orders_revenue'),
+        delivered_orders=Sum('delivered_orders'),
+        delivered_revenue=Sum('delivered_revenue'),
+    )
+    return {
+        'orders_count': totals['orders_count'] or 0,
+        'orders_revenue': totals['orders_revenue'] or Decimal('0'),
+        'delivered_orders': totals['delivered_orders'] or 0,
+        'delivered_revenue': totals['delivered_revenue'] or Decimal('0'),
+    }
+
+
+TOTAL_FIELDS = ('orders_count', 'orders_revenue', 'delivered_orders', 'delivered_revenue')
+
+
+def _split_period_totals(row: Dict, periods: Dict[str, Optional[date]]) -> Dict[str, Dict]:
+    return {
+        name: {
+            field: row.get(f'{name}_{field}') or (Decimal('0') if field.endswith('revenue') else 0)
+            for field in TOTAL_FIELDS
+        }
+        for name in periods
+    }
+
+
+def period_totals(
+    periods: Dict[str, Optional[date]],
+    store_ids: Optional[Iterable[int]] = None,
+    by_store: bool = False,
+) -> Dict:
+    """
+    Итоги нескольких периодов одним запросом (Sum(filter=date >= start) на период):
+    {имя периода: итоги как у sales_totals}. start=None — вся история.
+    С by_store=True — {store_id: {имя периода: итоги}} по DailyStoreSalesRollup.
+    """
+    rows = DailyStoreSalesRollup.objects.all() if by_store else DailySalesRollup.objects.all()
+    if store_ids is not None:
+        rows = DailyStoreSalesRollup.objects.filter(store_id__in=list(store_ids))
+    annotations = {
+        f'{name}_{field}': Sum(field, filter=Q(date__gte=start) if start else None)
+        for name, start in periods.items()
+        for field in TOTAL_FIELDS
+    }
+    if by_store:
+        return {
+            row.pop('store'): _split_period_totals(row, periods)
+            for row in rows.order_by().values('store').annotate(**annotations)
+        }
+    return _split_period_totals(rows.order_by().aggregate(**annotations), periods)
+
+
+def daily_sales(start: Optional[date] = None, store_ids: Optional[Iterable[int]] = None):
+    """Доставленные заказы по дням: строки {'day', 'orders', 'revenue'}"""
+    return (
+        _day_rows(start, store_ids)
+        .filter(delivered_orders__gt=0)
+        .values(day=F('date'))
+        .annotate(orders=Sum('delivered_orders'), revenue=Sum('delivered_revenue'))
+        .order_by('day')
+    )
+
+
+def monthly_sales(start: Optional[date] = None, store_ids: Optional[Iterable[int]] = None):
+    """Доставленные заказы по месяцам: строки {'month', 'orders', 'revenue'}"""
+    return (
+        _day_rows(start, store_ids)
+        .filter(delivered_orders__gt=0)
+        .values(month=TruncMonth('date'))
+        .annotate(orders=Sum('delivered_orders'), revenue=Sum('delivered_revenue'))
+        .order_by('month')
+    )
+
+
+def product_sales(start: Optional[date] = None):
+    """Продажи по товарам за период, по убыванию выручки"""
+    rows = DailyProductSalesRollup.objects.all()
+    if start:
+        rows = rows.filter(date__gte=start)
+    return (
+        rows.values('product__id', 'product__name', 'product__category__name', 'product__price')
+        .annotate(quantity=Sum('quantity'), revenue=Sum('revenue'), orders=Sum('orders_count'))
+        .order_by('-revenue', '-quantity')
+    )
+
+
+def category_sales(start: Optional[date] = None):
+    """Продажи по категориям за период, по убыванию выручки"""
+    rows = DailyCategorySalesRollup.objects.all()
+    if start:
+        rows = rows.filter(date__gte=start)
+    return (
+        rows.values('category__id', 'category__name')
+        .annotate(quantity=Sum('quantity'), revenue=Sum('revenue'), orders=Sum('orders_count'))
+        .order_by('-revenue', '-quantity')
+    )
@@ -0,0 +1,41 @@
+"""
+Инкрементальное обновление дневных агрегатов продаж по изменениям заказов
+
+Оформление и доставка учитываются после фиксации транзакции (on_commit): иначе строка
+агрегата за сегодня блокировалась бы до конца транзакции оформления заказа и все
+параллельные оформления выстраивались бы в очередь на ней. Сбой такого обновления
+не откатывает заказ — расхождение исправит ночной rebuild_recent_sales_rollups.
+"""
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+
+from . import loyalty_signals  # noqa: F401 — pre_save из loyalty_signals сохраняет _previous_status
+from .models import Order
+from .sales_rollups import DELIVERED, record_delivery, record_order_placed
+
+
+@receiver(post_save, sender=Order)
+def _update_sales_rollups(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        transaction.on_commit(partial(record_order_placed, instance), robust=True)
+        if instance.status == DELIVERED:
+            transaction.on_commit(partial(record_delivery, instance), robust=True)
+        return
+
+    was_delivered = getattr(instance, '_previous_status', None) == DELIVERED
+    is_delivered = instance.status == DELIVERED
+    if is_delivered != was_delivered:
+        transaction.on_commit(partial(record_delivery, instance, sign=1 if is_delivered else -1), robust=True)
+
+
+@receiver(pre_delete, sender=Order)
+def _remove_from_sales_rollups(sender, instance, **kwargs):
+    # Синхронно: в pre_delete позиции заказа ещё не удалены каскадом, после фиксации их уже нет
+    if instance.status == DELIVERED:
+        record_delivery(instance, sign=-1)
+    record_order_placed(instance, sign=-1)
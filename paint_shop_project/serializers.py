@@ -43,7 +43,7 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'slug', 'description', 'category', 'category_id',
             'manufacturer', 'manufacturer_id', 'price', 'old_price',
-            'stock_quantity', 'unit', 'weight', 'image', 'rating',
+            'stock_quantity', 'sellable_quantity', 'unit', 'weight', 'image', 'rating',
             'is_featured', 'is_active', 'discount_percent',
             'has_expiry_date', 'expiry_date', 'production_date', 'shelf_life_days'
         ]
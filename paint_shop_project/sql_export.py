@@ -0,0 +1,157 @@
+"""
+Потоковый экспорт SQL-скрипта базы
+
+pg_dump --format=plain запускается один раз (схема и данные из одного снимка), его
+stdout читается блоками по CHUNK_SIZE и сразу уходит в StreamingHttpResponse —
+при необходимости через gzip. На диске ничего не создается, в памяти держится
+один блок.
+
+Состав выгрузки задается шаблонами таблиц pg_dump:
+    include       — только эти таблицы (--table)
+    exclude       — без этих таблиц (--exclude-table)
+    exclude_data  — структура есть, данных нет (--exclude-table-data): так удобно
+                    пропускать журналы и метрики, не ломая внешние ключи
+Готовые наборы — SQL_EXPORT_PRESETS в настройках (по умолчанию DEFAULT_PRESETS).
+"""
+from __future__ import annotations
+
+import logging
+import re
+import subprocess
+import tempfile
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# Имя таблицы или шаблон pg_dump: буквы, цифры, _, схема через точку и * как маска
+TABLE_PATTERN_RE = re.compile(r'^[A-Za-z0-9_.*]+$')
+
+DEFAULT_PRESETS: Dict[str, dict] = {
+    'catalog': {
+        'label': 'Каталог: категории, товары, партии, магазины, акции',
+        'include': [
+            'paint_shop_project_category',
+            'paint_shop_project_manufacturer',
+            'paint_shop_project_product',
+            'paint_shop_project_productbatch',
+            'paint_shop_project_store',
+            'paint_shop_project_promotion',
+            'paint_shop_project_promocode',
+            'paint_shop_project_promorule',
+            'paint_shop_project_specialsection',
+        ],
+    },
+    'without_logs': {
+        'label': 'Вся база без данных метрик и журналов',
+        'exclude_data': [
+            'metrics',
+            'metric_rollups',
+            'paint_shop_project_errorlog',
+            'paint_shop_project_batchauditlog',
+            'paint_shop_project_pickeractionlog',
+            'paint_shop_project_searchhistory',
+            'paint_shop_project_viewhistory',
+            'django_celery_results_*',
+        ],
+    },
+}
+
+
+class SqlExportError(RuntimeError):
+    """pg_dump не запустился или завершился с ошибкой"""
+
+
+def export_presets() -> Dict[str, dict]:
+    return getattr(settings, 'SQL_EXPORT_PRESETS', DEFAULT_PRESETS)
+
+
+def parse_table_patterns(value: Optional[str]) -> List[str]:
+    """Список шаблонов из строки через запятую/пробел; недопустимые символы — ValueError"""
+    patterns = [item for item in re.split(r'[\s,]+', value or '') if item]
+    for pattern in patterns:
+        if not TABLE_PATTERN_RE.match(pattern):
+            raise ValueError(f'Недопустимое имя таблицы: {pattern}')
+    return patterns
+
+
+def build_dump_command(
+    pg_dump_binary: str,
+    connection_args: Sequence[str],
+    database_name: str,
+    *,
+    include: Iterable[str] = (),
+    exclude: Iterable[str] = (),
+    exclude_data: Iterable[str] = (),
+) -> List[str]:
+    command = [pg_dump_binary, '--format=plain', '--no-owner', '--no-privileges']
+    command.extend(connection_args)
+    # Значение в том же аргументе (--table=...): шаблон не может стать отдельной опцией
+    command.extend(f'--table={pattern}' for pattern in include)
+    command.extend(f'--exclude-table={pattern}' for pattern in exclude)
+    command.extend(f'--exclude-table-data={pattern}' for pattern in exclude_data)
+    command.append(str(database_name))
+    return command
+
+
+def stream_dump(command: List[str], env: dict, *, gzip_level: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Запускает pg_dump и возвращает итератор блоков его вывода (сжатых gzip при
+    gzip_level). Первый блок читается сразу: если pg_dump не смог подключиться,
+    SqlExportError бросается до начала ответа. Ошибка посреди выгрузки обрывает
+    поток, чтобы неполный файл не выглядел успешно скачанным.
+    """
+    stderr = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=stderr)
+    except OSError as exc:
+        stderr.close()
+        raise SqlExportError(str(exc)) from exc
+
+    first = process.stdout.read(CHUNK_SIZE)
+    if not first:
+        process.wait()
+        error = _read_stderr(stderr)
+        stderr.close()
+        if process.returncode != 0:
+            raise SqlExportError(error or f'pg_dump завершился с кодом {process.returncode}')
+    return _chunks(process, stderr, first, gzip_level)
+
+
+def _read_stderr(stderr) -> str:
+    stderr.seek(0)
+    return stderr.read().decode('utf-8', errors='replace').strip()
+
+
+def _chunks(process, stderr, first: bytes, gzip_level: Optional[int]) -> Iterator[bytes]:
+    # wbits=31: поток с заголовком gzip, а не голый deflate
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31) if gzip_level is not None else None
+    finished = False
+    try:
+        chunk = first
+        while chunk:
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+            chunk = process.stdout.read(CHUNK_SIZE)
+        process.wait()
+        if process.returncode != 0:
+            error = _read_stderr(stderr)
+            logger.error("SQL export interrupted: %s", error)
+            raise SqlExportError(error or f'pg_dump завершился с кодом {process.returncode}')
+        if compressor:
+            yield compressor.flush()
+        finished = True
+    finally:
+        if not finished and process.poll() is None:
+            # Клиент оборвал загрузку — pg_dump больше не нужен
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        if not stderr.closed:
+            stderr.close()
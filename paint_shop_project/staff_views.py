@@ -2,16 +2,21 @@
 Views для работников магазина (сборщики и доставщики)
 """
 import logging
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.mail import send_mail
-from django.db.models import Q, Count, Sum, Avg
+from django.db.models import F, Q, Count, Sum, Avg
+from django.db.models.functions import Coalesce
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from datetime import timedelta
 
 from .models import Order, OrderPicking, OrderDelivery, OrderItem, User, ProductBatch, PickerActionLog, Product, Store, Promotion, PromoCode
+from .batch_allocation import BatchAllocationError, apply_allocation, plan_fefo, sellable_batches
+from .sales_rollups import period_start, period_totals, product_sales
 
 logger = logging.getLogger(__name__)
 
@@ -41,157 +46,176 @@ def is_manager(user):
     )
 
 
-@login_required
-def manager_dashboard(request):
-    """Панель управления менеджера магазина"""
-    if not is_manager(request.user):
-        messages.error(request, _('У вас нет доступа к этой странице. Требуется роль с правом управлять магазином.'))
-        return redirect('home')
-    
-    # Получаем магазины, которыми управляет менеджер
-    managed_stores = Store.objects.filter(manager=request.user, is_active=True)
-    
-    # Если менеджер не привязан к магазину, показываем общую статистику
-    if not managed_stores.exists():
-        # Общая статистика по всем магазинам
-        orders = Order.objects.all()
-        products = Product.objects.all()
-    else:
-        # Статистика по магазинам менеджера
-        orders = Order.objects.filter(
-            Q(fulfillment_store__in=managed_stores) | Q(pickup_point__in=managed_stores)
-        )
-        products = Product.objects.all()  # Все товары для менеджера
-    
+MANAGER_DASHBOARD_CACHE_KEY = 'manager_dashboard:{user_id}'
+
+PENDING_STATUSES = ('created', 'confirmed')
+IN_TRANSIT_STATUSES = ('ready', 'in_transit')
+
+
+def _manager_dashboard_cache_timeout():
+    return getattr(settings, 'MANAGER_DASHBOARD_CACHE_SECONDS', 30)
+
+
+def build_manager_dashboard(user):
+    """
+    Данные панели менеджера: продажи за все периоды — одна условная агрегация по
+    дневным агрегатам (и одна с группировкой по магазинам), заказы — один GROUP BY по
+    (магазин, статус), товары, партии и сборки — по одной условной агрегации.
+    """
     now = timezone.now()
-    today = now.date()
-    last_7_days = now - timedelta(days=7)
-    last_30_days = now - timedelta(days=30)
-    
-    # Статистика заказов
-    total_orders = orders.count()
-    orders_today = orders.filter(order_date__date=today).count()
-    orders_last_7 = orders.filter(order_date__gte=last_7_days).count()
-    orders_last_30 = orders.filter(order_date__gte=last_30_days).count()
-    
-    # Статистика по статусам
-    orders_by_status = orders.values('status').annotate(count=Count('id')).order_by('-count')
-    
-    # Выручка
-    delivered_orders = orders.filter(status='delivered')
-    total_revenue = delivered_orders.aggregate(total=Sum('total_amount'))['total'] or 0
-    revenue_today = delivered_orders.filter(order_date__date=today).aggregate(total=Sum('total_amount'))['total'] or 0
-    revenue_last_7 = delivered_orders.filter(order_date__gte=last_7_days).aggregate(total=Sum('total_amount'))['total'] or 0
-    revenue_last_30 = delivered_orders.filter(order_date__gte=last_30_days).aggregate(total=Sum('total_amount'))['total'] or 0
-    
+    today = timezone.localdate(now)
+
+    # Магазины менеджера; если их нет — общая статистика по всем магазинам
+    managed_stores = list(Store.objects.filter(manager=user, is_active=True))
+    store_ids = [store.id for store in managed_stores] or None
+    orders = Order.objects.all()
+    if store_ids:
+        orders = orders.filter(Q(fulfillment_store__in=store_ids) | Q(pickup_point__in=store_ids))
+    stores_for_stats = managed_stores or list(Store.objects.filter(is_active=True)[:3])
+    stats_store_ids = [store.id for store in stores_for_stats]
+
+    # Продажи — из дневных агрегатов
+    totals = period_totals(
+        {'total': None, 'today': today, 'last_7': period_start(7), 'last_30': period_start(30)},
+        store_ids=store_ids,
+    )
+    store_sales = period_totals({'total': None, 'today': today}, store_ids=stats_store_ids, by_store=True)
+
+    # Заказы по статусам и магазинам (магазин комплектации, иначе точка самовывоза)
+    status_totals = {}
+    store_statuses = {}
+    status_rows = (
+        orders.annotate(store=Coalesce('fulfillment_store', 'pickup_point'))
+        .values('store', 'status')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    for row in status_rows:
+        status_totals[row['status']] = status_totals.get(row['status'], 0) + row['count']
+        if row['status'] in PENDING_STATUSES + IN_TRANSIT_STATUSES:
+            bucket = 'pending' if row['status'] in PENDING_STATUSES else 'in_transit'
+            counts = store_statuses.setdefault(row['store'], {'pending': 0, 'in_transit': 0})
+            counts[bucket] += row['count']
+    orders_by_status = [
+        {'status': status, 'count': count}
+        for status, count in sorted(status_totals.items(), key=lambda item: -item[1])
+    ]
+
     # Средний чек
-    avg_order_value = (total_revenue / delivered_orders.count()) if delivered_orders.count() > 0 else 0
-    
-    # Топ товары
-    top_products = (
-        OrderItem.objects.filter(order__in=delivered_orders)
-        .values('product__name', 'product__id')
-        .annotate(
-            total_quantity=Sum('quantity'),
-            total_revenue=Sum('price_per_unit')
+    delivered_total = totals['total']['delivered_orders']
+    avg_order_value = totals['total']['delivered_revenue'] / delivered_total if delivered_total > 0 else 0
+
+    # Топ товары (агрегаты по товарам общие для всех магазинов)
+    if store_ids is None:
+        top_products = [
+            {
+                'product__name': row['product__name'],
+                'product__id': row['product__id'],
+                'total_quantity': row['quantity'],
+                'total_revenue': row['revenue'],
+            }
+            for row in product_sales().order_by('-quantity')[:10]
+        ]
+    else:
+        top_products = list(
+            OrderItem.objects.filter(order__in=orders.filter(status='delivered'))
+            .values('product__name', 'product__id')
+            .annotate(
+                total_quantity=Sum('quantity'),
+                total_revenue=Sum(F('quantity') * F('price_per_unit'))
+            )
+            .order_by('-total_quantity')[:10]
         )
-        .order_by('-total_quantity')[:10]
-    )
-    
+
     # Статистика товаров
-    total_products = products.count()
-    active_products = products.filter(is_active=True).count()
-    low_stock_products = products.filter(stock_quantity__lt=10).count()
-    out_of_stock_products = products.filter(stock_quantity=0).count()
-    
+    product_stats = Product.objects.aggregate(
+        total_products=Count('id'),
+        active_products=Count('id', filter=Q(is_active=True)),
+        low_stock_products=Count('id', filter=Q(stock_quantity__lt=10)),
+        out_of_stock_products=Count('id', filter=Q(stock_quantity=0)),
+    )
+
     # Статистика партий
-    batches = ProductBatch.objects.all()
-    total_batches = batches.count()
-    expiring_soon_batches = batches.filter(
-        expiry_date__lte=today + timedelta(days=7),
-        expiry_date__gte=today,
-        remaining_quantity__gt=0
-    ).count()
-    expired_batches = batches.filter(
-        expiry_date__lt=today,
-        remaining_quantity__gt=0
-    ).count()
-    
+    in_stock = Q(remaining_quantity__gt=0)
+    batch_stats = ProductBatch.objects.aggregate(
+        total_batches=Count('id'),
+        expiring_soon_batches=Count('id', filter=in_stock & Q(
+            expiry_date__lte=today + timedelta(days=7),
+            expiry_date__gte=today,
+        )),
+        expired_batches=Count('id', filter=in_stock & Q(expiry_date__lt=today)),
+    )
+
     # Статистика сборок
-    pickings = OrderPicking.objects.filter(order__in=orders)
-    total_pickings = pickings.count()
-    pending_pickings = pickings.filter(status='pending').count()
-    in_progress_pickings = pickings.filter(status='in_progress').count()
-    completed_pickings = pickings.filter(status='completed').count()
-    
+    pickings = OrderPicking.objects.all()
+    if store_ids:
+        pickings = pickings.filter(order__in=orders)
+    picking_stats = pickings.aggregate(
+        total_pickings=Count('id'),
+        pending_pickings=Count('id', filter=Q(status='pending')),
+        in_progress_pickings=Count('id', filter=Q(status='in_progress')),
+        completed_pickings=Count('id', filter=Q(status='completed')),
+    )
+
     # Последние заказы
-    recent_orders = orders.select_related('user', 'fulfillment_store').order_by('-order_date')[:10]
-    
-    # Активные акции
-    active_promotions = Promotion.objects.filter(is_active=True, end_date__gte=now).count()
-    active_promocodes = PromoCode.objects.filter(is_active=True, end_date__gte=now).count()
-    
-    # Дополнительные показатели для бордов
-    status_totals = {entry['status']: entry['count'] for entry in orders_by_status}
-    pending_orders = status_totals.get('created', 0) + status_totals.get('confirmed', 0)
-    in_transit_orders = status_totals.get('ready', 0) + status_totals.get('in_transit', 0)
-    delivered_orders_count = status_totals.get('delivered', 0)
-    cancelled_orders = status_totals.get('cancelled', 0)
+    recent_orders = list(orders.select_related('user', 'fulfillment_store').order_by('-order_date')[:10])
 
-    stores_for_stats = managed_stores if managed_stores.exists() else Store.objects.filter(is_active=True)[:3]
     store_statistics = []
     for store in stores_for_stats:
-        store_orders = Order.objects.filter(
-            Q(fulfillment_store=store) | Q(pickup_point=store)
-        )
-        store_delivered = store_orders.filter(status='delivered')
-        store_stats = {
+        sales = store_sales.get(store.id, {})
+        statuses = store_statuses.get(store.id, {})
+        store_statistics.append({
             'name': store.name,
             'address': store.address,
-            'orders_total': store_orders.count(),
-            'orders_today': store_orders.filter(order_date__date=today).count(),
-            'revenue': store_delivered.aggregate(total=Sum('total_amount'))['total'] or 0,
-            'pending': store_orders.filter(status__in=['created', 'confirmed']).count(),
-            'in_transit': store_orders.filter(status__in=['ready', 'in_transit']).count(),
-            'delivered': store_delivered.count(),
-        }
-        store_statistics.append(store_stats)
+            'orders_total': sales['total']['orders_count'] if sales else 0,
+            'orders_today': sales['today']['orders_count'] if sales else 0,
+            'revenue': sales['total']['delivered_revenue'] if sales else 0,
+            'pending': statuses.get('pending', 0),
+            'in_transit': statuses.get('in_transit', 0),
+            'delivered': sales['total']['delivered_orders'] if sales else 0,
+        })
 
-    context = {
-        'manager_name': request.user.get_full_name() or request.user.username,
+    return {
         'managed_stores': managed_stores,
-        'total_orders': total_orders,
-        'orders_today': orders_today,
-        'orders_last_7': orders_last_7,
-        'orders_last_30': orders_last_30,
+        'total_orders': totals['total']['orders_count'],
+        'orders_today': totals['today']['orders_count'],
+        'orders_last_7': totals['last_7']['orders_count'],
+        'orders_last_30': totals['last_30']['orders_count'],
         'orders_by_status': orders_by_status,
-        'total_revenue': total_revenue,
-        'revenue_today': revenue_today,
-        'revenue_last_7': revenue_last_7,
-        'revenue_last_30': revenue_last_30,
+        'total_revenue': totals['total']['delivered_revenue'],
+        'revenue_today': totals['today']['delivered_revenue'],
+        'revenue_last_7': totals['last_7']['delivered_revenue'],
+        'revenue_last_30': totals['last_30']['delivered_revenue'],
         'avg_order_value': avg_order_value,
         'top_products': top_products,
-        'total_products': total_products,
-        'active_products': active_products,
-        'low_stock_products': low_stock_products,
-        'out_of_stock_products': out_of_stock_products,
-        'total_batches': total_batches,
-        'expiring_soon_batches': expiring_soon_batches,
-        'expired_batches': expired_batches,
-        'total_pickings': total_pickings,
-        'pending_pickings': pending_pickings,
-        'in_progress_pickings': in_progress_pickings,
-        'completed_pickings': completed_pickings,
+        **product_stats,
+        **batch_stats,
+        **picking_stats,
         'recent_orders': recent_orders,
-        'active_promotions': active_promotions,
-        'active_promocodes': active_promocodes,
-        'pending_orders': pending_orders,
-        'in_transit_orders': in_transit_orders,
-        'delivered_orders_count': delivered_orders_count,
-        'cancelled_orders': cancelled_orders,
+        'active_promotions': Promotion.objects.filter(is_active=True, end_date__gte=now).count(),
+        'active_promocodes': PromoCode.objects.filter(is_active=True, end_date__gte=now).count(),
+        'pending_orders': sum(status_totals.get(status, 0) for status in PENDING_STATUSES),
+        'in_transit_orders': sum(status_totals.get(status, 0) for status in IN_TRANSIT_STATUSES),
+        'delivered_orders_count': status_totals.get('delivered', 0),
+        'cancelled_orders': status_totals.get('cancelled', 0),
         'store_statistics': store_statistics,
     }
-    
+
+
+@login_required
+def manager_dashboard(request):
+    """Панель управления менеджера магазина (снимок на MANAGER_DASHBOARD_CACHE_SECONDS)"""
+    if not is_manager(request.user):
+        messages.error(request, _('У вас нет доступа к этой странице. Требуется роль с правом управлять магазином.'))
+        return redirect('home')
+
+    cache_key = MANAGER_DASHBOARD_CACHE_KEY.format(user_id=request.user.pk)
+    context = cache.get(cache_key)
+    if context is None:
+        context = build_manager_dashboard(request.user)
+        cache.set(cache_key, context, timeout=_manager_dashboard_cache_timeout())
+
+    context = {**context, 'manager_name': request.user.get_full_name() or request.user.username}
     return render(request, 'paint_shop_project/staff/manager_dashboard.html', context)
 
 
@@ -276,27 +300,19 @@ def picker_order_detail(request, order_id):
     
     order_items = OrderItem.objects.filter(order=order).select_related('product', 'batch')
     
-    # Получаем доступные партии для каждого товара в заказе (FEFO + правило 70%)
+    # Получаем доступные партии для всех товаров заказа одним запросом (FEFO + правило 70%)
+    batches_by_product = {}
+    for batch in sellable_batches({item.product_id for item in order_items}).select_related('product', 'product__category'):
+        batches_by_product.setdefault(batch.product_id, []).append(batch)
+    
     items_with_batches = []
     for item in order_items:
-        # Получаем доступные партии для этого товара
-        # Фильтруем: не просроченные, с остатком, и с минимум 70% срока годности
-        today = timezone.now().date()
-        available_batches = ProductBatch.objects.filter(
-            product=item.product,
-            expiry_date__gte=today,
-            remaining_quantity__gte=item.quantity
-        ).select_related('product', 'product__category').order_by('expiry_date')  # FEFO: сначала партии с ближайшим сроком годности
-        
-        # Фильтруем по правилу 70% срока годности
-        sellable_batches = []
-        for batch in available_batches:
-            if batch.is_sellable(min_percent=70):
-                sellable_batches.append(batch)
-        
         items_with_batches.append({
             'item': item,
-            'available_batches': sellable_batches,
+            'available_batches': [
+                batch for batch in batches_by_product.get(item.product_id, [])
+                if batch.remaining_quantity >= item.quantity
+            ],
             'has_expiry': item.product.has_expiry_date,
         })
     
@@ -355,7 +371,6 @@ def picker_assign_batch(request, order_id, item_id):
                 
                 # Логируем назначение партии
                 from .models import BatchAuditLog
-                from django.utils import timezone
                 BatchAuditLog.objects.create(
                     batch=batch,
                     action='assigned',
@@ -430,76 +445,31 @@ def picker_auto_assign_batches(request, order_id):
         return redirect('picker_dashboard')
     
     if request.method == 'POST':
-        today = timezone.now().date()
-        assigned_count = 0
-        failed_items = []
-        
-        order_items = OrderItem.objects.filter(order=order).select_related('product', 'product__category', 'batch')
+        # Позиции без срока годности или уже с назначенной партией пропускаем
+        order_items = OrderItem.objects.filter(
+            order=order,
+            product__has_expiry_date=True,
+            batch__isnull=True,
+        ).select_related('product')
         
-        for item in order_items:
-            # Пропускаем товары без срока годности или уже с назначенной партией
-            if not item.product.has_expiry_date or item.batch:
-                continue
-            
-            # Ищем доступные партии (FEFO + правило 70%)
-            available_batches = ProductBatch.objects.filter(
-                product=item.product,
-                expiry_date__gte=today,
-                remaining_quantity__gt=0
-            ).select_related('product', 'product__category').order_by('expiry_date')
-            
-            # Фильтруем по правилу 70% и сортируем по приоритету (FEFO)
-            sellable_batches = [
-                batch for batch in available_batches 
-                if batch.is_sellable(min_percent=70)
-            ]
-            
-            if not sellable_batches:
-                failed_items.append(item.product.name)
-                continue
-            
-            # Умный подбор: распределяем между несколькими партиями, если нужно
-            remaining_needed = item.quantity
-            batches_used = []
-            
-            for batch in sellable_batches:
-                if remaining_needed <= 0:
-                    break
-                
-                # Сколько можем взять из этой партии
-                take_from_batch = min(remaining_needed, batch.remaining_quantity)
-                
-                if take_from_batch > 0:
-                    # Если это первая партия, назначаем её на item
-                    if not batches_used:
-                        item.batch = batch
-                        item.save()
-                    
-                    # Уменьшаем остаток
-                    old_quantity = batch.remaining_quantity
-                    batch.remaining_quantity -= take_from_batch
-                    batch.save()
-                    
-                    # Логируем автоподбор партии
-                    from .models import BatchAuditLog
-                    BatchAuditLog.objects.create(
-                        batch=batch,
-                        action='assigned',
-                        user=request.user,
-                        old_value=old_quantity,
-                        new_value=batch.remaining_quantity,
-                        comment=f'Автоподбор для заказа #{order_id}, позиция: {item.product.name} (взято: {take_from_batch} из {item.quantity})',
-                        ip_address=request.META.get('REMOTE_ADDR') if hasattr(request, 'META') else None,
-                    )
-                    
-                    batches_used.append((batch, take_from_batch))
-                    remaining_needed -= take_from_batch
-            
-            if remaining_needed > 0:
-                # Не хватило партий
-                failed_items.append(f"{item.product.name} (недостаточно: нужно {item.quantity}, доступно {item.quantity - remaining_needed})")
+        # Умный подбор (FEFO + правило 70%): позицию можно распределить между несколькими партиями
+        plan = plan_fefo(order_items)
+        failed_items = []
+        for line in plan.incomplete_lines:
+            if not line.takes:
+                failed_items.append(line.item.product.name)
             else:
-                assigned_count += len(batches_used)
+                failed_items.append(f"{line.item.product.name} (недостаточно: нужно {line.item.quantity}, доступно {line.allocated})")
+        
+        try:
+            assigned_count = apply_allocation(
+                plan,
+                user=request.user,
+                ip_address=request.META.get('REMOTE_ADDR') if hasattr(request, 'META') else None,
+            )
+        except BatchAllocationError:
+            messages.error(request, _('Остатки партий изменились, повторите автоподбор.'))
+            return redirect('picker_order_detail', order_id=order_id)
         
         if assigned_count > 0:
             messages.success(request, _('Автоматически назначено партий: %(count)d') % {'count': assigned_count})
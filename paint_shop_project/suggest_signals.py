@@ -0,0 +1,22 @@
+"""
+Сигналы для обновления индекса подсказок поиска
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import product_suggest
+from .models import Product
+
+
+@receiver(post_save, sender=Product)
+def update_suggest_index(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(lambda: product_suggest.product_changed(instance))
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_suggest_index(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: product_suggest.product_deleted(product_id))
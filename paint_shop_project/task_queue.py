@@ -0,0 +1,35 @@
+"""
+Постановка задач Celery с выполнением в процессе, если брокера нет
+
+По умолчанию CELERY_BROKER_URL — memory://: такой брокер живет только внутри процесса
+веб-сервера, и сообщения из него никто не читает. Пока настоящий брокер (Redis,
+RabbitMQ) не задан, задачи выполняются сразу в вызывающем процессе, как до переноса
+работы в Celery. С брокером задача уходит воркеру (celery -A paint_shop worker).
+"""
+from __future__ import annotations
+
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LOCAL_BROKER_PREFIX = 'memory://'
+
+
+def broker_configured() -> bool:
+    """Задан ли брокер, который читают воркеры других процессов"""
+    broker_url = getattr(settings, 'CELERY_BROKER_URL', '') or LOCAL_BROKER_PREFIX
+    return not broker_url.startswith(LOCAL_BROKER_PREFIX)
+
+
+def enqueue(task, *args, **kwargs):
+    """
+    Ставит задачу в очередь, а без брокера выполняет ее сразу (task.apply).
+    Возвращает AsyncResult или EagerResult; исключение задачи при выполнении
+    на месте не пробрасывается, а остается в результате (result.failed()).
+    """
+    if broker_configured():
+        return task.delay(*args, **kwargs)
+    logger.info("No Celery broker configured, running %s inline", task.name)
+    return task.apply(args=args, kwargs=kwargs)
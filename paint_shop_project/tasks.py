@@ -2,7 +2,6 @@
 Celery задачи для автоматизации резервного копирования
 """
 import logging
-from datetime import datetime
 from pathlib import Path
 
 from celery import shared_task
@@ -10,36 +9,65 @@ from django.conf import settings
 from django.core.mail import mail_admins
 from django.utils import timezone
 
-from paint_shop_project.admin_views.database import perform_backup, _get_backup_root
+from paint_shop_project.admin_views.database import (
+    backup_is_due,
+    backup_lock,
+    perform_backup,
+)
 from .models import DatabaseBackup
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task(bind=True, name='create_scheduled_backup')
-def create_scheduled_backup(self, comment=None):
+def create_scheduled_backup(self, comment=None, manual=False, folder_name=None, destination_dir=None):
     """
-    Создает автоматическую резервную копию базы данных.
+    Создает резервную копию базы данных — единственное место, где запускается pg_dump.
+    
+    Beat вызывает задачу каждый час; автоматический бэкап делается, только если
+    последний успешный старше BACKUP_AUTO_INTERVAL_HOURS. Одновременно выполняется
+    не больше одного бэкапа на кластер (backup_lock), остальные вызовы пропускаются.
     
     Args:
         comment: Опциональный комментарий для бэкапа
+        manual: Бэкап по кнопке со страницы обслуживания БД (без проверки интервала и уведомлений)
+        folder_name: Подпапка для ручного бэкапа
+        destination_dir: Каталог для ручного бэкапа (по умолчанию стандартный)
     
     Returns:
         dict: Результат операции
     """
+    with backup_lock() as acquired:
+        if not acquired:
+            logger.info("Backup skipped: another backup is running")
+            return {'status': 'skipped', 'reason': 'locked'}
+        if not manual and not backup_is_due():
+            return {'status': 'skipped', 'reason': 'not_due'}
+        return _run_backup(comment, manual, folder_name, destination_dir)
+
+
+def _run_backup(comment, manual, folder_name, destination_dir):
     start_time = timezone.now()
     backup_path = None
+    notify = not manual and getattr(settings, 'BACKUP_ENABLE_NOTIFICATIONS', True)
     
     try:
-        logger.info("Starting scheduled database backup")
-        
-        # Создаем бэкап в стандартной папке с подпапкой по дате
-        today = timezone.localtime().strftime("%Y-%m-%d")
-        backup_path = perform_backup(
-            label="scheduled",
-            folder_name=f"auto_{today}",
-            comment=comment or f"Автоматический бэкап от {start_time.strftime('%d.%m.%Y %H:%M')}",
-        )
+        logger.info("Starting %s database backup", 'manual' if manual else 'scheduled')
+        
+        if manual:
+            backup_path = perform_backup(
+                destination_dir=Path(destination_dir) if destination_dir else None,
+                folder_name=folder_name,
+                comment=comment,
+            )
+        else:
+            # Создаем бэкап в стандартной папке с подпапкой по дате
+            today = timezone.localtime().strftime("%Y-%m-%d")
+            backup_path = perform_backup(
+                label="scheduled",
+                folder_name=f"auto_{today}",
+                comment=comment or f"Автоматический бэкап от {start_time.strftime('%d.%m.%Y %H:%M')}",
+            )
         
         # Получаем запись из истории
         backup_record = DatabaseBackup.objects.filter(
@@ -60,14 +88,14 @@ def create_scheduled_backup(self, comment=None):
         }
         
         logger.info(
-            "Scheduled backup completed successfully: %s (%.2f MB, %.1f sec)",
+            "Backup completed successfully: %s (%.2f MB, %.1f sec)",
             backup_path.name,
             file_size / (1024 * 1024),
             duration
         )
         
         # Отправляем уведомление администраторам
-        if getattr(settings, 'BACKUP_ENABLE_NOTIFICATIONS', True):
+        if notify:
             try:
                 send_backup_notification(result)
             except Exception as exc:
@@ -77,7 +105,7 @@ def create_scheduled_backup(self, comment=None):
         
     except Exception as exc:
         error_msg = str(exc)
-        logger.error("Scheduled backup failed: %s", error_msg)
+        logger.error("Backup failed: %s", error_msg)
         
         result = {
             'status': 'failed',
@@ -86,7 +114,7 @@ def create_scheduled_backup(self, comment=None):
         }
         
         # Отправляем уведомление об ошибке
-        if getattr(settings, 'BACKUP_ENABLE_NOTIFICATIONS', True):
+        if notify:
             try:
                 send_backup_notification(result, is_error=True)
             except Exception as notif_exc:
@@ -140,286 +168,171 @@ def send_backup_notification(result: dict, is_error: bool = False):
 
 
 @shared_task(name='cleanup_old_backups')
-def cleanup_old_backups(days_to_keep=30):
+def cleanup_old_backups(days_to_keep=None):
     """
-    Удаляет старые резервные копии старше указанного количества дней.
+    Удаляет резервные копии, у которых истек срок хранения их класса
+    (BACKUP_RETENTION_DAYS: ежедневные, еженедельные, ежемесячные, перед восстановлением).
+    Истекшие копии выбираются из каталога BackupFile одним запросом.
     
     Args:
-        days_to_keep: Количество дней для хранения бэкапов (по умолчанию 30)
+        days_to_keep: Срок хранения ежедневных копий вместо настройки (дни)
     
     Returns:
         dict: Статистика очистки
     """
-    from datetime import timedelta
-    
-    cutoff_date = timezone.now() - timedelta(days=days_to_keep)
-    backup_root = _get_backup_root()
-    
-    deleted_count = 0
-    freed_space = 0
-    errors = []
+    from .backup_catalog import apply_retention
     
     try:
-        # Находим все бэкапы старше указанной даты
-        old_backups = DatabaseBackup.objects.filter(
-            operation='backup',
-            status='success',
-            started_at__lt=cutoff_date
-        )
-        
-        for backup_record in old_backups:
-            try:
-                backup_path = Path(backup_record.file_path)
-                
-                # Проверяем, существует ли файл
-                if backup_path.exists():
-                    file_size = backup_path.stat().st_size
-                    
-                    # Удаляем файл
-                    backup_path.unlink()
-                    freed_space += file_size
-                    deleted_count += 1
-                    
-                    logger.info("Deleted old backup: %s", backup_path)
-                else:
-                    logger.warning("Backup file not found: %s", backup_path)
-                
-                # Удаляем запись из истории (опционально - можно оставить для архива)
-                # backup_record.delete()
-                
-            except Exception as exc:
-                error_msg = f"Failed to delete {backup_record.file_path}: {exc}"
-                errors.append(error_msg)
-                logger.error(error_msg)
-        
-        result = {
-            'status': 'success',
-            'deleted_count': deleted_count,
-            'freed_space_mb': freed_space / (1024 * 1024),
-            'errors': errors,
-        }
-        
-        logger.info(
-            "Cleanup completed: deleted %d backups, freed %.2f MB",
-            deleted_count,
-            freed_space / (1024 * 1024)
-        )
-        
-        return result
-        
+        stats = apply_retention(daily_days=days_to_keep)
     except Exception as exc:
         logger.error("Cleanup failed: %s", exc)
         raise
+    
+    result = {
+        'status': 'success',
+        'deleted_count': stats['deleted'],
+        'freed_space_mb': stats['freed_bytes'] / (1024 * 1024),
+        'errors': stats['errors'],
+    }
+    logger.info(
+        "Cleanup completed: deleted %d backups, freed %.2f MB",
+        result['deleted_count'],
+        result['freed_space_mb']
+    )
+    return result
 
 
-"""
-import logging
-from datetime import datetime
-from pathlib import Path
+@shared_task(name='reconcile_backup_catalog')
+def reconcile_backup_catalog(verify=False):
+    """
+    Сверка каталога BackupFile с каталогом копий на диске: добавляет файлы,
+    скопированные вручную, и убирает строки удаленных файлов.
+    """
+    from .backup_catalog import reconcile_catalog
 
-from celery import shared_task
-from django.conf import settings
-from django.core.mail import mail_admins
-from django.utils import timezone
+    stats = reconcile_catalog(verify=verify)
+    if stats['mismatched']:
+        logger.error("Backup checksum mismatch for catalog entries: %s", stats['mismatched'])
+    return {'status': 'success', **stats}
 
-from paint_shop_project.admin_views.database import perform_backup, _get_backup_root
-from .models import DatabaseBackup
 
-logger = logging.getLogger(__name__)
+@shared_task(name='refresh_sellable_stock')
+def refresh_sellable_stock():
+    """
+    Ночной пересчёт Product.sellable_quantity: партии, перешедшие порог 70%
+    срока годности, перестают учитываться в доступном к продаже остатке.
+    """
+    from .batch_allocation import refresh_sellable_quantity
 
+    updated = refresh_sellable_quantity()
+    logger.info("Sellable stock refreshed for %d products", updated)
+    return {'status': 'success', 'updated': updated}
 
-@shared_task(bind=True, name='create_scheduled_backup')
-def create_scheduled_backup(self, comment=None):
+
+@shared_task(name='spoil_expired_batches')
+def spoil_expired_batches(days_overdue=0, notify=False):
     """
-    Создает автоматическую резервную копию базы данных.
-    
-    Args:
-        comment: Опциональный комментарий для бэкапа
-    
-    Returns:
-        dict: Результат операции
+    Ночное списание просроченных партий пачками (UPDATE ... RETURNING) под блокировкой
+    «одно списание на кластер»: параллельный запуск из cron или второго воркера
+    пропускается.
     """
-    start_time = timezone.now()
-    backup_path = None
-    
-    try:
-        logger.info("Starting scheduled database backup")
-        
-        # Создаем бэкап в стандартной папке с подпапкой по дате
-        today = timezone.localtime().strftime("%Y-%m-%d")
-        backup_path = perform_backup(
-            label="scheduled",
-            folder_name=f"auto_{today}",
-            comment=comment or f"Автоматический бэкап от {start_time.strftime('%d.%m.%Y %H:%M')}",
-        )
-        
-        # Получаем запись из истории
-        backup_record = DatabaseBackup.objects.filter(
-            file_path=str(backup_path),
-            operation='backup',
-            status='success'
-        ).order_by('-started_at').first()
-        
-        file_size = backup_path.stat().st_size if backup_path.exists() else 0
-        duration = (timezone.now() - start_time).total_seconds()
-        
-        result = {
-            'status': 'success',
-            'file_path': str(backup_path),
-            'file_size': file_size,
-            'duration_seconds': duration,
-            'backup_record_id': backup_record.id if backup_record else None,
-        }
-        
-        logger.info(
-            "Scheduled backup completed successfully: %s (%.2f MB, %.1f sec)",
-            backup_path.name,
-            file_size / (1024 * 1024),
-            duration
-        )
-        
-        # Отправляем уведомление администраторам
-        if getattr(settings, 'BACKUP_ENABLE_NOTIFICATIONS', True):
-            try:
-                send_backup_notification(result)
-            except Exception as exc:
-                logger.error("Failed to send backup notification: %s", exc)
-        
-        return result
-        
-    except Exception as exc:
-        error_msg = str(exc)
-        logger.error("Scheduled backup failed: %s", error_msg)
-        
-        result = {
-            'status': 'failed',
-            'error': error_msg,
-            'duration_seconds': (timezone.now() - start_time).total_seconds(),
-        }
-        
-        # Отправляем уведомление об ошибке
-        if getattr(settings, 'BACKUP_ENABLE_NOTIFICATIONS', True):
-            try:
-                send_backup_notification(result, is_error=True)
-            except Exception as notif_exc:
-                logger.error("Failed to send backup error notification: %s", notif_exc)
-        
-        # Пробрасываем исключение, чтобы Celery пометил задачу как неудачную
-        raise
+    from .batch_spoilage import notify_managers, spoil_expired_batches as spoil
 
+    report = spoil(days_overdue=days_overdue)
+    if report.locked:
+        return {'status': 'skipped', 'reason': 'locked'}
+    if notify and report.batches:
+        notify_managers(report)
+    return {
+        'status': 'success',
+        'batches': report.batches,
+        'quantity': report.quantity,
+        'duration_seconds': round(report.duration_seconds, 3),
+    }
 
-def send_backup_notification(result: dict, is_error: bool = False):
+
+@shared_task(name='collect_business_metrics')
+def collect_business_metrics():
     """
-    Отправляет email уведомление администраторам о результате бэкапа.
-    
-    Args:
-        result: Словарь с результатами операции
-        is_error: Флаг, указывающий на ошибку
+    Периодический сбор бизнес-метрик для /metrics/: один пересчёт на интервал
+    для всего кластера, снимок хранится в общем кэше.
     """
-    if is_error:
-        subject = '[Жевжик] Ошибка автоматического бэкапа базы данных'
-        message = f"""
-Произошла ошибка при создании автоматической резервной копии базы данных.
+    from .prometheus_metrics import collect_business_metrics as collect
 
-Ошибка: {result.get('error', 'Неизвестная ошибка')}
-Время: {timezone.localtime().strftime('%d.%m.%Y %H:%M:%S')}
-Длительность: {result.get('duration_seconds', 0):.1f} секунд
+    snapshot = collect()
+    return {'status': 'success', 'collected_at': snapshot['collected_at']}
 
-Проверьте логи и настройки резервного копирования.
-"""
-    else:
-        file_size_mb = result.get('file_size', 0) / (1024 * 1024)
-        duration = result.get('duration_seconds', 0)
-        
-        subject = '[Жевжик] Автоматический бэкап успешно создан'
-        message = f"""
-Автоматическая резервная копия базы данных успешно создана.
 
-Файл: {Path(result.get('file_path', '')).name}
-Размер: {file_size_mb:.2f} MB
-Время создания: {timezone.localtime().strftime('%d.%m.%Y %H:%M:%S')}
-Длительность: {duration:.1f} секунд
+@shared_task(name='rebuild_recent_sales_rollups')
+def rebuild_recent_sales_rollups(days=2):
+    """
+    Ночная сверка дневных агрегатов продаж за последние дни: исправляет расхождения
+    после правок заказов в обход сигналов (QuerySet.update, правки в БД).
+    """
+    from .sales_rollups import period_start, rebuild_sales_rollups
 
-Файл сохранен в стандартном каталоге резервных копий.
-"""
-    
-    try:
-        mail_admins(subject, message, fail_silently=False)
-        logger.info("Backup notification sent successfully")
-    except Exception as exc:
-        logger.error("Failed to send backup notification email: %s", exc)
-        # Не пробрасываем исключение, чтобы не прерывать основной процесс
+    rebuilt = rebuild_sales_rollups(start=period_start(days))
+    logger.info("Sales rollups rebuilt for last %d days (%d days with orders)", days, rebuilt)
+    return {'status': 'success', 'days': rebuilt}
 
 
-@shared_task(name='cleanup_old_backups')
-def cleanup_old_backups(days_to_keep=30):
+@shared_task(name='rebuild_rfm_snapshot')
+def rebuild_rfm_snapshot():
     """
-    Удаляет старые резервные копии старше указанного количества дней.
-    
-    Args:
-        days_to_keep: Количество дней для хранения бэкапов (по умолчанию 30)
-    
-    Returns:
-        dict: Статистика очистки
+    Ночной пересчет RFM-сегментов клиентов: страница RFM-анализа читает только
+    готовый снимок CustomerRFMSnapshot.
     """
-    from datetime import timedelta
-    
-    cutoff_date = timezone.now() - timedelta(days=days_to_keep)
-    backup_root = _get_backup_root()
-    
-    deleted_count = 0
-    freed_space = 0
-    errors = []
-    
-    try:
-        # Находим все бэкапы старше указанной даты
-        old_backups = DatabaseBackup.objects.filter(
-            operation='backup',
-            status='success',
-            started_at__lt=cutoff_date
-        )
-        
-        for backup_record in old_backups:
-            try:
-                backup_path = Path(backup_record.file_path)
-                
-                # Проверяем, существует ли файл
-                if backup_path.exists():
-                    file_size = backup_path.stat().st_size
-                    
-                    # Удаляем файл
-                    backup_path.unlink()
-                    freed_space += file_size
-                    deleted_count += 1
-                    
-                    logger.info("Deleted old backup: %s", backup_path)
-                else:
-                    logger.warning("Backup file not found: %s", backup_path)
-                
-                # Удаляем запись из истории (опционально - можно оставить для архива)
-                # backup_record.delete()
-                
-            except Exception as exc:
-                error_msg = f"Failed to delete {backup_record.file_path}: {exc}"
-                errors.append(error_msg)
-                logger.error(error_msg)
-        
-        result = {
-            'status': 'success',
-            'deleted_count': deleted_count,
-            'freed_space_mb': freed_space / (1024 * 1024),
-            'errors': errors,
-        }
-        
-        logger.info(
-            "Cleanup completed: deleted %d backups, freed %.2f MB",
-            deleted_count,
-            freed_space / (1024 * 1024)
-        )
-        
-        return result
-        
-    except Exception as exc:
-        logger.error("Cleanup failed: %s", exc)
-        raise
+    from .rfm_snapshot import rebuild_rfm_snapshot as rebuild
+
+    customers = rebuild()
+    logger.info("RFM snapshot rebuilt for %d customers", customers)
+    return {'status': 'success', 'customers': customers}
+
+
+@shared_task(name='run_export_job')
+def run_export_job(job_id):
+    """
+    Формирование отчета ExportJob вне запроса администратора; результат
+    сохраняется в MEDIA_ROOT/exports и доступен для скачивания до expires_at.
+    """
+    from .export_jobs import run_export_job as run
+
+    job = run(job_id)
+    return {'status': job.status, 'job_id': job.pk}
+
+
+@shared_task(name='cleanup_expired_exports')
+def cleanup_expired_exports():
+    """Удаление файлов и заданий экспорта, у которых истек срок хранения"""
+    from .dashboard_pdf import cleanup_chart_cache
+    from .export_jobs import cleanup_expired_exports as cleanup
+
+    deleted = cleanup()
+    charts = cleanup_chart_cache()
+    logger.info("Expired export jobs removed: %d, unused dashboard charts removed: %d", deleted, charts)
+    return {'status': 'success', 'deleted': deleted, 'charts': charts}
+
+
+@shared_task(name='render_dashboard_charts')
+def render_dashboard_charts(periods=None):
+    """
+    Прогрев графиков PDF-дашборда: картинки рисуются вне запроса и берутся
+    из кэша при экспорте, пока данные периода не изменились.
+    """
+    from .dashboard_pdf import render_dashboard_charts as render
+
+    periods = periods or getattr(settings, 'DASHBOARD_PDF_PREWARM_PERIODS', [30])
+    rendered = {period: len(render(period)) for period in periods}
+    return {'status': 'success', 'charts': rendered}
+
+
+@shared_task(name='refresh_maintenance_metrics')
+def refresh_maintenance_metrics():
+    """
+    Снимок метрик БД и продаж для страницы обслуживания БД: страница читает его
+    из кэша и не выполняет тяжелых запросов к pg_stat_* и заказам сама.
+    """
+    from .admin_views.database import collect_maintenance_metrics
 
+    snapshot = collect_maintenance_metrics()
+    return {'status': 'success', 'collected_at': snapshot['collected_at'].isoformat()}
@@ -1,7 +1,10 @@
 """
 Unit-тесты для критической логики работы с партиями товаров
 """
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock
+
+from django.test import TestCase, override_settings
 from django.utils import timezone
 from datetime import timedelta
 from django.contrib.auth import get_user_model
@@ -398,3 +401,310 @@ class BatchSpoilageTestCase(TestCase):
         self.assertEqual(expired_batch.remaining_quantity, initial_quantity)
 
 
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BatchSpoilageEngineTestCase(TestCase):
+    """Списание пачками через UPDATE ... RETURNING под блокировкой на кластер"""
+    
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        category = Category.objects.create(name='Молочные продукты', slug='dairy')
+        self.milk = Product.objects.create(name='Молоко', slug='milk', category=category, price=80, has_expiry_date=True)
+        self.kefir = Product.objects.create(name='Кефир', slug='kefir', category=category, price=90, has_expiry_date=True)
+        today = timezone.now().date()
+        self.batches = [
+            ProductBatch.objects.create(
+                product=product, batch_number=number, production_date=today - timedelta(days=20),
+                expiry_date=today + timedelta(days=expires), quantity=10, remaining_quantity=quantity,
+            )
+            for product, number, expires, quantity in [
+                (self.milk, 'M1', -1, 5),
+                (self.milk, 'M2', -3, 2),
+                (self.kefir, 'K1', -10, 4),
+                (self.kefir, 'K2', 60, 6),    # не просрочена, продается
+                (self.kefir, 'K3', -2, 0),    # уже пуста
+            ]
+        ]
+    
+    def test_spoils_in_chunks_and_reports_returned_rows(self):
+        from .batch_spoilage import spoil_expired_batches
+        from .models import BatchAuditLog
+        BatchAuditLog.objects.all().delete()
+        Product.objects.update(stock_quantity=100, sellable_quantity=100)
+        
+        report = spoil_expired_batches(limit=2)
+        
+        self.assertFalse(report.locked)
+        self.assertEqual((report.batches, report.quantity, report.chunks), (3, 11, 2))
+        self.assertEqual(report.value, Decimal('920.00'))
+        self.assertEqual(report.by_product['Молоко'], {
+            'batches': 2, 'total_quantity': 7, 'total_value': Decimal('560.00'),
+        })
+        self.assertEqual(
+            list(ProductBatch.objects.order_by('id').values_list('remaining_quantity', flat=True)), [0, 0, 0, 6, 0],
+        )
+        # Одна запись аудита на партию, без дублей quantity_changed из pre_save
+        self.assertEqual(
+            sorted(BatchAuditLog.objects.values_list('batch__batch_number', 'action', 'old_value', 'new_value')),
+            [('K1', 'spoiled', 4, 0), ('M1', 'spoiled', 5, 0), ('M2', 'spoiled', 2, 0)],
+        )
+        # Доступный остаток затронутых товаров пересчитан, хотя сигналы партий не срабатывали
+        self.assertEqual(Product.objects.get(pk=self.kefir.pk).sellable_quantity, 6)
+        self.assertEqual(Product.objects.get(pk=self.milk.pk).sellable_quantity, 0)
+        
+        # Повторный запуск ничего не списывает
+        self.assertEqual(spoil_expired_batches().batches, 0)
+    
+    def test_days_overdue_and_dry_run_preview(self):
+        from .batch_spoilage import preview_expired, spoil_expired_batches
+        
+        preview = preview_expired(days_overdue=2)
+        self.assertEqual((preview.batches, preview.quantity, preview.value), (2, 6, Decimal('520.00')))
+        self.assertEqual(ProductBatch.objects.filter(remaining_quantity=0).count(), 1)
+        
+        self.assertEqual(spoil_expired_batches(days_overdue=2).batches, 2)
+        self.assertEqual(ProductBatch.objects.get(batch_number='M1').remaining_quantity, 5)
+    
+    def test_run_skipped_while_locked(self):
+        import threading
+        from django.db import connections
+        from .batch_spoilage import spoilage_lock
+        from .tasks import spoil_expired_batches as spoil_task
+        
+        # Блокировку держит другое соединение: advisory lock реентерабелен внутри одной сессии
+        locked, release = threading.Event(), threading.Event()
+        
+        def hold_lock():
+            try:
+                with spoilage_lock():
+                    locked.set()
+                    release.wait(5)
+            finally:
+                connections.close_all()
+        
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait(5)
+        try:
+            result = spoil_task()
+        finally:
+            release.set()
+            holder.join()
+        
+        self.assertEqual(result, {'status': 'skipped', 'reason': 'locked'})
+        self.assertEqual(ProductBatch.objects.get(batch_number='M1').remaining_quantity, 5)
+        
+        result = spoil_task()
+        self.assertEqual((result['status'], result['batches'], result['quantity']), ('success', 3, 11))
+        self.assertIn('duration_seconds', result)
+    
+    def test_task_notifies_managers(self):
+        from .models import Notification
+        from .tasks import spoil_expired_batches as spoil_task
+        role = Role.objects.create(name='store_manager', can_manage_store=True, is_staff_role=True)
+        manager = User.objects.create_user(username='manager', password='testpass123', role=role)
+        
+        spoil_task(notify=True)
+        
+        notification = Notification.objects.get(user=manager)
+        self.assertIn('Списано партий: 3', notification.message)
+        self.assertIn('Молоко: 7 ед.', notification.message)
+
+
+class BatchAllocationTestCase(TestCase):
+    """Тесты для подбора партий по FEFO с правилом 70% в SQL"""
+    
+    def setUp(self):
+        from .models import BatchAuditLog
+        self.category = Category.objects.create(name='Молочные продукты', slug='dairy')
+        # stock_quantity задаём после создания, чтобы сигнал не создал автоматическую партию
+        self.product = Product.objects.create(
+            name='Молоко', slug='milk', category=self.category, price=80, has_expiry_date=True
+        )
+        Product.objects.filter(pk=self.product.pk).update(stock_quantity=100)
+        self.user = User.objects.create_user(username='picker', password='testpass123')
+        self.order = Order.objects.create(
+            user=self.user, delivery_type='pickup', total_amount=800, payment_method='cash'
+        )
+        today = timezone.now().date()
+        self.fresh = self._batch('FRESH', today - timedelta(days=1), today + timedelta(days=9), 30)
+        self.older = self._batch('OLDER', today - timedelta(days=2), today + timedelta(days=8), 5)
+        self.stale = self._batch('STALE', today - timedelta(days=5), today + timedelta(days=5), 50)
+        BatchAuditLog.objects.all().delete()
+    
+    def _batch(self, number, production_date, expiry_date, quantity):
+        return ProductBatch.objects.create(
+            product=self.product, batch_number=number, production_date=production_date,
+            expiry_date=expiry_date, quantity=quantity, remaining_quantity=quantity,
+        )
+    
+    def test_sql_rule_matches_is_sellable(self):
+        from .batch_allocation import sellable_batches
+        expected = {b.id for b in ProductBatch.objects.all() if b.is_sellable(min_percent=70)}
+        self.assertEqual(set(sellable_batches([self.product.id]).values_list('id', flat=True)), expected)
+        self.assertNotIn(self.stale.id, expected)
+    
+    def test_sql_expiry_percent_matches_property(self):
+        from .batch_allocation import expiry_percent_expression
+        today = timezone.now().date()
+        self._batch('EXPIRED', today - timedelta(days=10), today - timedelta(days=1), 3)
+        self._batch('SAMEDAY', today, today, 3)
+        rows = ProductBatch.objects.annotate(percent=expiry_percent_expression())
+        for batch in rows:
+            self.assertAlmostEqual(float(batch.percent), batch.expiry_percent_remaining, places=6, msg=batch.batch_number)
+    
+    def test_availability_in_single_query(self):
+        from .batch_allocation import find_shortages
+        with self.assertNumQueries(1):
+            shortages = find_shortages({self.product.id: 40})
+        self.assertEqual(len(shortages), 1)
+        self.assertIn('35', shortages[0])
+        self.assertEqual(find_shortages({self.product.id: 35}), [])
+    
+    def test_fefo_plan_and_bulk_apply(self):
+        from .batch_allocation import apply_allocation, plan_fefo
+        from .models import BatchAuditLog
+        item = OrderItem.objects.create(order=self.order, product=self.product, quantity=10, price_per_unit=80)
+        
+        plan = plan_fefo(OrderItem.objects.filter(pk=item.pk).select_related('product'))
+        self.assertEqual([(t.batch.id, t.quantity) for t in plan.lines[0].takes], [(self.older.id, 5), (self.fresh.id, 5)])
+        
+        with self.assertNumQueries(7):  # savepoint, блокировка, 3 пакетные записи, пересчёт остатка, release
+            self.assertEqual(apply_allocation(plan, user=self.user), 2)
+        
+        item.refresh_from_db()
+        self.older.refresh_from_db()
+        self.fresh.refresh_from_db()
+        self.assertEqual(item.batch, self.older)
+        self.assertEqual(self.older.remaining_quantity, 0)
+        self.assertEqual(self.fresh.remaining_quantity, 25)
+        self.assertEqual(BatchAuditLog.objects.filter(action='assigned').count(), 2)
+    
+    def test_incomplete_line_is_not_applied(self):
+        from .batch_allocation import apply_allocation, plan_fefo
+        item = OrderItem.objects.create(order=self.order, product=self.product, quantity=36, price_per_unit=80)
+        plan = plan_fefo([item])
+        self.assertEqual(len(plan.incomplete_lines), 1)
+        self.assertEqual(apply_allocation(plan), 0)
+        self.fresh.refresh_from_db()
+        self.assertEqual(self.fresh.remaining_quantity, 30)
+
+
+class SellableQuantityTestCase(TestCase):
+    """Тесты для денормализованного Product.sellable_quantity"""
+    
+    def setUp(self):
+        self.category = Category.objects.create(name='Молочные продукты', slug='dairy')
+        self.today = timezone.now().date()
+    
+    def test_product_without_expiry_follows_stock(self):
+        product = Product.objects.create(name='Соль', slug='salt', category=self.category, price=30, stock_quantity=12)
+        self.assertEqual(product.sellable_quantity, 12)
+        product.stock_quantity = 0
+        product.save()
+        self.assertEqual(Product.objects.get(pk=product.pk).sellable_quantity, 0)
+        self.assertFalse(product.is_available)
+    
+    def test_batches_and_nightly_refresh(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from .batch_allocation import refresh_sellable_quantity
+        product = Product.objects.create(
+            name='Кефир', slug='kefir', category=self.category, price=90, has_expiry_date=True
+        )
+        Product.objects.filter(pk=product.pk).update(stock_quantity=100)
+        batch = ProductBatch.objects.create(
+            product=product, batch_number='K1', production_date=self.today - timedelta(days=2),
+            expiry_date=self.today + timedelta(days=8), quantity=20, remaining_quantity=20,
+        )
+        self.assertEqual(Product.objects.get(pk=product.pk).sellable_quantity, 20)
+        
+        batch.remaining_quantity = 15
+        batch.save()
+        self.assertEqual(Product.objects.get(pk=product.pk).sellable_quantity, 15)
+        
+        # Через 3 дня остаётся 5 из 10 дней срока — партия перестаёт продаваться
+        refresh_sellable_quantity(today=self.today + timedelta(days=3))
+        self.assertEqual(Product.objects.get(pk=product.pk).sellable_quantity, 0)
+        
+        call_command('refresh_sellable_stock', stdout=StringIO())
+        self.assertEqual(Product.objects.get(pk=product.pk).sellable_quantity, 15)
+    
+    def test_catalog_filters_and_sorts_by_sellable_quantity(self):
+        from django.urls import reverse
+        Product.objects.create(name='Мало', slug='few', category=self.category, price=10, stock_quantity=1)
+        Product.objects.create(name='Много', slug='many', category=self.category, price=10, stock_quantity=40)
+        Product.objects.create(name='Нет', slug='none', category=self.category, price=10, stock_quantity=0)
+        
+        response = self.client.get(reverse('api_products'), {'in_stock': '1', 'sort': 'in_stock'})
+        self.assertEqual([p['name'] for p in response.json()['products']], ['Много', 'Мало'])
+        
+        response = self.client.get('/api/v1/products/', {'in_stock': '1', 'ordering': '-sellable_quantity'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        results = data['results'] if isinstance(data, dict) else data
+        self.assertEqual([p['name'] for p in results], ['Много', 'Мало'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class WarehouseDashboardTestCase(TestCase):
+    """Метрики дашборда склада: агрегаты в SQL и общий кэш"""
+    
+    def setUp(self):
+        from django.core.cache import cache
+        from .models import BatchAuditLog
+        cache.clear()
+        self.category = Category.objects.create(name='Молочные продукты', slug='dairy')
+        self.product = Product.objects.create(
+            name='Молоко', slug='milk', category=self.category, price=80, has_expiry_date=True
+        )
+        today = timezone.now().date()
+        self.batches = [
+            ProductBatch.objects.create(
+                product=self.product, batch_number=number, production_date=today - timedelta(days=produced),
+                expiry_date=today + timedelta(days=expires), quantity=quantity, remaining_quantity=quantity,
+            )
+            for number, produced, expires, quantity in [
+                ('B1', 8, 2, 5),     # истекает через 2 дня, малый остаток
+                ('B2', 4, 6, 20),    # истекает через 6 дней
+                ('B3', 10, -1, 7),   # просрочена
+                ('B4', 1, 29, 40),
+            ]
+        ]
+        BatchAuditLog.objects.all().delete()
+        for quantity in (3, 4):
+            BatchAuditLog.objects.create(batch=self.batches[2], action='spoiled', old_value=quantity, new_value=0)
+        self.staff = User.objects.create_user(username='admin', password='testpass123', is_staff=True)
+    
+    def test_metrics_cover_all_batches(self):
+        from .admin_views.warehouse_dashboard import collect_warehouse_metrics
+        with self.assertNumQueries(4):
+            metrics = collect_warehouse_metrics()
+        
+        self.assertEqual(
+            (metrics['expiring_3_days'], metrics['expiring_7_days'], metrics['expiring_14_days']), (1, 2, 2),
+        )
+        self.assertEqual((metrics['expired_count'], metrics['expired_quantity']), (1, 7))
+        self.assertEqual((metrics['low_stock_count'], metrics['low_stock_quantity']), (2, 12))
+        self.assertEqual((metrics['total_batches'], metrics['total_quantity']), (4, 72))
+        self.assertEqual((metrics['spoiled_count'], metrics['spoiled_value']), (2, Decimal('560.00')))
+        
+        expected = sum(b.expiry_percent_remaining for b in self.batches) / len(self.batches)
+        self.assertEqual(metrics['avg_percent'], round(expected, 1))
+    
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_dashboard_is_served_from_shared_cache(self):
+        from django.urls import reverse
+        self.client.force_login(self.staff)
+        url = reverse('admin:warehouse-dashboard')
+        
+        response = self.client.get(url)
+        self.assertEqual(response.context['expired_count'], 1)
+        
+        ProductBatch.objects.filter(pk=self.batches[3].pk).update(expiry_date=timezone.now().date() - timedelta(days=1))
+        with mock.patch('paint_shop_project.admin_views.warehouse_dashboard.collect_warehouse_metrics') as collect:
+            response = self.client.get(url)
+        collect.assert_not_called()
+        self.assertEqual(response.context['expired_count'], 1)
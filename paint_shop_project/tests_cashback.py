@@ -0,0 +1,149 @@
+"""
+Тесты баланса кешбэка
+"""
+import threading
+from decimal import Decimal
+from io import StringIO
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from . import promo_cache
+from .cashback_ledger import (
+    InsufficientCashbackError,
+    earn_cashback,
+    find_discrepancies,
+    get_balance,
+    spend_cashback,
+)
+from .models import Cart, CashbackBalance, CashbackTransaction, Category, LoyaltyCard, Order, Product
+from .order_service import CashbackUnavailableError, place_order
+from .pricing import price_cart
+
+User = get_user_model()
+
+
+def _order(user):
+    return Order.objects.create(user=user, delivery_type='pickup', total_amount=Decimal('1000.00'), payment_method='card')
+
+
+class CashbackLedgerTestCase(TestCase):
+    """Баланс меняется вместе с журналом и не уходит в минус"""
+
+    def setUp(self):
+        promo_cache.clear_local_cache()
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        self.order = _order(self.user)
+
+    def test_running_balance(self):
+        earn_cashback(self.user, self.order, Decimal('50.00'), 'Начисление')
+        entry = spend_cashback(self.user, self.order, Decimal('20.00'), 'Списание')
+        self.assertEqual(entry.balance_after, Decimal('30.00'))
+        self.assertEqual(get_balance(self.user), Decimal('30.00'))
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.total_cashback_earned, self.user.total_cashback_spent), (Decimal('50.00'), Decimal('20.00')))
+
+        with self.assertRaises(InsufficientCashbackError):
+            spend_cashback(self.user, self.order, Decimal('30.01'), 'Списание')
+        self.assertEqual(CashbackTransaction.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(find_discrepancies(), [])
+
+    def test_loyalty_award_goes_through_ledger(self):
+        LoyaltyCard.objects.create(user=self.user, card_number='0001')
+        self.order.status = 'delivered'
+        self.order.save()
+        # Бронзовый уровень: 5% от 1000
+        self.assertEqual(get_balance(self.user), Decimal('50.00'))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.get_cashback_balance(), Decimal('50.00'))
+
+    def test_place_order_spends_cashback(self):
+        category = Category.objects.create(name='Хлеб', slug='bread')
+        product = Product.objects.create(name='Батон', slug='baton', category=category, price=Decimal('100.00'), stock_quantity=5)
+        earn_cashback(self.user, self.order, Decimal('30.00'), 'Начисление')
+
+        Cart.objects.create(user=self.user, product=product, quantity=1)
+        with self.assertRaises(CashbackUnavailableError):
+            place_order(self.user, price_cart(self.user), delivery_type='pickup', payment_method='cash', cashback_used=Decimal('40.00'))
+        product.refresh_from_db()
+        self.assertEqual(product.stock_quantity, 5)
+
+        order = place_order(self.user, price_cart(self.user), delivery_type='pickup', payment_method='cash', cashback_used=Decimal('30.00'))
+        self.assertEqual(order.amount_due, Decimal('70.00'))
+        self.assertEqual(get_balance(self.user), Decimal('0.00'))
+
+    def test_reconcile_command(self):
+        earn_cashback(self.user, self.order, Decimal('50.00'), 'Начисление')
+        other = User.objects.create_user(username='other', password='testpass123')
+        # Операции в обход журнала и ручная правка итогов пользователя
+        CashbackTransaction.objects.create(user=other, order=_order(other), amount=Decimal('15.00'), transaction_type='earned', description='Вручную')
+        CashbackBalance.objects.filter(user=self.user).update(balance=Decimal('999.00'))
+        User.objects.filter(pk=self.user.pk).update(total_cashback_spent=Decimal('5.00'))
+
+        out = StringIO()
+        call_command('reconcile_cashback_balances', stdout=out)
+        self.assertIn('Расхождения у пользователей: 2', out.getvalue())
+
+        call_command('reconcile_cashback_balances', '--fix', stdout=StringIO())
+        self.assertEqual(find_discrepancies(), [])
+        self.assertEqual(get_balance(self.user), Decimal('50.00'))
+        self.assertEqual(get_balance(other), Decimal('15.00'))
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_cashback_spent, Decimal('0.00'))
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_is_read_only(self):
+        entry = earn_cashback(self.user, self.order, Decimal('50.00'), 'Начисление')
+        admin = User.objects.create_superuser(username='admin', password='testpass123', email='admin@example.com')
+        self.client.force_login(admin)
+
+        self.assertEqual(self.client.get(reverse('admin:paint_shop_project_cashbacktransaction_add')).status_code, 403)
+        change_url = reverse('admin:paint_shop_project_cashbacktransaction_change', args=[entry.pk])
+        self.assertEqual(self.client.get(change_url).status_code, 200)
+        response = self.client.post(change_url, {'amount': '5000.00', 'description': 'Правка'})
+        self.assertEqual(response.status_code, 403)
+        entry.refresh_from_db()
+        self.assertEqual(entry.amount, Decimal('50.00'))
+
+
+@skipUnless(connection.features.has_select_for_update, 'Нужна СУБД с SELECT ... FOR UPDATE (PostgreSQL)')
+class ConcurrentCashbackSpendTestCase(TransactionTestCase):
+    """Параллельные списания одного кешбэка проходят по очереди"""
+
+    ATTEMPTS = 6
+
+    def test_parallel_spends_do_not_overdraw(self):
+        user = User.objects.create_user(username='buyer', password='testpass123')
+        order = _order(user)
+        earn_cashback(user, order, Decimal('100.00'), 'Начисление')
+
+        barrier = threading.Barrier(self.ATTEMPTS)
+        results = []
+        lock = threading.Lock()
+
+        def spend():
+            try:
+                barrier.wait()
+                spend_cashback(user, order, Decimal('40.00'), 'Списание')
+                outcome = 'ok'
+            except InsufficientCashbackError:
+                outcome = 'rejected'
+            except Exception as exc:  # pragma: no cover - диагностика
+                outcome = repr(exc)
+            finally:
+                connections.close_all()
+            with lock:
+                results.append(outcome)
+
+        threads = [threading.Thread(target=spend) for _ in range(self.ATTEMPTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count('ok'), 2, results)
+        self.assertEqual(get_balance(user), Decimal('20.00'))
+        self.assertEqual(find_discrepancies(), [])
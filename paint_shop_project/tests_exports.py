@@ -0,0 +1,309 @@
+"""
+Тесты экспорта отчетов
+"""
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from importlib.util import find_spec
+from io import BytesIO
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .admin_views.exports import ExportReportsView
+from .export_jobs import cleanup_expired_exports, get_export_root, run_export_job, submit_export_job
+from .models import Category, ExportJob, Order, OrderItem, Product
+
+User = get_user_model()
+
+
+class ExportTestMixin:
+    """Каталог экспорта во временной папке и выполнение заданий без брокера"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _submit(self, data):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.client.post(reverse('admin:export-reports'), data)
+        self.assertRedirects(response, reverse('admin:export-reports'), fetch_redirect_response=False)
+        return callbacks
+
+
+class OrdersExportTestCase(ExportTestMixin, TestCase):
+    """Потоковый экспорт заказов в CSV и XLSX"""
+
+    def setUp(self):
+        super().setUp()
+        self.staff = User.objects.create_user(username='admin', password='testpass123', is_staff=True)
+        self.client.force_login(self.staff)
+        category = Category.objects.create(name='Хлеб', slug='bread')
+        self.products = [
+            Product.objects.create(
+                name=f'Товар {i}', slug=f'product-{i}', category=category, price=Decimal('50.00'),
+            )
+            for i in range(2)
+        ]
+        self.url = reverse('admin:export-reports')
+
+    def _create_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(user=self.staff, total_amount=Decimal('150.00'))
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=self.products[0], quantity=1, price_per_unit=Decimal('50.00')),
+                OrderItem(order=order, product=self.products[1], quantity=2, price_per_unit=Decimal('50.00')),
+            ])
+
+    def _export(self, export_format):
+        self._submit({'report_type': 'orders', 'days': 30, 'format': export_format})
+        job = ExportJob.objects.latest('id')
+        run_export_job(job.pk)
+        response = self.client.get(reverse('admin:export-job-download', args=[job.pk]))
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        # Следующий вызов с теми же параметрами должен формировать отчет заново
+        ExportJob.objects.all().delete()
+        return response, content
+
+    def test_csv_export(self):
+        self._create_orders(3)
+        response, content = self._export('csv')
+
+        self.assertIn('.csv', response['Content-Disposition'])
+        lines = content.decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], 'ID;Дата;Клиент;Статус;Сумма;Товаров')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].endswith(';admin;Создан;150.0;2'))
+
+    def test_xlsx_export(self):
+        from openpyxl import load_workbook
+
+        self._create_orders(2)
+        response, content = self._export('xlsx')
+
+        self.assertIn('.xlsx', response['Content-Disposition'])
+        rows = list(load_workbook(BytesIO(content)).active.iter_rows(values_only=True))
+        self.assertEqual(rows[0], ('ID', 'Дата', 'Клиент', 'Статус', 'Сумма', 'Товаров'))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][4:], (150, 2))
+
+    def test_query_count_does_not_depend_on_orders(self):
+        def export_queries():
+            request = self.client.post(self.url, {'report_type': 'orders', 'days': 30, 'format': 'csv'}).wsgi_request
+            view = ExportReportsView()
+            view.setup(request)
+            with CaptureQueriesContext(connection) as ctx:
+                b''.join(view.dispatch_export(request).streaming_content)
+            return len(ctx.captured_queries)
+
+        self._create_orders(1)
+        baseline = export_queries()
+        self._create_orders(20)
+        self.assertEqual(export_queries(), baseline)
+
+
+class ExportJobTestCase(ExportTestMixin, TestCase):
+    """Постановка в очередь, дедупликация и срок хранения заданий экспорта"""
+
+    def setUp(self):
+        super().setUp()
+        self.staff = User.objects.create_user(username='admin', password='testpass123', is_staff=True)
+        self.client.force_login(self.staff)
+        self.data = {'report_type': 'orders', 'days': '365', 'format': 'csv'}
+
+    def test_identical_requests_share_one_job(self):
+        callbacks = self._submit(self.data)
+        self.assertEqual(len(callbacks), 1)
+        other = User.objects.create_user(username='admin2', password='testpass123', is_staff=True)
+        self.client.force_login(other)
+        self.assertEqual(len(self._submit(self.data)), 0)
+
+        job = ExportJob.objects.get()
+        self.assertEqual((job.status, job.progress, job.requested_by), ('pending', 0, self.staff))
+
+        run_export_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), ('done', 100))
+        self.assertTrue(job.filename.endswith('.csv'))
+        self.assertEqual(self.client.get(reverse('admin:export-job-status', args=[job.pk])).json()['ready'], True)
+
+        # Только что готовый отчет тоже переиспользуется; другой период — новое задание
+        self.assertEqual(submit_export_job('orders', {'days': '365', 'format': 'csv'})[0], job)
+        self.assertTrue(submit_export_job('orders', {'days': '30', 'format': 'csv'})[1])
+
+    def test_done_job_reused_only_within_window_or_forced(self):
+        self._submit(self.data)
+        job = ExportJob.objects.get()
+        run_export_job(job.pk)
+
+        # «Сформировать заново»: готовое задание не переиспользуется
+        self.assertEqual(len(self._submit({**self.data, 'force': '1'})), 1)
+        forced = ExportJob.objects.exclude(pk=job.pk).get()
+        self.assertEqual(forced.params, {'days': '365', 'format': 'csv'})
+        # Повторный force, пока новое задание в очереди, получает его же
+        self.assertEqual(submit_export_job('orders', forced.params, force=True), (forced, False))
+
+        ExportJob.objects.filter(pk=forced.pk).delete()
+        ExportJob.objects.filter(pk=job.pk).update(finished_at=timezone.now() - timedelta(minutes=10))
+        with self.captureOnCommitCallbacks(execute=False):
+            self.assertTrue(submit_export_job('orders', {'days': '365', 'format': 'csv'})[1])
+
+    def test_job_runs_inline_without_broker(self):
+        # memory:// никто не читает: отчет формируется сразу после фиксации
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:export-reports'), self.data)
+        self.assertEqual(ExportJob.objects.get().status, 'done')
+
+        with override_settings(CELERY_BROKER_URL='redis://localhost:6379/0'), \
+                mock.patch('paint_shop_project.tasks.run_export_job.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            job, created = submit_export_job('orders', {'days': '30', 'format': 'csv'})
+        self.assertTrue(created)
+        delay.assert_called_once_with(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'pending')
+
+    def test_concurrent_submit_falls_back_to_finished_job(self):
+        self._submit(self.data)
+        job = ExportJob.objects.get()
+        run_export_job(job.pk)
+        # Конкурирующее задание завершилось между проверкой и вставкой
+        with mock.patch('paint_shop_project.export_jobs._reusable_job', side_effect=[None, job]), \
+                mock.patch.object(ExportJob.objects, 'create', side_effect=IntegrityError):
+            self.assertEqual(submit_export_job('orders', {'days': '365', 'format': 'csv'}), (job, False))
+
+    def test_stale_active_job_is_replaced(self):
+        self._submit(self.data)
+        stuck = ExportJob.objects.get()
+        # Сообщение потеряно: задание давно в очереди и повторный запрос его не получает
+        ExportJob.objects.filter(pk=stuck.pk).update(created_at=timezone.now() - timedelta(minutes=20))
+        self.assertEqual(len(self._submit(self.data)), 1)
+        stuck.refresh_from_db()
+        self.assertEqual(stuck.status, 'failed')
+        fresh = ExportJob.objects.exclude(pk=stuck.pk).get()
+        self.assertEqual(fresh.status, 'pending')
+
+        # Упавший воркер: задание формируется слишком долго, force ставит новое
+        ExportJob.objects.filter(pk=fresh.pk).update(status='running', started_at=timezone.now() - timedelta(minutes=20))
+        with self.captureOnCommitCallbacks(execute=False):
+            job, created = submit_export_job('orders', fresh.params, force=True)
+        self.assertTrue(created)
+        self.assertEqual(ExportJob.objects.get(pk=fresh.pk).status, 'failed')
+        # Позднее сообщение для зависшего задания расчет не запускает
+        self.assertEqual(run_export_job(stuck.pk).status, 'failed')
+
+        ExportJob.objects.filter(pk=job.pk).update(created_at=timezone.now() - timedelta(minutes=20))
+        status = self.client.get(reverse('admin:export-job-status', args=[job.pk])).json()
+        self.assertEqual((status['status'], status['ready']), ('failed', False))
+
+    def test_failed_report_marks_job(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            job, _ = submit_export_job('batches_history', {'start_date': '2024-13-45', 'end_date': '2024-01-01'})
+        run_export_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('Ошибка при экспорте', job.error_message)
+        self.assertEqual(self.client.get(reverse('admin:export-job-download', args=[job.pk])).status_code, 404)
+
+    def test_cleanup_removes_expired_files(self):
+        self._submit(self.data)
+        job = ExportJob.objects.get()
+        run_export_job(job.pk)
+        job.refresh_from_db()
+        path = Path(get_export_root()) / job.file_path
+        self.assertTrue(path.exists())
+
+        self.assertEqual(cleanup_expired_exports(), 0)
+        ExportJob.objects.filter(pk=job.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(cleanup_expired_exports(), 1)
+        self.assertFalse(path.exists())
+        self.assertFalse(ExportJob.objects.exists())
+
+
+HAS_PDF_LIBS = all(find_spec(name) for name in ('matplotlib', 'reportlab'))
+
+
+class DashboardPdfTestCase(ExportTestMixin, TestCase):
+    """Данные и кэш графиков PDF-дашборда"""
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user(username='buyer', password='testpass123')
+        category = Category.objects.create(name='Хлеб', slug='bread')
+        product = Product.objects.create(name='Батон', slug='baton', category=category, price=Decimal('50.00'))
+        # Агрегаты продаж обновляются после фиксации транзакции
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(user=user, total_amount=Decimal('100.00'))
+            OrderItem.objects.create(order=order, product=product, quantity=2, price_per_unit=Decimal('50.00'))
+            order.status = 'delivered'
+            order.save()
+        self.order = order
+
+    def test_data_version_follows_sales(self):
+        from .dashboard_pdf import available_charts, dashboard_data, data_version
+
+        data = dashboard_data(30)
+        self.assertEqual(data['revenues'], [100.0])
+        self.assertEqual(data['statuses'], [('Доставлен', 1)])
+        self.assertEqual(data['top_products'][0]['quantity'], 2)
+        self.assertEqual(available_charts(data), ['daily_revenue', 'daily_orders', 'statuses', 'top_products'])
+
+        version = data_version(data, ('days', 'revenues'))
+        self.assertEqual(data_version(dashboard_data(30), ('days', 'revenues')), version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.order.user, total_amount=Decimal('40.00'), status='delivered')
+        changed = dashboard_data(30)
+        self.assertNotEqual(data_version(changed, ('days', 'revenues')), version)
+        # График статусов зависит только от статусов
+        self.assertEqual(changed['statuses'], [('Доставлен', 2)])
+
+    @skipUnless(HAS_PDF_LIBS, 'reportlab и matplotlib не установлены')
+    def test_charts_are_reused_between_exports(self):
+        from .dashboard_pdf import build_dashboard_pdf, render_dashboard_charts
+
+        charts = render_dashboard_charts(30)
+        self.assertEqual(len(charts), 4)
+        with mock.patch('paint_shop_project.dashboard_pdf._pyplot') as pyplot:
+            output = BytesIO()
+            build_dashboard_pdf(30, output)
+        pyplot.assert_not_called()
+        self.assertTrue(output.getvalue().startswith(b'%PDF'))
+        self.assertEqual(render_dashboard_charts(30), charts)
+
+    @skipUnless(HAS_PDF_LIBS, 'reportlab и matplotlib не установлены')
+    def test_sections_are_generated_while_pages_are_laid_out(self):
+        from reportlab.platypus import SimpleDocTemplate
+        from . import dashboard_pdf
+
+        events = []
+        original_chart_path = dashboard_pdf.chart_path
+        original_page_end = SimpleDocTemplate.handle_pageEnd
+
+        def chart_path(name, *args):
+            events.append(name)
+            return original_chart_path(name, *args)
+
+        def handle_page_end(doc):
+            events.append('page')
+            return original_page_end(doc)
+
+        with mock.patch.object(dashboard_pdf, 'chart_path', side_effect=chart_path), \
+                mock.patch.object(SimpleDocTemplate, 'handle_pageEnd', autospec=True, side_effect=handle_page_end):
+            dashboard_pdf.build_dashboard_pdf(30, BytesIO())
+
+        # График следующего раздела готовится только после верстки предыдущих страниц
+        self.assertEqual(events[0], 'daily_revenue')
+        self.assertLess(events.index('page'), events.index('top_products'))
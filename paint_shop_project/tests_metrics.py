@@ -0,0 +1,195 @@
+"""
+Тесты агрегации метрик в памяти и сброса в MetricRollup
+"""
+import time
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from prometheus_client import REGISTRY
+
+from paint_shop import metrics
+from . import prometheus_metrics
+from .prometheus_middleware import PrometheusMetricsMiddleware
+from .models import Category, MetricRollup, Order, Product
+
+
+@mock.patch.object(metrics, 'FLUSH_INTERVAL', 3600)
+class MetricAggregationTestCase(TestCase):
+    """Тесты для paint_shop.metrics"""
+
+    LABELS = {'method': 'GET', 'status_code': '200', 'path': '/catalog/'}
+
+    def setUp(self):
+        with metrics._metrics_lock:
+            metrics._metrics_storage.clear()
+
+    def test_recording_does_not_touch_database(self):
+        with self.assertNumQueries(0):
+            for _ in range(50):
+                metrics.increment_counter('zhevzhik_http_requests_total', labels=self.LABELS)
+                metrics.observe_histogram('zhevzhik_http_request_duration_seconds', 0.03, labels=self.LABELS)
+            metrics.set_gauge('zhevzhik_users_total', 7)
+        self.assertFalse(MetricRollup.objects.exists())
+
+    def test_flush_writes_one_row_per_series(self):
+        for _ in range(3):
+            metrics.increment_counter('zhevzhik_http_requests_total', labels=self.LABELS)
+        metrics.increment_counter('zhevzhik_http_requests_total', labels={**self.LABELS, 'status_code': '404'})
+        metrics.set_gauge('zhevzhik_users_total', 5)
+        metrics.set_gauge('zhevzhik_users_total', 7)
+
+        self.assertEqual(metrics.flush_metrics(), 3)
+        self.assertEqual(metrics.flush_metrics(), 0)
+
+        metrics.increment_counter('zhevzhik_http_requests_total', value=2, labels=self.LABELS)
+        metrics.flush_metrics()
+
+        self.assertEqual(MetricRollup.objects.count(), 3)
+        counter = MetricRollup.objects.get(
+            name='zhevzhik_http_requests_total',
+            labels_key=metrics._labels_key(self.LABELS),
+        )
+        self.assertEqual(counter.value, 5)
+        self.assertEqual(MetricRollup.objects.get(name='zhevzhik_users_total').value, 7)
+
+    def test_histogram_buckets_in_export(self):
+        for value in (0.003, 0.03, 0.03, 20):
+            metrics.observe_histogram('zhevzhik_http_request_duration_seconds', value, labels=self.LABELS)
+
+        output = metrics.generate_prometheus_metrics()
+
+        rollup = MetricRollup.objects.get(metric_type='histogram')
+        self.assertEqual(rollup.count, 4)
+        self.assertEqual(sum(rollup.buckets), 4)
+        self.assertIn('zhevzhik_http_request_duration_seconds_bucket{le="0.005",', output)
+        self.assertIn('le="0.05",method="GET",path="/catalog/",status_code="200"} 3', output)
+        self.assertIn('le="+Inf",method="GET",path="/catalog/",status_code="200"} 4', output)
+        self.assertIn(
+            'zhevzhik_http_request_duration_seconds_count{method="GET",path="/catalog/",status_code="200"} 4',
+            output,
+        )
+
+    def test_export_cost_does_not_grow_with_history(self):
+        metrics.increment_counter('zhevzhik_http_requests_total', labels=self.LABELS)
+        metrics.flush_metrics()
+        with CaptureQueriesContext(connection) as short_history:
+            metrics.generate_prometheus_metrics()
+
+        for _ in range(200):
+            metrics.increment_counter('zhevzhik_http_requests_total', labels=self.LABELS)
+            metrics.observe_histogram('zhevzhik_http_request_duration_seconds', 0.1, labels=self.LABELS)
+        metrics.flush_metrics()
+        with CaptureQueriesContext(connection) as long_history:
+            output = metrics.generate_prometheus_metrics()
+
+        self.assertEqual(len(short_history), len(long_history))
+        self.assertIn('zhevzhik_http_requests_total{method="GET",path="/catalog/",status_code="200"} 201.0', output)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BusinessMetricsCollectorTestCase(TestCase):
+    """Тесты сборщика бизнес-метрик для /metrics/"""
+
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create_user(username='buyer', password='testpass123')
+        category = Category.objects.create(name='Хлеб', slug='bread')
+        Product.objects.create(name='Батон', slug='baton', category=category, price=Decimal('50.00'))
+        Order.objects.create(user=user, total_amount=Decimal('150.00'), status='pending')
+
+    def test_collect_runs_one_query_per_group(self):
+        with self.assertNumQueries(10):
+            snapshot = prometheus_metrics.collect_business_metrics()
+
+        self.assertEqual(snapshot['values']['users_total'], 1)
+        self.assertEqual(snapshot['values']['orders_total'], 1)
+        self.assertEqual(snapshot['values']['revenue_total'], 150.0)
+        self.assertEqual(snapshot['labeled']['orders_by_status'], {'pending': 1})
+        self.assertEqual(snapshot['labeled']['products_by_category'], {'Хлеб': 1})
+        self.assertEqual(set(snapshot['timings']), {
+            'users', 'orders', 'orders_by_status', 'carts', 'products', 'products_by_category',
+            'reviews', 'payments', 'promotions', 'batches',
+        })
+
+    def test_scrape_serves_cached_snapshot_without_database(self):
+        prometheus_metrics.collect_business_metrics()
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/metrics/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(REGISTRY.get_sample_value('zhevzhik_orders_total'), 1.0)
+        self.assertEqual(REGISTRY.get_sample_value('zhevzhik_orders_by_status', {'status': 'pending'}), 1.0)
+        self.assertLess(REGISTRY.get_sample_value('zhevzhik_business_metrics_age_seconds'), 60)
+
+    def test_stale_snapshot_is_recollected_once(self):
+        snapshot = prometheus_metrics.collect_business_metrics()
+        snapshot['collected_at'] = time.time() - 3600
+        cache.set(prometheus_metrics.BUSINESS_METRICS_CACHE_KEY, snapshot)
+
+        with mock.patch.object(
+            prometheus_metrics, 'collect_business_metrics', wraps=prometheus_metrics.collect_business_metrics,
+        ) as collect:
+            prometheus_metrics.update_business_metrics()
+            prometheus_metrics.update_business_metrics()
+
+        self.assertEqual(collect.call_count, 1)
+        self.assertLess(REGISTRY.get_sample_value('zhevzhik_business_metrics_age_seconds'), 60)
+
+
+    def test_unknown_snapshot_keys_are_skipped(self):
+        snapshot = prometheus_metrics.collect_business_metrics()
+        snapshot['values']['removed_metric'] = 5
+        snapshot['labeled']['removed_labeled_metric'] = {'x': 1}
+
+        with self.assertLogs(prometheus_metrics.logger, 'WARNING'):
+            prometheus_metrics.apply_business_metrics(snapshot)
+
+        self.assertEqual(REGISTRY.get_sample_value('zhevzhik_orders_total'), 1.0)
+        self.assertEqual(REGISTRY.get_sample_value('zhevzhik_products_by_category', {'category': 'Хлеб'}), 1.0)
+
+
+class RouteLabelTestCase(TestCase):
+    """Метка path в HTTP-метриках ограничена шаблонами маршрутов"""
+
+    def setUp(self):
+        PrometheusMetricsMiddleware._seen_label_sets.clear()
+
+    def _requests(self, method, status_code, path):
+        return REGISTRY.get_sample_value(
+            'zhevzhik_http_requests_total',
+            {'method': method, 'status_code': status_code, 'path': path},
+        ) or 0
+
+    def test_tokens_share_route_label(self):
+        route = '/password-reset-confirm/<uidb64>/<token>/'
+        before = self._requests('GET', '200', route)
+
+        self.client.get('/password-reset-confirm/MQ/abc-123/')
+        self.client.get('/password-reset-confirm/Mg/def-456/')
+
+        self.assertEqual(self._requests('GET', '200', route) - before, 2)
+
+    def test_unknown_paths_go_to_unmatched(self):
+        before = self._requests('GET', '404', 'unmatched')
+
+        self.client.get('/no-such-page-1/?utm_source=x')
+        self.client.get('/no-such-page-2/')
+
+        self.assertEqual(self._requests('GET', '404', 'unmatched') - before, 2)
+
+    @override_settings(METRICS_MAX_LABEL_SETS=1)
+    def test_label_sets_are_capped(self):
+        overflow_before = REGISTRY.get_sample_value('zhevzhik_http_label_overflow_total')
+        before = self._requests('GET', '404', 'overflow')
+
+        self.client.get('/password-reset-confirm/MQ/abc-123/')
+        self.client.get('/no-such-page/')
+
+        self.assertEqual(self._requests('GET', '404', 'overflow') - before, 1)
+        self.assertEqual(REGISTRY.get_sample_value('zhevzhik_http_label_overflow_total') - overflow_before, 1)
@@ -0,0 +1,179 @@
+"""
+Тесты атомарного оформления заказа
+"""
+import threading
+from datetime import time, timedelta
+from decimal import Decimal
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import promo_cache
+from .models import Cart, Category, DeliverySlot, Order, OrderItem, Product, PromoCode, Store
+from .order_service import (
+    DeliverySlotUnavailableError,
+    InsufficientStockError,
+    PromoCodeUnavailableError,
+    place_order,
+)
+from .pricing import price_cart
+
+User = get_user_model()
+
+
+class PlaceOrderTestCase(TestCase):
+    """Тесты для place_order"""
+
+    def setUp(self):
+        promo_cache.clear_local_cache()
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        self.category = Category.objects.create(name='Хлеб', slug='bread')
+        self.products = [
+            Product.objects.create(
+                name=f'Товар {i}', slug=f'product-{i}', category=self.category,
+                price=Decimal('100.00'), stock_quantity=5,
+            )
+            for i in range(3)
+        ]
+        store = Store.objects.create(
+            name='Магазин', address='ул. Ленина, 1', phone='+70000000000',
+            working_hours='9-21', manager=self.user,
+        )
+        self.slot = DeliverySlot.objects.create(
+            store=store, date=timezone.now().date() + timedelta(days=1),
+            start_time=time(10), end_time=time(12), capacity=1,
+        )
+
+    def _place(self, **kwargs):
+        options = {'delivery_type': 'pickup', 'payment_method': 'cash'}
+        options.update(kwargs)
+        return place_order(self.user, price_cart(self.user), **options)
+
+    def test_places_order_and_decrements_stock(self):
+        for product in self.products:
+            Cart.objects.create(user=self.user, product=product, quantity=2)
+
+        order = self._place(delivery_type='delivery', delivery_address='ул. Мира, 5', delivery_slot_id=self.slot.id)
+
+        self.assertEqual(OrderItem.objects.filter(order=order).count(), 3)
+        self.assertEqual(order.total_amount, Decimal('600.00'))
+        self.assertEqual(set(Product.objects.values_list('stock_quantity', flat=True)), {3})
+        self.slot.refresh_from_db()
+        self.assertEqual(self.slot.reserved_count, 1)
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+        self.assertTrue(hasattr(order, 'picking'))
+
+    def test_insufficient_stock_rolls_back(self):
+        Cart.objects.create(user=self.user, product=self.products[0], quantity=1)
+        Cart.objects.create(user=self.user, product=self.products[1], quantity=6)
+
+        with self.assertRaises(InsufficientStockError) as ctx:
+            self._place()
+
+        self.assertEqual(len(ctx.exception.unavailable), 1)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock_quantity, 5)
+        self.assertEqual(Cart.objects.filter(user=self.user).count(), 2)
+
+    def test_full_slot_rolls_back(self):
+        Cart.objects.create(user=self.user, product=self.products[0], quantity=1)
+        DeliverySlot.objects.filter(pk=self.slot.pk).update(reserved_count=1)
+
+        with self.assertRaises(DeliverySlotUnavailableError):
+            self._place(delivery_type='delivery', delivery_address='ул. Мира, 5', delivery_slot_id=self.slot.id)
+
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock_quantity, 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_exhausted_promo_code_rolls_back(self):
+        now = timezone.now()
+        code = PromoCode.objects.create(
+            code='LAST', description='Последний', discount_type='fixed', discount_value=10,
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1), max_uses=1,
+        )
+        Cart.objects.create(user=self.user, product=self.products[0], quantity=1)
+        pricing = price_cart(self.user, promo_code='LAST')
+        self.assertEqual(pricing.applied_promo_code, code)
+
+        # Последнее использование забрал параллельный заказ после расчета цены
+        PromoCode.objects.filter(pk=code.pk).update(used_count=1)
+        with self.assertRaises(PromoCodeUnavailableError):
+            place_order(self.user, pricing, delivery_type='pickup', payment_method='cash')
+
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock_quantity, 5)
+        self.assertTrue(Cart.objects.filter(user=self.user).exists())
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        Cart.objects.create(user=self.user, product=self.products[0], quantity=1)
+        pricing = price_cart(self.user)
+        with CaptureQueriesContext(connection) as small_cart:
+            place_order(self.user, pricing, delivery_type='pickup', payment_method='cash')
+
+        for product in self.products:
+            Cart.objects.create(user=self.user, product=product, quantity=1)
+        pricing = price_cart(self.user)
+        with CaptureQueriesContext(connection) as big_cart:
+            place_order(self.user, pricing, delivery_type='pickup', payment_method='cash')
+        self.assertEqual(len(small_cart), len(big_cart))
+
+
+@skipUnless(connection.features.has_select_for_update, 'Нужна СУБД с SELECT ... FOR UPDATE (PostgreSQL)')
+class ConcurrentCheckoutTestCase(TransactionTestCase):
+    """Параллельные оформления одного товара не продают больше остатка"""
+
+    BUYERS = 8
+    STOCK = 3
+
+    def setUp(self):
+        promo_cache.clear_local_cache()
+        category = Category.objects.create(name='Хлеб', slug='bread')
+        self.product = Product.objects.create(
+            name='Батон', slug='baton', category=category,
+            price=Decimal('50.00'), stock_quantity=self.STOCK,
+        )
+        self.users = [
+            User.objects.create_user(username=f'buyer{i}', password='testpass123')
+            for i in range(self.BUYERS)
+        ]
+        for user in self.users:
+            Cart.objects.create(user=user, product=self.product, quantity=1)
+
+    def test_parallel_checkouts_do_not_oversell(self):
+        barrier = threading.Barrier(self.BUYERS)
+        results = []
+        lock = threading.Lock()
+
+        def checkout(user):
+            try:
+                pricing = price_cart(user)
+                barrier.wait()
+                place_order(user, pricing, delivery_type='pickup', payment_method='cash')
+                outcome = 'ok'
+            except InsufficientStockError:
+                outcome = 'rejected'
+            except Exception as exc:  # pragma: no cover - диагностика
+                outcome = repr(exc)
+            finally:
+                connections.close_all()
+            with lock:
+                results.append(outcome)
+
+        threads = [threading.Thread(target=checkout, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count('ok'), self.STOCK, results)
+        self.assertEqual(results.count('rejected'), self.BUYERS - self.STOCK, results)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 0)
+        self.assertEqual(
+            sum(OrderItem.objects.filter(product=self.product).values_list('quantity', flat=True)),
+            self.STOCK,
+        )
@@ -0,0 +1,134 @@
+"""
+Тесты пагинации по курсору
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import CashbackTransaction, Category, Order, Product
+from .pagination import InvalidCursor, KeysetPaginator, decode_cursor, encode_cursor
+
+User = get_user_model()
+
+
+class KeysetPaginatorTestCase(TestCase):
+    """Обход страниц вперед и назад при совпадающих значениях ключа"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        moment = timezone.now().replace(microsecond=123456)
+        orders = [
+            Order.objects.create(user=self.user, delivery_type='pickup', total_amount=Decimal('100.00'), payment_method='card')
+            for _ in range(7)
+        ]
+        # У части заказов одинаковое время: порядок внутри них задает id
+        for position, order in enumerate(orders):
+            Order.objects.filter(pk=order.pk).update(order_date=moment - timedelta(minutes=position // 3))
+        self.expected = list(Order.objects.order_by('-order_date', '-id').values_list('id', flat=True))
+        self.paginator = KeysetPaginator(Order.objects.filter(user=self.user), ('-order_date', '-id'), 3)
+
+    def test_walk_forward_and_back(self):
+        pages = [self.paginator.page()]
+        while pages[-1].has_next():
+            pages.append(self.paginator.page(pages[-1].next_cursor))
+        self.assertEqual([order.id for page in pages for order in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertFalse(pages[0].has_previous())
+
+        previous = self.paginator.page(pages[2].previous_cursor)
+        self.assertEqual([order.id for order in previous], self.expected[3:6])
+        self.assertTrue(previous.has_next())
+        first = self.paginator.page(previous.previous_cursor)
+        self.assertEqual([order.id for order in first], self.expected[:3])
+        self.assertFalse(first.has_previous())
+
+    def test_page_does_not_count(self):
+        cursor = self.paginator.page().next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            self.paginator.page(cursor)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('COUNT(', queries[0]['sql'].upper())
+        self.assertNotIn('OFFSET', queries[0]['sql'].upper())
+
+    def test_invalid_cursor(self):
+        for cursor in ['мусор', encode_cursor([1]), encode_cursor(['не дата', 1])]:
+            with self.assertRaises(InvalidCursor):
+                self.paginator.page(cursor)
+        self.assertEqual(decode_cursor(encode_cursor([Decimal('1.50')], backwards=True)), (['1.50'], True))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class CursorEndpointsTestCase(TestCase):
+    """Курсоры в API каталога и заказов, «Показать ещё» в истории"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        category = Category.objects.create(name='Хлеб', slug='bread')
+        # Одинаковые цены: следующая страница не должна терять или повторять товары
+        for i in range(25):
+            Product.objects.create(name=f'Товар {i:02d}', slug=f'product-{i}', category=category, price=Decimal(50 + i % 3))
+
+    def _walk(self, url, params, key):
+        ids, cursor = [], None
+        while True:
+            response = self.client.get(url, dict(params, **({'cursor': cursor} if cursor else {})))
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            ids.extend(item['id'] for item in data[key])
+            cursor = data.get('next_cursor')
+            if not cursor:
+                return ids, data
+
+    def test_api_products_cursor(self):
+        ids, _data = self._walk(reverse('api_products'), {'sort': 'price_desc'}, 'products')
+        self.assertEqual(ids, list(Product.objects.order_by('-price', '-id').values_list('id', flat=True)))
+
+        response = self.client.get(reverse('api_products'), {'cursor': 'мусор'})
+        self.assertEqual(response.status_code, 400)
+        # Номер страницы по-прежнему поддерживается
+        self.assertEqual(self.client.get(reverse('api_products'), {'page': 2}).json()['total_pages'], 2)
+
+    def test_drf_viewset_cursor(self):
+        response = self.client.get('/api/v1/products/', {'ordering': 'price'})
+        data = response.json()
+        self.assertNotIn('count', data)
+        ids = [item['id'] for item in data['results']]
+        response = self.client.get(data['next'])
+        ids.extend(item['id'] for item in response.json()['results'])
+        self.assertIsNone(response.json()['next'])
+        self.assertEqual(ids, list(Product.objects.order_by('price', 'id').values_list('id', flat=True)))
+        self.assertEqual(self.client.get('/api/v1/products/', {'cursor': 'мусор'}).status_code, 404)
+
+    def test_order_history_load_more(self):
+        self.client.force_login(self.user)
+        orders = [
+            Order.objects.create(user=self.user, delivery_type='pickup', total_amount=Decimal('100.00'), payment_method='card')
+            for _ in range(12)
+        ]
+        for order in orders:
+            CashbackTransaction.objects.create(user=self.user, order=order, amount=Decimal('5.00'), transaction_type='earned', description='Начисление')
+
+        ids, data = self._walk(reverse('api_user_orders'), {}, 'orders')
+        self.assertEqual(ids, [order.id for order in reversed(orders)])
+        self.assertFalse(data['has_next'])
+
+        response = self.client.get(reverse('order_history'), {'status': 'created'})
+        self.assertEqual(len(response.context['orders']), 10)
+        self.assertEqual(response.context['total_orders'], 12)
+        next_url = response.context['next_page_url']
+        self.assertIn('status=created', next_url)
+        rows = self.client.get(next_url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').json()
+        self.assertIn(f'#{orders[0].id}', rows['html'])
+        self.assertIsNone(rows['next_url'])
+
+        response = self.client.get(reverse('cashback_history'))
+        self.assertEqual(len(response.context['transactions']), 10)
+        response = self.client.get(response.context['next_page_url'])
+        self.assertEqual(len(response.context['transactions']), 2)
+        self.assertEqual(response.context['first_page_url'], reverse('cashback_history'))
@@ -0,0 +1,188 @@
+"""
+Тесты единого расчёта стоимости корзины
+"""
+from decimal import Decimal
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Cart, Category, Favorite, FavoriteCategory, Product, PromoCode, Promotion, UserPromotion, Order
+from . import promo_cache
+from .pricing import price_cart, calculate_rule_discount
+
+User = get_user_model()
+
+
+class CartPricingTestCase(TestCase):
+    """Тесты для price_cart"""
+
+    def setUp(self):
+        promo_cache.clear_local_cache()
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        self.category = Category.objects.create(name='Молочные продукты', slug='dairy')
+        self.other_category = Category.objects.create(name='Хлеб', slug='bread')
+        self.products = [
+            Product.objects.create(
+                name=f'Товар {i}',
+                slug=f'product-{i}',
+                category=self.category if i % 2 else self.other_category,
+                price=Decimal('100.00'),
+                stock_quantity=50,
+            )
+            for i in range(6)
+        ]
+
+    def _fill_cart(self, count):
+        for product in self.products[:count]:
+            Cart.objects.create(user=self.user, product=product, quantity=2)
+
+    def test_empty_cart(self):
+        pricing = price_cart(self.user)
+        self.assertTrue(pricing.is_empty)
+        self.assertEqual(pricing.total, Decimal('0.00'))
+
+    def test_favorite_discounts(self):
+        self._fill_cart(2)  # product-0 (bread), product-1 (dairy)
+        FavoriteCategory.objects.create(user=self.user, category=self.category, discount_percent=10)
+        Favorite.objects.create(user=self.user, product=self.products[0])
+
+        pricing = price_cart(self.user)
+        self.assertEqual(pricing.subtotal, Decimal('400.00'))
+        self.assertEqual(pricing.favorite_discount_amount, Decimal('20.00'))
+        self.assertEqual(pricing.favorite_products_discount, Decimal('20.00'))
+        self.assertEqual(pricing.total_without_delivery, Decimal('360.00'))
+
+    def test_best_promotion_and_promo_code_priority(self):
+        self._fill_cart(1)
+        now = timezone.now()
+        small = Promotion.objects.create(
+            name='5%', discount_type='percentage', discount_value=5,
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1),
+        )
+        big = Promotion.objects.create(
+            name='50 ₽', discount_type='fixed', discount_value=50,
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1),
+        )
+        pricing = price_cart(self.user)
+        self.assertEqual(pricing.applied_promotion, big)
+        self.assertEqual(pricing.promotion_discount, Decimal('50.00'))
+
+        pricing = price_cart(self.user, promotion_id=str(small.id))
+        self.assertEqual(pricing.applied_promotion, small)
+        self.assertEqual(pricing.promotion_discount, Decimal('10.00'))
+
+        PromoCode.objects.create(
+            code='HALF', description='50%', discount_type='percent', discount_value=50,
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1), max_uses=10,
+        )
+        pricing = price_cart(self.user, promo_code='HALF')
+        self.assertIsNone(pricing.applied_promotion)
+        self.assertEqual(pricing.promotion_discount, Decimal('100.00'))
+
+        pricing = price_cart(self.user, promo_code='MISSING')
+        self.assertEqual(pricing.promo_message, 'Промокод не найден')
+        self.assertEqual(pricing.applied_promotion, big)
+
+    def test_used_promotion_is_skipped(self):
+        self._fill_cart(1)
+        now = timezone.now()
+        promo = Promotion.objects.create(
+            name='Разовая', discount_type='fixed', discount_value=30,
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1),
+        )
+        order = Order.objects.create(user=self.user, delivery_type='pickup', total_amount=100, payment_method='cash')
+        UserPromotion.objects.create(user=self.user, promotion=promo, order=order, discount_amount=30)
+        pricing = price_cart(self.user)
+        self.assertIsNone(pricing.applied_promotion)
+
+    def test_delivery_cost_threshold(self):
+        self._fill_cart(1)
+        pricing = price_cart(self.user, delivery_type='delivery')
+        self.assertEqual(pricing.delivery_cost, Decimal('200.00'))
+        self.assertEqual(pricing.total, Decimal('400.00'))
+        self.assertEqual(price_cart(self.user).delivery_cost, Decimal('0.00'))
+
+    def test_rule_discount_sweets(self):
+        sweets = Category.objects.create(name='Сладости', slug='sweets')
+        product = Product.objects.create(name='Конфеты', slug='candy', category=sweets, price=Decimal('40.00'))
+        item = Cart.objects.create(user=self.user, product=product, quantity=3)
+        self.assertEqual(calculate_rule_discount([item], []), Decimal('40.00'))
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        FavoriteCategory.objects.create(user=self.user, category=self.category)
+        self._fill_cart(1)
+        promo_cache.get_snapshot()
+        with CaptureQueriesContext(connection) as small_cart:
+            price_cart(User.objects.get(pk=self.user.pk))
+        Cart.objects.all().delete()
+        self._fill_cart(6)
+        with CaptureQueriesContext(connection) as big_cart:
+            price_cart(User.objects.get(pk=self.user.pk))
+        self.assertEqual(len(small_cart), len(big_cart))
+
+    def test_cart_summary_view(self):
+        self._fill_cart(2)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('cart_summary'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['subtotal'], 400.0)
+
+
+class PromoCacheTestCase(TestCase):
+    """Тесты для кеша акций и промо-правил"""
+
+    def setUp(self):
+        promo_cache.clear_local_cache()
+        self.now = timezone.now()
+
+    def _promotion(self, **kwargs):
+        defaults = {
+            'name': 'Акция',
+            'discount_type': 'fixed',
+            'discount_value': 10,
+            'start_date': self.now - timedelta(days=1),
+            'end_date': self.now + timedelta(days=1),
+        }
+        defaults.update(kwargs)
+        return Promotion.objects.create(**defaults)
+
+    def test_snapshot_is_served_without_queries(self):
+        self._promotion()
+        promo_cache.get_snapshot()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(promo_cache.active_promotions()), 1)
+
+    def test_invalidated_on_save_and_delete(self):
+        promo = self._promotion()
+        self.assertEqual(len(promo_cache.active_promotions()), 1)
+        self._promotion(name='Вторая')
+        self.assertEqual(len(promo_cache.active_promotions()), 2)
+        promo.delete()
+        self.assertEqual(len(promo_cache.active_promotions()), 1)
+
+    def test_expires_at_next_boundary(self):
+        ending = self._promotion(end_date=self.now + timedelta(hours=2))
+        starting = self._promotion(start_date=self.now + timedelta(hours=1), end_date=self.now + timedelta(days=3))
+        snapshot = promo_cache.get_snapshot()
+        self.assertEqual(snapshot.expires_at, starting.start_date)
+        self.assertEqual(snapshot.active_promotions(self.now), [ending])
+        self.assertFalse(snapshot.is_fresh(starting.start_date))
+
+    def test_register_promo_code_use_respects_max_uses(self):
+        code = PromoCode.objects.create(
+            code='ONCE', description='Разовый', discount_type='fixed', discount_value=10,
+            start_date=self.now - timedelta(days=1), end_date=self.now + timedelta(days=1), max_uses=1,
+        )
+        self.assertTrue(promo_cache.get_promo_code('ONCE').is_valid())
+        version = promo_cache._current_version()
+        self.assertTrue(promo_cache.register_promo_code_use(code))
+        self.assertFalse(promo_cache.register_promo_code_use(code))
+        # Использование промокода не сбрасывает снимок, счётчик читается из БД
+        self.assertEqual(promo_cache._current_version(), version)
+        self.assertFalse(promo_cache.get_promo_code('ONCE').is_valid())
+        self.assertEqual(promo_cache.get_snapshot().promo_codes['ONCE'].used_count, 0)
@@ -0,0 +1,170 @@
+"""
+Тесты маршрутизации чтений на реплику
+"""
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from . import db_routing
+from .db_routing import PRIMARY_ALIAS, REPLICA_ALIAS, REPLICA_PIN_COOKIE, ReplicaPinMiddleware, use_replica
+from .models import Category, Product
+
+User = get_user_model()
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(db_routing, 'replica_available', return_value=True)
+        self.available = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_outside_opt_in_stay_on_primary(self):
+        self.assertEqual(Product.objects.all().db, PRIMARY_ALIAS)
+        self.available.assert_not_called()
+
+    def test_reads_inside_use_replica_go_to_replica(self):
+        with use_replica():
+            self.assertEqual(Product.objects.all().db, REPLICA_ALIAS)
+            with use_replica():
+                self.assertEqual(Category.objects.all().db, REPLICA_ALIAS)
+            # Вложенный блок не снимает разрешение внешнего
+            self.assertEqual(Category.objects.all().db, REPLICA_ALIAS)
+        self.assertEqual(Product.objects.all().db, PRIMARY_ALIAS)
+
+    def test_decorator_enables_replica(self):
+        @db_routing.replica_reads
+        def view():
+            return Product.objects.all().db
+
+        self.assertEqual(view(), REPLICA_ALIAS)
+
+    def test_write_pins_rest_of_block_to_primary(self):
+        router = db_routing.ReplicaRouter()
+        with use_replica():
+            self.assertEqual(router.db_for_write(Product), PRIMARY_ALIAS)
+            self.assertEqual(Product.objects.all().db, PRIMARY_ALIAS)
+        with use_replica():
+            self.assertEqual(Product.objects.all().db, REPLICA_ALIAS)
+
+    def test_cache_and_sessions_never_read_from_replica(self):
+        from django.contrib.sessions.models import Session
+
+        with use_replica():
+            self.assertEqual(Session.objects.all().db, PRIMARY_ALIAS)
+
+    def test_migrations_are_not_applied_to_replica(self):
+        router = db_routing.ReplicaRouter()
+        self.assertFalse(router.allow_migrate(REPLICA_ALIAS, 'paint_shop_project'))
+        self.assertIsNone(router.allow_migrate(PRIMARY_ALIAS, 'paint_shop_project'))
+
+
+class ReplicaLagTests(SimpleTestCase):
+    def setUp(self):
+        db_routing.reset_lag_cache()
+        self.addCleanup(db_routing.reset_lag_cache)
+        patcher = mock.patch.object(db_routing, 'replica_configured', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _fake_connection(self, lag=None, error=None):
+        connection = mock.MagicMock(vendor='postgresql')
+        cursor = connection.cursor.return_value.__enter__.return_value
+        if error:
+            cursor.execute.side_effect = error
+        cursor.fetchone.return_value = (lag,)
+        return connection
+
+    def test_lag_is_checked_once_per_interval(self):
+        connection = self._fake_connection(lag=1.5)
+        with mock.patch.object(db_routing, 'connections', {REPLICA_ALIAS: connection}):
+            self.assertEqual(db_routing.replica_lag_seconds(), 1.5)
+            self.assertEqual(db_routing.replica_lag_seconds(), 1.5)
+        self.assertEqual(connection.cursor.call_count, 1)
+
+    @override_settings(REPLICA_MAX_LAG_SECONDS=10)
+    def test_lagging_replica_falls_back_to_primary(self):
+        with mock.patch.object(db_routing, 'connections', {REPLICA_ALIAS: self._fake_connection(lag=30)}):
+            with use_replica():
+                self.assertEqual(Product.objects.all().db, PRIMARY_ALIAS)
+
+    @override_settings(REPLICA_MAX_LAG_SECONDS=10)
+    def test_fresh_replica_is_used(self):
+        with mock.patch.object(db_routing, 'connections', {REPLICA_ALIAS: self._fake_connection(lag=2)}):
+            with use_replica():
+                self.assertEqual(Product.objects.all().db, REPLICA_ALIAS)
+
+    def test_unavailable_replica_falls_back_to_primary(self):
+        connection = self._fake_connection(error=DatabaseError('connection refused'))
+        with mock.patch.object(db_routing, 'connections', {REPLICA_ALIAS: connection}):
+            self.assertIsNone(db_routing.replica_lag_seconds())
+            with use_replica():
+                self.assertEqual(Product.objects.all().db, PRIMARY_ALIAS)
+
+
+class ReplicaPinMiddlewareTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        for name in ('replica_available', 'replica_configured'):
+            patcher = mock.patch.object(db_routing, name, return_value=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _run(self, request, write=False):
+        seen = {}
+
+        def view(request):
+            with use_replica():
+                if write:
+                    db_routing.ReplicaRouter().db_for_write(Product)
+                seen['db'] = Product.objects.all().db
+            return HttpResponse()
+
+        response = ReplicaPinMiddleware(view)(request)
+        return seen['db'], response
+
+    def test_plain_get_reads_replica_without_cookie(self):
+        db, response = self._run(self.factory.get('/'))
+        self.assertEqual(db, REPLICA_ALIAS)
+        self.assertNotIn(REPLICA_PIN_COOKIE, response.cookies)
+
+    def test_write_sets_pin_cookie(self):
+        db, response = self._run(self.factory.get('/'), write=True)
+        self.assertEqual(db, PRIMARY_ALIAS)
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+
+    def test_post_reads_primary_and_pins(self):
+        db, response = self._run(self.factory.post('/'))
+        self.assertEqual(db, PRIMARY_ALIAS)
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+
+    @override_settings(REPLICA_STICKY_SECONDS=15)
+    def test_pinned_client_reads_primary(self):
+        request = self.factory.get('/')
+        request.COOKIES[REPLICA_PIN_COOKIE] = '1'
+        db, _response = self._run(request)
+        self.assertEqual(db, PRIMARY_ALIAS)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ReplicaOptInViewsTests(TestCase):
+    """Отчетные страницы включают чтение с реплики, обычные — нет"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='testpass123', email='admin@example.com')
+        self.client.force_login(self.admin)
+
+    def test_dashboard_and_analytics_opt_in(self):
+        for url in (reverse('admin:dashboard'), reverse('analytics')):
+            with self.subTest(url=url), mock.patch.object(db_routing, 'replica_available', return_value=False) as available:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(available.called)
+
+    def test_regular_pages_do_not_touch_replica(self):
+        with mock.patch.object(db_routing, 'replica_available', return_value=False) as available:
+            self.client.get(reverse('home'))
+        available.assert_not_called()
@@ -0,0 +1,123 @@
+"""
+Тесты RFM-снимка клиентов
+"""
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .admin_views.rfm import RFMAnalysisView
+from .models import CustomerRFMSnapshot, Order
+from .rfm_snapshot import rebuild_rfm_snapshot, segment_stats
+from .tasks import rebuild_rfm_snapshot as rebuild_rfm_snapshot_task
+
+User = get_user_model()
+
+
+class RFMSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+
+    def _customer(self, username, orders, days_ago, amount, status='delivered'):
+        user = User.objects.create_user(username=username, password='testpass123')
+        for _ in range(orders):
+            order = Order.objects.create(user=user, total_amount=Decimal(amount), status=status)
+            Order.objects.filter(pk=order.pk).update(order_date=self.now - timedelta(days=days_ago))
+        return user
+
+    def _snapshot(self, user):
+        return CustomerRFMSnapshot.objects.get(user=user)
+
+    def test_scores_and_segments_computed_in_one_pass(self):
+        champion = self._customer('champion', orders=10, days_ago=3, amount='6000.00')
+        lost = self._customer('lost', orders=1, days_ago=200, amount='1000.00')
+        attention = self._customer('attention', orders=3, days_ago=100, amount='4000.00')
+        self._customer('undelivered', orders=2, days_ago=5, amount='3000.00', status='created')
+        staff = self._customer('staff', orders=1, days_ago=1, amount='1000.00')
+        staff.is_staff = True
+        staff.save()
+
+        self.assertEqual(rebuild_rfm_snapshot(self.now), 3)
+
+        snapshot = self._snapshot(champion)
+        self.assertEqual((snapshot.rfm_score, snapshot.segment), ('555', 'champions'))
+        self.assertEqual(snapshot.frequency, 10)
+        self.assertEqual(snapshot.monetary, Decimal('60000.00'))
+        self.assertEqual(snapshot.recency_days, 3)
+
+        self.assertEqual((self._snapshot(lost).rfm_score, self._snapshot(lost).segment), ('111', 'lost'))
+        self.assertEqual(
+            (self._snapshot(attention).rfm_score, self._snapshot(attention).segment), ('233', 'needs_attention'),
+        )
+
+    @override_settings(RFM_THRESHOLDS={'frequency': (4, 3, 2, 1)})
+    def test_thresholds_come_from_settings(self):
+        user = self._customer('buyer', orders=1, days_ago=3, amount='1000.00')
+        rebuild_rfm_snapshot(self.now)
+        self.assertEqual(self._snapshot(user).f_score, 2)
+
+    def test_rebuild_replaces_previous_snapshot(self):
+        user = self._customer('buyer', orders=1, days_ago=3, amount='1000.00')
+        rebuild_rfm_snapshot(self.now)
+        Order.objects.filter(user=user).update(status='cancelled')
+
+        result = rebuild_rfm_snapshot_task()
+
+        self.assertEqual(result, {'status': 'success', 'customers': 0})
+        self.assertFalse(CustomerRFMSnapshot.objects.exists())
+
+    def test_segment_stats_include_empty_segments(self):
+        self._customer('a', orders=10, days_ago=3, amount='6000.00')
+        self._customer('b', orders=10, days_ago=3, amount='5000.00')
+        rebuild_rfm_snapshot(self.now)
+
+        stats = segment_stats()
+
+        self.assertEqual(stats['champions']['count'], 2)
+        self.assertEqual(stats['champions']['total_revenue'], Decimal('110000.00'))
+        self.assertEqual(stats['champions']['avg_order_value'], Decimal('55000.00'))
+        self.assertEqual(stats['lost']['count'], 0)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class RFMAnalysisViewTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for index in range(5):
+            user = User.objects.create_user(username=f'buyer{index}', password='testpass123')
+            for _ in range(10):
+                Order.objects.create(user=user, total_amount=Decimal(6000 + index * 100), status='delivered')
+        rebuild_rfm_snapshot(now)
+        admin = User.objects.create_superuser(username='admin', password='testpass123', email='admin@example.com')
+        self.client.force_login(admin)
+        self.url = reverse('admin:rfm-analysis')
+
+    def test_overview_reads_only_segment_stats(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['segment_stats']['champions']['count'], 5)
+        self.assertIsNone(response.context['members_page'])
+        self.assertIsNotNone(response.context['computed_at'])
+
+    def test_segment_members_are_paginated_by_monetary(self):
+        with mock.patch.object(RFMAnalysisView, 'members_per_page', 2):
+            response = self.client.get(self.url, {'segment': 'champions'})
+            page = response.context['members_page']
+            self.assertEqual([member.user.username for member in page], ['buyer4', 'buyer3'])
+            self.assertTrue(page.has_next())
+
+            response = self.client.get(self.url, {'segment': 'champions', 'cursor': page.next_cursor})
+            self.assertEqual(
+                [member.user.username for member in response.context['members_page']], ['buyer2', 'buyer1'],
+            )
+
+    def test_unknown_segment_and_bad_cursor_are_ignored(self):
+        response = self.client.get(self.url, {'segment': 'nope'})
+        self.assertIsNone(response.context['members_page'])
+
+        response = self.client.get(self.url, {'segment': 'champions', 'cursor': 'garbage'})
+        self.assertEqual(len(response.context['members_page']), 5)
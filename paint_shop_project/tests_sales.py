@@ -0,0 +1,244 @@
+"""
+Тесты дневных агрегатов продаж
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    Category,
+    DailyCategorySalesRollup,
+    DailyProductSalesRollup,
+    DailySalesRollup,
+    DailyStoreSalesRollup,
+    Order,
+    OrderItem,
+    Product,
+    Store,
+)
+from .sales_rollups import daily_sales, period_totals, rebuild_sales_rollups, sales_totals
+
+User = get_user_model()
+
+
+class SalesRollupTestCase(TestCase):
+    """Инкрементальное обновление и пересборка агрегатов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        self.category = Category.objects.create(name='Хлеб', slug='bread')
+        self.products = [
+            Product.objects.create(
+                name=f'Товар {i}', slug=f'product-{i}', category=self.category, price=Decimal('100.00'),
+            )
+            for i in range(2)
+        ]
+        self.store = Store.objects.create(
+            name='Магазин', address='ул. Ленина, 1', phone='+70000000000',
+            working_hours='9-21', manager=self.user,
+        )
+        self.today = timezone.localdate()
+
+    def _order(self, status='created'):
+        # Агрегаты обновляются после фиксации транзакции — выполняем отложенные обработчики
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(
+                user=self.user, total_amount=Decimal('500.00'), fulfillment_store=self.store, status=status,
+            )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=self.products[0], quantity=2, price_per_unit=Decimal('100.00')),
+                OrderItem(order=order, product=self.products[1], quantity=3, price_per_unit=Decimal('100.00')),
+            ])
+        return order
+
+    def _set_status(self, order, status):
+        with self.captureOnCommitCallbacks(execute=True):
+            order.status = status
+            order.save()
+
+    def _snapshot(self):
+        return {
+            'days': list(DailySalesRollup.objects.order_by('date').values_list(
+                'date', 'orders_count', 'orders_revenue', 'delivered_orders', 'delivered_revenue',
+            )),
+            'stores': list(DailyStoreSalesRollup.objects.order_by('date', 'store').values_list(
+                'date', 'store', 'orders_count', 'delivered_orders', 'delivered_revenue',
+            )),
+            'products': list(DailyProductSalesRollup.objects.order_by('date', 'product').values_list(
+                'date', 'product', 'quantity', 'revenue', 'orders_count',
+            )),
+            'categories': list(DailyCategorySalesRollup.objects.order_by('date', 'category').values_list(
+                'date', 'category', 'quantity', 'revenue', 'orders_count',
+            )),
+        }
+
+    def test_placed_order_counted_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            Order.objects.create(user=self.user, total_amount=Decimal('500.00'), fulfillment_store=self.store)
+        # Внутри транзакции оформления строки агрегатов не блокируются
+        self.assertFalse(DailySalesRollup.objects.exists())
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(DailySalesRollup.objects.get(date=self.today).orders_count, 1)
+        self.assertEqual(DailyStoreSalesRollup.objects.get(store=self.store).orders_count, 1)
+
+    def test_status_transitions_update_rollups(self):
+        order = self._order()
+        day = DailySalesRollup.objects.get(date=self.today)
+        self.assertEqual((day.orders_count, day.delivered_orders), (1, 0))
+
+        self._set_status(order, 'delivered')
+
+        day.refresh_from_db()
+        self.assertEqual(day.delivered_orders, 1)
+        self.assertEqual(day.delivered_revenue, Decimal('500.00'))
+        self.assertEqual(DailyStoreSalesRollup.objects.get(store=self.store).delivered_revenue, Decimal('500.00'))
+        self.assertEqual(DailyProductSalesRollup.objects.get(product=self.products[1]).quantity, 3)
+        category = DailyCategorySalesRollup.objects.get(category=self.category)
+        self.assertEqual((category.quantity, category.revenue, category.orders_count), (5, Decimal('500.00'), 1))
+
+        self._set_status(order, 'cancelled')
+        day.refresh_from_db()
+        self.assertEqual((day.orders_count, day.delivered_orders, day.delivered_revenue), (1, 0, Decimal('0')))
+        self.assertEqual(DailyProductSalesRollup.objects.get(product=self.products[1]).quantity, 0)
+
+        order.delete()
+        day.refresh_from_db()
+        self.assertEqual((day.orders_count, day.orders_revenue), (0, Decimal('0')))
+
+    def test_rebuild_matches_incremental_updates(self):
+        for status in ('created', 'delivered', 'delivered'):
+            order = self._order()
+            if status == 'delivered':
+                self._set_status(order, status)
+        incremental = self._snapshot()
+
+        DailySalesRollup.objects.all().delete()
+        call_command('rebuild_sales_rollups', stdout=open('/dev/null', 'w'))
+
+        self.assertEqual(self._snapshot(), incremental)
+        self.assertEqual(sales_totals()['delivered_revenue'], Decimal('1000.00'))
+        self.assertEqual(rebuild_sales_rollups(start=self.today), 1)
+        self.assertEqual(self._snapshot(), incremental)
+
+    def test_dashboard_api_reads_rollups(self):
+        for _ in range(5):
+            order = self._order()
+            self._set_status(order, 'delivered')
+        staff = User.objects.create_user(username='admin', password='testpass123', is_staff=True)
+        self.client.force_login(staff)
+
+        # Количество запросов не зависит от числа заказов: читаются только строки агрегатов
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('admin:dashboard-api'), {'period': 365})
+
+        data = response.json()
+        self.assertEqual(data['daily'], [{'day': self.today.isoformat(), 'revenue': 2500.0, 'orders': 5}])
+        self.assertEqual(data['monthly'][0]['orders'], 5)
+        self.assertEqual(list(daily_sales())[0]['orders'], 5)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_dashboards_render_from_rollups(self):
+        order = self._order()
+        self._set_status(order, 'delivered')
+        admin = User.objects.create_superuser(username='admin', password='testpass123', email='admin@example.com')
+        self.client.force_login(admin)
+
+        response = self.client.get(reverse('admin:dashboard'))
+        self.assertEqual(response.context['total_revenue'], Decimal('500.00'))
+        self.assertEqual(response.context['top_products'][0]['quantity'], 3)
+
+        response = self.client.get(reverse('analytics'))
+        self.assertEqual(response.context['total_orders'], 1)
+        self.assertEqual(response.context['popular_categories'][0].order_count, 1)
+
+        response = self.client.get(reverse('manager_dashboard'))
+        self.assertEqual(response.context['total_revenue'], Decimal('500.00'))
+        self.assertEqual(response.context['store_statistics'][0]['delivered'], 1)
+
+    def test_period_totals_in_one_query(self):
+        order = self._order()
+        self._set_status(order, 'delivered')
+        self._order()
+        periods = {'total': None, 'today': self.today, 'tomorrow': self.today + timedelta(days=1)}
+
+        with self.assertNumQueries(1):
+            totals = period_totals(periods)
+        self.assertEqual(totals['total'], sales_totals())
+        self.assertEqual((totals['today']['orders_count'], totals['today']['delivered_revenue']), (2, Decimal('500.00')))
+        self.assertEqual(totals['tomorrow']['delivered_revenue'], Decimal('0'))
+
+        by_store = period_totals(periods, store_ids=[self.store.id], by_store=True)
+        self.assertEqual(by_store[self.store.id]['total'], sales_totals(store_ids=[self.store.id]))
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class ManagerDashboardTestCase(TestCase):
+    """Панель менеджера: фиксированное число запросов и снимок в кэше на менеджера"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.manager = User.objects.create_superuser(username='manager', password='testpass123', email='m@example.com')
+        self.buyer = User.objects.create_user(username='buyer', password='testpass123')
+        self.store = Store.objects.create(
+            name='Магазин', address='ул. Ленина, 1', phone='+70000000000',
+            working_hours='9-21', manager=self.manager,
+        )
+        self.other_store = Store.objects.create(
+            name='Другой', address='ул. Мира, 2', phone='+70000000001', working_hours='9-21',
+            manager=User.objects.create_user(username='other_manager', password='testpass123'),
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            for store, status in [
+                (self.store, 'delivered'), (self.store, 'created'), (self.store, 'in_transit'),
+                (self.other_store, 'created'),
+            ]:
+                order = Order.objects.create(user=self.buyer, total_amount=Decimal('300.00'), fulfillment_store=store)
+                if status != 'created':
+                    order.status = status
+                    order.save()
+
+    def test_dashboard_scoped_to_managed_stores(self):
+        from .staff_views import build_manager_dashboard
+
+        with self.assertNumQueries(11):
+            data = build_manager_dashboard(self.manager)
+
+        self.assertEqual((data['total_orders'], data['orders_today']), (3, 3))
+        self.assertEqual(data['total_revenue'], Decimal('300.00'))
+        self.assertEqual(data['avg_order_value'], Decimal('300.00'))
+        self.assertEqual((data['pending_orders'], data['in_transit_orders'], data['delivered_orders_count']), (1, 1, 1))
+        self.assertEqual(data['orders_by_status'][0]['count'], 1)
+        self.assertEqual(len(data['recent_orders']), 3)
+        stats = data['store_statistics']
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(
+            (stats[0]['orders_total'], stats[0]['pending'], stats[0]['in_transit'], stats[0]['delivered']), (3, 1, 1, 1),
+        )
+
+    def test_snapshot_is_cached_per_manager(self):
+        self.client.force_login(self.manager)
+        response = self.client.get(reverse('manager_dashboard'))
+        self.assertEqual(response.context['total_orders'], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.buyer, total_amount=Decimal('300.00'), fulfillment_store=self.store)
+        with self.assertNumQueries(3):  # сессия, пользователь и счетчик корзины в шапке
+            response = self.client.get(reverse('manager_dashboard'))
+        self.assertEqual(response.context['total_orders'], 3)
+        self.assertEqual(response.context['manager_name'], 'manager')
+
+        other = User.objects.create_superuser(username='other', password='testpass123', email='o@example.com')
+        self.client.force_login(other)
+        response = self.client.get(reverse('manager_dashboard'))
+        self.assertEqual(response.context['total_orders'], 5)
@@ -0,0 +1,178 @@
+"""
+Тесты поиска товаров
+"""
+from decimal import Decimal
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import product_suggest
+from .models import Category, Product, SearchHistory
+from .pagination import KeysetPaginator
+from .product_search import search_products, trigram_enabled
+
+IS_POSTGRES = connection.vendor == 'postgresql'
+
+User = get_user_model()
+
+
+class ProductSearchTestCase(TestCase):
+    """Поиск в каталоге, API и фильтре DRF"""
+
+    def setUp(self):
+        category = Category.objects.create(name='Молочные продукты', slug='dairy')
+        self.milk = Product.objects.create(
+            name='Молоко пастеризованное', slug='milk', category=category, price=Decimal('80.00'),
+            description='Цельное коровье',
+        )
+        self.cheese = Product.objects.create(
+            name='Сыр российский', slug='cheese', category=category, price=Decimal('450.00'),
+            description='Твердый сыр. Молоко коровье',
+        )
+        self.bread = Product.objects.create(
+            name='Хлеб ржаной', slug='bread', category=category, price=Decimal('50.00'),
+            description='На закваске',
+        )
+
+    def _search(self, query, **kwargs):
+        return list(search_products(Product.objects.all(), query, **kwargs))
+
+    def test_finds_by_name_and_description(self):
+        self.assertCountEqual(self._search('Молоко'), [self.milk, self.cheese])
+        self.assertEqual(self._search('ржаной'), [self.bread])
+        self.assertEqual(self._search('  '), list(Product.objects.all()))
+
+    def test_views_use_search(self):
+        response = self.client.get(reverse('product_list'), {'search': 'Хлеб'})
+        self.assertEqual(response.context['sort_by'], 'relevance')
+        self.assertEqual(list(response.context['products']), [self.bread])
+
+        response = self.client.get(reverse('api_products'), {'search': 'сыр', 'sort': 'relevance'})
+        self.assertEqual([item['id'] for item in response.json()['products']], [self.cheese.id])
+
+        response = self.client.get('/api/v1/products/', {'search': 'Молоко'})
+        self.assertCountEqual([item['id'] for item in response.json()['results']], [self.milk.id, self.cheese.id])
+
+    @skipUnless(IS_POSTGRES, 'полнотекстовый поиск доступен только в PostgreSQL')
+    def test_russian_word_forms_and_prefixes(self):
+        self.assertEqual(self._search('сыры'), [self.cheese])
+        self.assertCountEqual(self._search('молока'), [self.milk, self.cheese])
+        self.assertEqual(self._search('ржан хлеб'), [self.bread])
+        self.assertEqual(self._search('хлеба'), [self.bread])
+        self.assertEqual(self._search('!|&'), [])
+
+    @skipUnless(IS_POSTGRES, 'полнотекстовый поиск доступен только в PostgreSQL')
+    def test_name_match_ranks_above_description(self):
+        results = self._search('молоко', order_by_rank=True)
+        self.assertEqual(results, [self.milk, self.cheese])
+        self.assertGreater(results[0].search_rank, results[1].search_rank)
+
+        # search_vector пересчитывается триггером при изменении названия
+        self.bread.name = 'Хлеб молочный'
+        self.bread.save()
+        self.assertIn(self.bread, self._search('молочный'))
+
+    @skipUnless(IS_POSTGRES, 'полнотекстовый поиск доступен только в PostgreSQL')
+    def test_relevance_pages_by_cursor(self):
+        # search_rank переходит в курсор и обратно без потери точности
+        paginator = KeysetPaginator(search_products(Product.objects.all(), 'молоко'), ('-search_rank', 'name', 'id'), 1)
+        first = paginator.page()
+        second = paginator.page(first.next_cursor)
+        self.assertEqual([first[0], second[0]], [self.milk, self.cheese])
+        self.assertFalse(second.has_next())
+
+    @skipUnless(IS_POSTGRES, 'полнотекстовый поиск доступен только в PostgreSQL')
+    def test_typo_tolerance(self):
+        if not trigram_enabled():
+            self.skipTest('расширение pg_trgm не установлено')
+        self.assertIn(self.milk, self._search('малоко'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ProductSuggestTestCase(TestCase):
+    """Подсказки поиска из индекса в памяти"""
+
+    def setUp(self):
+        cache.clear()
+        product_suggest.reset()
+        self.addCleanup(product_suggest.reset)
+        self.category = Category.objects.create(name='Хлеб', slug='bread')
+        self.bread = Product.objects.create(name='Хлеб ржаной', slug='rye', category=self.category, price=Decimal('50.00'))
+        Product.objects.create(name='Хлебцы хрустящие', slug='crisp', category=self.category, price=Decimal('90.00'))
+        Product.objects.create(name='Хлеб белый', slug='white', category=self.category, price=Decimal('40.00'), is_active=False)
+        user = User.objects.create_user(username='buyer', password='testpass123')
+        SearchHistory.objects.bulk_create([SearchHistory(user=user, query=query) for query in ['хлеб бородинский', 'Хлеб  Бородинский', 'хлопья']])
+
+    def _texts(self, prefix):
+        return [item.text for item in product_suggest.suggest(prefix)]
+
+    def test_prefix_lookup(self):
+        self.assertEqual(self._texts('хлеб'), ['хлеб бородинский', 'Хлеб ржаной', 'Хлебцы хрустящие'])
+        self.assertEqual(self._texts('РЖАН'), ['Хлеб ржаной'])
+        # Запрос, встретившийся один раз, в подсказки не попадает; слишком короткий префикс — пусто
+        self.assertEqual(self._texts('хлоп'), [])
+        self.assertEqual(self._texts('х'), [])
+
+    def test_endpoint_does_not_touch_database(self):
+        url = reverse('product-suggest')
+        self.client.get(url, {'q': 'хл'})
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'q': 'ржа', 'limit': 5})
+        self.assertEqual(response.json()['suggestions'], [
+            {'text': 'Хлеб ржаной', 'type': 'product', 'product_id': self.bread.id},
+        ])
+
+    def test_index_follows_product_changes(self):
+        self.assertEqual(self._texts('ржан'), ['Хлеб ржаной'])
+        with self.captureOnCommitCallbacks(execute=True):
+            baton = Product.objects.create(name='Батон нарезной', slug='baton', category=self.category, price=Decimal('45.00'))
+            self.bread.is_active = False
+            self.bread.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self._texts('нарез'), ['Батон нарезной'])
+            self.assertEqual(self._texts('ржан'), [])
+
+        # Изменение в другом процессе: новая версия в кеше и товар с более поздним updated_at
+        Product.objects.filter(pk=baton.pk).update(name='Батон отрубной', updated_at=timezone.now())
+        cache.set(product_suggest.VERSION_KEY, 'other-process')
+        product_suggest._state['checked_at'] = 0.0
+        self.assertEqual(self._texts('отруб'), ['Батон отрубной'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            baton.delete()
+        self.assertEqual(self._texts('батон'), [])
+
+    def test_unchanged_name_keeps_index_and_version(self):
+        self.assertEqual(self._texts('ржан'), ['Хлеб ржаной'])
+        version = cache.get(product_suggest.VERSION_KEY)
+        # Пересчет рейтинга после отзыва не меняет ни название, ни активность
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bread.rating = Decimal('4.50')
+            self.bread.save()
+        self.assertEqual(cache.get(product_suggest.VERSION_KEY), version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bread.name = 'Хлеб ржаной заварной'
+            self.bread.save()
+        self.assertNotEqual(cache.get(product_suggest.VERSION_KEY), version)
+        self.assertEqual(self._texts('завар'), ['Хлеб ржаной заварной'])
+        self.assertEqual(len(product_suggest.get_index().products[self.bread.pk]), 3)
+
+    def test_deletions_from_other_processes(self):
+        self.assertEqual(self._texts('хлебц'), ['Хлебцы хрустящие'])
+        crisp = Product.objects.get(slug='crisp')
+        # Удаление в другом процессе: запись в журнале удаленных и новая версия
+        Product.objects.filter(pk=crisp.pk).delete()
+        product_suggest._record_deleted(crisp.pk)
+        product_suggest._record_deleted(self.bread.pk + 1000)
+        cache.set(product_suggest.VERSION_KEY, 'other-process')
+        product_suggest._state['checked_at'] = 0.0
+
+        self.assertEqual(self._texts('хлебц'), [])
+        self.assertEqual(product_suggest._state['deleted_seq'], 2)
+        self.assertEqual(product_suggest._read_deleted(0), ([crisp.pk, self.bread.pk + 1000], 2))
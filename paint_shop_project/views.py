@@ -10,10 +10,16 @@ from django.contrib import messages
 from django.http import JsonResponse
 from django.db.models import Q, Avg, Sum, Count
 from django.db.models.functions import Coalesce
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
-from .models import Category, Product, Promotion, UserPromotion, Cart, Order, OrderItem, User, Review, LoyaltyCard, LoyaltyTransaction, Favorite, SearchHistory, ViewHistory, PromoCode, Notification, EmployeeRating, FavoriteCategory, CashbackTransaction, SupportTicket, SupportResponse, SpecialSection, UserSpecialSection, Store, PhoneVerification, Payment, ErrorLog, OrderStatusHistory, PaymentMethod, PromoRule, UserAddress
+from .models import Category, Product, Promotion, Cart, Order, OrderItem, User, Review, LoyaltyCard, LoyaltyTransaction, Favorite, SearchHistory, ViewHistory, PromoCode, Notification, EmployeeRating, FavoriteCategory, CashbackTransaction, SupportTicket, SupportResponse, SpecialSection, UserSpecialSection, Store, PhoneVerification, Payment, ErrorLog, OrderStatusHistory, PaymentMethod, UserAddress
 from .notifications import send_order_confirmation
+from .pricing import price_cart, DEFAULT_DELIVERY_COST, FREE_DELIVERY_THRESHOLD
+from .order_service import place_order, OrderPlacementError, InsufficientStockError
+from .product_search import RELEVANCE_SORT, search_products
+from .pagination import InvalidCursor, KeysetPaginator
+from .db_routing import replica_reads
+from .cashback_ledger import get_balance as get_cashback_balance, get_summary as get_cashback_summary
 from django.contrib.auth.forms import UserCreationForm, PasswordResetForm
 from django.contrib.auth.views import PasswordResetView
 from django import forms
@@ -584,186 +590,25 @@ def cart_count_view(request):
         count = 0
     return JsonResponse({'count': count})
 
-@login_required
-def _calculate_cart_promotions(cart_items):
-    """Расширенная промо: 1+1 (сладости), mix&match (напитки) + PromoRule."""
-    from decimal import Decimal
-    extra_discount = Decimal('0')
-    # 1+1 для категории 'Сладости'
-    sweets_qs = [ci for ci in cart_items if getattr(ci.product.category, 'slug', '') == 'sweets']
-    for ci in sweets_qs:
-        free_units = ci.quantity // 2
-        if free_units > 0:
-            extra_discount += Decimal(str(ci.product.price)) * free_units
-    # mix&match: напитки — при суммарно >=3 единиц скидка 10% на напитки
-    beverages = [ci for ci in cart_items if getattr(ci.product.category, 'slug', '') == 'beverages']
-    beverages_qty = sum(ci.quantity for ci in beverages)
-    if beverages_qty >= 3:
-        beverages_subtotal = sum(Decimal(str(ci.total_price)) for ci in beverages)
-        extra_discount += beverages_subtotal * Decimal('0.10')
-
-    # Общие правила PromoRule (активные и по времени)
-    try:
-        from django.utils import timezone
-        now = timezone.now()
-        rules = PromoRule.objects.filter(is_active=True, start_date__lte=now, end_date__gte=now)
-        for rule in rules:
-            if rule.rule_type == 'n_for_m' and rule.category:
-                qty_sum = sum(ci.quantity for ci in cart_items if ci.product.category_id == rule.category_id)
-                if qty_sum >= max(rule.n, rule.m, 1):
-                    # Скидка = бесплатные единицы по самой дешёвой цене категории
-                    free_units = (qty_sum // max(rule.n, 1)) * max(rule.n - rule.m, 0)
-                    if free_units > 0:
-                        cat_items = [ci for ci in cart_items if ci.product.category_id == rule.category_id]
-                        unit_prices = []
-                        for ci in cat_items:
-                            unit_prices += [Decimal(str(ci.product.price))] * ci.quantity
-                        unit_prices.sort()  # самые дешёвые бесплатно
-                        extra_discount += sum(unit_prices[:free_units])
-            elif rule.rule_type == 'percent_category' and rule.category and rule.percent > 0:
-                cat_items = [ci for ci in cart_items if ci.product.category_id == rule.category_id]
-                qty_sum = sum(ci.quantity for ci in cat_items)
-                if qty_sum >= max(rule.min_qty, 1):
-                    cat_subtotal = sum(Decimal(str(ci.total_price)) for ci in cat_items)
-                    extra_discount += cat_subtotal * Decimal(str(rule.percent/100))
-    except Exception:
-        pass
-    return extra_discount
-
-
 def cart_summary_view(request):
     """Возвращает актуальные суммы корзины с учетом скидок и ожидаемый кешбэк"""
     logger.debug("cart_summary_view user=%s", getattr(request.user, 'id', None))
-    cart_items = Cart.objects.filter(user=request.user)
-    subtotal = sum(item.total_price for item in cart_items)
-    # Скидка любимых категорий
-    favorite_discount_amount = 0.0
-    try:
-        for item in cart_items:
-            discount_percent = 0
-            if hasattr(request.user, 'get_favorite_categories_discount'):
-                discount_percent = request.user.get_favorite_categories_discount(item.product.category)
-            if discount_percent and discount_percent > 0:
-                favorite_discount_amount += float(item.total_price) * float(discount_percent) / 100.0
-    except Exception:
-        favorite_discount_amount = 0.0
-    favorite_discount_amount = round(favorite_discount_amount, 2)
-
-    # Скидка 10% на любимые товары (максимум 4)
-    favorite_products_discount = 0.0
-    try:
-        from .models import Favorite
-        user_favorite_product_ids = set(Favorite.objects.filter(user=request.user).values_list('product_id', flat=True))
-        for item in cart_items:
-            if item.product.id in user_favorite_product_ids:
-                # Скидка 10% на любимые товары
-                favorite_products_discount += float(item.total_price) * 0.10
-    except Exception:
-        favorite_products_discount = 0.0
-    favorite_products_discount = round(favorite_products_discount, 2)
-
-    # Лучшая активная акция (оценочно)
-    from django.utils import timezone
-    active_promotions = Promotion.objects.filter(is_active=True, start_date__lte=timezone.now(), end_date__gte=timezone.now())
-    promotion_discount = 0.0
-    for promo in active_promotions:
-        try:
-            disc = float(promo.calculate_discount(max(float(subtotal) - favorite_discount_amount - favorite_products_discount, 0.0)))
-            promotion_discount = max(promotion_discount, disc)
-        except Exception:
-            pass
-    # Доп. промо: 1+1 и mix&match
-    try:
-        extra_disc = float(_calculate_cart_promotions(cart_items))
-    except Exception:
-        extra_disc = 0.0
-    total_after_discounts = max(float(subtotal) - favorite_discount_amount - favorite_products_discount - promotion_discount - extra_disc, 0.0)
-
-    # Ожидаемый кешбэк
-    expected_cashback = 0.0
-    try:
-        loyalty_card = getattr(request.user, 'loyalty_card', None)
-        if loyalty_card:
-            expected_cashback = float(loyalty_card.calculate_cashback(total_after_discounts))
-    except Exception:
-        expected_cashback = 0.0
-
-    data = {
-        'subtotal': round(float(subtotal), 2),
-        'favorite_discount_amount': round(float(favorite_discount_amount), 2),
-        'favorite_products_discount': round(float(favorite_products_discount), 2),
-        'promotion_discount': round(float(promotion_discount + extra_disc), 2),
-        'total_after_discounts': round(float(total_after_discounts), 2),
-        'expected_cashback': round(float(expected_cashback), 2),
-    }
+    data = price_cart(request.user).as_summary()
     logger.debug("cart_summary_view result=%s", data)
     return JsonResponse(data)
 
 @login_required
 def cart_view(request):
-    cart_items = Cart.objects.filter(user=request.user)
-    subtotal = sum(item.total_price for item in cart_items)
-    # Скидка по любимым категориям и ожидаемый кешбэк
-    favorite_discount_amount = 0.0
-    try:
-        for item in cart_items:
-            discount_percent = 0
-            if hasattr(request.user, 'get_favorite_categories_discount'):
-                discount_percent = request.user.get_favorite_categories_discount(item.product.category)
-            if discount_percent and discount_percent > 0:
-                favorite_discount_amount += float(item.total_price) * float(discount_percent) / 100.0
-    except Exception:
-        favorite_discount_amount = 0.0
-    favorite_discount_amount = round(favorite_discount_amount, 2)
-
-    # Скидка 10% на любимые товары (максимум 4)
-    favorite_products_discount = 0.0
-    try:
-        from .models import Favorite
-        user_favorite_product_ids = set(Favorite.objects.filter(user=request.user).values_list('product_id', flat=True))
-        for item in cart_items:
-            if item.product.id in user_favorite_product_ids:
-                # Скидка 10% на любимые товары
-                favorite_products_discount += float(item.total_price) * 0.10
-    except Exception:
-        favorite_products_discount = 0.0
-    favorite_products_discount = round(favorite_products_discount, 2)
-
-    # Акции (без промокода на корзине: просто показать ориентировочно лучшую)
-    from django.utils import timezone
-    active_promotions = Promotion.objects.filter(is_active=True, start_date__lte=timezone.now(), end_date__gte=timezone.now())
-    promotion_discount = 0.0
-    for promo in active_promotions:
-        try:
-            disc = float(promo.calculate_discount(max(float(subtotal) - favorite_discount_amount - favorite_products_discount, 0.0)))
-            promotion_discount = max(promotion_discount, disc)
-        except Exception:
-            pass
-    # Доп. промо: 1+1 и mix&match
-    try:
-        extra_disc = float(_calculate_cart_promotions(cart_items))
-    except Exception:
-        extra_disc = 0.0
-    total_after_discounts = max(float(subtotal) - favorite_discount_amount - favorite_products_discount - promotion_discount - extra_disc, 0.0)
-
-    # Ожидаемый кешбэк
-    expected_cashback = 0
-    try:
-        loyalty_card = getattr(request.user, 'loyalty_card', None)
-        if loyalty_card:
-            expected_cashback = float(loyalty_card.calculate_cashback(total_after_discounts))
-    except Exception:
-        expected_cashback = 0
-
+    pricing = price_cart(request.user)
     context = {
-        'cart_items': cart_items,
-        'total': subtotal,
-        'cart_total': subtotal,
-        'favorite_discount_amount': favorite_discount_amount,
-        'favorite_products_discount': favorite_products_discount,
-        'promotion_discount': round(promotion_discount + extra_disc, 2),
-        'total_after_discounts': total_after_discounts,
-        'expected_cashback': expected_cashback,
+        'cart_items': pricing.items,
+        'total': pricing.subtotal,
+        'cart_total': pricing.subtotal,
+        'favorite_discount_amount': pricing.favorite_discount_amount,
+        'favorite_products_discount': pricing.favorite_products_discount,
+        'promotion_discount': pricing.total_promotion_discount,
+        'total_after_discounts': pricing.total_without_delivery,
+        'expected_cashback': pricing.expected_cashback,
     }
     return render(request, 'paint_shop_project/cart.html', context)
 
@@ -900,111 +745,23 @@ def remove_from_cart(request, cart_id):
 
 @login_required
 def checkout_view(request):
-    cart_items = Cart.objects.filter(user=request.user)
-    if not cart_items.exists():
-        messages.warning(request, 'Ваша корзина пуста!')
-        return redirect('cart')
-    
-    subtotal = sum(item.total_price for item in cart_items)
-    # Скидка по любимым категориям
-    favorite_discount_amount = 0.0
-    try:
-        for item in cart_items:
-            discount_percent = 0
-            if hasattr(request.user, 'get_favorite_categories_discount'):
-                discount_percent = request.user.get_favorite_categories_discount(item.product.category)
-            if discount_percent and discount_percent > 0:
-                favorite_discount_amount += float(item.total_price) * float(discount_percent) / 100.0
-    except Exception:
-        favorite_discount_amount = 0.0
-    favorite_discount_amount = round(favorite_discount_amount, 2)
-    
-    # Скидка 10% на любимые товары (максимум 4)
-    favorite_products_discount = 0.0
-    try:
-        from .models import Favorite
-        user_favorite_product_ids = set(Favorite.objects.filter(user=request.user).values_list('product_id', flat=True))
-        for item in cart_items:
-            if item.product.id in user_favorite_product_ids:
-                # Скидка 10% на любимые товары
-                favorite_products_discount += float(item.total_price) * 0.10
-    except Exception:
-        favorite_products_discount = 0.0
-    favorite_products_discount = round(favorite_products_discount, 2)
-
-    # Применяем промокод, если задан, иначе лучшую действующую акцию к промежуточной сумме (после любимых категорий)
-    from django.utils import timezone
-    active_promotions = Promotion.objects.filter(is_active=True, start_date__lte=timezone.now(), end_date__gte=timezone.now())
-    # Одноразовые: исключим уже использованные пользователем
-    try:
-        used_ids = set(UserPromotion.objects.filter(user=request.user).values_list('promotion_id', flat=True)) if request.user.is_authenticated else set()
-        active_promotions = active_promotions.exclude(id__in=used_ids)
-    except Exception:
-        pass
-    promotion_discount = 0.0
-    applied_promotion = None
-    applied_promo_code = None
-    promo_message = None
-    base_for_promo = max(float(subtotal) - favorite_discount_amount - favorite_products_discount, 0.0)
-    # Принудительное применение промокода, если передан
-    promo_code_value = request.GET.get('promo_code') or None
-    if promo_code_value:
-        try:
-            promo_code_obj = PromoCode.objects.get(code=promo_code_value)
-            if promo_code_obj.is_valid() and base_for_promo >= float(promo_code_obj.min_order_amount):
-                if promo_code_obj.discount_type == 'percent':
-                    promotion_discount = float(base_for_promo) * float(promo_code_obj.discount_value) / 100.0
-                else:
-                    promotion_discount = min(float(promo_code_obj.discount_value), float(base_for_promo))
-                applied_promo_code = promo_code_obj
-            else:
-                promo_message = 'Промокод недействителен или не подходит по сумме заказа'
-        except PromoCode.DoesNotExist:
-            promo_message = 'Промокод не найден'
-    
-    # Если промокод не применён, применяем выбранную пользователем акцию (либо ничего)
-    selected_promotion_id = request.GET.get('promotion_id')
-    if not applied_promo_code:
-        if selected_promotion_id:
-            try:
-                sp = active_promotions.get(id=int(selected_promotion_id))
-                promotion_discount = float(sp.calculate_discount(base_for_promo))
-                applied_promotion = sp
-            except Exception:
-                applied_promotion = None
-                promotion_discount = 0.0
-        else:
-            promotion_discount = 0.0
-            applied_promotion = None
-
-    # Стоимость доставки по умолчанию для отображения (переключается на фронте)
-    # Бесплатная доставка от 5000 (после скидок)
-    FREE_DELIVERY_THRESHOLD = 5000
-    default_delivery_cost = 200
-
-    total_without_delivery = max(base_for_promo - promotion_discount, 0.0)
-    
     # Определяем тип доставки из GET параметров или по умолчанию самовывоз
     selected_delivery_type = request.GET.get('delivery_type', 'pickup')
-    
-    # Отображаемый итог: для самовывоза доставка = 0, для доставки зависит от порога
-    if selected_delivery_type == 'delivery':
-        delivery_display_cost = 0 if total_without_delivery >= FREE_DELIVERY_THRESHOLD else default_delivery_cost
-    else:
-        delivery_display_cost = 0  # Самовывоз - бесплатно
-    
-    total = total_without_delivery + delivery_display_cost
+    pricing = price_cart(
+        request.user,
+        promo_code=request.GET.get('promo_code') or None,
+        promotion_id=request.GET.get('promotion_id') or None,
+        delivery_type=selected_delivery_type,
+    )
+    if pricing.is_empty:
+        messages.warning(request, 'Ваша корзина пуста!')
+        return redirect('cart')
 
     # Список акций с потенциальной экономией
-    promotions_with_saving = []
-    for promo in active_promotions:
-        try:
-            promotions_with_saving.append({
-                'promo': promo,
-                'saving': float(promo.calculate_discount(base_for_promo))
-            })
-        except Exception:
-            promotions_with_saving.append({'promo': promo, 'saving': 0.0})
+    promotions_with_saving = [
+        {'promo': promo, 'saving': float(saving)}
+        for promo, saving in pricing.available_promotions
+    ]
 
     # Адреса пользователя и тайм-слоты
     user_addresses = []
@@ -1035,40 +792,31 @@ def checkout_view(request):
     # Баланс кешбэка пользователя
     cashback_balance = 0
     try:
-        from .models import CashbackTransaction
-        total_earned = CashbackTransaction.objects.filter(
-            user=request.user, 
-            transaction_type='earned'
-        ).aggregate(total=models.Sum('amount'))['total'] or 0
-        total_spent = CashbackTransaction.objects.filter(
-            user=request.user, 
-            transaction_type='spent'
-        ).aggregate(total=models.Sum('amount'))['total'] or 0
-        cashback_balance = float(total_earned - total_spent)
+        cashback_balance = float(get_cashback_balance(request.user))
     except Exception:
         cashback_balance = 0
 
     logger.info("checkout_view user=%s promo_code=%s promotion_id=%s delivery_type=%s", getattr(request.user,'id',None), request.GET.get('promo_code'), request.GET.get('promotion_id'), selected_delivery_type)
     context = {
-        'cart_items': cart_items,
-        'total': subtotal,
-        'favorite_discount_amount': favorite_discount_amount,
-        'favorite_products_discount': favorite_products_discount,
-        'promotion_discount': round(promotion_discount, 2),
-        'applied_promotion': applied_promotion,
-        'applied_promo_code': applied_promo_code,
-        'promo_message': promo_message,
-        'total_without_delivery': total_without_delivery,
-        'default_delivery_cost': default_delivery_cost,
+        'cart_items': pricing.items,
+        'total': pricing.subtotal,
+        'favorite_discount_amount': pricing.favorite_discount_amount,
+        'favorite_products_discount': pricing.favorite_products_discount,
+        'promotion_discount': pricing.total_promotion_discount,
+        'applied_promotion': pricing.applied_promotion,
+        'applied_promo_code': pricing.applied_promo_code,
+        'promo_message': pricing.promo_message,
+        'total_without_delivery': pricing.total_without_delivery,
+        'default_delivery_cost': DEFAULT_DELIVERY_COST,
         'free_delivery_threshold': FREE_DELIVERY_THRESHOLD,
-        'computed_total': total,
+        'computed_total': pricing.total,
         'promotions_with_saving': promotions_with_saving,
         'user_addresses': user_addresses,
         'default_address': default_address,
         'cashback_balance': cashback_balance,
         'delivery_slots': delivery_slots,
-        'delivery_display_cost': delivery_display_cost,
-        'selected_promotion_id': int(selected_promotion_id) if selected_promotion_id else None,
+        'delivery_display_cost': pricing.delivery_cost,
+        'selected_promotion_id': pricing.applied_promotion.id if pricing.applied_promotion else None,
         'payment_methods': payment_methods,
         'selected_delivery_type': selected_delivery_type,  # Добавляем выбранный тип доставки
     }
@@ -1091,8 +839,15 @@ def create_order(request):
                 messages.error(request, 'Для онлайн-оплаты используйте процесс оплаты на странице оформления заказа.')
                 return redirect('checkout')
         
-        cart_items = Cart.objects.filter(user=request.user)
-        if not cart_items.exists():
+        delivery_type = request.POST.get('delivery_type', 'pickup')
+        pricing = price_cart(
+            request.user,
+            promo_code=request.POST.get('promo_code') or None,
+            promotion_id=request.POST.get('promotion_id') or None,
+            delivery_type=delivery_type,
+        )
+        cart_items = pricing.items
+        if pricing.is_empty:
             messages.warning(request, 'Ваша корзина пуста!')
             return redirect('cart')
         
@@ -1115,8 +870,6 @@ def create_order(request):
                 messages.error(request, f'Следующие товары закончились: {", ".join(unavailable_products)}')
                 return redirect('cart')
         
-        subtotal = sum(item.total_price for item in cart_items)
-        delivery_type = request.POST.get('delivery_type', 'pickup')
         delivery_address = request.POST.get('delivery_address', '')
         delivery_entrance = request.POST.get('delivery_entrance', '')
         delivery_apartment = request.POST.get('delivery_apartment', '')
@@ -1130,98 +883,7 @@ def create_order(request):
         fulfillment_store_id = request.POST.get('fulfillment_store_id')
         delivery_slot_id = request.POST.get('delivery_slot_id')
         
-        # Добавляем стоимость доставки если выбрана доставка
-        # Бесплатная доставка от 5000 (будет пересчитано после применения скидок)
-        FREE_DELIVERY_THRESHOLD = 5000
-
-        # Скидка по любимым категориям (как на checkout)
-        favorite_discount_amount = 0.0
-        try:
-            for item in cart_items:
-                discount_percent = 0
-                if hasattr(request.user, 'get_favorite_categories_discount'):
-                    discount_percent = request.user.get_favorite_categories_discount(item.product.category)
-                if discount_percent and discount_percent > 0:
-                    favorite_discount_amount += float(item.total_price) * float(discount_percent) / 100.0
-        except Exception:
-            favorite_discount_amount = 0.0
-        favorite_discount_amount = round(favorite_discount_amount, 2)
-        
-        # Скидка 10% на любимые товары (максимум 4)
-        favorite_products_discount = 0.0
-        try:
-            from .models import Favorite
-            user_favorite_product_ids = set(Favorite.objects.filter(user=request.user).values_list('product_id', flat=True))
-            for item in cart_items:
-                if item.product.id in user_favorite_product_ids:
-                    # Скидка 10% на любимые товары
-                    favorite_products_discount += float(item.total_price) * 0.10
-        except Exception:
-            favorite_products_discount = 0.0
-        favorite_products_discount = round(favorite_products_discount, 2)
-
-        # Промокод/акции
-        from django.utils import timezone
-        active_promotions = Promotion.objects.filter(is_active=True, start_date__lte=timezone.now(), end_date__gte=timezone.now())
-        # Одноразовые: исключим уже использованные пользователем
-        try:
-            used_ids = set(UserPromotion.objects.filter(user=request.user).values_list('promotion_id', flat=True)) if request.user.is_authenticated else set()
-            active_promotions = active_promotions.exclude(id__in=used_ids)
-        except Exception:
-            pass
-        promotion_discount = 0.0
-        applied_promotion = None
-        applied_promo_code = None
-        base_for_promo = max(float(subtotal) - favorite_discount_amount - favorite_products_discount, 0.0)
-        promo_code_value = request.POST.get('promo_code') or None
-        # Промокод имеет приоритет
-        if promo_code_value:
-            try:
-                promo_code_obj = PromoCode.objects.get(code=promo_code_value)
-                if promo_code_obj.is_valid() and base_for_promo >= float(promo_code_obj.min_order_amount):
-                    if promo_code_obj.discount_type == 'percent':
-                        promotion_discount = float(base_for_promo) * float(promo_code_obj.discount_value) / 100.0
-                    else:
-                        promotion_discount = min(float(promo_code_obj.discount_value), float(base_for_promo))
-                    applied_promo_code = promo_code_obj
-                    # увеличиваем использований
-                    try:
-                        promo_code_obj.used_count = (promo_code_obj.used_count or 0) + 1
-                        promo_code_obj.save(update_fields=['used_count'])
-                    except Exception:
-                        pass
-                # иначе упадём на авто-акции ниже
-            except PromoCode.DoesNotExist:
-                pass
-        for promo in active_promotions:
-            try:
-                disc = float(promo.calculate_discount(base_for_promo))
-                if disc > promotion_discount and not applied_promo_code:
-                    promotion_discount = disc
-                    applied_promotion = promo
-            except Exception:
-                pass
-        # Доп. промо (1+1, mix&match)
-        try:
-            extra_disc = float(_calculate_cart_promotions(cart_items))
-            promotion_discount += extra_disc
-        except Exception:
-            pass
-
-        total_without_delivery = max(base_for_promo - promotion_discount, 0.0)
-        
-        # Расчет стоимости доставки
-        if delivery_type == 'delivery':
-            # Бесплатная доставка от 5000 (после скидок)
-            if total_without_delivery >= FREE_DELIVERY_THRESHOLD:
-                delivery_cost = 0
-            else:
-                delivery_cost = 200
-        else:
-            # Самовывоз - доставка бесплатна
-            delivery_cost = 0
-        
-        final_total = total_without_delivery + float(delivery_cost)
+        final_total = float(pricing.total)
         
         # Обработка использования кешбэка (чекбокс, не способ оплаты)
         cashback_used = 0
@@ -1229,17 +891,9 @@ def create_order(request):
         logger.info("create_order cashback: use_cashback=%s checkbox_value=%s", use_cashback, request.POST.get('use_cashback'))
         if use_cashback:
             try:
-                from .models import CashbackTransaction
-                from decimal import Decimal
-                total_earned = CashbackTransaction.objects.filter(
-                    user=request.user, 
-                    transaction_type='earned'
-                ).aggregate(total=models.Sum('amount'))['total'] or 0
-                total_spent = CashbackTransaction.objects.filter(
-                    user=request.user, 
-                    transaction_type='spent'
-                ).aggregate(total=models.Sum('amount'))['total'] or 0
-                cashback_balance = Decimal(str(total_earned - total_spent))
+                # Предварительная проверка; окончательно списание проверяется в place_order
+                # под блокировкой строки баланса
+                cashback_balance = get_cashback_balance(request.user)
                 
                 if cashback_balance <= 0:
                     error_msg = f"create_order CASHBACK ERROR: Недостаточно средств на балансе кешбэка. balance={cashback_balance}"
@@ -1313,25 +967,13 @@ def create_order(request):
                 messages.error(request, 'Ошибка при использовании кешбэка')
                 return redirect('checkout')
         
-        # Определяем магазин комплектации и слот (если доставка)
+        # Определяем магазин комплектации (слот доставки бронируется при оформлении заказа)
         fulfillment_store = None
-        selected_slot = None
         if fulfillment_store_id:
             try:
                 fulfillment_store = Store.objects.get(id=int(fulfillment_store_id))
             except Exception:
                 fulfillment_store = None
-        if delivery_type == 'delivery' and delivery_slot_id:
-            from .models import DeliverySlot
-            try:
-                selected_slot = DeliverySlot.objects.select_for_update().get(id=int(delivery_slot_id))
-                if not selected_slot.available:
-                    messages.error(request, 'Выбранный слот доставки недоступен')
-                    return redirect('checkout')
-            except DeliverySlot.DoesNotExist:
-                messages.error(request, 'Слот доставки не найден')
-                logger.warning("create_order slot_not_found user=%s slot=%s", request.user.id, delivery_slot_id)
-                return redirect('checkout')
 
         # Адрес: выбрать сохраненный или сохранить новый (только для доставки)
         if delivery_type == 'delivery':
@@ -1383,71 +1025,6 @@ def create_order(request):
             except Exception as e:
                 logger.warning("create_order failed to save address: %s", e)
 
-        # Проверяем доступность товаров с учетом партий и правила 70% срока годности
-        from django.utils import timezone
-        from .models import ProductBatch
-        today = timezone.now().date()
-        unavailable_products = []
-        
-        for cart_item in cart_items.select_related('product'):
-            product = cart_item.product
-            
-            # Для товаров с партиями проверяем доступность по партиям
-            if product.has_expiry_date:
-                # Ищем доступные партии с правилом 70%
-                available_batches = ProductBatch.objects.filter(
-                    product=product,
-                    expiry_date__gte=today,
-                    remaining_quantity__gte=cart_item.quantity
-                )
-                
-                # Фильтруем по правилу 70%
-                sellable_batches = [b for b in available_batches if b.is_sellable(min_percent=70)]
-                
-                if not sellable_batches:
-                    # Проверяем, есть ли вообще партии
-                    all_batches = ProductBatch.objects.filter(product=product)
-                    if all_batches.exists():
-                        unavailable_products.append(
-                            f"{product.name} (нет доступных партий с минимум 70% срока годности, требуется {cart_item.quantity})"
-                        )
-                    else:
-                        # Если партий нет, проверяем старое поле stock_quantity
-                        if product.stock_quantity is not None and product.stock_quantity < cart_item.quantity:
-                            unavailable_products.append(
-                                f"{product.name} (доступно {product.stock_quantity}, требуется {cart_item.quantity})"
-                            )
-                else:
-                    # Проверяем, достаточно ли остатка в доступных партиях
-                    total_available = sum(b.remaining_quantity for b in sellable_batches)
-                    if total_available < cart_item.quantity:
-                        unavailable_products.append(
-                            f"{product.name} (доступно {total_available} в пригодных партиях, требуется {cart_item.quantity})"
-                        )
-            else:
-                # Для товаров без срока годности проверяем только stock_quantity
-                if product.stock_quantity is not None and product.stock_quantity < cart_item.quantity:
-                    unavailable_products.append(
-                        f"{product.name} (доступно {product.stock_quantity}, требуется {cart_item.quantity})"
-                    )
-        
-        # Если есть недоступные товары - отменяем заказ
-        if unavailable_products:
-            messages.error(request, 
-                f'Невозможно оформить заказ:\n' + 
-                '\n'.join([f"- {p}" for p in unavailable_products])
-            )
-            return redirect('cart')
-        
-        # Создаем заказ только после всех проверок
-        # Если использован кешбэк, сохраняем исходную сумму в total_amount (до списания кешбэка)
-        # для корректного отображения и расчета прогресса лояльности
-        from decimal import Decimal
-        order_total = final_total
-        if use_cashback and cashback_used > 0:
-            # Восстанавливаем исходную сумму заказа (до списания кешбэка)
-            order_total = float(Decimal(str(final_total)) + Decimal(str(cashback_used)))
-        
         # Финальная проверка адреса перед созданием заказа
         if delivery_type == 'delivery' and (not delivery_address or not delivery_address.strip()):
             error_msg = f"create_order DELIVERY ERROR: Адрес потерян перед созданием заказа! delivery_type={delivery_type} delivery_address='{delivery_address}' selected_address_id={selected_address_id} POST data: {dict(request.POST)}"
@@ -1456,105 +1033,36 @@ def create_order(request):
             messages.error(request, 'Ошибка: адрес доставки не был сохранен. Попробуйте еще раз.')
             return redirect('checkout')
         
+        # Создаем заказ: остатки, слот, позиции, акции, кешбэк и корзина меняются в одной транзакции
+        # (в total_amount сохраняется исходная сумма до списания кешбэка — для прогресса лояльности)
         logger.info("create_order creating order: user=%s delivery_type=%s delivery_address=%s entrance=%s apartment=%s floor=%s total_amount=%.2f payment_method=%s cashback_used=%.2f use_cashback=%s selected_address_id=%s", 
-                    request.user.id, delivery_type, delivery_address, delivery_entrance, delivery_apartment, delivery_floor, order_total, payment_method, float(cashback_used), use_cashback, selected_address_id)
-        order = Order.objects.create(
-            user=request.user,
-            delivery_type=delivery_type,
-            delivery_address=delivery_address,
-            total_amount=order_total,
-            payment_method=payment_method,
-            favorite_discount_amount=favorite_discount_amount,
-            promotion_discount=promotion_discount,
-            delivery_cost=delivery_cost,
-            fulfillment_store=fulfillment_store,
-            delivery_slot=selected_slot,
-            comment=delivery_comment,
-            cashback_used=cashback_used,
-            amount_due=Decimal(str(final_total))
-        )
-        logger.info("create_order created user=%s order=%s total=%.2f final_total=%.2f cashback_used=%.2f delivery_address=%s", 
-                    request.user.id, order.id, order_total, final_total, float(cashback_used), order.delivery_address)
-        
-        # Проверка, что адрес сохранился в заказе
-        if delivery_type == 'delivery' and (not order.delivery_address or not order.delivery_address.strip()):
-            error_msg = f"create_order DELIVERY ERROR: Адрес не сохранился в заказе! order_id={order.id} order.delivery_address='{order.delivery_address}'"
-            logger.error(error_msg)
-            print(f"\n{'='*80}\n{error_msg}\n{'='*80}\n")
-        
-        # Создаем запись о сборке заказа
-        from .models import OrderPicking, OrderDelivery
-        OrderPicking.objects.create(order=order, status='pending')
-        
-        # Если заказ с доставкой, создаем запись о доставке
-        if delivery_type == 'delivery':
-            OrderDelivery.objects.create(order=order, status='pending')
-
-        # Запишем использованную акцию
-        if applied_promotion and promotion_discount > 0:
-            try:
-                UserPromotion.objects.create(
-                    user=request.user,
-                    promotion=applied_promotion,
-                    order=order,
-                    discount_amount=promotion_discount,
-                )
-            except Exception:
-                pass
-        
-        # Создаем позиции заказа
-        for cart_item in cart_items.select_related('product'):
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                quantity=cart_item.quantity,
-                price_per_unit=cart_item.product.price
+                    request.user.id, delivery_type, delivery_address, delivery_entrance, delivery_apartment, delivery_floor, float(pricing.total), payment_method, float(cashback_used), use_cashback, selected_address_id)
+        try:
+            order = place_order(
+                request.user,
+                pricing,
+                delivery_type=delivery_type,
+                payment_method=payment_method,
+                delivery_address=delivery_address,
+                fulfillment_store=fulfillment_store,
+                delivery_slot_id=delivery_slot_id,
+                comment=delivery_comment,
+                cashback_used=cashback_used,
             )
-            # Списываем остаток со склада
-            try:
-                product = cart_item.product
-                if product.stock_quantity is not None:
-                    product.stock_quantity = max(0, int(product.stock_quantity) - int(cart_item.quantity))
-                    product.save(update_fields=['stock_quantity'])
-            except Exception:
-                pass
-        
-        # Резервируем место в слоте и очищаем корзину
-        if selected_slot:
-            try:
-                selected_slot.reserve(1)
-            except Exception:
-                pass
-        cart_items.delete()
-        
-        # Списание кешбэка, если использован
-        logger.info("create_order cashback spending: use_cashback=%s cashback_used=%s order_id=%s", use_cashback, cashback_used, order.id)
-        if use_cashback and cashback_used > 0:
-            try:
-                from .models import CashbackTransaction
-                # Убеждаемся, что cashback_used это Decimal
-                cashback_amount = Decimal(str(cashback_used))
-                logger.info("create_order creating cashback transaction: amount=%s order_id=%s", cashback_amount, order.id)
-                if cashback_amount > 0:
-                    transaction = CashbackTransaction.objects.create(
-                        user=request.user,
-                        order=order,
-                        amount=cashback_amount,
-                        transaction_type='spent',
-                        description=f'Использование кешбэка для заказа #{order.id}'
-                    )
-                    logger.info("create_order cashback transaction created: id=%s amount=%s", transaction.id, transaction.amount)
-                    # Обновляем статистику пользователя
-                    try:
-                        request.user.total_cashback_spent = (request.user.total_cashback_spent or Decimal('0')) + cashback_amount
-                        request.user.save(update_fields=['total_cashback_spent'])
-                        logger.info("create_order user total_cashback_spent updated: %s", request.user.total_cashback_spent)
-                    except Exception as e:
-                        logger.warning("create_order failed to update user total_cashback_spent: %s", e)
-                    messages.success(request, f'Списано кешбэка: {cashback_used:.2f} ₽')
-            except Exception as e:
-                logger.exception("cashback_spend_error order=%s cashback_used=%s err=%s", order.id, cashback_used, e)
-                messages.warning(request, 'Ошибка при списании кешбэка, но заказ создан')
+        except InsufficientStockError as e:
+            messages.error(request, 
+                f'Невозможно оформить заказ:\n' + 
+                '\n'.join([f"- {p}" for p in e.unavailable])
+            )
+            return redirect('cart')
+        except OrderPlacementError as e:
+            logger.warning("create_order rejected user=%s slot=%s reason=%s", request.user.id, delivery_slot_id, e.message)
+            messages.error(request, e.message)
+            return redirect('checkout')
+        logger.info("create_order created user=%s order=%s total=%.2f final_total=%.2f cashback_used=%.2f delivery_address=%s", 
+                    request.user.id, order.id, float(order.total_amount), final_total, float(cashback_used), order.delivery_address)
+        if cashback_used > 0:
+            messages.success(request, f'Списано кешбэка: {cashback_used:.2f} ₽')
         
         # Обновляем статистику лояльности (кешбэк начислится автоматически при статусе 'delivered' через сигнал)
         try:
@@ -1584,33 +1092,50 @@ def create_order(request):
 
 from django.core.paginator import Paginator
 
+# Сортировки каталога. Последним полем идет id: порядок однозначен, и по этим же
+# ключам работает пагинация курсором (api_products) на индексах Product.Meta
+PRODUCT_SORT_ORDERINGS = {
+    'price_asc': ('price', 'id'),
+    'price_desc': ('-price', '-id'),
+    'name': ('name', 'id'),
+    'rating': ('-rating', '-id'),
+    'newest': ('-created_at', '-id'),
+    'in_stock': ('-sellable_quantity', 'name', 'id'),
+    RELEVANCE_SORT: ('-search_rank', 'name', 'id'),
+}
+DEFAULT_PRODUCT_ORDERING = ('-created_at', '-id')
+
+
+def product_ordering(sort_by, searching=False):
+    """Поля order_by для сортировки каталога; релевантность — только при поиске"""
+    if sort_by == RELEVANCE_SORT and not searching:
+        return DEFAULT_PRODUCT_ORDERING
+    return PRODUCT_SORT_ORDERINGS.get(sort_by, DEFAULT_PRODUCT_ORDERING)
+
+
 def product_list_view(request):
     category_id = request.GET.get('category')
     search_query = request.GET.get('search')
-    sort_by = request.GET.get('sort', 'name')
+    # При поиске по умолчанию сначала самые релевантные товары
+    sort_by = request.GET.get('sort') or (RELEVANCE_SORT if search_query else 'name')
+    in_stock_only = request.GET.get('in_stock') == '1'
     
     products = Product.objects.filter(is_active=True)
     
     if category_id:
         products = products.filter(category_id=category_id)
     
+    if in_stock_only:
+        products = products.filter(sellable_quantity__gt=0)
+    
     if search_query:
-        products = products.filter(
-            Q(name__icontains=search_query) | 
-            Q(description__icontains=search_query)
-        )
+        products = search_products(products, search_query)
+        # Запросы авторизованных пользователей питают подсказки поиска (product_suggest)
+        if request.user.is_authenticated and not request.GET.get('page'):
+            SearchHistory.objects.create(user=request.user, query=search_query.strip()[:200])
     
     # Сортировка
-    if sort_by == 'price_asc':
-        products = products.order_by('price')
-    elif sort_by == 'price_desc':
-        products = products.order_by('-price')
-    elif sort_by == 'name':
-        products = products.order_by('name')
-    elif sort_by == 'rating':
-        products = products.order_by('-rating')
-    elif sort_by == 'newest':
-        products = products.order_by('-created_at')
+    products = products.order_by(*product_ordering(sort_by, searching=bool(search_query)))
     
     # Пагинация
     paginator = Paginator(products, 12)  # 12 товаров на страницу
@@ -1641,6 +1166,7 @@ def product_list_view(request):
         'selected_category_obj': selected_category_obj,
         'search_query': search_query,
         'sort_by': sort_by,
+        'in_stock_only': in_stock_only,
         'product_id_to_qty': product_id_to_qty,
     }
     return render(request, 'paint_shop_project/product_list.html', context)
@@ -1740,6 +1266,48 @@ def get_reviews(request, product_id):
     
     return JsonResponse({'reviews': reviews_data})
 
+HISTORY_PAGE_SIZE = 10
+
+
+def _history_page(request, queryset, ordering):
+    """Страница истории по ?cursor=; поврежденный курсор — первая страница"""
+    paginator = KeysetPaginator(queryset, ordering, HISTORY_PAGE_SIZE)
+    try:
+        return paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        return paginator.page()
+
+
+def _cursor_url(request, cursor=None):
+    """Текущий URL с теми же фильтрами и другим курсором (без курсора — первая страница)"""
+    params = request.GET.copy()
+    params.pop('page', None)
+    params.pop('cursor', None)
+    if cursor is not None:
+        params['cursor'] = cursor
+    return f"{request.path}?{params.urlencode()}" if params else request.path
+
+
+def _history_links(request, page):
+    """Ссылки «Показать ещё» и «В начало» для шаблона partials/load_more.html"""
+    return {
+        'next_page_url': _cursor_url(request, page.next_cursor) if page.has_next() else None,
+        'first_page_url': _cursor_url(request) if request.GET.get('cursor') else None,
+    }
+
+
+def _wants_rows(request):
+    return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+
+def _load_more_response(request, page, template_name, context):
+    """Ответ кнопке «Показать ещё»: разметка следующих строк и URL следующей порции"""
+    from django.template.loader import render_to_string
+    return JsonResponse({
+        'html': render_to_string(template_name, context, request=request),
+        'next_url': _history_links(request, page)['next_page_url'],
+    })
+
 @login_required
 def order_history_view(request):
     """История заказов пользователя"""
@@ -1788,11 +1356,8 @@ def order_history_view(request):
         if search.isdigit():
             orders_qs = orders_qs.filter(id=int(search))
 
-    # Пагинация
-    from django.core.paginator import Paginator
-    paginator = Paginator(orders_qs, 10)
-    page_number = request.GET.get('page')
-    orders = paginator.get_page(page_number)
+    # Пагинация по курсору («Показать ещё»): без COUNT и OFFSET
+    orders = _history_page(request, orders_qs, ('-order_date', '-id'))
 
     # Прогресс
     status_progress = {
@@ -1806,17 +1371,25 @@ def order_history_view(request):
     for o in orders:
         setattr(o, 'progress', status_progress.get(o.status, 0))
     
-    # Статистика по отфильтрованному набору без учета пагинации
-    total_orders = orders_qs.count()
-    delivered_orders_qs = orders_qs.filter(status='delivered')
-    delivered_orders_count = delivered_orders_qs.count()
-    delivered_total_spent = delivered_orders_qs.aggregate(total=Sum('final_amount'))['total'] or 0
+    if _wants_rows(request):
+        return _load_more_response(request, orders, 'paint_shop_project/partials/order_history_rows.html', {'orders': orders})
+    
+    # Статистика по отфильтрованному набору без учета пагинации, одним запросом
+    stats = orders_qs.order_by().aggregate(
+        total_orders=Count('id'),
+        delivered_orders_count=Count('id', filter=Q(status='delivered')),
+        delivered_total_spent=Sum('final_amount', filter=Q(status='delivered')),
+    )
+    total_orders = stats['total_orders']
+    delivered_orders_count = stats['delivered_orders_count']
+    delivered_total_spent = stats['delivered_total_spent'] or 0
     average_spent = 0
     if delivered_orders_count:
         average_spent = delivered_total_spent / delivered_orders_count
     
     context = {
         'orders': orders,
+        **_history_links(request, orders),
         'total_orders': total_orders,
         'total_spent': delivered_total_spent,
         'delivered_orders_count': delivered_orders_count,
@@ -2020,9 +1593,7 @@ def profile_view(request):
     except Exception:
         loyalty_level = ""
     try:
-        total_cashback_earned = getattr(user, 'total_cashback_earned', 0) or 0
-        total_cashback_spent = getattr(user, 'total_cashback_spent', 0) or 0
-        cashback_balance = total_cashback_earned - total_cashback_spent
+        cashback_balance = get_cashback_balance(user)
     except Exception:
         cashback_balance = 0
     
@@ -2289,6 +1860,7 @@ def mark_all_notifications_read(request):
     return JsonResponse({'status': 'all_read'})
 
 @login_required
+@replica_reads
 def analytics_view(request):
     """Страница аналитики (только для администраторов)"""
     if not request.user.is_staff:
@@ -2297,26 +1869,40 @@ def analytics_view(request):
     # Общая статистика
     total_users = User.objects.count()
     total_products = Product.objects.count()
-    total_orders = Order.objects.count()
-    total_revenue = Order.objects.aggregate(total=models.Sum('total_amount'))['total'] or 0
+    
+    # Заказы и суммы — из дневных агрегатов продаж
+    from datetime import timedelta
+    from .models import DailyCategorySalesRollup
+    from .sales_rollups import period_start, sales_totals
+    totals = sales_totals()
+    total_orders = totals['orders_count']
+    total_revenue = totals['orders_revenue']
     
     # Статистика за последние 30 дней
-    from datetime import datetime, timedelta
     thirty_days_ago = timezone.now() - timedelta(days=30)
     
-    recent_orders = Order.objects.filter(order_date__gte=thirty_days_ago)
-    recent_revenue = recent_orders.aggregate(total=models.Sum('total_amount'))['total'] or 0
+    recent_revenue = sales_totals(period_start(30))['orders_revenue']
     recent_users = User.objects.filter(date_joined__gte=thirty_days_ago).count()
     
-    # Популярные товары
-    popular_products = Product.objects.annotate(
-        order_count=models.Count('orderitem__order')
-    ).order_by('-order_count')[:10]
+    # Популярные товары (по числу доставленных заказов)
+    popular_products = (
+        Product.objects.select_related('category')
+        .annotate(order_count=models.Sum('daily_sales__orders_count'))
+        .filter(order_count__gt=0)
+        .order_by('-order_count')[:10]
+    )
     
     # Популярные категории
+    category_orders = (
+        DailyCategorySalesRollup.objects.filter(category=models.OuterRef('pk'))
+        .order_by()
+        .values('category')
+        .annotate(total=models.Sum('orders_count'))
+        .values('total')
+    )
     popular_categories = Category.objects.annotate(
-        product_count=models.Count('product'),
-        order_count=models.Count('product__orderitem__order')
+        product_count=models.Count('products', distinct=True),
+        order_count=Coalesce(models.Subquery(category_orders), 0),
     ).order_by('-order_count')[:10]
     
     # Статистика по статусам заказов
@@ -2353,37 +1939,55 @@ def api_products(request):
     if category_id:
         products = products.filter(category_id=category_id)
     
+    # Только товары, доступные к продаже
+    if request.GET.get('in_stock') == '1':
+        products = products.filter(sellable_quantity__gt=0)
+    
     # Поиск
     search = request.GET.get('search')
     if search:
-        products = products.filter(
-            Q(name__icontains=search) | 
-            Q(description__icontains=search)
-        )
+        products = search_products(products, search)
     
-    # Пагинация
-    from django.core.paginator import Paginator
-    page = request.GET.get('page', 1)
-    paginator = Paginator(products, 20)
-    products_page = paginator.get_page(page)
+    ordering = product_ordering(request.GET.get('sort'), searching=bool(search))
+    
+    def serialize(product):
+        return {
+            'id': product.id,
+            'name': product.name,
+            'price': float(product.price),
+            'old_price': float(product.old_price) if product.old_price else None,
+            'image': product.image.url if product.image else None,
+            'category': product.category.name,
+            'manufacturer': product.manufacturer.name if product.manufacturer else None,
+            'rating': float(product.rating),
+            'in_stock': product.is_in_stock,
+            'sellable_quantity': product.sellable_quantity,
+        }
+    
+    # Старый режим со страницами по номеру (COUNT + OFFSET) — только для клиентов,
+    # которые явно передают ?page=
+    if request.GET.get('page'):
+        from django.core.paginator import Paginator
+        paginator = Paginator(products.order_by(*ordering), 20)
+        products_page = paginator.get_page(request.GET.get('page'))
+        return JsonResponse({
+            'products': [serialize(product) for product in products_page],
+            'total_pages': paginator.num_pages,
+            'current_page': products_page.number,
+            'has_next': products_page.has_next(),
+            'has_previous': products_page.has_previous(),
+        })
+    
+    # Пагинация по курсору: ?cursor= из next_cursor/previous_cursor предыдущего ответа
+    try:
+        products_page = KeysetPaginator(products, ordering, 20).page(request.GET.get('cursor'))
+    except InvalidCursor:
+        return JsonResponse({'error': 'Некорректный курсор'}, status=400)
     
     data = {
-        'products': [
-            {
-                'id': product.id,
-                'name': product.name,
-                'price': float(product.price),
-                'old_price': float(product.old_price) if product.old_price else None,
-                'image': product.image.url if product.image else None,
-                'category': product.category.name,
-                'manufacturer': product.manufacturer.name if product.manufacturer else None,
-                'rating': float(product.rating),
-                'in_stock': product.is_in_stock,
-            }
-            for product in products_page
-        ],
-        'total_pages': paginator.num_pages,
-        'current_page': products_page.number,
+        'products': [serialize(product) for product in products_page],
+        'next_cursor': products_page.next_cursor,
+        'previous_cursor': products_page.previous_cursor,
         'has_next': products_page.has_next(),
         'has_previous': products_page.has_previous(),
     }
@@ -2399,7 +2003,7 @@ def api_root(request):
             'path': '/api/products/',
             'method': 'GET',
             'url': f"{base}/api/products/",
-            'desc': 'Фильтры: ?category=<id>, ?search=<text>'
+            'desc': 'Фильтры: ?category=<id>, ?search=<text>, ?in_stock=1; сортировка: ?sort=price_asc|price_desc|name|rating|newest|in_stock|relevance; страницы: ?cursor=<next_cursor>'
         },
         {
             'name': 'Список категорий',
@@ -2420,7 +2024,7 @@ def api_root(request):
             'path': '/api/user/orders/',
             'method': 'GET',
             'url': f"{base}/api/user/orders/",
-            'desc': 'Требуется авторизация'
+            'desc': 'Требуется авторизация; страницы: ?cursor=<next_cursor>'
         },
         {
             'name': 'Избранное пользователя',
@@ -2559,7 +2163,9 @@ def api_schema(request):
                     'parameters': [
                         {'name': 'category', 'in': 'query', 'schema': {'type': 'integer'}, 'example': 1, 'description': 'ID категории'},
                         {'name': 'search', 'in': 'query', 'schema': {'type': 'string'}, 'example': 'молоко', 'description': 'Поиск по названию/описанию'},
-                        {'name': 'page', 'in': 'query', 'schema': {'type': 'integer', 'default': 1}},
+                        {'name': 'sort', 'in': 'query', 'schema': {'type': 'string', 'enum': ['price_asc', 'price_desc', 'name', 'rating', 'newest', 'in_stock', 'relevance']}},
+                        {'name': 'cursor', 'in': 'query', 'schema': {'type': 'string'}, 'description': 'next_cursor или previous_cursor из предыдущего ответа'},
+                        {'name': 'page', 'in': 'query', 'schema': {'type': 'integer'}, 'description': 'Устаревший режим с номером страницы (total_pages вместо курсоров)'},
                     ],
                     'responses': {
                         '200': {
@@ -2570,9 +2176,9 @@ def api_schema(request):
                                         'default': {
                                             'value': {
                                                 'products': [{'$ref': '#/components/schemas/Product'}],
-                                                'total_pages': 1,
-                                                'current_page': 1,
-                                                'has_next': False,
+                                                'next_cursor': 'eyJrIjpbIjIwMjYtMTAtMTdUMTI6MDA6MDArMDM6MDAiLDQyXX0',
+                                                'previous_cursor': None,
+                                                'has_next': True,
                                                 'has_previous': False
                                             }
                                         }
@@ -2626,6 +2232,9 @@ def api_schema(request):
             '/api/user/orders/': {
                 'get': {
                     'summary': 'Заказы пользователя (auth)',
+                    'parameters': [
+                        {'name': 'cursor', 'in': 'query', 'schema': {'type': 'string'}, 'description': 'next_cursor из предыдущего ответа'},
+                    ],
                     'responses': {
                         '200': {
                             'description': 'OK',
@@ -2634,7 +2243,9 @@ def api_schema(request):
                                     'examples': {
                                         'default': {
                                             'value': {
-                                                'orders': [{'$ref': '#/components/schemas/Order'}]
+                                                'orders': [{'$ref': '#/components/schemas/Order'}],
+                                                'next_cursor': None,
+                                                'has_next': False
                                             }
                                         }
                                     }
@@ -2786,8 +2397,12 @@ def api_product_detail(request, product_id):
 
 @login_required
 def api_user_orders(request):
-    """API: Заказы пользователя"""
-    orders = Order.objects.filter(user=request.user).order_by('-order_date')
+    """API: Заказы пользователя (страницы по курсору, новые сначала)"""
+    orders = Order.objects.filter(user=request.user).prefetch_related('items__product')
+    try:
+        orders_page = KeysetPaginator(orders, ('-order_date', '-id'), 20).page(request.GET.get('cursor'))
+    except InvalidCursor:
+        return JsonResponse({'error': 'Некорректный курсор'}, status=400)
     
     data = {
         'orders': [
@@ -2809,8 +2424,12 @@ def api_user_orders(request):
                     for item in order.items.all()
                 ]
             }
-            for order in orders
-        ]
+            for order in orders_page
+        ],
+        'next_cursor': orders_page.next_cursor,
+        'previous_cursor': orders_page.previous_cursor,
+        'has_next': orders_page.has_next(),
+        'has_previous': orders_page.has_previous(),
     }
     
     return JsonResponse(data)
@@ -2947,27 +2566,22 @@ def cashback_history_view(request):
         except Exception:
             pass
 
-    # Пагинация
-    from django.core.paginator import Paginator
-    paginator = Paginator(transactions_qs, 10)
-    page_number = request.GET.get('page')
-    transactions = paginator.get_page(page_number)
-    
-    # Статистика
-    total_earned = CashbackTransaction.objects.filter(
-        user=user, 
-        transaction_type='earned'
-    ).aggregate(total=Sum('amount'))['total'] or 0
-    
-    total_spent = CashbackTransaction.objects.filter(
-        user=user, 
-        transaction_type='spent'
-    ).aggregate(total=Sum('amount'))['total'] or 0
+    # Пагинация по курсору («Показать ещё»): без COUNT и OFFSET
+    transactions = _history_page(request, transactions_qs, ('-created_at', '-id'))
+    if _wants_rows(request):
+        return _load_more_response(
+            request, transactions, 'paint_shop_project/partials/cashback_history_rows.html', {'transactions': transactions},
+        )
     
-    current_balance = total_earned - total_spent
+    # Статистика: одна строка баланса вместо суммирования журнала
+    summary = get_cashback_summary(user)
+    total_earned = summary.total_earned
+    total_spent = summary.total_spent
+    current_balance = summary.balance
     
     context = {
         'transactions': transactions,
+        **_history_links(request, transactions),
         'total_earned': total_earned,
         'total_spent': total_spent,
         'current_balance': current_balance,
@@ -3111,7 +2725,7 @@ def enhanced_profile_view(request):
     # Кешбэк статистика
     total_cashback_earned = user.total_cashback_earned
     total_cashback_spent = user.total_cashback_spent
-    current_cashback = total_cashback_earned - total_cashback_spent
+    current_cashback = get_cashback_balance(user)
     
     # Любимые категории
     favorite_categories = FavoriteCategory.objects.filter(user=user).select_related('category')
@@ -3306,19 +2920,18 @@ def _create_order_after_payment(request, payment_id, transaction_id, amount, car
     if not request.user.is_authenticated:
         return None
     from decimal import Decimal
-    from django.utils import timezone
-    from .models import (
-        Cart, Order, OrderItem, ProductBatch, OrderPicking, OrderDelivery, 
-        UserAddress, UserPromotion, CashbackTransaction, Payment, PaymentMethod,
-        Store, Promotion, PromoCode
-    )
+    from .models import UserAddress, Payment, PaymentMethod, Store
     
-    cart_items = Cart.objects.filter(user=request.user)
-    if not cart_items.exists():
+    delivery_type = request.POST.get('delivery_type', 'pickup')
+    pricing = price_cart(
+        request.user,
+        promo_code=request.POST.get('promo_code') or None,
+        promotion_id=request.POST.get('promotion_id') or None,
+        delivery_type=delivery_type,
+    )
+    if pricing.is_empty:
         return None
     
-    subtotal = sum(item.total_price for item in cart_items)
-    delivery_type = request.POST.get('delivery_type', 'pickup')
     payment_method = payment_method_override or request.POST.get('payment_method', 'online')
     saved_payment_id = None
     
@@ -3344,95 +2957,14 @@ def _create_order_after_payment(request, payment_id, transaction_id, amount, car
     fulfillment_store_id = request.POST.get('fulfillment_store_id')
     delivery_slot_id = request.POST.get('delivery_slot_id')
     
-    FREE_DELIVERY_THRESHOLD = 5000
-    
-    # Скидка по любимым категориям
-    favorite_discount_amount = 0.0
-    try:
-        for item in cart_items:
-            discount_percent = 0
-            if hasattr(request.user, 'get_favorite_categories_discount'):
-                discount_percent = request.user.get_favorite_categories_discount(item.product.category)
-            if discount_percent and discount_percent > 0:
-                favorite_discount_amount += float(item.total_price) * float(discount_percent) / 100.0
-    except Exception:
-        favorite_discount_amount = 0.0
-    favorite_discount_amount = round(favorite_discount_amount, 2)
-    
-    # Скидка 10% на любимые товары (максимум 4)
-    favorite_products_discount = 0.0
-    try:
-        from .models import Favorite
-        user_favorite_product_ids = set(Favorite.objects.filter(user=request.user).values_list('product_id', flat=True))
-        for item in cart_items:
-            if item.product.id in user_favorite_product_ids:
-                # Скидка 10% на любимые товары
-                favorite_products_discount += float(item.total_price) * 0.10
-    except Exception:
-        favorite_products_discount = 0.0
-    favorite_products_discount = round(favorite_products_discount, 2)
-    
-    # Промокод/акции (та же логика что в create_order)
-    active_promotions = Promotion.objects.filter(is_active=True, start_date__lte=timezone.now(), end_date__gte=timezone.now())
-    promotion_discount = 0.0
-    applied_promotion = None
-    applied_promo_code = None
-    base_for_promo = max(float(subtotal) - favorite_discount_amount - favorite_products_discount, 0.0)
-    promo_code_value = request.POST.get('promo_code') or None
-    
-    if promo_code_value:
-        try:
-            promo_code_obj = PromoCode.objects.get(code=promo_code_value)
-            if promo_code_obj.is_valid() and base_for_promo >= float(promo_code_obj.min_order_amount):
-                if promo_code_obj.discount_type == 'percent':
-                    promotion_discount = float(base_for_promo) * float(promo_code_obj.discount_value) / 100.0
-                else:
-                    promotion_discount = min(float(promo_code_obj.discount_value), float(base_for_promo))
-                applied_promo_code = promo_code_obj
-                try:
-                    promo_code_obj.used_count = (promo_code_obj.used_count or 0) + 1
-                    promo_code_obj.save(update_fields=['used_count'])
-                except Exception:
-                    pass
-        except PromoCode.DoesNotExist:
-            pass
-    
-    for promo in active_promotions:
-        try:
-            disc = float(promo.calculate_discount(base_for_promo))
-            if disc > promotion_discount and not applied_promo_code:
-                promotion_discount = disc
-                applied_promotion = promo
-        except Exception:
-            pass
-    
-    total_without_delivery = max(base_for_promo - promotion_discount, 0.0)
-    
-    # Расчет стоимости доставки
-    if delivery_type == 'delivery':
-        if total_without_delivery >= FREE_DELIVERY_THRESHOLD:
-            delivery_cost = 0
-        else:
-            delivery_cost = 200
-    else:
-        delivery_cost = 0
-    
-    final_total = total_without_delivery + float(delivery_cost)
+    final_total = float(pricing.total)
     
     # Обработка использования кешбэка (чекбокс, не способ оплаты)
     cashback_used = Decimal('0')
     use_cashback = request.POST.get('use_cashback') == 'on'
     if use_cashback:
         try:
-            total_earned = CashbackTransaction.objects.filter(
-                user=request.user, 
-                transaction_type='earned'
-            ).aggregate(total=models.Sum('amount'))['total'] or 0
-            total_spent = CashbackTransaction.objects.filter(
-                user=request.user, 
-                transaction_type='spent'
-            ).aggregate(total=models.Sum('amount'))['total'] or 0
-            cashback_balance = Decimal(str(total_earned - total_spent))
+            cashback_balance = get_cashback_balance(request.user)
             
             if cashback_balance > 0:
                 # Получаем сумму кешбэка из формы
@@ -3461,22 +2993,13 @@ def _create_order_after_payment(request, payment_id, transaction_id, amount, car
         except Exception as e:
             logger.exception("cashback_payment_error in _create_order_after_payment: %s", e)
     
-    # Определяем магазин и слот
+    # Определяем магазин (слот доставки бронируется при оформлении заказа)
     fulfillment_store = None
-    selected_slot = None
     if fulfillment_store_id:
         try:
             fulfillment_store = Store.objects.get(id=int(fulfillment_store_id))
         except Exception:
             pass
-    if delivery_type == 'delivery' and delivery_slot_id:
-        from .models import DeliverySlot
-        try:
-            selected_slot = DeliverySlot.objects.select_for_update().get(id=int(delivery_slot_id))
-            if not selected_slot.available:
-                return None
-        except DeliverySlot.DoesNotExist:
-            return None
     
     # Адрес доставки
     if delivery_type == 'delivery':
@@ -3511,76 +3034,42 @@ def _create_order_after_payment(request, payment_id, transaction_id, amount, car
     else:
         delivery_address = ''
     
-    # Проверка доступности товаров (упрощённая версия)
-    today = timezone.now().date()
-    unavailable_products = []
-    
-    for cart_item in cart_items.select_related('product'):
-        product = cart_item.product
-        if product.has_expiry_date:
-            available_batches = ProductBatch.objects.filter(
-                product=product,
-                expiry_date__gte=today,
-                remaining_quantity__gte=cart_item.quantity
+    # Создаем заказ в одной транзакции с платежом
+    # (в total_amount сохраняется исходная сумма до списания кешбэка — для расчета лояльности)
+    order_total = pricing.total
+    try:
+        with transaction.atomic():
+            order = place_order(
+                request.user,
+                pricing,
+                delivery_type=delivery_type,
+                payment_method=payment_method,
+                delivery_address=delivery_address,
+                fulfillment_store=fulfillment_store,
+                delivery_slot_id=delivery_slot_id,
+                comment=delivery_comment,
+                cashback_used=cashback_used,
+                status='confirmed',  # Заказ сразу подтверждён после оплаты
             )
-            sellable_batches = [b for b in available_batches if b.is_sellable(min_percent=70)]
-            if not sellable_batches:
-                all_batches = ProductBatch.objects.filter(product=product)
-                if all_batches.exists():
-                    unavailable_products.append(f"{product.name} (нет доступных партий)")
-                else:
-                    if product.stock_quantity is not None and product.stock_quantity < cart_item.quantity:
-                        unavailable_products.append(f"{product.name} (недостаточно на складе)")
-            else:
-                total_available = sum(b.remaining_quantity for b in sellable_batches)
-                if total_available < cart_item.quantity:
-                    unavailable_products.append(f"{product.name} (недостаточно в партиях)")
-        else:
-            if product.stock_quantity is not None and product.stock_quantity < cart_item.quantity:
-                unavailable_products.append(f"{product.name} (недостаточно на складе)")
-    
-    if unavailable_products:
+            
+            # Создаем запись о платеже
+            # Нормализуем payment_method для Payment модели (Payment использует те же choices что Order)
+            payment_method_for_payment = payment_method
+            if payment_method not in ['online', 'card', 'cash']:
+                # Если это СБП или другой метод, сохраняем как 'online' для совместимости
+                payment_method_for_payment = 'online' if payment_method == 'sbp' else 'online'
+    
+            Payment.objects.create(
+                order=order,
+                amount=Decimal(str(final_total)),
+                payment_method=payment_method_for_payment,
+                status='success',
+                transaction_id=transaction_id,
+            )
+    except OrderPlacementError as e:
+        logger.warning("_create_order_after_payment rejected user=%s payment=%s reason=%s", request.user.id, payment_id, e.message)
         return None
     
-    # Создаем заказ
-    # Сохраняем исходную сумму заказа (до списания кешбэка) для расчета лояльности
-    order_total = final_total
-    if use_cashback and cashback_used > 0:
-        # Восстанавливаем исходную сумму заказа (до списания кешбэка)
-        order_total = float(Decimal(str(final_total)) + Decimal(str(cashback_used)))
-    
-    order = Order.objects.create(
-        user=request.user,
-        delivery_type=delivery_type,
-        delivery_address=delivery_address,
-        total_amount=order_total,
-        payment_method=payment_method,
-        favorite_discount_amount=favorite_discount_amount,
-        promotion_discount=promotion_discount,
-        delivery_cost=delivery_cost,
-        fulfillment_store=fulfillment_store,
-        delivery_slot=selected_slot,
-        comment=delivery_comment,
-        status='confirmed',  # Заказ сразу подтверждён после оплаты
-        cashback_used=cashback_used,
-        amount_due=Decimal(str(final_total))
-    )
-    
-    # Создаем запись о платеже
-    # Нормализуем payment_method для Payment модели (Payment использует те же choices что Order)
-    payment_method_for_payment = payment_method
-    if payment_method not in ['online', 'card', 'cash']:
-        # Если это СБП или другой метод, сохраняем как 'online' для совместимости
-        payment_method_for_payment = 'online' if payment_method == 'sbp' else 'online'
-    
-    Payment.objects.create(
-        order=order,
-        amount=Decimal(str(final_total)),
-        payment_method=payment_method_for_payment,
-        status='success',
-        transaction_id=transaction_id,
-    )
-    
     # Автоматическое сохранение карты
     if card_number and card_expiry and card_holder and request.POST.get('save_card') == 'on':
         try:
@@ -3610,69 +3099,6 @@ def _create_order_after_payment(request, payment_id, transaction_id, amount, car
         except Exception as e:
             logger.exception("save_card_error: %s", e)
     
-    # Создаем записи о сборке и доставке
-    OrderPicking.objects.create(order=order, status='pending')
-    if delivery_type == 'delivery':
-        OrderDelivery.objects.create(order=order, status='pending')
-    
-    # Записываем использованную акцию
-    if applied_promotion and promotion_discount > 0:
-        try:
-            UserPromotion.objects.create(
-                user=request.user,
-                promotion=applied_promotion,
-                order=order,
-                discount_amount=promotion_discount,
-            )
-        except Exception:
-            pass
-    
-    # Создаем позиции заказа
-    for cart_item in cart_items.select_related('product'):
-        OrderItem.objects.create(
-            order=order,
-            product=cart_item.product,
-            quantity=cart_item.quantity,
-            price_per_unit=cart_item.product.price
-        )
-        try:
-            product = cart_item.product
-            if product.stock_quantity is not None:
-                product.stock_quantity = max(0, int(product.stock_quantity) - int(cart_item.quantity))
-                product.save(update_fields=['stock_quantity'])
-        except Exception:
-            pass
-    
-    # Резервируем место в слоте и очищаем корзину
-    if selected_slot:
-        try:
-            selected_slot.reserve(1)
-        except Exception:
-            pass
-    cart_items.delete()
-    
-    # Списание кешбэка, если использован
-    if use_cashback and cashback_used > 0:
-        try:
-            # Убеждаемся, что cashback_used это Decimal
-            cashback_amount = Decimal(str(cashback_used))
-            if cashback_amount > 0:
-                CashbackTransaction.objects.create(
-                    user=request.user,
-                    order=order,
-                    amount=cashback_amount,
-                    transaction_type='spent',
-                    description=f'Использование кешбэка для заказа #{order.id}'
-                )
-                # Обновляем статистику пользователя
-                try:
-                    request.user.total_cashback_spent = (request.user.total_cashback_spent or Decimal('0')) + cashback_amount
-                    request.user.save(update_fields=['total_cashback_spent'])
-                except Exception:
-                    pass
-        except Exception as e:
-            logger.exception("cashback_spend_error in _create_order_after_payment order=%s cashback_used=%s err=%s", order.id, cashback_used, e)
-    
     # Начисляем кешбэк (логика из loyalty_signals.py сработает при статусе 'delivered')
     try:
         loyalty_card = request.user.loyalty_card